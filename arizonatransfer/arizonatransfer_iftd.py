@@ -178,7 +178,6 @@ def retrieve_files(host, filelist, destdir='.', indicator=None, nestmode=False):
          proto_list = ["iftcache_receiver"]
       
          cache_connect_args[ protocols.iftcache.IFTCACHE_MAX_AGE ] = 10 * 24 * 3600 * 365    # ~10 years
-         cache_connect_args[ protocols.iftcache.IFTCACHE_SQUID_PORTNUM ] = 31128  # specific to our installation
          cache_connect_args[ protocols.iftcache.IFTCACHE_USER_TIMEOUT ] = iftd_user_timeout
          cache_connect_args[ protocols.iftcache.IFTCACHE_REMOTE_IFTD_PORT ] = iftd_remote_port
          cache_connect_args[ protocols.iftcache.IFTCACHE_REMOTE_RPC_DIR ] = iftd_rpc_dir
@@ -223,7 +222,7 @@ def retrieve_files(host, filelist, destdir='.', indicator=None, nestmode=False):
       proto_args_dict = {}
 
       if nestmode:
-         # nest needs squid details; client does not
+         # nest reads through iftd's disk cache; client does not
          proto_args_dict[ "iftcache_receiver" ] = cache_connect_args
 
       rc = -1
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  asking for one chunk per request versus runs of chunks sized by iftreceiver.chunk_scheduler.
+=============
+Purpose:
+    To measure how much receive throughput is gained by asking a protocol for a run of contiguous chunks
+    per request, sized from the measured bandwidth-delay product, instead of one chunk per request.
+
+Setup:
+    A server thread on the loopback interface serves byte ranges of a file of random noise.  Each request
+    is "<first chunk> <number of chunks>\n", and the server waits a fixed delay before answering to stand
+    in for a network round trip.  The client receives the file the way iftreceiver does:  it gets the next
+    unreceived chunks from an iftfile, reserves them, asks for them, and locks, writes, and unlocks each one.
+    It does this twice per delay:
+       * per-chunk:  one chunk per request (what iftreceiver used to do).
+       * batched:    chunk_scheduler.run_length() contiguous chunks per request.
+    Each run reports MB/s, the number of requests made, and the scheduler's final run length, fitted
+    bandwidth, and fitted delay.  Writes go through iftfile, so they include hashing the received data.
+
+Expected result:
+    Per-chunk throughput is bounded by one chunk per round trip, and falls as the delay grows.  Batched
+    throughput stays close to what the client can write, since the scheduler grows the run until the
+    round trip is a small part of each request.
+
+Usage:
+    bench_chunk_runs.py [file size in MB] [chunk size in KB] [delay in ms ...]
+"""
+
+import sys
+import os
+import time
+import socket
+import threading
+
+sys.path.append( "../" )
+
+import iftfile
+import iftcore
+from iftcore import *
+from iftcore.iftreceiver import chunk_scheduler
+
+
+def serve( listen_soc, data, chunksize, delay ):
+   soc, addr = listen_soc.accept()
+   f = soc.makefile( "r" )
+   while True:
+      line = f.readline()
+      if len(line) == 0:
+         break
+
+      start, count = [int(x) for x in line.split()]
+      if delay > 0:
+         time.sleep( delay )
+
+      soc.sendall( data[start * chunksize : (start + count) * chunksize] )
+
+   f.close()
+   soc.close()
+
+
+def recv_exactly( soc, length ):
+   parts = []
+   while length > 0:
+      part = soc.recv( min( length, 1024 * 1024 ) )
+      if len(part) == 0:
+         raise Exception("connection closed")
+      parts.append( part )
+      length -= len(part)
+
+   return "".join( parts )
+
+
+def receive( path, data, chunksize, delay, batched ):
+   listen_soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+   listen_soc.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+   listen_soc.bind( ("127.0.0.1", 0) )
+   listen_soc.listen( 1 )
+   server = threading.Thread( target=serve, args=(listen_soc, data, chunksize, delay) )
+   server.start()
+
+   soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+   soc.connect( listen_soc.getsockname() )
+   soc.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+
+   file_attrs = {
+      iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+      iftfile.JOB_ATTR_FILE_SIZE:len(data)
+   }
+
+   if os.path.exists( path ):
+      os.remove( path )
+
+   ift_file = iftfile.iftfile( path )
+   ift_file.fopen( file_attrs, iftfile.MODE_WRITE )
+
+   owner = "bench"
+   scheduler = chunk_scheduler( chunksize )
+   num_requests = 0
+
+   start = time.time()
+   while not ift_file.is_complete():
+      count = 1
+      if batched:
+         count = scheduler.run_length()
+
+      chunk_ids = ift_file.next_unwritten_chunks( count, True )
+      reserve_time = scheduler.reservation_time( 1.0 )
+      for chunk_id in chunk_ids:
+         ift_file.reserve_chunk( owner, chunk_id, reserve_time )
+
+      first = chunk_ids[0]
+      num_bytes = min( len(chunk_ids) * chunksize, len(data) - first * chunksize )
+
+      stime = time.time()
+      soc.sendall( "%d %d\n" % (first, len(chunk_ids)) )
+      received = recv_exactly( soc, num_bytes )
+      etime = time.time()
+      num_requests += 1
+
+      scheduler.record( len(chunk_ids), num_bytes, etime - stime )
+
+      for i in xrange(0, len(chunk_ids)):
+         ift_file.lock_chunk( owner, chunk_ids[i], True )
+         ift_file.set_chunk( received[i * chunksize : (i+1) * chunksize], chunk_ids[i] )
+         ift_file.unlock_chunk( owner, chunk_ids[i] )
+
+   elapsed = time.time() - start
+   correct = (ift_file.calc_hash() == iftfile.get_hash( path ))
+   ift_file.fclose()
+
+   soc.close()
+   server.join()
+   listen_soc.close()
+
+   fd = open( path, "rb" )
+   correct = correct and fd.read() == data
+   fd.close()
+   os.remove( path )
+
+   bandwidth = "-"
+   if scheduler.bandwidth != None:
+      bandwidth = "%.1f MB/s" % (scheduler.bandwidth / (1024.0 * 1024.0))
+
+   rtt = "-"
+   if scheduler.delay != None:
+      rtt = "%.2f ms" % (scheduler.delay * 1000.0)
+
+   name = "per-chunk"
+   run = "-"
+   if batched:
+      name = "batched"
+      run = str(scheduler.run_length())
+
+   print "%-10s delay=%5.1f ms %8.2f MB/s %7d requests   run=%-5s fitted bandwidth=%-12s delay=%-10s correct=%s" % (name, delay * 1000.0, len(data) / elapsed / (1024.0 * 1024.0), num_requests, run, bandwidth, rtt, correct)
+
+
+if __name__ == "__main__":
+   size_mb = 32
+   chunk_kb = 64
+   delays = [0.0, 1.0, 5.0]
+
+   if len(sys.argv) > 1:
+      size_mb = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      chunk_kb = int(sys.argv[2])
+   if len(sys.argv) > 3:
+      delays = [float(d) for d in sys.argv[3:]]
+
+   chunksize = chunk_kb * 1024
+   data = os.urandom( size_mb * 1024 * 1024 )
+   path = "/tmp/bench_chunk_runs.dat"
+
+   print str(size_mb) + " MB in chunks of " + str(chunk_kb) + " KB over loopback"
+   for delay in delays:
+      receive( path, data, chunksize, delay / 1000.0, False )
+      receive( path, data, chunksize, delay / 1000.0, True )
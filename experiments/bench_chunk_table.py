@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  receiver chunk bookkeeping as the number of chunks grows.
+=============
+Purpose:
+    To measure the cost per chunk of keeping track of which chunks of a file being received are written,
+    reserved, and locked, for files of 1 thousand to 10 million chunks.
+
+Setup:
+    One receiver takes a file from start to finish the way iftreceiver does:  for each chunk, it finds
+    the next unreceived chunk, reserves it, locks it, marks it written, unlocks it, and asks whether the
+    file is complete.  No data is written; only the bookkeeping is timed.  Two implementations are compared:
+       * legacy:       what iftfile used to do--parallel Python lists of written flags, reservation times,
+                       owners, and locks, scanned in full to find the next chunk and to check completion.
+       * chunk_table:  iftchunks.chunk_table (bitmap, counter, cursor, expiry heap, striped locks).
+    The legacy lists are quadratic overall, so they are only run up to a cap (10 thousand chunks by default).
+    Each run reports the total time, the time per chunk, and the memory the table takes up front.
+
+Expected result:
+    The time per chunk stays about the same for chunk_table from 1 thousand to 10 million chunks, while the
+    legacy time per chunk grows with the number of chunks.  The chunk_table bitmap takes one byte per
+    eight chunks, where the legacy lists take four pointers per chunk.
+
+Usage:
+    bench_chunk_table.py [largest number of chunks] [largest number of chunks for the legacy lists]
+"""
+
+import sys
+import time
+import threading
+
+sys.path.append( "../" )
+
+import iftchunks
+
+
+class legacy_table:
+   """
+   The lists iftfile used to keep, and the scans it used to do over them.
+   """
+   def __init__( self, num_chunks ):
+      self.mask = [False] * num_chunks
+      self.locks = [threading.BoundedSemaphore(1)] * num_chunks
+      self.reservations = [0] * num_chunks
+      self.owners = [None] * num_chunks
+
+   def next_free( self ):
+      now = time.time()
+      for i in xrange(0, len(self.mask)):
+         if self.reservations[i] >= now:
+            continue
+         if self.mask[i] == False:
+            return [i]
+      return []
+
+   def is_complete( self ):
+      for chunk in self.mask:
+         if chunk == False:
+            return False
+      return True
+
+
+def run_legacy( num_chunks ):
+   owner = "bench"
+   table = legacy_table( num_chunks )
+   while True:
+      free = table.next_free()
+      if len(free) == 0:
+         break
+
+      i = free[0]
+      if table.reservations[i] >= time.time() and table.owners[i] != None:
+         continue
+
+      table.reservations[i] = time.time() + 60
+      table.owners[i] = owner
+
+      table.locks[i].acquire()
+      table.mask[i] = True
+      table.reservations[i] = 0
+      table.owners[i] = None
+      table.locks[i].release()
+
+      table.is_complete()
+
+
+def run_chunk_table( num_chunks ):
+   owner = "bench"
+   table = iftchunks.chunk_table( num_chunks )
+   while True:
+      now = time.time()
+      free = table.next_free( now, 1 )
+      if len(free) == 0:
+         break
+
+      i = free[0]
+      if not table.reserve( i, owner, now + 60, now ):
+         continue
+
+      table.lock( i, owner )
+      table.mark_written( i )
+      table.unlock( i, owner )
+
+      table.is_complete()
+
+
+def run( name, func, num_chunks, table_bytes ):
+   start = time.time()
+   func( num_chunks )
+   elapsed = time.time() - start
+
+   print "%-12s %10d chunks %10.2f s %8.2f us/chunk %12d bytes" % (name, num_chunks, elapsed, elapsed * 1000000.0 / num_chunks, table_bytes)
+
+
+if __name__ == "__main__":
+   max_chunks = 10000000
+   max_legacy_chunks = 10000
+
+   if len(sys.argv) > 1:
+      max_chunks = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      max_legacy_chunks = int(sys.argv[2])
+
+   pointer_size = len(repr(sys.maxint)) > 10 and 8 or 4
+
+   num_chunks = 1000
+   while num_chunks <= max_chunks:
+      if num_chunks <= max_legacy_chunks:
+         run( "legacy", run_legacy, num_chunks, 4 * pointer_size * num_chunks )
+
+      run( "chunk_table", run_chunk_table, num_chunks, (num_chunks + 7) / 8 )
+      num_chunks *= 10
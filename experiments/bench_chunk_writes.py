@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  receiver write path with chunks arriving in random order.
+=============
+Purpose:
+    To measure how fast an iftfile being received can store chunks that arrive out of order, and to check
+    that the reconstructed file is correct.
+
+Setup:
+    A file of random noise is split into chunks, and the chunks are stored in a random order.  Two write paths
+    are compared:
+       * legacy:  what iftfile.set_chunk used to do--open the file with "ab", seek, write, close--per chunk.
+       * iftfile: iftfile.set_chunk through the file's persistent descriptor, with positional writes into a
+                  preallocated file, with and without fsync batching (JOB_ATTR_FSYNC_CHUNKS).
+    Each run includes computing the received file's SHA-1 for verification, since the iftfile path hashes
+    chunks as they are written and the legacy path read the whole file back afterwards.  Each run reports
+    MB/s and whether the file's SHA-1 matches the original.
+
+Expected result:
+    The legacy path produces a corrupt file (append mode ignores the seek), and the iftfile path is correct
+    and faster, since it makes one write per chunk instead of an open/seek/write/close and never reads the
+    file back.  SHA-1 dominates both paths on slow hashlib builds, so the gap is widest with fast hashing.
+    Frequent fsyncs cost throughput.
+
+Usage:
+    bench_chunk_writes.py [file size in MB] [chunk size in KB] [directory]
+"""
+
+import sys
+import os
+import time
+import random
+import hashlib
+
+sys.path.append( "../" )
+
+import iftfile
+
+
+def legacy_write( path, data, chunksize, order ):
+   for i in order:
+      fd = open( path, "ab" )
+      fd.seek( chunksize * i )
+      fd.write( data[i * chunksize : (i+1) * chunksize] )
+      fd.close()
+
+   # verify
+   m = hashlib.sha1()
+   fd = open( path, "r" )
+   m.update( fd.read() )
+   fd.close()
+   return m.hexdigest()
+
+
+def iftfile_write( path, data, chunksize, order, fsync_chunks ):
+   file_attrs = {
+      iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+      iftfile.JOB_ATTR_FILE_SIZE:len(data),
+      iftfile.JOB_ATTR_FSYNC_CHUNKS:fsync_chunks
+   }
+
+   ift_file = iftfile.iftfile( path )
+   rc = ift_file.fopen( file_attrs, iftfile.MODE_WRITE )
+   if rc != 0:
+      print "could not open " + path + " (rc = " + str(rc) + ")"
+      sys.exit(1)
+
+   for i in order:
+      ift_file.lock_chunk( "bench", i, True )
+      ift_file.set_chunk( data[i * chunksize : (i+1) * chunksize], i )
+      ift_file.unlock_chunk( "bench", i )
+
+   # verify
+   received_hash = ift_file.calc_hash()
+   ift_file.fclose()
+   return received_hash
+
+
+def run( name, func, path, data, file_hash ):
+   if os.path.exists( path ):
+      os.remove( path )
+
+   start = time.time()
+   received_hash = func()
+   elapsed = time.time() - start
+
+   correct = (received_hash == file_hash and iftfile.get_hash( path ) == file_hash)
+   os.remove( path )
+
+   print "%-24s %8.2f MB/s   correct=%s" % (name, len(data) / elapsed / (1024.0 * 1024.0), correct)
+
+
+if __name__ == "__main__":
+   size_mb = 64
+   chunk_kb = 64
+   directory = "/tmp"
+
+   if len(sys.argv) > 1:
+      size_mb = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      chunk_kb = int(sys.argv[2])
+   if len(sys.argv) > 3:
+      directory = sys.argv[3]
+
+   chunksize = chunk_kb * 1024
+   data = os.urandom( size_mb * 1024 * 1024 )
+   file_hash = hashlib.sha1( data ).hexdigest()
+
+   num_chunks = (len(data) + chunksize - 1) / chunksize
+   order = range(0, num_chunks)
+   random.shuffle( order )
+
+   path = os.path.join( directory, "bench_chunk_writes.dat" )
+
+   print str(size_mb) + " MB in " + str(num_chunks) + " chunks of " + str(chunk_kb) + " KB, random order"
+
+   run( "legacy (ab per chunk)", lambda: legacy_write( path, data, chunksize, order ), path, data, file_hash )
+   run( "iftfile, no fsync", lambda: iftfile_write( path, data, chunksize, order, 0 ), path, data, file_hash )
+   run( "iftfile, fsync/256", lambda: iftfile_write( path, data, chunksize, order, 256 ), path, data, file_hash )
+   run( "iftfile, fsync/16", lambda: iftfile_write( path, data, chunksize, order, 16 ), path, data, file_hash )
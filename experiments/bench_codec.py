@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  compressing chunks on the way with each codec, on text, binary and already-compressed files.
+=============
+Purpose:
+    To measure what compressing chunks (see iftcodec) costs and saves for the kinds of files
+    iftd carries, so that the codec the sender picks on its own (and its level) is one that
+    makes transfers faster, and to check that it leaves alone the files it can't help.
+
+Setup:
+    Three corpora of the same size are made from files on this host:
+       * text:        Python source and documentation, concatenated
+       * binary:      executables and shared libraries from /usr/bin and /usr/lib
+       * compressed:  the binary corpus, gzip'ed (as a tarball or package would be)
+    Each is cut into chunks, and every chunk is encoded and then decoded with each codec
+    and level, as the sender and receiver would (the decoded chunks are checked against
+    the originals).  For each, the benchmark reports the size on the wire as a share of
+    the file, how fast encoding and decoding go (MB/s of file), and the time to move the
+    file over a link of the given bandwidth:  encoding, sending and decoding one after the
+    other (the worst case, since iftd's receive pipeline overlaps decoding with receiving).
+    "none" is the chunks as they are.  "auto" is the codec iftcodec.choose() picks from the
+    corpus's MIME type and its first chunks, and its time includes choosing.
+
+Expected result:
+    Text should shrink to well under half its size, so any codec should beat sending it as
+    it is on a link slower than the codec.  Binaries should compress less, and
+    already-compressed data not at all, in which case chunks go out as they are and all a
+    codec costs is the time spent trying.  bz2 should compress best but run several times
+    slower than zlib, and high zlib levels should buy little over level 1 for their time.
+    "auto" should compress the text and binaries, and not even try on the compressed
+    corpus.
+
+Usage:
+    bench_codec.py [corpus MB] [chunk KB] [link MB/s] | grep -v "^\[iftd"
+"""
+
+import sys
+import os
+import time
+import zlib
+import gzip
+import StringIO
+
+sys.path.append( "../" )
+
+import iftcodec
+
+
+def gather( dirs, suffixes, size ):
+   """
+   Concatenate files under dirs whose names end in one of suffixes (any file if None), up to size bytes
+   """
+   parts = []
+   total = 0
+   for d in dirs:
+      for (root, subdirs, files) in os.walk( d ):
+         subdirs.sort()
+         for name in sorted( files ):
+            if suffixes != None and not [s for s in suffixes if name.endswith( s )]:
+               continue
+
+            path = os.path.join( root, name )
+            if os.path.islink( path ) or not os.path.isfile( path ):
+               continue
+
+            try:
+               fd = open( path, "rb" )
+               data = fd.read( size - total )
+               fd.close()
+            except IOError:
+               continue
+
+            parts.append( data )
+            total += len(data)
+            if total >= size:
+               return "".join( parts )
+
+   data = "".join( parts )
+   while len(data) > 0 and len(data) < size:
+      data += data[0 : size - len(data)]
+   return data
+
+
+def gzipped( data, size ):
+   """
+   gzip data, and repeat the result to make size bytes
+   """
+   buf = StringIO.StringIO()
+   gz = gzip.GzipFile( fileobj=buf, mode="wb", compresslevel=6 )
+   gz.write( data )
+   gz.close()
+   out = buf.getvalue()
+   while len(out) < size:
+      out += out[0 : size - len(out)]
+   return out[0:size]
+
+
+def run( chunks, codec, level, bandwidth ):
+   """
+   Encode and decode every chunk; return (bytes on the wire, encode seconds, decode seconds, transfer seconds)
+   """
+   file_size = sum( [len(c) for c in chunks] )
+
+   start = time.time()
+   encoded = [iftcodec.encode( c, codec, level ) for c in chunks]
+   encode_time = time.time() - start
+
+   start = time.time()
+   decoded = [iftcodec.decode( e ) for e in encoded]
+   decode_time = time.time() - start
+
+   assert decoded == chunks, "decoding with " + codec + " went wrong"
+   wire_bytes = sum( [len(e) for e in encoded] )
+   return (wire_bytes, encode_time, decode_time, encode_time + float(wire_bytes) / bandwidth + decode_time)
+
+
+def show( corpus, name, file_size, wire_bytes, encode_time, decode_time, transfer_time ):
+   encode_rate = decode_rate = float("inf")
+   if encode_time > 0:
+      encode_rate = file_size / encode_time / 1048576
+   if decode_time > 0:
+      decode_rate = file_size / decode_time / 1048576
+   print "%-11s %-8s %7.1f%% %10.1f %10.1f %10.2f" % (corpus, name, 100.0 * wire_bytes / file_size, encode_rate, decode_rate, transfer_time)
+
+
+if __name__ == "__main__":
+   corpus_mb = 16
+   chunk_kb = 256
+   link_mbps = 10
+   if len(sys.argv) > 1:
+      corpus_mb = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      chunk_kb = int(sys.argv[2])
+   if len(sys.argv) > 3:
+      link_mbps = float(sys.argv[3])
+
+   size = corpus_mb * 1048576
+   chunksize = chunk_kb * 1024
+   bandwidth = link_mbps * 1048576
+
+   text = gather( [sys.prefix + "/lib", "/usr/share/doc", "/usr/lib/python3"], [".py", ".txt", ".rst", ".html"], size )
+   binary = gather( ["/usr/bin", "/usr/lib/x86_64-linux-gnu"], None, size )
+   corpora = [
+      ("text", "text/x-python", text),
+      ("binary", "application/x-executable", binary),
+      ("compressed", "application/x-gzip", gzipped( binary, size ))
+   ]
+
+   codecs = [(iftcodec.CODEC_NONE, None), (iftcodec.CODEC_ZLIB, 1), (iftcodec.CODEC_ZLIB, 6), (iftcodec.CODEC_ZLIB, 9), (iftcodec.CODEC_BZ2, 1), (iftcodec.CODEC_BZ2, 9)]
+
+   print "%d MB corpora, %d KB chunks, %.0f MB/s link" % (corpus_mb, chunk_kb, link_mbps)
+   print "%-11s %-8s %8s %10s %10s %10s" % ("corpus", "codec", "wire", "enc MB/s", "dec MB/s", "xfer s")
+   for (corpus, mime_type, data) in corpora:
+      chunks = [data[i : i + chunksize] for i in xrange(0, len(data), chunksize)]
+      for (codec, level) in codecs:
+         name = codec
+         if level != None:
+            name += "-" + str(level)
+         result = run( chunks, codec, level, bandwidth )
+         show( corpus, name, len(data), *result )
+
+      # what the sender would pick on its own
+      start = time.time()
+      chosen = iftcodec.choose( None, None, mime_type, chunks[0:iftcodec.CODEC_SAMPLE_CHUNKS] )
+      choose_time = time.time() - start
+      if chosen == None:
+         chosen = [iftcodec.CODEC_NONE, None]
+      wire_bytes, encode_time, decode_time, transfer_time = run( chunks, chosen[0], chosen[1], bandwidth )
+      show( corpus, "auto", len(data), wire_bytes, encode_time + choose_time, decode_time, transfer_time + choose_time )
+      print "%-11s (auto picked %s)" % ("", str(chosen))
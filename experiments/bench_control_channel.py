@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  inter-iftd negotiation over one-shot XML-RPC connections versus pooled control connections.
+=============
+Purpose:
+    To measure how much of each transfer's setup time goes to the inter-iftd control calls, and how much
+    of it is saved by keeping persistent connections to each peer (iftutil.control_client) and by pickling
+    calls instead of encoding them as XML.
+
+Setup:
+    A stand-in for the remote iftd's inter-iftd API runs on loopback, with functions shaped like
+    recv_iftd_sender_data, get_iftd_sender_data, send_iftd_receiver_choice and ack_sender (taking and
+    returning job attributes, protocol lists and chunk hashes like the real ones, but doing no work).
+    One "negotiation" is the four calls a transfer makes.  It is done three ways:
+       * legacy:       a new xmlrpclib client per transfer, against a server with the stock HTTP/1.0
+                       request handler, so every call opens a connection (as iftapi.make_XMLRPC_client
+                       does; its TimeoutTransport is written for Python 2.5's httplib, so the stock
+                       transport stands in for it here)
+       * pooled-xml:   iftutil.control_client with XML-RPC, against iftutil.remote_request_handler
+       * pooled-pickle: iftutil.control_client with pickled calls
+    for a file with no chunk hashes, and for one with 1000 (as for a file of 1000 chunks).
+    Each run reports milliseconds per negotiation.
+
+Expected result:
+    Pooling saves a TCP handshake (and the server's thread start-up) on every call.  On loopback this
+    is the larger saving when there are no chunk hashes.  With many chunk hashes, encoding dominates,
+    and pickling is more than ten times faster than XML.
+
+Usage:
+    bench_control_channel.py [negotiations per run]
+"""
+
+import sys
+import os
+import time
+import threading
+import hashlib
+import xmlrpclib
+import SocketServer
+import SimpleXMLRPCServer
+
+sys.path.append( "../" )
+
+import iftfile
+import iftutil
+
+
+def recv_iftd_sender_data( xmit_id, job_attrs, available_protos, receiver_connect_dict, chunk_hashes, sender_xmlrpc_url ):
+   return (xmit_id, "/tmp/iftd/chunks/" + xmit_id, available_protos[0], available_protos)
+
+def get_iftd_sender_data( xmit_id, job_attrs, available_protos, connect_dict ):
+   return (0, "/tmp/iftd/chunks/" + xmit_id, 1 << 30, "0" * 40, "application/octet-stream", available_protos, [True] * len(available_protos), job_attrs.get( "hashes" ), "0" * 40)
+
+def send_iftd_receiver_choice( xmit_id, receiver_chunk_dir, best_proto, available_protos ):
+   return xmit_id
+
+def ack_sender( xmit_id, rc ):
+   return None
+
+FUNCS = [recv_iftd_sender_data, get_iftd_sender_data, send_iftd_receiver_choice, ack_sender]
+
+
+class legacy_server( SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer ):
+   # the inter-iftd server before pooling:  HTTP/1.0, one connection per call
+   pass
+
+
+def start( server ):
+   server.logRequests = False
+   for func in FUNCS:
+      server.register_function( func )
+
+   t = threading.Thread( target=server.serve_forever )
+   t.setDaemon( True )
+   t.start()
+   return server.server_address[1]
+
+
+def make_job_attrs( num_hashes ):
+   attrs = {}
+   for i in xrange(0, 25):
+      attrs[ "JOB_ATTR_%d" % i ] = "/some/path/value/%d" % i
+   attrs[ iftfile.JOB_ATTR_SRC_NAME ] = "/tmp/iftd/files/data.bin"
+   attrs[ iftfile.JOB_ATTR_FILE_SIZE ] = 1 << 30
+   attrs[ iftfile.JOB_ATTR_CHUNK_TIMEOUT ] = 1.0
+   attrs[ "hashes" ] = [hashlib.sha1( str(i) ).hexdigest() for i in xrange(0, num_hashes)]
+   return attrs
+
+
+def negotiate( client, job_attrs, xmit_id ):
+   protos = ["http_receiver", "iftsocket_receiver", "bittorrent_receiver"]
+   client.recv_iftd_sender_data( xmit_id, job_attrs, protos, {}, job_attrs["hashes"], "http://127.0.0.1:4001/RPC2" )
+   client.get_iftd_sender_data( xmit_id, job_attrs, protos, {} )
+   client.send_iftd_receiver_choice( xmit_id, "/tmp/iftd/chunks/" + xmit_id, "iftsocket", ["http", "iftsocket"] )
+   client.ack_sender( xmit_id, 0 )
+
+
+def run( name, make_client, job_attrs, count ):
+   negotiate( make_client(), job_attrs, "warmup" )
+   start_time = time.time()
+   for i in xrange(0, count):
+      negotiate( make_client(), job_attrs, str(i) )
+   elapsed = time.time() - start_time
+   print "%6d hashes  %-14s %8.2f ms/negotiation" % (len(job_attrs["hashes"]), name, elapsed / count * 1000.0)
+
+
+if __name__ == "__main__":
+   count = 200
+   if len(sys.argv) > 1:
+      count = int(sys.argv[1])
+
+   legacy_port = start( legacy_server( ("127.0.0.1", 0), allow_none=True ) )
+   pooled_port = start( iftutil.create_server( 0, [], request_handler = iftutil.remote_request_handler ) )
+
+   for num_hashes in [0, 1000]:
+      job_attrs = make_job_attrs( num_hashes )
+      run( "legacy", lambda: xmlrpclib.Server( "http://127.0.0.1:" + str(legacy_port) + "/RPC2", allow_none=True ), job_attrs, count )
+      run( "pooled-xml", lambda: iftutil.control_client( "127.0.0.1", pooled_port, "RPC2", 20, binary=False ), job_attrs, count )
+      run( "pooled-pickle", lambda: iftutil.control_client( "127.0.0.1", pooled_port, "RPC2", 20, binary=True ), job_attrs, count )
+
+   iftutil.CONTROL_POOL.close_all()
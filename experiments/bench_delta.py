@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  receiving a new version of a file in full versus as a delta against the old version.
+=============
+Purpose:
+    To measure how many bytes delta mode (JOB_ATTR_DELTA, see iftdelta) keeps off the network
+    when the receiver already has an older copy of the file, and what that does to the time it
+    takes to receive the file, including the time spent scanning the old copy for chunks.
+
+Setup:
+    For each synthetic edit below, the old version of a file of random data is written where the
+    new version is to be received, and the new version is received twice into a real iftfile
+    under /tmp, with every chunk checked against its SHA-1 as iftd does:
+       * full:   the old copy is ignored and every chunk is received
+       * delta:  chunks found in the old copy (by rolling Adler-32, confirmed by SHA-1) are
+                 copied out of it first, and only the rest are received
+    A stand-in receiver's "network" hands back chunks from memory after sleeping as long as a
+    link with the given bandwidth and round-trip time would take to carry them.  Each run
+    reports the bytes that crossed the link and the time from opening the file to it being
+    complete (the delta's scan time is included, and also shown on its own).
+    The edits:
+       * unchanged:  the same file
+       * edited:     16 bytes changed in place, spread through the file
+       * inserted:   one byte inserted at the start, shifting everything after it
+       * deleted:    4 KB cut out of the middle
+       * appended:   1 MB added to the end
+       * rewritten:  nothing in common (the worst case for delta mode)
+
+Expected result:
+    Delta mode should fetch only the chunks an edit touched:  next to nothing for the first
+    five, so the time becomes that of scanning and copying the old copy.  Shifted data should be
+    found as readily as data that stayed put.  When nothing matches, the window slides over the
+    whole old copy a byte at a time in Python, so delta mode should cost about that scan
+    (a few MB/s) on top of the full transfer.
+
+Usage:
+    bench_delta.py [file MB] [chunk KB] [link MB/s] [round trip ms] | grep -v "^\[iftd"
+    (the receiver logs every chunk it stores)
+"""
+
+import sys
+import os
+import time
+import random
+import array
+import hashlib
+
+sys.path.append( "../" )
+sys.path.append( "../test" )
+
+import iftfile
+import iftdelta
+import iftcore
+from iftcore import *
+import iftcore.iftreceiver
+from iftcore.consts import *
+from stand_ins import stand_in_job
+
+
+class link_receiver( iftcore.iftreceiver.receiver ):
+   """
+   Receives chunks over a simulated link, counting the bytes
+   """
+   def __init__( self, chunks, bandwidth, rtt ):
+      iftcore.iftreceiver.receiver.__init__( self )
+      self.name = "link_receiver"
+      self.chunks = chunks
+      self.bandwidth = bandwidth
+      self.rtt = rtt
+      self.num_bytes = 0
+      self.set_chunking_mode( PROTO_DETERMINISTIC_CHUNKING )
+
+   def recv_chunks( self, remote_chunk_dir, desired_chunks ):
+      num_bytes = sum( [len(self.chunks[i]) for i in desired_chunks] )
+      self.num_bytes += num_bytes
+      time.sleep( self.rtt + float(num_bytes) / self.bandwidth )
+      for i in desired_chunks:
+         self.add_chunk( i, self.chunks[i] )
+      return 0
+
+
+def run( delta, old, new, chunksize, bandwidth, rtt ):
+   """
+   Receive new over old; return (bytes over the link, total seconds, scan seconds)
+   """
+   path = "/tmp/bench_delta"
+   fd = open( path, "wb" )
+   fd.write( old )
+   fd.close()
+
+   chunks = [new[i : i + chunksize] for i in xrange(0, len(new), chunksize)]
+   attrs = {iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+            iftfile.JOB_ATTR_FILE_SIZE:len(new),
+            iftfile.JOB_ATTR_FILE_HASH:hashlib.sha1( new ).hexdigest(),
+            iftfile.JOB_ATTR_CHUNK_HASHES:[hashlib.sha1( c ).hexdigest() for c in chunks],
+            iftfile.JOB_ATTR_WEAK_SUMS:iftdelta.weak_sums( chunks )}
+
+   start_time = time.time()
+   old_copy = None
+   if delta:
+      old_copy = iftdelta.open_basis( path )
+
+   ift_file = iftfile.acquire_iftfile_recv( "bench", path, attrs )
+   scan_time = 0
+   if old_copy != None:
+      iftdelta.apply_basis( old_copy, ift_file, chunksize, len(new), attrs[iftfile.JOB_ATTR_CHUNK_HASHES], attrs[iftfile.JOB_ATTR_WEAK_SUMS] )
+      scan_time = time.time() - start_time
+
+   attrs.update( {iftfile.JOB_ATTR_IFTFILE:ift_file,
+                  iftfile.JOB_ATTR_CHUNK_TIMEOUT:10,
+                  iftfile.JOB_ATTR_REMOTE_IFTD:True,
+                  iftfile.JOB_ATTR_SRC_CHUNK_DIR:"/tmp",
+                  iftfile.JOB_ATTR_SRC_NAME:"source",
+                  iftfile.JOB_ATTR_DEST_NAME:path} )
+
+   receiver = link_receiver( chunks, bandwidth, rtt )
+   if not ift_file.is_complete():
+      receiver.on_start( stand_in_job( attrs ), {} )
+      receiver.run( 0 )
+
+   elapsed = time.time() - start_time
+   assert ift_file.is_complete() and ift_file.calc_hash() == attrs[iftfile.JOB_ATTR_FILE_HASH], "file was not received"
+   iftfile.release_iftfile_recv( "bench", path )
+   os.remove( path )
+   return (receiver.num_bytes, elapsed, scan_time)
+
+
+if __name__ == "__main__":
+   file_mb = 32
+   chunk_kb = 64
+   link_mbps = 10
+   rtt_ms = 20
+   if len(sys.argv) > 1:
+      file_mb = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      chunk_kb = int(sys.argv[2])
+   if len(sys.argv) > 3:
+      link_mbps = float(sys.argv[3])
+   if len(sys.argv) > 4:
+      rtt_ms = float(sys.argv[4])
+
+   chunksize = chunk_kb * 1024
+   size = file_mb * 1048576
+   random.seed( 0 )
+   old = os.urandom( size )
+
+   edited = array.array( 'B', old )
+   for i in xrange(0, 16):
+      edited[ random.randint(0, size - 1) ] ^= 0xFF
+
+   workloads = [
+      ("unchanged", old),
+      ("edited", edited.tostring()),
+      ("inserted", "x" + old),
+      ("deleted", old[0 : size / 2 + 1000] + old[size / 2 + 5096 :]),
+      ("appended", old + os.urandom( 1048576 )),
+      ("rewritten", os.urandom( size ))
+   ]
+
+   print "%d MB file, %d KB chunks, %.0f MB/s link, %.1f ms round trip" % (file_mb, chunk_kb, link_mbps, rtt_ms)
+   print "%-10s %12s %9s   %12s %9s %9s   %7s" % ("edit", "full bytes", "full s", "delta bytes", "delta s", "scan s", "saved")
+   for (name, new) in workloads:
+      full_bytes, full_time, ignored = run( False, old, new, chunksize, link_mbps * 1048576, rtt_ms / 1000.0 )
+      delta_bytes, delta_time, scan_time = run( True, old, new, chunksize, link_mbps * 1048576, rtt_ms / 1000.0 )
+      print "%-10s %12d %9.2f   %12d %9.2f %9.2f   %6.1f%%" % (name, full_bytes, full_time, delta_bytes, delta_time, scan_time, 100.0 * (full_bytes - delta_bytes) / full_bytes)
@@ -0,0 +1,320 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  one multi-range urllib2 request per batch versus pipelined ranges over persistent connections.
+=============
+Purpose:
+    To measure how much http_receiver throughput is gained by keeping several HTTP/1.1 connections open,
+    merging adjacent chunks into single ranges, and pipelining range requests on each connection, instead
+    of opening a new connection per batch and asking for one multipart/byteranges response with a range
+    per chunk.
+
+Setup:
+    A server on the loopback interface serves byte ranges of a file of random noise over HTTP/1.1 keep-alive
+    connections.  It answers single ranges with 206 and Content-Range, and several ranges with
+    multipart/byteranges (which the old receiver needs).  Each connection's responses are held back until a
+    fixed delay after their request arrived, to stand in for a network round trip without serializing
+    requests the way a sleep in the handler would.  Each receiver gets the file the way iftreceiver does:
+    it asks for chunk_scheduler.run_length() unreceived chunks at a time, and locks, writes, and unlocks
+    each chunk it gets.  This is done per delay with:
+       * legacy:     the old recv_chunks (a new urllib2 connection and one multipart response per batch)
+       * pipelined:  the current recv_chunks, at a few connection counts and pipeline depths
+    Each run reports MB/s and how many connections the server accepted.
+
+Expected result:
+    Legacy throughput pays for a TCP connect and a round trip per batch, plus line-by-line parsing of the
+    multipart body.  Pipelined throughput hides the round trips behind each other, so it stays close to
+    what the client can write as the delay grows, and more connections help at larger delays.
+
+Usage:
+    bench_http_ranges.py [file size in MB] [chunk size in KB] [delay in ms ...]
+"""
+
+import sys
+import os
+import time
+import socket
+import threading
+import urllib2
+from Queue import Queue
+
+sys.path.append( "../" )
+
+import iftfile
+import iftcore
+from iftcore import *
+from iftcore.iftreceiver import chunk_scheduler
+import protocols.http
+from iftdata import *
+
+
+class range_server:
+   """
+   HTTP/1.1 keep-alive server of one file's byte ranges, with a simulated round trip.
+   """
+
+   def __init__( self, data, delay ):
+      self.data = data
+      self.delay = delay
+      self.connections = 0
+      self.listen_soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+      self.listen_soc.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+      self.listen_soc.bind( ("127.0.0.1", 0) )
+      self.listen_soc.listen( 64 )
+      self.port = self.listen_soc.getsockname()[1]
+      t = threading.Thread( target=self.accept_loop )
+      t.setDaemon( True )
+      t.start()
+
+   def accept_loop( self ):
+      while True:
+         try:
+            soc, addr = self.listen_soc.accept()
+         except:
+            return
+
+         self.connections += 1
+         responses = Queue()
+         for target in (self.read_requests, self.write_responses):
+            t = threading.Thread( target=target, args=(soc, responses) )
+            t.setDaemon( True )
+            t.start()
+
+   def respond( self, headers ):
+      size = len(self.data)
+      ranges = []
+      if headers.has_key( "range" ):
+         for r in headers["range"].split("=", 1)[1].split(","):
+            first, last = r.split("-")
+            ranges.append( (int(first), min( int(last), size - 1 )) )
+
+      if len(ranges) == 0:
+         return "HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % size + self.data
+
+      if len(ranges) == 1:
+         first, last = ranges[0]
+         return "HTTP/1.1 206 Partial Content\r\nContent-Range: bytes %d-%d/%d\r\nContent-Length: %d\r\n\r\n" % (first, last, size, last - first + 1) + self.data[first : last + 1]
+
+      parts = []
+      for (first, last) in ranges:
+         parts.append( "\r\n--BOUNDARY\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" % (first, last, size) )
+         parts.append( self.data[first : last + 1] )
+      parts.append( "\r\n--BOUNDARY--\r\n" )
+      body = "".join( parts )
+      return "HTTP/1.1 206 Partial Content\r\nContent-Type: multipart/byteranges; boundary=BOUNDARY\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+
+   def read_requests( self, soc, responses ):
+      f = soc.makefile( "rb" )
+      while True:
+         line = f.readline()
+         if len(line) == 0:
+            break
+
+         headers = {}
+         while True:
+            line = f.readline().strip()
+            if len(line) == 0:
+               break
+            name, value = line.split( ":", 1 )
+            headers[ name.strip().lower() ] = value.strip()
+
+         close = headers.get( "connection", "" ).lower() == "close"
+         responses.put( (time.time() + self.delay, self.respond( headers ), close) )
+         if close:
+            break
+
+      responses.put( None )
+      f.close()
+
+   def write_responses( self, soc, responses ):
+      while True:
+         item = responses.get()
+         if item == None:
+            break
+
+         due, response, close = item
+         if due > time.time():
+            time.sleep( due - time.time() )
+
+         try:
+            soc.sendall( response )
+         except socket.error:
+            break
+
+         if close:
+            break
+
+      soc.close()
+
+   def close( self ):
+      self.listen_soc.close()
+
+
+class legacy_http_receiver( protocols.http.http_receiver ):
+   """
+   http_receiver's recv_chunks from before persistent connections (one multi-range request per batch).
+   """
+
+   def recv_chunks( self, remote_chunk_dir, desired_chunks ):
+      chunksize = self.job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE )
+      desired_chunks.sort()
+      byte_ranges = []
+      for chunk in desired_chunks:
+         byte_ranges.append( [ chunksize * chunk, min( chunksize * (chunk+1) - 1, self.file_size - 1 ) ] )
+
+      byte_range_str = "bytes="
+      for brange in byte_ranges:
+         byte_range_str += str(brange[0]) + "-" + str(brange[1]) + ","
+      byte_range_str = byte_range_str[:-1]
+
+      remote_file = self.job_attrs.get( iftfile.JOB_ATTR_SRC_NAME )
+      req = urllib2.Request( "http://" + self.job_attrs.get( iftfile.JOB_ATTR_SRC_HOST ) + ":" + str(self.portnum) + remote_file )
+      req.add_header( "range", byte_range_str )
+      resp = urllib2.urlopen( req )
+      if resp.code < 200 or resp.code > 400:
+         return E_NO_CONNECT
+
+      data = resp
+      content_type = resp.headers.getheader('content-type')
+      content_range = resp.headers.getheader('content-range')
+      if content_type != None and "multipart/byteranges" in content_type:
+         boundary = content_type[ content_type.find("boundary=") + 9 : ].strip()
+         CRLF = "\r\n"
+         while True:
+            line = data.readline()
+            if len(line) == 0:
+               break
+            if line == CRLF:
+               continue
+
+            line = line[ : len(line) - 2 ]
+            start_byte = -1
+            stop_byte = -1
+            if line == "--" + boundary + "--":
+               break
+
+            elif line == "--" + boundary:
+               while True:
+                  line = data.readline()
+                  if line.lower().startswith("content-range"):
+                     content_range = line[ line.find("bytes ") + 6 : line.find("/") ]
+                     start_byte = int( content_range[0: content_range.find("-")] )
+                     stop_byte = int( content_range[ content_range.find("-") + 1 : ] ) + 1
+                  if line == CRLF:
+                     break
+
+               self.add_chunk( start_byte / chunksize, data.read( stop_byte - start_byte ) )
+
+         resp.close()
+         return 0
+
+      start_byte = int( content_range[ 6 : content_range.find("-") ] )
+      self.add_chunk( start_byte / chunksize, resp.read() )
+      resp.close()
+      return 0
+
+
+def collecting( receiver_class ):
+   """
+   Make a receiver that keeps what add_chunk() gives it.
+   """
+   class collecting_receiver( receiver_class ):
+      def add_chunk( self, chunk_id, chunk_str ):
+         self.got[ chunk_id ] = chunk_str
+
+   return collecting_receiver()
+
+
+def receive( path, data, chunksize, delay, receiver_class, connections=None, depth=None ):
+   server = range_server( data, delay )
+
+   receiver = collecting( receiver_class )
+   receiver.job_attrs = {
+      iftfile.JOB_ATTR_SRC_HOST:"127.0.0.1",
+      iftfile.JOB_ATTR_SRC_NAME:"/bench",
+      iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+      iftfile.JOB_ATTR_FILE_SIZE:len(data)
+   }
+   receiver.remote_host = "127.0.0.1"
+   receiver.portnum = server.port
+   receiver.file_size = len(data)
+   receiver.connect_args = {}
+   if connections != None:
+      receiver.connect_args[ protocols.http.HTTP_CONNECTIONS ] = connections
+      receiver.connect_args[ protocols.http.HTTP_PIPELINE_DEPTH ] = depth
+
+   file_attrs = {
+      iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+      iftfile.JOB_ATTR_FILE_SIZE:len(data)
+   }
+
+   if os.path.exists( path ):
+      os.remove( path )
+
+   ift_file = iftfile.iftfile( path )
+   ift_file.fopen( file_attrs, iftfile.MODE_WRITE )
+
+   owner = "bench"
+   scheduler = chunk_scheduler( chunksize )
+
+   start = time.time()
+   while not ift_file.is_complete():
+      chunk_ids = ift_file.next_unwritten_chunks( scheduler.run_length(), True )
+      reserve_time = scheduler.reservation_time( 1.0 )
+      for chunk_id in chunk_ids:
+         ift_file.reserve_chunk( owner, chunk_id, reserve_time )
+
+      receiver.got = {}
+      stime = time.time()
+      rc = receiver.recv_chunks( "", list(chunk_ids) )
+      etime = time.time()
+      assert rc == 0, "recv_chunks failed, rc = " + str(rc)
+
+      scheduler.record( len(receiver.got), sum( [len(c) for c in receiver.got.values()] ), etime - stime )
+
+      for chunk_id, chunk in receiver.got.items():
+         ift_file.lock_chunk( owner, chunk_id, True )
+         ift_file.set_chunk( chunk, chunk_id )
+         ift_file.unlock_chunk( owner, chunk_id )
+
+   elapsed = time.time() - start
+   ift_file.fclose()
+   for connection in receiver.connections:
+      connection.close()
+
+   server.close()
+
+   fd = open( path, "rb" )
+   correct = fd.read() == data
+   fd.close()
+   os.remove( path )
+
+   return (len(data) / elapsed / (1024.0 * 1024.0), server.connections, correct)
+
+
+if __name__ == "__main__":
+   size_mb = 32
+   chunksize = 64 * 1024
+   delays = [0.0, 0.005, 0.02]
+
+   if len(sys.argv) > 1:
+      size_mb = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      chunksize = int(sys.argv[2]) * 1024
+   if len(sys.argv) > 3:
+      delays = [float(d) / 1000.0 for d in sys.argv[3:]]
+
+   data = os.urandom( size_mb * 1024 * 1024 )
+   path = "/tmp/bench_http_ranges"
+
+   print str(size_mb) + " MB in chunks of " + str(chunksize / 1024) + " KB"
+   for delay in delays:
+      runs = [("legacy", legacy_http_receiver, None, None),
+              ("1 conn x 1", protocols.http.http_receiver, 1, 1),
+              ("1 conn x 4", protocols.http.http_receiver, 1, 4),
+              ("4 conn x 4", protocols.http.http_receiver, 4, 4)]
+
+      for (name, receiver_class, connections, depth) in runs:
+         mbps, num_connections, correct = receive( path, data, chunksize, delay, receiver_class, connections, depth )
+         print "delay %5.1f ms  %-12s %8.2f MB/s   %4d connections   correct=%s" % (delay * 1000, name, mbps, num_connections, correct)
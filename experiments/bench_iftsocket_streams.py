@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  iftsocket over one TCP stream versus several, and with new connections per transfer versus kept ones.
+=============
+Purpose:
+    To measure what iftsocket gains on a long, thin link from spreading a transfer's chunks across several
+    TCP streams (IFTSOCKET_STREAMS), and from keeping streams open between transfers to the same receiver
+    (IFTSOCKET_KEEPALIVE) instead of connecting again for each one.
+
+Setup:
+    A receiver listens on loopback, behind a proxy (a child process) that adds latency.  For each stream
+    the proxy waits one round trip before connecting to the receiver (the TCP handshake), then delivers
+    data half a round trip after it was sent, with no more than a window of it unacknowledged at once,
+    so each stream moves about window / RTT bytes per second.  The sender runs in another child process,
+    with checksums off, and (like iftd) starts each transfer once the receiver has finished the last.
+       * streams:    one file is sent over 1, 2, 4 and 8 streams
+       * keepalive:  a run of small files is sent one after another, with 4 streams, with and without
+                     IFTSOCKET_KEEPALIVE
+    Each run reports MB/s (and transfers/s for the keepalive runs).
+
+Expected result:
+    With one stream, throughput is about window / RTT.  It grows about linearly with the number of
+    streams, until the proxy or the CPU is the limit.  For small files, keeping the streams saves a
+    handshake round trip per transfer, so with the defaults a transfer over kept streams takes about a
+    third as long (about one round trip less the time to send, instead of two).
+
+Usage:
+    bench_iftsocket_streams.py [RTT in ms] [window in KB] [file size in MB]
+"""
+
+import sys
+import os
+import time
+import socket
+import signal
+import threading
+
+sys.path.append( "../" )
+
+import iftfile
+import protocols.iftsocket
+from iftcore.consts import *
+from iftdata import *
+
+
+class bench_job:
+   # the parts of an iftjob iftsocket uses
+   def __init__( self, attrs ):
+      self.attrs = attrs
+
+   def get_attr( self, attr ):
+      return self.attrs.get( attr )
+
+
+def free_port():
+   soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+   soc.bind( ("127.0.0.1", 0) )
+   port = soc.getsockname()[1]
+   soc.close()
+   return port
+
+
+def relay( client, upstream_port, rtt, window ):
+   """
+   Forward one stream to the receiver.  Data arrives half a round trip after it is sent, and no more
+   than a window of it can be unacknowledged (acknowledgements take the other half of the round trip).
+   """
+   time.sleep( rtt )
+   upstream = socket.create_connection( ("127.0.0.1", upstream_port) )
+
+   in_flight = []       # [(arrival time, data)]
+   acks = []            # [(acknowledgement time, length)]
+   state = [0, False]   # unacknowledged bytes, whether the client has hung up
+   cv = threading.Condition()
+
+   def deliver():
+      while True:
+         cv.acquire()
+         while len(in_flight) == 0 and not state[1]:
+            cv.wait()
+         if len(in_flight) == 0:
+            cv.release()
+            break
+         arrival, data = in_flight.pop(0)
+         cv.release()
+
+         delay = arrival - time.time()
+         if delay > 0:
+            time.sleep( delay )
+         upstream.sendall( data )
+
+         cv.acquire()
+         acks.append( (time.time() + rtt / 2, len(data)) )
+         cv.notify()
+         cv.release()
+
+      upstream.close()
+
+   t = threading.Thread( target=deliver )
+   t.setDaemon( True )
+   t.start()
+
+   while True:
+      # wait for room in the window
+      cv.acquire()
+      while True:
+         now = time.time()
+         while len(acks) > 0 and acks[0][0] <= now:
+            state[0] -= acks.pop(0)[1]
+         if state[0] < window:
+            break
+         if len(acks) > 0:
+            cv.wait( acks[0][0] - now )
+         else:
+            cv.wait()
+      room = window - state[0]
+      cv.release()
+
+      data = client.recv( room )
+
+      cv.acquire()
+      if len(data) == 0:
+         state[1] = True
+         cv.notify()
+         cv.release()
+         break
+      state[0] += len(data)
+      in_flight.append( (time.time() + rtt / 2, data) )
+      cv.notify()
+      cv.release()
+
+   t.join()
+   client.close()
+
+
+def start_proxy( upstream_port, rtt, window ):
+   """
+   Start a process that forwards connections to upstream_port with latency.
+   Return (port, pid).
+   """
+   listen_soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+   listen_soc.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+   listen_soc.bind( ("127.0.0.1", 0) )
+   listen_soc.listen( 64 )
+   port = listen_soc.getsockname()[1]
+
+   pid = os.fork()
+   if pid == 0:
+      while True:
+         client, addr = listen_soc.accept()
+         client.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, window )
+         t = threading.Thread( target=relay, args=(client, upstream_port, rtt, window) )
+         t.setDaemon( True )
+         t.start()
+
+   listen_soc.close()
+   return (port, pid)
+
+
+def run( name, proxy_port, receiver_port, files, chunksize, num_streams, keepalive ):
+   """
+   Send each of files (strings) in turn, and report how long it took.
+   """
+   # send from another process, so that the sender doesn't compete with the receiver for the interpreter.
+   # Like iftd, the sender starts each transfer once the receiver says the last one is done.
+   rfd, wfd = os.pipe()
+   pid = os.fork()
+   if pid == 0:
+      os.close( wfd )
+      sender = protocols.iftsocket.iftsocket_sender()
+      sender.setup( {PROTO_PORTNUM:proxy_port} )
+      for i in xrange(0, len(files)):
+         job = bench_job( {iftfile.JOB_ATTR_DEST_HOST:"127.0.0.1", PROTO_PORTNUM:proxy_port, iftfile.JOB_ATTR_FILE_HASH:name + str(i),
+                           protocols.iftsocket.IFTSOCKET_STREAMS:num_streams, protocols.iftsocket.IFTSOCKET_KEEPALIVE:keepalive,
+                           protocols.iftsocket.IFTSOCKET_CHECKSUM:False, protocols.iftsocket.IFTSOCKET_TIMEOUT:60} )
+         assert sender.prepare_transmit( job ) == 0, "could not connect"
+         for j in xrange(0, len(files[i]), chunksize):
+            sender.send_chunk( files[i][j : j + chunksize], j / chunksize, None, None )
+         sender.proto_clean()
+         os.read( rfd, 1 )
+
+      sender.kill( None )
+      os._exit(0)
+
+   os.close( rfd )
+   received = [0]
+   def add_chunk( chunk_id, data ):
+      received[0] += len(data)
+
+   ok = True
+   start = time.time()
+   for i in xrange(0, len(files)):
+      receiver = protocols.iftsocket.iftsocket_receiver()
+      receiver.setup( {PROTO_PORTNUM:receiver_port} )
+      receiver.recv_job( bench_job( {iftfile.JOB_ATTR_FILE_HASH:name + str(i), iftfile.JOB_ATTR_CHUNKSIZE:chunksize} ) )
+      receiver.await_sender( {PROTO_PORTNUM:receiver_port, protocols.iftsocket.IFTSOCKET_TIMEOUT:10}, 10 )
+      receiver.add_chunk = add_chunk
+      rc = receiver.recv_chunks( "", range(0, (len(files[i]) + chunksize - 1) / chunksize) )
+      receiver.proto_clean()
+      os.write( wfd, "x" )
+      ok = ok and rc == 0
+
+   elapsed = time.time() - start
+   os.waitpid( pid, 0 )
+   os.close( wfd )
+
+   total = sum( [len(f) for f in files] )
+   ok = ok and received[0] == total
+   print "%-22s %8.2f MB/s  %8.1f transfers/s   ok=%s" % (name, total / elapsed / (1024.0 * 1024.0), len(files) / elapsed, ok)
+
+
+if __name__ == "__main__":
+   rtt_ms = 20
+   window_kb = 64
+   size_mb = 16
+
+   if len(sys.argv) > 1:
+      rtt_ms = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      window_kb = int(sys.argv[2])
+   if len(sys.argv) > 3:
+      size_mb = int(sys.argv[3])
+
+   receiver_port = free_port()
+   proxy_port, proxy_pid = start_proxy( receiver_port, rtt_ms / 1000.0, window_kb * 1024 )
+
+   print "RTT %d ms, window %d KB (about %.2f MB/s per stream)" % (rtt_ms, window_kb, window_kb / 1024.0 / (rtt_ms / 1000.0))
+
+   data = os.urandom( size_mb * 1024 * 1024 )
+   for num_streams in [1, 2, 4, 8]:
+      run( "%d stream(s)" % num_streams, proxy_port, receiver_port, [data], 256 * 1024, num_streams, True )
+
+   small = [os.urandom( 64 * 1024 ) for i in xrange(0, 30)]
+   run( "new streams per file", proxy_port, receiver_port, small, 16 * 1024, 4, False )
+   run( "kept streams", proxy_port, receiver_port, small, 16 * 1024, 4, True )
+
+   os.kill( proxy_pid, signal.SIGTERM )
+   os.waitpid( proxy_pid, 0 )
+   protocols.iftsocket.close_idle_streams()
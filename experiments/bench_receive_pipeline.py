@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  receiving, verifying and writing chunks on one thread versus a staged receive pipeline.
+=============
+Purpose:
+    To measure how much faster a receiver takes in large chunks when hashing and writing them
+    are taken off the protocol's thread (iftcore.iftreceiver.receive_pipeline), so that the
+    next batch is on its way in while the last one is checked and written out.  Before, each
+    batch was received, then SHA-1'd chunk by chunk, then written chunk by chunk, all before
+    the protocol asked for the next one.
+
+Setup:
+    A stand-in receiver's "network" hands back chunks from memory after sleeping as long as
+    a link with the given bandwidth and round-trip time would take to carry them (so it holds
+    no CPU, just like waiting on a socket).  It receives a file of large chunks into a real
+    iftfile under /tmp, checking every chunk against its SHA-1 as iftd does for jobs with
+    chunk hashes, and fsyncing every few chunks.  The same transfer is run two ways:
+       * inline:    RECEIVE_PIPELINE = False, the old path
+       * pipeline:  RECEIVE_PIPELINE = True, with iftd's default verify and write pools
+    Each run reports MB/s from the first request to the file being complete.
+
+Expected result:
+    Inline, the link sits idle while each batch is hashed and written, so throughput is
+    the link's rate less the time spent on the CPU and disk.  With the pipeline, the three
+    overlap (hashlib and file writes let go of the GIL), so throughput should get close to
+    whichever stage is slowest--usually the link--instead of the sum of all three.
+
+Usage:
+    bench_receive_pipeline.py [file MB] [chunk KB] [link MB/s] [round trip ms] | grep -v "^\[iftd"
+    (the receiver logs every chunk it stores)
+"""
+
+import sys
+import os
+import time
+import hashlib
+
+sys.path.append( "../" )
+sys.path.append( "../test" )
+
+import iftfile
+import iftcore
+from iftcore import *
+import iftcore.iftreceiver
+from iftcore.consts import *
+from stand_ins import stand_in_job
+
+
+class link_receiver( iftcore.iftreceiver.receiver ):
+   """
+   Receives chunks over a simulated link
+   """
+   def __init__( self, chunks, bandwidth, rtt ):
+      iftcore.iftreceiver.receiver.__init__( self )
+      self.name = "link_receiver"
+      self.chunks = chunks
+      self.bandwidth = bandwidth
+      self.rtt = rtt
+      self.set_chunking_mode( PROTO_DETERMINISTIC_CHUNKING )
+
+   def recv_chunks( self, remote_chunk_dir, desired_chunks ):
+      num_bytes = sum( [len(self.chunks[i]) for i in desired_chunks] )
+      time.sleep( self.rtt + float(num_bytes) / self.bandwidth )
+      for i in desired_chunks:
+         self.add_chunk( i, self.chunks[i] )
+      return 0
+
+
+def run( name, use_pipeline, chunks, chunk_hashes, chunksize, bandwidth, rtt ):
+   iftcore.iftreceiver.RECEIVE_PIPELINE = use_pipeline
+   path = "/tmp/bench_receive_pipeline"
+   file_size = sum( [len(c) for c in chunks] )
+
+   ift_file = iftfile.iftfile( path )
+   ift_file.fopen( {iftfile.JOB_ATTR_CHUNKSIZE:chunksize, iftfile.JOB_ATTR_FILE_SIZE:file_size, iftfile.JOB_ATTR_FSYNC_CHUNKS:16}, iftfile.MODE_WRITE )
+   job = stand_in_job( {iftfile.JOB_ATTR_IFTFILE:ift_file,
+                        iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+                        iftfile.JOB_ATTR_CHUNK_HASHES:chunk_hashes,
+                        iftfile.JOB_ATTR_CHUNK_TIMEOUT:10,
+                        iftfile.JOB_ATTR_REMOTE_IFTD:True,
+                        iftfile.JOB_ATTR_SRC_CHUNK_DIR:"/tmp",
+                        iftfile.JOB_ATTR_SRC_NAME:"source",
+                        iftfile.JOB_ATTR_DEST_NAME:path} )
+
+   receiver = link_receiver( chunks, bandwidth, rtt )
+   receiver.on_start( job, {} )
+   start_time = time.time()
+   receiver.run( 0 )
+   elapsed = time.time() - start_time
+
+   complete = ift_file.is_complete()
+   ift_file.fclose()
+   os.remove( path )
+   print "%-10s %8.1f MB/s   %6.2f s   complete=%s" % (name, file_size / elapsed / 1048576.0, elapsed, complete)
+
+
+if __name__ == "__main__":
+   file_mb = 256
+   chunk_kb = 1024
+   link_mbps = 400
+   rtt_ms = 2
+   if len(sys.argv) > 1:
+      file_mb = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      chunk_kb = int(sys.argv[2])
+   if len(sys.argv) > 3:
+      link_mbps = float(sys.argv[3])
+   if len(sys.argv) > 4:
+      rtt_ms = float(sys.argv[4])
+
+   chunksize = chunk_kb * 1024
+   chunks = [os.urandom( chunksize ) for i in xrange(0, file_mb * 1024 / chunk_kb)]
+   chunk_hashes = [hashlib.sha1( c ).hexdigest() for c in chunks]
+
+   print "%d MB file, %d KB chunks, %.0f MB/s link, %.1f ms round trip" % (file_mb, chunk_kb, link_mbps, rtt_ms)
+   for i in xrange(0, 2):
+      run( "inline", False, chunks, chunk_hashes, chunksize, link_mbps * 1048576, rtt_ms / 1000.0 )
+      run( "pipeline", True, chunks, chunk_hashes, chunksize, link_mbps * 1048576, rtt_ms / 1000.0 )
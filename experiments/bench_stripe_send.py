@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  sending a file with one active protocol versus striping it across two with TransferCore.stripe_send.
+=============
+Purpose:
+    To measure how much send throughput is gained by having every connected active sender send at once,
+    each taking chunks from a shared queue in proportion to its speed, instead of sending with one
+    protocol and keeping the others for failover.
+
+Setup:
+    Two loopback "links", each a child process that accepts one TCP connection and reads from it no
+    faster than a given rate (so that each link, not the CPU, is the bottleneck).  An iftsocket_sender
+    is connected to each link, and a file of random noise is sent three ways:
+       * link A alone
+       * link B alone
+       * links A and B together, striped by stripe_send
+    Each run reports MB/s, and how many bytes went over each link.
+
+    The http sender cannot be one of the striped protocols:  it is passive (it serves chunks that the
+    receiver asks for, and its send_chunk() only reports them available), so it does not move data
+    when stripe_send calls it.  Both links therefore use iftsocket, at different speeds, standing in
+    for two different protocols.
+
+Expected result:
+    Each link alone runs at about its rate.  Striped, the throughput is close to the sum of the two
+    rates, and each link carries a share of the file proportional to its rate.
+
+Usage:
+    bench_stripe_send.py [file size in MB] [link A MB/s] [link B MB/s]
+"""
+
+import sys
+import os
+import time
+import socket
+
+sys.path.append( "../" )
+
+import iftfile
+import iftstats
+import ifttransfer
+import protocols.iftsocket
+from iftcore.consts import *
+
+
+class bench_job:
+   # the parts of an iftjob a sender uses
+   def __init__( self, attrs ):
+      self.attrs = attrs
+      self.stats = {}
+
+   def get_attr( self, attr ):
+      return self.attrs.get( attr )
+
+   def get_stat( self, attr ):
+      return self.stats.get( attr )
+
+   def set_stat( self, attr, value ):
+      self.stats[ attr ] = value
+
+
+def start_link( rate ):
+   """
+   Start a process that reads one connection at no more than rate bytes per second.
+   Return (port, pid, read end of a pipe it reports the bytes it read on).
+   """
+   listen_soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+   listen_soc.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+   listen_soc.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, 65536 )
+   listen_soc.bind( ("127.0.0.1", 0) )
+   listen_soc.listen( 1 )
+   port = listen_soc.getsockname()[1]
+
+   rfd, wfd = os.pipe()
+   pid = os.fork()
+   if pid == 0:
+      os.close( rfd )
+      soc, addr = listen_soc.accept()
+      total = 0
+      start = time.time()
+      while True:
+         data = soc.recv( 65536 )
+         if len(data) == 0:
+            break
+
+         total += len(data)
+         ahead = total / float(rate) - (time.time() - start)
+         if ahead > 0:
+            time.sleep( ahead )
+
+      os.write( wfd, str(total) )
+      os._exit(0)
+
+   os.close( wfd )
+   listen_soc.close()
+   return (port, pid, rfd)
+
+
+def send( data, chunksize, rates ):
+   links = [start_link( rate ) for rate in rates]
+
+   senders = []
+   for (port, pid, rfd) in links:
+      # the sink takes one connection and reads it to the end
+      job = bench_job( {iftfile.JOB_ATTR_DEST_HOST:"127.0.0.1", PROTO_PORTNUM:port, protocols.iftsocket.IFTSOCKET_STREAMS:1, protocols.iftsocket.IFTSOCKET_KEEPALIVE:False} )
+      iftstats.begin_transfer( job, sender=True )
+
+      sender = protocols.iftsocket.iftsocket_sender()
+      sender.name = "iftsocket:" + str(port)
+      sender.ift_job = job
+      assert sender.prepare_transmit( job ) == 0, "could not connect"
+      senders.append( sender )
+
+   chunk_data = [[data[i : i + chunksize], i / chunksize, None, None] for i in xrange(0, len(data), chunksize)]
+
+   start = time.time()
+   rc = ifttransfer.TransferCore.stripe_send( senders, chunk_data, 3 )
+   for sender in senders:
+      sender.proto_clean()
+
+   received = []
+   for (port, pid, rfd) in links:
+      os.waitpid( pid, 0 )
+      received.append( int( os.read( rfd, 100 ) ) )
+      os.close( rfd )
+
+   elapsed = time.time() - start
+
+   shares = ", ".join( ["%.1f MB/s link: %5.1f MB" % (rates[i] / (1024.0 * 1024.0), received[i] / (1024.0 * 1024.0)) for i in xrange(0, len(rates))] )
+   print "%-10s %8.2f MB/s   (%s)   ok=%s" % ("+".join( [str(r / (1024 * 1024)) for r in rates] ), len(data) / elapsed / (1024.0 * 1024.0), shares, rc == TRANSMIT_STATE_SUCCESS)
+
+
+if __name__ == "__main__":
+   size_mb = 128
+   rate_a = 40
+   rate_b = 20
+
+   if len(sys.argv) > 1:
+      size_mb = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      rate_a = int(sys.argv[2])
+   if len(sys.argv) > 3:
+      rate_b = int(sys.argv[3])
+
+   data = os.urandom( size_mb * 1024 * 1024 )
+   chunksize = 65536
+
+   print str(size_mb) + " MB in chunks of " + str(chunksize / 1024) + " KB over rate-limited loopback links"
+   send( data, chunksize, [rate_a * 1024 * 1024] )
+   send( data, chunksize, [rate_b * 1024 * 1024] )
+   send( data, chunksize, [rate_a * 1024 * 1024, rate_b * 1024 * 1024] )
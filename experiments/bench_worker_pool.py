@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+"""
+=============
+Benchmark:  a fresh thread per transfer versus reusable worker pools.
+=============
+Purpose:
+    To measure what iftd gains by running transfer and protocol threads on the workers of
+    iftutil.iftworkers, instead of starting a new thread for every task:  how many tasks get
+    run instead of turned away when load spikes, how fast short tasks go through, and how
+    many threads it takes.
+
+Setup:
+    Thousands of short "transfers" (each holds its thread for about a millisecond, as a
+    small file's receive loop does while it waits on the network) are submitted as fast
+    as possible, three ways:
+       * legacy-counter:  the old iftutil.iftthreading, which starts a thread per task, counts
+                          the live ones by scanning them all, and rejects a task once its limit
+                          is reached (copied below, with the copy module it needs imported;
+                          without it every task is rejected)
+       * raw-threads:     thread.start_new_thread per task with no limit, as begin_ift_recv did
+                          for each receiving protocol
+       * pool:            iftutil.iftworkers, with the same limit on running tasks as
+                          legacy-counter and iftd's default queue length
+    Each run reports how many tasks ran and were rejected, tasks per second, the most
+    threads alive at once, and how many threads were started.
+
+Expected result:
+    legacy-counter turns most of a burst away as soon as its limit is reached, and its
+    scan makes each submission slower as the limit grows.  raw-threads runs everything but
+    starts a thread per task and has no bound on how many are alive.  The pool runs every
+    task, starting no more threads than its limit, with the submitter slowed down by the
+    queue instead of its tasks being dropped.
+
+Usage:
+    bench_worker_pool.py [number of transfers] [thread limit]
+"""
+
+import sys
+import time
+import copy
+import thread
+import threading
+from collections import deque
+
+sys.path.append( "../" )
+
+import iftutil
+
+
+class iftthreading:
+   """
+   The thread "pool" before iftutil.iftworkers:  a thread per task, and a limit on live ones.
+   """
+
+   __threads = None
+   __alive = None
+   __num_threads = 0
+   __threads_lock = threading.BoundedSemaphore(1)
+
+   def __purge_dead(self):
+      self.__alive.clear()
+      for t in self.__threads:
+         if t.isAlive():
+            self.__alive.append( t )
+
+      self.__threads = copy.copy(self.__alive)
+
+   def __init__(self, num_threads):
+      self.__threads = deque( [] )
+      self.__alive = deque( [] )
+      self.__num_threads = num_threads
+
+   def start_new_thread(self, func, arguments, block=False):
+      good = True
+      self.__threads_lock.acquire()
+      self.__purge_dead()
+      if len(self.__threads) >= self.__num_threads:
+         good = False
+      self.__threads_lock.release()
+
+      if not good:
+         return good
+
+      t = threading.Thread( target=func, args=arguments )
+      self.__threads.append(t)
+      t.start()
+      return True
+
+
+lock = threading.Lock()
+counts = {"done": 0, "alive": 0, "peak": 0, "threads": set()}
+
+def short_transfer():
+   lock.acquire()
+   counts["alive"] += 1
+   counts["peak"] = max( counts["peak"], counts["alive"] )
+   counts["threads"].add( thread.get_ident() )
+   lock.release()
+
+   time.sleep( 0.001 )
+
+   lock.acquire()
+   counts["alive"] -= 1
+   counts["done"] += 1
+   lock.release()
+
+
+def run( name, submit, count ):
+   counts["done"] = 0
+   counts["alive"] = 0
+   counts["peak"] = 0
+   counts["threads"] = set()
+
+   start_time = time.time()
+   accepted = 0
+   for i in xrange(0, count):
+      if submit():
+         accepted += 1
+
+   while counts["done"] < accepted:
+      time.sleep( 0.001 )
+
+   elapsed = time.time() - start_time
+   print "%-15s ran %6d  rejected %6d  %9.0f tasks/s  peak running %5d  threads started %6d" % (name, accepted, count - accepted, accepted / elapsed, counts["peak"], len(counts["threads"]))
+
+
+if __name__ == "__main__":
+   count = 5000
+   limit = iftutil.MAX_RECEIVER_THREADS
+   if len(sys.argv) > 1:
+      count = int(sys.argv[1])
+   if len(sys.argv) > 2:
+      limit = int(sys.argv[2])
+
+   legacy = iftthreading( limit )
+   run( "legacy-counter", lambda: legacy.start_new_thread( short_transfer, () ), count )
+
+   def raw():
+      thread.start_new_thread( short_transfer, () )
+      return True
+
+   run( "raw-threads", raw, count )
+
+   pool = iftutil.iftworkers( "bench", limit )
+   run( "pool", lambda: pool.start_new_thread( short_transfer, () ), count )
+   print pool.stats()
+   pool.shutdown()
@@ -23,6 +23,11 @@ import iftutil
 from iftdata import *
 import iftloader
 import iftcore
+import iftmerkle
+import iftjournal
+import iftdelta
+import iftstore
+import iftcodec
 from iftcore.consts import *
 from ifttransfer import *
 
@@ -37,6 +42,7 @@ import random
 import httplib
 import stat
 import socket
+import uuid
 
 import protocols
 
@@ -57,6 +63,27 @@ PROTOCOLS = {}
 # specify True/False (or None) if there is a known remote IFTD port
 IFTD_REMOTE_PORT = "IFTD_REMOTE_PORT"
 
+# default number of a batch's files to transfer at once (see begin_ift_batch)
+BATCH_CONCURRENCY = 4
+
+# idle instances of each protocol kept to run later transfers (see protocol_pool)
+PROTOCOL_POOL_SIZE = 8
+
+# transfers started with submit_ift
+# handle ==> ift_transfer
+TRANSFERS = {}
+TRANSFERS_LOCK = threading.Lock()
+
+# how long to remember a submitted transfer's status after it finishes (seconds)
+TRANSFER_KEEP = 3600.0
+
+# states of a submitted transfer
+TRANSFER_NEGOTIATING = "negotiating"
+TRANSFER_RUNNING = "running"
+TRANSFER_SUCCEEDED = "succeeded"
+TRANSFER_FAILED = "failed"
+TRANSFER_CANCELLED = "cancelled"
+
 
 
 iftd_alive = False
@@ -111,6 +138,7 @@ def iftd_setup(given_protocols, config_filename):
                continue
          
             PROTOCOLS[proto.name] = proto
+            PROTOCOL_POOL.clear()      # idle instances were cloned from the old one
             
             iftlog.log(3, "protocol_setup: set up " + proto_name + " as " + proto.name)
    
@@ -289,6 +317,149 @@ def protocol_shutdown( shutdown_arg_dict=None ):
 
 
 
+def job_protocols( job ):
+   """
+   Get the names of the protocols to use for a job:  the ones it asks for that we have, or all of ours.
+   """
+   available_protocols = job.get_attr( iftfile.JOB_ATTR_PROTOS )
+   if available_protocols == None or len(available_protocols) == 0:
+      return list_protocols()
+   
+   absent = []
+   
+   # make sure that they are all defined
+   for proto in available_protocols:
+      if proto not in PROTOCOLS.keys():
+         absent.append( proto )
+      
+   
+   for proto in absent:
+      iftlog.log(3, "begin_ift: unrecognized protocol " + proto + ", ignoring..." )
+      available_protocols.remove( proto )
+   
+   return available_protocols
+
+
+
+def fill_connect_dict( connect_dict ):
+   """
+   Make sure there is a dictionary of connection arguments for every protocol in connect_dict.
+   Return connect_dict (a new one if it was None).
+   """
+   if connect_dict == None:
+      connect_dict = {}
+   
+   for proto in list_protocols():
+      cd = connect_dict.get(proto)
+      if cd == None:
+         connect_dict[proto] = {}
+   
+   return connect_dict
+
+
+
+class protocol_pool:
+   """
+   Idle protocol instances, reset after their last transfer and ready to run another.
+
+   An instance is checked out for a transfer, and checked back in once the
+   transfer has cleaned it up.  Up to max_idle instances of each protocol
+   are kept; the rest are dropped.  Only protocols that can be reset
+   (transmitter.reset) are kept at all.  When no idle instance is left,
+   the vanilla instance in PROTOCOLS is cloned, so a protocol's setup()
+   still runs only once.
+   """
+   
+   def __init__( self, max_idle=PROTOCOL_POOL_SIZE ):
+      self.max_idle = max_idle
+      self.idle = {}       # protocol name ==> idle instances
+      self.lock = threading.Lock()
+      self.hits = 0        # checkouts that got an idle instance
+      self.misses = 0      # checkouts that cloned the vanilla instance
+      self.dropped = 0     # instances checked in but not kept
+   
+   
+   def checkout( self, proto_name ):
+      """
+      Get an instance of the named protocol to run a transfer with.
+      """
+      self.lock.acquire()
+      idle = self.idle.get( proto_name )
+      if idle:
+         self.hits += 1
+         proto = idle.pop()
+         self.lock.release()
+         return proto
+      
+      self.misses += 1
+      self.lock.release()
+      
+      # clone the vanilla protocol so we can run more than one concurrently
+      return copy.deepcopy( PROTOCOLS[proto_name] )
+   
+   
+   def checkin( self, proto ):
+      """
+      Give back an instance whose transfer has cleaned it up.
+      Return True if it was kept for another transfer.
+      """
+      try:
+         rc = proto.reset()
+      except Exception, inst:
+         iftlog.exception( "protocol_pool: could not reset " + str(proto.name), inst )
+         rc = E_UNHANDLED_EXCEPTION
+      
+      self.lock.acquire()
+      try:
+         idle = self.idle.setdefault( proto.name, [] )
+         if rc != 0 or len(idle) >= self.max_idle or PROTOCOLS.get( proto.name ) in (None, proto) or proto in idle:
+            self.dropped += 1
+            return False
+         
+         idle.append( proto )
+         return True
+      finally:
+         self.lock.release()
+   
+   
+   def clear( self ):
+      """
+      Drop every idle instance (i.e. when the vanilla instances change).
+      """
+      self.lock.acquire()
+      self.idle = {}
+      self.lock.release()
+   
+   
+   def stats( self ):
+      """
+      Get a dictionary of how often checkouts found an idle instance, and how many are idle.
+      """
+      self.lock.acquire()
+      ret = {"hits": self.hits, "misses": self.misses, "dropped": self.dropped, "idle": dict( [(name, len(idle)) for (name, idle) in self.idle.items()] )}
+      self.lock.release()
+      return ret
+
+
+PROTOCOL_POOL = protocol_pool()
+
+
+def clone_protocol( proto_name ):
+   """
+   Get an instance of a protocol to run a transfer with (see protocol_pool.checkout).
+   """
+   return PROTOCOL_POOL.checkout( proto_name )
+
+
+def release_protocols( protos ):
+   """
+   Give back protocol instances whose transfer has cleaned them up (see protocol_pool.checkin).
+   """
+   for proto in protos:
+      PROTOCOL_POOL.checkin( proto )
+
+
+
 def begin_ift( job_attrs, connect_dict=None, sender=False, receiver=False, iftd_remote_port=USER_PORT+1, iftd_xmlrpc_path="/RPC2", user_timeout=60 ):
    """
    Initiate an intelligent file transmission, using the local and remote iftd instances' previous knowledge
@@ -326,9 +497,19 @@ def begin_ift( job_attrs, connect_dict=None, sender=False, receiver=False, iftd_
   
    iftlog.log(5, ">>> begin_ift entered <<<")
    
-   global PROTOCOLS
+   return run_ift( job_attrs, connect_dict, sender, receiver, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+
+
+
+def run_ift( job_attrs, connect_dict, sender, receiver, iftd_remote_port, iftd_xmlrpc_path, user_timeout, transfer=None ):
+   """
+   Carry out begin_ift.  If given, transfer is the ift_transfer through which
+   the transfer is watched and cancelled (see submit_ift).
+   """
    
    job = iftfile.iftjob( job_attrs )
+   if transfer != None:
+      transfer.job = job
    
    # sanity check
    if sender and receiver:
@@ -338,50 +519,571 @@ def begin_ift( job_attrs, connect_dict=None, sender=False, receiver=False, iftd_
       return -1      # cannot do
    
    # get the available protocols
-   available_protocols = job.get_attr( iftfile.JOB_ATTR_PROTOS )
-   if available_protocols == None or len(available_protocols) == 0:
-      available_protocols = list_protocols()
-   else:
-      absent = []
-      
-      # make sure that they are all defined
-      for proto in available_protocols:
-         if proto not in PROTOCOLS.keys():
-            absent.append( proto )
-         
-      
-      for proto in absent:
-         iftlog.log(3, "begin_ift: unrecognized protocol " + proto + ", ignoring..." )
-         available_protocols.remove( proto )
+   available_protocols = job_protocols( job )
    
    # stuff the relevant data into connect_dict if needed
-   if connect_dict == None:
-      connect_dict = {}
-   
-   
-   for proto in list_protocols():
-      cd = connect_dict.get(proto)
-      if cd == None:
-         connect_dict[proto] = {}
-         cd = connect_dict[proto]
-      
+   connect_dict = fill_connect_dict( connect_dict )
    
    # am I the sender or receiver?
    # Have the sender contact the remote iftd instance for protocol information.
    if sender:
-      rc = iftsend( job, available_protocols, connect_dict, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+      rc = iftsend( job, available_protocols, connect_dict, iftd_remote_port, iftd_xmlrpc_path, user_timeout, transfer )
       iftlog.log(5, ">>> begin_ift rc=" + str(rc) + " <<<")
       return rc
    else:
-      rc = iftreceive( job, available_protocols, connect_dict, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+      rc = iftreceive( job, available_protocols, connect_dict, iftd_remote_port, iftd_xmlrpc_path, user_timeout, transfer )
       iftlog.log(5, ">>> begin_ift rc=" + str(rc) + " <<<")
       return rc
 
 
 
+class ift_transfer:
+   """
+   A transfer started by submit_ift, running in a thread of its own.
+   """
+   
+   def __init__( self, handle, sender ):
+      self.handle = handle
+      self.sender = sender
+      self.job = None
+      self.xmit_id = None        # set once negotiation gets far enough to identify the transmission
+      self.peer = None           # control_client for the other iftd
+      self.rc = None
+      self.cancelled = False
+      self.submit_time = time.time()
+      self.start_time = None
+      self.end_time = None
+      self.progress = (0, None, 0, [])    # last seen (chunks done, number of chunks, bytes done, protocols running)
+      self.finished = threading.Event()
+      self.lock = threading.Lock()
+   
+   
+   def started( self, xmit_id, peer ):
+      """
+      Called by iftsend and iftreceive once they know the transmission's ID.
+      Return False if the transfer has been cancelled, in which case it should stop.
+      """
+      self.lock.acquire()
+      try:
+         self.peer = peer
+         if self.cancelled:
+            return False
+         
+         self.xmit_id = xmit_id
+         self.start_time = time.time()
+         return True
+      finally:
+         self.lock.release()
+   
+   
+   def finish( self, rc ):
+      """
+      Record how the transfer ended.
+      """
+      self.lock.acquire()
+      try:
+         if self.cancelled:
+            rc = E_CANCELLED
+         
+         if rc == 0:
+            chunks, num_chunks, num_bytes, protos = self.progress
+            file_size = None
+            if self.job != None:
+               file_size = self.job.get_attr( iftfile.JOB_ATTR_FILE_SIZE )
+            
+            if num_chunks != None:
+               chunks = num_chunks
+            if file_size != None:
+               num_bytes = file_size
+            
+            self.progress = (chunks, num_chunks, num_bytes, [])
+         else:
+            self.progress = self.progress[:3] + ([],)
+         
+         self.rc = rc
+         self.end_time = time.time()
+      finally:
+         self.lock.release()
+      
+      self.finished.set()
+   
+   
+   def cancel( self ):
+      """
+      Cancel the transfer.  Its protocols stop, and it cleans up and finishes with E_CANCELLED.
+      Return 0, or E_BAD_STATE if it has already finished.
+      """
+      self.lock.acquire()
+      if self.end_time != None:
+         self.lock.release()
+         return E_BAD_STATE
+      
+      self.cancelled = True
+      xmit_id = self.xmit_id
+      self.lock.release()
+      
+      if xmit_id == None:
+         return 0      # still negotiating; it stops once it gets far enough to notice
+      
+      if self.sender:
+         TransferCore.cancel_send( xmit_id )
+         cancel_remote( self.peer, xmit_id )
+      else:
+         TransferCore.cancel_recv( xmit_id )
+      
+      return 0
+   
+   
+   def __poll( self ):
+      """
+      Update our progress from the transmission.  Call with the lock held.
+      """
+      if self.sender:
+         progress = TransferCore.send_progress( self.xmit_id )
+         if progress != None:
+            self.progress = progress
+         
+         return
+      
+      progress = TransferCore.recv_progress( self.xmit_id )
+      if progress != None:
+         chunks, num_chunks, chunk_size, protos = progress
+         num_bytes = chunks * chunk_size
+         file_size = self.job.get_attr( iftfile.JOB_ATTR_FILE_SIZE )
+         if file_size != None:
+            num_bytes = min( num_bytes, file_size )
+         
+         self.progress = (chunks, num_chunks, num_bytes, protos)
+   
+   
+   def status( self ):
+      """
+      Report on the transfer (see ift_status).
+      """
+      self.lock.acquire()
+      try:
+         if self.xmit_id != None and self.end_time == None:
+            self.__poll()
+         
+         chunks, num_chunks, num_bytes, protos = self.progress
+         
+         file_name = None
+         file_size = None
+         if self.job != None:
+            file_size = self.job.get_attr( iftfile.JOB_ATTR_FILE_SIZE )
+            if self.sender:
+               file_name = self.job.get_attr( iftfile.JOB_ATTR_SRC_NAME )
+            else:
+               file_name = self.job.get_attr( iftfile.JOB_ATTR_DEST_NAME )
+         
+         now = time.time()
+         if self.end_time != None:
+            now = self.end_time
+         
+         if self.end_time != None:
+            if self.rc == 0:
+               state = TRANSFER_SUCCEEDED
+            elif self.rc == E_CANCELLED:
+               state = TRANSFER_CANCELLED
+            else:
+               state = TRANSFER_FAILED
+         elif self.start_time != None:
+            state = TRANSFER_RUNNING
+         else:
+            state = TRANSFER_NEGOTIATING
+         
+         # estimate the time left from the rate so far
+         eta = None
+         if state == TRANSFER_RUNNING and file_size != None and num_bytes > 0:
+            rate = num_bytes / max( now - self.start_time, 0.001 )
+            eta = (file_size - num_bytes) / rate
+         
+         if file_size != None:
+            file_size = float(file_size)
+         
+         # (byte counts are floats, since XML-RPC integers are only 32 bits)
+         return {"handle": self.handle,
+                 "state": state,
+                 "rc": self.rc,
+                 "file": file_name,
+                 "chunks_done": chunks,
+                 "chunks_total": num_chunks,
+                 "bytes_done": float(num_bytes),
+                 "bytes_total": file_size,
+                 "protocols": protos,
+                 "elapsed": now - self.submit_time,
+                 "eta": eta}
+      finally:
+         self.lock.release()
+
+
+
+def cancel_remote( peer, xmit_id ):
+   """
+   Tell the iftd at the other end of a transfer that we have cancelled it.
+   """
+   try:
+      peer.cancel_iftd_transfer( xmit_id )
+   except Exception, inst:
+      iftlog.exception( "cancel_remote: could not tell the remote iftd about cancelling " + str(xmit_id), inst )
+
+
+
+def submit_ift( job_attrs, connect_dict=None, sender=False, receiver=False, iftd_remote_port=USER_PORT+1, iftd_xmlrpc_path="/RPC2", user_timeout=60 ):
+   """
+   Start a transfer as begin_ift would, but in the background.
+   Takes the same arguments as begin_ift.
+   At most iftutil.MAX_SUBMIT_THREADS submitted transfers run at once; the rest wait their turn.
+   
+   @return
+      A handle for the transfer, to pass to ift_status, wait_ift and cancel_ift
+   """
+   
+   forget_transfers()
+   
+   handle = uuid.uuid4().hex
+   transfer = ift_transfer( handle, sender )
+   
+   TRANSFERS_LOCK.acquire()
+   TRANSFERS[ handle ] = transfer
+   TRANSFERS_LOCK.release()
+   
+   # waits for room in the submit pool if it is saturated
+   started = iftutil.SubmitThreadPool.start_new_thread( run_submitted, (transfer, job_attrs, connect_dict, sender, receiver, iftd_remote_port, iftd_xmlrpc_path, user_timeout), True, iftutil.POOL_SUBMIT_TIMEOUT )
+   if not started:
+      iftlog.log(5, "submit_ift: could not queue transfer " + handle)
+      transfer.finish( E_TRY_AGAIN )
+      return handle
+   
+   iftlog.log(3, "submit_ift: transfer " + handle + " submitted")
+   return handle
+
+
+
+def run_submitted( transfer, job_attrs, connect_dict, sender, receiver, iftd_remote_port, iftd_xmlrpc_path, user_timeout ):
+   """
+   Run a transfer given to submit_ift.
+   """
+   rc = E_UNHANDLED_EXCEPTION
+   try:
+      rc = run_ift( job_attrs, connect_dict, sender, receiver, iftd_remote_port, iftd_xmlrpc_path, user_timeout, transfer )
+   except Exception, inst:
+      iftlog.exception( "run_submitted: transfer " + transfer.handle + " failed", inst )
+   
+   transfer.finish( rc )
+   iftlog.log(3, "run_submitted: transfer " + transfer.handle + " finished with rc=" + str(transfer.rc))
+
+
+
+def forget_transfers():
+   """
+   Forget transfers that finished more than TRANSFER_KEEP seconds ago.
+   """
+   now = time.time()
+   TRANSFERS_LOCK.acquire()
+   for (handle, transfer) in TRANSFERS.items():
+      if transfer.end_time != None and now - transfer.end_time > TRANSFER_KEEP:
+         del TRANSFERS[ handle ]
+   
+   TRANSFERS_LOCK.release()
+
+
+
+def ift_status( handle ):
+   """
+   Report on a transfer started with submit_ift.
+   
+   @return
+      None if the handle is unknown (or the transfer finished long ago); otherwise a dictionary with
+         handle:        the transfer's handle
+         state:         "negotiating", "running", "succeeded", "failed" or "cancelled"
+         rc:            begin_ift's return code, once the transfer has finished
+         file:          the file being sent or received
+         chunks_done:   chunks sent or received so far
+         chunks_total:  number of chunks in the file (None until known)
+         bytes_done:    bytes sent or received so far
+         bytes_total:   size of the file (None until known)
+         protocols:     names of the protocols moving data
+         elapsed:       seconds since the transfer was submitted
+         eta:           estimated seconds left (None if there is no estimate)
+   """
+   transfer = TRANSFERS.get( handle )
+   if transfer == None:
+      return None
+   
+   return transfer.status()
+
+
+
+def wait_ift( handle, timeout=None ):
+   """
+   Wait up to timeout seconds (forever if None) for a transfer started with submit_ift to finish.
+   
+   @return
+      The transfer's status (see ift_status)
+   """
+   transfer = TRANSFERS.get( handle )
+   if transfer == None:
+      return None
+   
+   transfer.finished.wait( timeout )
+   return transfer.status()
+
+
+
+def cancel_ift( handle ):
+   """
+   Cancel a transfer started with submit_ift.  The transfer stops its protocols,
+   releases its chunks, removes its chunk directory, and finishes with E_CANCELLED.
+   
+   @return
+      0 on success, E_INVAL if the handle is unknown, or E_BAD_STATE if the transfer has already finished
+   """
+   transfer = TRANSFERS.get( handle )
+   if transfer == None:
+      return E_INVAL
+   
+   return transfer.cancel()
+
 
 
-def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USER_PORT + 1, iftd_xmlrpc_path = "/RPC2", user_timeout = 60 ):
+def begin_ift_batch( jobs_attrs, connect_dict=None, sender=False, receiver=False, iftd_remote_port=USER_PORT+1, iftd_xmlrpc_path="/RPC2", user_timeout=60, max_concurrent=None ):
+   """
+   Transmit several files, as begin_ift would one at a time, but:
+      * the files are transferred max_concurrent at a time, and the next file starts as soon as one finishes
+        (they run on iftutil.SubmitThreadPool, so they count towards its limit along with submit_ift's transfers);
+      * the files about to start are negotiated with each remote iftd in a single round;
+      * protocol instances that have finished one file are started again for the next, rather than cloned.
+   
+   @arg jobs_attrs
+      List of job attribute dictionaries (see begin_ift), one per file
+   
+   @arg connect_dict, sender, receiver, iftd_remote_port, iftd_xmlrpc_path, user_timeout
+      As for begin_ift, and used for every file
+   
+   @arg max_concurrent
+      How many files to transfer at once (default is BATCH_CONCURRENCY)
+   
+   @return
+      List of begin_ift return codes, one per file, in the order the files were given
+   """
+   
+   iftlog.log(5, ">>> begin_ift_batch entered (" + str(len(jobs_attrs)) + " files) <<<")
+   
+   # sanity check
+   if sender == receiver:
+      return [-1] * len(jobs_attrs)      # cannot do
+   
+   if max_concurrent == None or max_concurrent < 1:
+      max_concurrent = BATCH_CONCURRENCY
+   
+   connect_dict = fill_connect_dict( connect_dict )
+   
+   results = [None] * len(jobs_attrs)
+   pending = range(0, len(jobs_attrs))
+   running = [0]
+   cv = threading.Condition()
+   
+   def run_transfer( i, finish_args ):
+      rc = E_UNHANDLED_EXCEPTION
+      try:
+         if sender:
+            rc = finish_send( *finish_args )
+         else:
+            rc = run_receive( *finish_args )
+      except Exception, inst:
+         iftlog.exception( "begin_ift_batch: transfer of file " + str(i) + " failed", inst )
+      
+      cv.acquire()
+      results[i] = rc
+      running[0] -= 1
+      cv.notify()
+      cv.release()
+   
+   while len(pending) > 0:
+      # wait for free slots, then negotiate as many files as will fill them
+      cv.acquire()
+      while running[0] >= max_concurrent:
+         cv.wait()
+      
+      group = pending[:max_concurrent - running[0]]
+      cv.release()
+      del pending[:len(group)]
+      
+      jobs = []
+      for i in group:
+         job = iftfile.iftjob( jobs_attrs[i] )
+         jobs.append( (i, job, job_protocols( job )) )
+      
+      if sender:
+         negotiated = negotiate_send_batch( jobs, connect_dict, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+      else:
+         negotiated = negotiate_receive_batch( jobs, connect_dict, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+      
+      for (i, rc, finish_args) in negotiated:
+         if finish_args == None:
+            results[i] = rc
+            continue
+         
+         cv.acquire()
+         running[0] += 1
+         cv.release()
+         
+         # run on the submit pool, so batches share its limit with submitted transfers.
+         # (on one of its workers, or if it is full for too long, run the transfer here instead of waiting on ourselves)
+         if iftutil.SubmitThreadPool.is_worker() or not iftutil.SubmitThreadPool.start_new_thread( run_transfer, (i, finish_args), True, iftutil.POOL_SUBMIT_TIMEOUT ):
+            run_transfer( i, finish_args )
+   
+   # wait for the last transfers
+   cv.acquire()
+   while running[0] > 0:
+      cv.wait()
+   cv.release()
+   
+   iftlog.log(5, ">>> begin_ift_batch rc=" + str(results) + " <<<")
+   return results
+
+
+
+def call_batch( client, method_name, calls ):
+   """
+   Call method_name on a remote iftd once for each argument list in calls, all
+   in one round trip if it has method_name + "_batch" (one at a time if not).
+   Return the list of results, with None for each call that failed remotely.
+   """
+   try:
+      return client.call( method_name + "_batch", (calls,) )
+   except xmlrpclib.Fault, inst:
+      iftlog.log(3, "call_batch: remote iftd does not have " + method_name + "_batch, calling " + method_name + " for each file")
+   
+   results = []
+   for args in calls:
+      try:
+         results.append( client.call( method_name, tuple(args) ) )
+      except xmlrpclib.Fault, inst:
+         iftlog.log(5, "call_batch: " + method_name + " failed: " + str(inst))
+         results.append( None )
+   
+   return results
+
+
+
+def negotiate_send_batch( jobs, connect_dict, iftd_remote_port, iftd_xmlrpc_path, user_timeout ):
+   """
+   Prepare to send each of jobs (a list of (index, iftjob, available protocols)),
+   and give each receiving iftd the sender data for all of its files in one call.
+   Return a list of (index, rc, finish_send arguments), where the arguments are None if the file failed with rc.
+   """
+   negotiated = []
+   by_host = {}
+   for (i, job, available_protocols) in jobs:
+      rc, state = prepare_send( job, available_protocols, connect_dict, user_timeout )
+      if rc != 0:
+         negotiated.append( (i, rc, None) )
+         continue
+      
+      by_host.setdefault( job.get_attr( iftfile.JOB_ATTR_DEST_HOST ), [] ).append( (i, job, state) )
+   
+   for (recv_host, host_jobs) in by_host.items():
+      recv_xmlrpc = iftutil.control_client( recv_host, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+      try:
+         t1 = time.time()
+         replies = call_batch( recv_xmlrpc, "recv_iftd_sender_data", [state["call_args"] for (i, job, state) in host_jobs] )
+         xmlrpc_response_time = time.time() - t1
+      except Exception, inst:
+         iftlog.exception( "negotiate_send_batch: could not contact receiver " + str(recv_host), inst )
+         for (i, job, state) in host_jobs:
+            abort_send( job, state )
+            negotiated.append( (i, E_NO_CONNECT, None) )
+         continue
+      
+      for k in xrange(0, len(host_jobs)):
+         i, job, state = host_jobs[k]
+         negotiated.append( (i, 0, (job, state, replies[k], xmlrpc_response_time, user_timeout)) )
+   
+   return negotiated
+
+
+
+def negotiate_receive_batch( jobs, connect_dict, iftd_remote_port, iftd_xmlrpc_path, user_timeout ):
+   """
+   Prepare to receive each of jobs (a list of (index, iftjob, available protocols)),
+   getting the sender data for all of a sending iftd's files in one call, and
+   telling it our protocol choices for all of them in one more.
+   Return a list of (index, rc, run_receive arguments), where the arguments are None if the file failed with rc.
+   """
+   negotiated = []
+   by_host = {}
+   for (i, job, available_protocols) in jobs:
+      rc, xmit_id = prepare_receive( job, available_protocols )
+      if rc != 0:
+         negotiated.append( (i, rc, None) )
+         continue
+      
+      by_host.setdefault( job.get_attr( iftfile.JOB_ATTR_SRC_HOST ), [] ).append( (i, job, available_protocols, xmit_id) )
+   
+   for (send_host, host_jobs) in by_host.items():
+      send_xmlrpc = iftutil.control_client( send_host, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+      
+      # ask the sender about all the files at once (files with no sender data go without a remote IFTD)
+      sender_data = {}
+      xmlrpc_response_time = 0
+      remote_jobs = [entry for entry in host_jobs if entry[1].get_attr( iftfile.JOB_ATTR_REMOTE_IFTD ) != False]
+      try:
+         if len(remote_jobs) > 0:
+            t1 = time.time()
+            replies = call_batch( send_xmlrpc, "get_iftd_sender_data", [(xmit_id, job.attrs, receivers( available_protocols ), connect_dict) for (i, job, available_protocols, xmit_id) in remote_jobs] )
+            xmlrpc_response_time = time.time() - t1
+            for k in xrange(0, len(remote_jobs)):
+               sender_data[ remote_jobs[k][0] ] = replies[k]
+         
+      except socket.error, inst:
+         pass
+      
+      except Exception, inst:
+         iftlog.exception( "negotiate_receive_batch: could not get sender data from " + str(send_host), inst )
+         for (i, job, available_protocols, xmit_id) in host_jobs:
+            negotiated.append( (i, E_NO_CONNECT, None) )
+         continue
+      
+      choosing = []
+      for (i, job, available_protocols, xmit_id) in host_jobs:
+         if sender_data.has_key( i ) and sender_data[i] == None:
+            negotiated.append( (i, E_NO_CONNECT, None) )
+            continue
+         
+         rc, state = setup_receive( job, available_protocols, connect_dict, xmit_id, sender_data.get( i ), xmlrpc_response_time, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+         if rc != 0:
+            negotiated.append( (i, rc, None) )
+         elif state["choice_args"] == None:
+            negotiated.append( (i, 0, (job, state, None, send_xmlrpc)) )
+         else:
+            choosing.append( (i, job, state) )
+      
+      if len(choosing) == 0:
+         continue
+      
+      # inform the sender of our choices
+      try:
+         replies = call_batch( send_xmlrpc, "send_iftd_receiver_choice", [state["choice_args"] for (i, job, state) in choosing] )
+      except Exception, inst:
+         iftlog.exception( "negotiate_receive_batch: could not begin to receive from " + str(send_host), inst )
+         for (i, job, state) in choosing:
+            abort_receive( job, state )
+            negotiated.append( (i, E_UNHANDLED_EXCEPTION, None) )
+         continue
+      
+      for k in xrange(0, len(choosing)):
+         i, job, state = choosing[k]
+         negotiated.append( (i, 0, (job, state, replies[k], send_xmlrpc)) )
+   
+   return negotiated
+
+
+
+
+
+def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USER_PORT + 1, iftd_xmlrpc_path = "/RPC2", user_timeout = 60, transfer = None ):
    """
    Intelligently send a file to a remote host.
    
@@ -402,6 +1104,43 @@ def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USE
    
    @arg user_timeout
       Timeout for XML-RPC calls
+   
+   @arg transfer
+      ift_transfer to report to, if the transfer was submitted (see submit_ift)
+   """
+   
+   rc, state = prepare_send( job, available_protocols, connect_dict, user_timeout )
+   if rc != 0:
+      return rc
+   
+   # send our data to the receiver so it can begin listening
+   recv_xmlrpc = iftutil.control_client( job.get_attr( iftfile.JOB_ATTR_DEST_HOST ), iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+   
+   try:
+      t1 = time.time()
+      dat = recv_xmlrpc.call( "recv_iftd_sender_data", state["call_args"] )
+      t2 = time.time()
+   except Exception, inst:
+      iftlog.exception( "iftsend: could not contact receiver!", inst )
+      abort_send( job, state )
+      return E_NO_CONNECT
+   
+   if transfer != None and not transfer.started( state["xmit_id"], recv_xmlrpc ):
+      # cancelled while the receiver was getting ready
+      abort_send( job, state )
+      cancel_remote( recv_xmlrpc, state["xmit_id"] )
+      return E_CANCELLED
+   
+   return finish_send( job, state, dat, t2 - t1, user_timeout )
+
+
+
+def prepare_send( job, available_protocols, connect_dict, user_timeout ):
+   """
+   Get ready to send a file:  make its chunks, start the passive senders,
+   and work out what to tell the receiver.
+   Return (0, send state) on success, or (error rc, None).
+   The receiver's iftd is then called with recv_iftd_sender_data( *state["call_args"] ).
    """
    
    from iftdata import SEND_FILES_DIR
@@ -411,7 +1150,7 @@ def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USE
    recv_host = job.get_attr( iftfile.JOB_ATTR_DEST_HOST )
    if recv_host == None:
       iftlog.log(5, "iftsend: remote host not defined")
-      return E_INVAL
+      return (E_INVAL, None)
    
    # can we even proceed to read this?
    filename = job.get_attr( iftfile.JOB_ATTR_SRC_NAME )
@@ -419,28 +1158,29 @@ def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USE
    # sanity check
    if filename == None:
       iftlog.log(5, "iftsend: filename is not specified!")
-      return E_INVAL
+      return (E_INVAL, None)
    
    if not os.path.exists( filename ):
       iftlog.log(5, "iftsend: file " + filename + " does not exist!")
-      return E_FILE_NOT_FOUND
+      return (E_FILE_NOT_FOUND, None)
    
    if not (stat.S_IWUSR & os.stat( filename ).st_mode):
       iftlog.log(5, "iftsend: cannot read file " + filename)
-      return E_IOERROR
+      return (E_IOERROR, None)
    
    if SEND_FILES_DIR[-1] != "/":
       SEND_FILES_DIR = SEND_FILES_DIR + "/"
    
    if not filename.startswith(SEND_FILES_DIR, 0, len(SEND_FILES_DIR)):
       iftlog.log(5, "iftsend: cannot send file " + filename + ", it is not in " + SEND_FILES_DIR )
-      return E_FILE_NOT_FOUND
+      return (E_FILE_NOT_FOUND, None)
    
    # prepare to send
-   rc, file_hash, chunk_hashes, chunk_data = prepare_sender( job.get_attr( iftfile.JOB_ATTR_SRC_NAME ), job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE) )
+   use_views = (job.get_attr( iftfile.JOB_ATTR_CHUNK_VIEWS ) == True)
+   rc, file_hash, chunk_hashes, chunk_data = prepare_sender( job.get_attr( iftfile.JOB_ATTR_SRC_NAME ), job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE), use_views )
    if rc != 0:
       iftlog.log(5, "iftsend: could not prepare to send")
-      return rc
+      return (rc, None)
    
    job.set_attr( iftfile.JOB_ATTR_GIVEN_CHUNKS, True )      # we will be given chunks out of band
    job.set_meta( iftfile.JOB_ATTR_GIVEN_CHUNKS, Queue.Queue(0) )  # use a blocking queue to get chunks within
@@ -457,9 +1197,31 @@ def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USE
    if job.get_attr( iftfile.JOB_ATTR_FILE_TYPE ) == None:
       job.set_attr( iftfile.JOB_ATTR_FILE_TYPE, iftstats.fset_filetype( job.attrs ) )
    
-   # pass receiver the chunk hashes
-   if job.get_attr( iftfile.JOB_ATTR_CHUNK_HASHES ) == None:
+   # offer the receiver a codec to compress chunks with, unless the file won't compress
+   codec = iftcodec.choose( job.get_attr( iftfile.JOB_ATTR_CODEC ), job.get_attr( iftfile.JOB_ATTR_CODEC_LEVEL ), job.get_attr( iftfile.JOB_ATTR_FILE_TYPE ),
+                            [iftfile.chunk_data_str( c[0] ) for c in chunk_data[0:iftcodec.CODEC_SAMPLE_CHUNKS]] )
+   if codec == None:
+      codec = [iftcodec.CODEC_NONE, None]
+   
+   job.set_attr( iftfile.JOB_ATTR_CODEC, codec[0] )
+   job.set_attr( iftfile.JOB_ATTR_CODEC_LEVEL, codec[1] )
+   job.set_attr( iftfile.JOB_ATTR_CHUNK_CODEC, None )       # until the receiver agrees to it
+   
+   # pass receiver the chunk hashes, or just the root of their Merkle tree
+   # (unless it needs all the hashes to look for chunks it already has)
+   merkle_tree = None
+   if job.get_attr( iftfile.JOB_ATTR_MERKLE_HASHES ) == True:
+      merkle_tree = iftmerkle.merkle_tree( chunk_hashes )
+      job.set_attr( iftfile.JOB_ATTR_MERKLE_ROOT, merkle_tree.root() )
+   
+   if merkle_tree != None and not wants_chunk_hashes( job.attrs ):
+      chunk_hashes = []
+   
+   elif job.get_attr( iftfile.JOB_ATTR_CHUNK_HASHES ) == None:
       job.set_attr( iftfile.JOB_ATTR_CHUNK_HASHES, chunk_hashes )
+   
+   if job.get_attr( iftfile.JOB_ATTR_DELTA ) == True:
+      job.set_attr( iftfile.JOB_ATTR_WEAK_SUMS, iftdelta.weak_sums( [iftfile.chunk_data_str( c[0] ) for c in chunk_data] ) )
       
    job.set_attr( iftfile.JOB_ATTR_SRC_CHUNK_DIR, iftfile.get_chunks_dir( filename, file_hash, True ) )
    
@@ -480,8 +1242,7 @@ def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USE
          
       proto = None
       try:
-         # clone the vanilla protocol so we can run more than one concurrently
-         proto = copy.deepcopy( PROTOCOLS[proto_name] )
+         proto = clone_protocol( proto_name )
          proto.assign_job( job )
       except Exception, inst:
          iftlog.exception("iftsend: cannot clone " + proto_name + ", skipping...", inst)
@@ -490,7 +1251,7 @@ def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USE
    
    # start up the passive sending protocols
    passive_protos = start_passive_protos( user_job=job, connect_dict=connect_dict, protos=proto_list, timeout=1.0 )
-   TransferCore.begin_ift_send( xmit_id, job, chunk_data, job.get_attr( iftfile.JOB_ATTR_CHUNK_TIMEOUT ), connect_dict )
+   TransferCore.begin_ift_send( xmit_id, job, chunk_data, job.get_attr( iftfile.JOB_ATTR_CHUNK_TIMEOUT ), connect_dict, merkle_tree )
    TransferCore.run_ift_send_passive( xmit_id, job, passive_protos, user_timeout )
    
    iftlog.log(1, "iftsend: passive senders started: " + str([p.name for p in passive_protos]))
@@ -498,42 +1259,75 @@ def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USE
    # expect acknowledgement from the receiver...
    TransferCore.add_receiver_ack( xmit_id )
    
-   # send our data to the receiver so it can begin listening
-   recv_xmlrpc = make_XMLRPC_client( host=recv_host, port=iftd_remote_port, xmlrpc_dir=iftd_xmlrpc_path, timeout = user_timeout )
+   from iftdata import USER_PORT
+   from iftdata import RPC_DIR
+   
+   state = {
+      "xmit_id": xmit_id,
+      "file_hash": file_hash,
+      "chunk_data": chunk_data,
+      "proto_list": proto_list,
+      "passive_protos": passive_protos,
+      "connect_dict": connect_dict,
+      "call_args": (xmit_id, job.attrs, available_protocols, connect_dict, chunk_hashes, "http://" + job.get_attr( iftfile.JOB_ATTR_SRC_HOST ) + ":" + str(USER_PORT+1) + "/" + RPC_DIR)
+   }
+   return (0, state)
+
+
+
+def abort_send( job, state ):
+   """
+   Clean up after a send that prepare_send began, but that cannot go on.
+   """
+   release_protocols( state["passive_protos"] )
+   iftfile.release_chunk_views( state["chunk_data"] )
+   iftfile.cleanup_chunks_dir( job.get_attr( iftfile.JOB_ATTR_SRC_NAME ), state["file_hash"] )
+
+
+
+def finish_send( job, state, dat, xmlrpc_response_time, user_timeout ):
+   """
+   Send a file that prepare_send got ready, given the receiver's reply (dat) to
+   recv_iftd_sender_data and how long it took.  Afterwards, the protocol instances
+   that sent it go back to the protocol pool.
+   Return 0 on success, or the error rc.
+   """
+   
+   xmit_id = state["xmit_id"]
+   chunk_data = state["chunk_data"]
    
-   xmlrpc_response_time = 0
    try:
-      from iftdata import USER_PORT
-      from iftdata import RPC_DIR
-      
-      t1 = time.time()
-      dat = recv_xmlrpc.recv_iftd_sender_data( xmit_id, job.attrs, available_protocols, connect_dict, chunk_hashes, "http://" + job.get_attr( iftfile.JOB_ATTR_SRC_HOST ) + ":" + str(USER_PORT+1) + "/" + RPC_DIR )
-      t2 = time.time()
-      xmlrpc_response_time = t2 - t1
-      
-      if dat[1] == None and dat[2] == None and dat[3] == None:
+      if dat == None or (dat[1] == None and dat[2] == None and dat[3] == None):
          iftlog.log(5, "iftsend: could not connect to the receiver!")
+         abort_send( job, state )
          return E_NO_CONNECT
       
       # unpack data
       ack_id = dat[0]
       remote_chunk_dir = dat[1]
       best_proto_name = dat[2]
-      available_proto_names = proto_names( dat[3] )
-      
-      if ack_id != xmit_id:
-         iftlog.log(5, "iftsend: Out-of-sequence ACK will not be handled!")
-         return E_NO_CONNECT
-      
-      # store remote chunk dir
-      job.set_attr( iftfile.JOB_ATTR_DEST_CHUNK_DIR, remote_chunk_dir )
+      available_proto_names = proto_names( dat[3] )
       
+      # the receiver may have some of the file already (i.e. from an earlier attempt)
+      if len(dat) > 4 and ack_id == xmit_id:
+         TransferCore.set_receiver_chunks( xmit_id, dat[4] )
       
+      # the receiver may have agreed to have chunks compressed
+      if len(dat) > 5 and ack_id == xmit_id:
+         job.set_attr( iftfile.JOB_ATTR_CHUNK_CODEC, dat[5] )
    except Exception, inst:
-      iftlog.exception( "iftsend: could not contact receiver!", inst )
-      iftfile.cleanup_chunks_dir( job.get_attr( iftfile.JOB_ATTR_SRC_NAME ), file_hash )
+      iftlog.exception( "iftsend: bad reply from receiver!", inst )
+      abort_send( job, state )
+      return E_NO_CONNECT
+   
+   if ack_id != xmit_id:
+      iftlog.log(5, "iftsend: Out-of-sequence ACK will not be handled!")
+      abort_send( job, state )
       return E_NO_CONNECT
    
+   # store remote chunk dir
+   job.set_attr( iftfile.JOB_ATTR_DEST_CHUNK_DIR, remote_chunk_dir )
+   
    # supply the chunks data with the remote chunk dir
    for i in xrange(0, len(chunk_data) ):
       chunk_data[i][3] = remote_chunk_dir
@@ -546,18 +1340,23 @@ def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USE
    
    
    # start active senders
-   active_senders = start_active_protos( user_job=job, connect_dict=connect_dict, protos=proto_list, timeout=xmlrpc_response_time*2 )
+   job.set_attr( iftfile.JOB_ATTR_XMIT_ID, xmit_id )
+   active_senders = start_active_protos( user_job=job, connect_dict=state["connect_dict"], protos=state["proto_list"], timeout=xmlrpc_response_time*2 )
    
    rc = TRANSMIT_STATE_SUCCESS
    receiver_rc = None
    if len(active_senders) > 0:
-      rc, receiver_rc = TransferCore.run_ift_send_active( xmit_id, job, active_senders, user_timeout, best_proto_name == None )
+      rc, receiver_rc = TransferCore.run_ift_send_active( xmit_id, job, active_senders, user_timeout )
    
    else:
       receiver_rc = TransferCore.await_receiver_ack( xmit_id, user_timeout )
+   
+   # the senders that ran have been cleaned, and can start up again for another file
+   release_protocols( state["passive_protos"] + active_senders )
       
    iftlog.log(1, "iftsend is done!")
-   iftfile.cleanup_chunks_dir( job.get_attr( iftfile.JOB_ATTR_SRC_NAME ), file_hash )
+   iftfile.release_chunk_views( chunk_data )
+   iftfile.cleanup_chunks_dir( job.get_attr( iftfile.JOB_ATTR_SRC_NAME ), state["file_hash"] )
    if rc != TRANSMIT_STATE_SUCCESS:
       iftlog.log(5, "iftsend: transmission failed (sender rc = " + str(rc) + ", receiver rc = " + str(receiver_rc) + ")")
       return rc
@@ -567,8 +1366,7 @@ def iftsend( job, available_protocols, connect_dict=None, iftd_remote_port = USE
    
 
 
-
-def iftreceive(  job, available_protocols, connect_dict=None, iftd_remote_port = USER_PORT + 1, iftd_xmlrpc_path = "/RPC2", user_timeout = 60 ):
+def iftreceive(  job, available_protocols, connect_dict=None, iftd_remote_port = USER_PORT + 1, iftd_xmlrpc_path = "/RPC2", user_timeout = 60, transfer = None ):
    """
    Intelligently receive a file to the local host.
    
@@ -589,11 +1387,70 @@ def iftreceive(  job, available_protocols, connect_dict=None, iftd_remote_port =
    
    @arg user_timeout
       Timeout for XML-RPC calls
+   
+   @arg transfer
+      ift_transfer to report to, if the transfer was submitted (see submit_ift)
    """
    
+   rc, xmit_id = prepare_receive( job, available_protocols )
+   if rc != 0:
+      return rc
+   
+   # ask sender for available protocols
+   send_xmlrpc = iftutil.control_client( job.get_attr( iftfile.JOB_ATTR_SRC_HOST ), iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+   
+   if transfer != None and not transfer.started( xmit_id, send_xmlrpc ):
+      return E_CANCELLED
+   
+   dat = None
+   xmlrpc_response_time = 0
+   try:
+      if job.get_attr( iftfile.JOB_ATTR_REMOTE_IFTD ) == False:
+         raise socket.error(111)
+
+      t1 = time.time()
+      dat = send_xmlrpc.get_iftd_sender_data( xmit_id, job.attrs, receivers( available_protocols ), connect_dict )
+      t2 = time.time()
+      xmlrpc_response_time = t2 - t1      # how long did it take to respond?  use this to calculate receiver startup delay
+   except socket.error, inst:
+      # no remote IFTD (setup_receive deals with it)
+      pass
+         
+   except Exception, inst:
+      iftlog.exception( "iftreceive: could not get sender data", inst)
+      return E_NO_CONNECT
+   
+   rc, state = setup_receive( job, available_protocols, connect_dict, xmit_id, dat, xmlrpc_response_time, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+   if rc != 0:
+      return rc
+   
+   if transfer != None and transfer.cancelled:
+      # cancelled before we began listening
+      abort_receive( job, state )
+      return E_CANCELLED
+   
+   # inform the sender of our choice
+   choice_rc = None
+   if state["choice_args"] != None:
+      try:
+         choice_rc = send_xmlrpc.call( "send_iftd_receiver_choice", state["choice_args"] )
+      except Exception, inst:
+         iftlog.exception( "iftreceive: could not begin to receive", inst)
+         abort_receive( job, state )
+         return E_UNHANDLED_EXCEPTION
+   
+   return run_receive( job, state, choice_rc, send_xmlrpc )
+
+
+
+def prepare_receive( job, available_protocols ):
+   """
+   Check that we can receive a job, and work out its transmission ID.
+   Return (0, xmit_id) on success, or (error rc, None).
+   The sender's iftd (if any) is then called with get_iftd_sender_data( xmit_id, job.attrs, receivers( available_protocols ), connect_dict ).
+   """
    
    from iftdata import RECV_FILES_DIR
-   job_attrs = job.attrs
    
    if RECV_FILES_DIR[-1] != "/":
       RECV_FILES_DIR = RECV_FILES_DIR + "/"
@@ -601,89 +1458,114 @@ def iftreceive(  job, available_protocols, connect_dict=None, iftd_remote_port =
    # don't even bother if this isn't to the right path
    if not os.path.abspath( job.get_attr( iftfile.JOB_ATTR_DEST_NAME ) ).startswith( RECV_FILES_DIR, 0, len(RECV_FILES_DIR)):
       iftlog.log(5, "iftreceive: will not receive to " + str(job.get_attr( iftfile.JOB_ATTR_DEST_NAME )) + ", since it is not in " + RECV_FILES_DIR)
-      return E_INVAL
+      return (E_INVAL, None)
 
-
-   send_host = job.get_attr( iftfile.JOB_ATTR_SRC_HOST )
+   # have the sender serve chunks straight out of the file unless one of our receivers needs chunk files
+   if job.get_attr( iftfile.JOB_ATTR_CHUNK_VIEWS ) == None:
+      job.set_attr( iftfile.JOB_ATTR_CHUNK_VIEWS, chunk_views_usable( receivers( available_protocols ) ) )
+   
+   # take what chunks we can from our chunk store
+   if job.get_attr( iftfile.JOB_ATTR_CHUNK_STORE ) == None and iftstore.enabled():
+      job.set_attr( iftfile.JOB_ATTR_CHUNK_STORE, True )
+   
+   # chunks are only compressed when the sender starts the transfer (see recv_iftd_sender_data)
+   if job.get_attr( iftfile.JOB_ATTR_CHUNK_CODEC ) != None:
+      job.set_attr( iftfile.JOB_ATTR_CHUNK_CODEC, None )
+   
    job_str = cPickle.dumps( job.attrs )
    m = hashlib.sha1()
    m.update( job_str )
-   xmit_id = m.hexdigest()
+   return (0, m.hexdigest())
 
-   # ask sender for available protocols
+
+
+def setup_receive( job, available_protocols, connect_dict, xmit_id, dat, xmlrpc_response_time, iftd_remote_port, iftd_xmlrpc_path, user_timeout ):
+   """
+   Given the sender's reply (dat) to get_iftd_sender_data, or None if there is no
+   remote IFTD, start up the receiving protocols and begin listening for the sender.
+   Return (0, receive state) on success, or (error rc, None).
+   If state["choice_args"] is not None, the sender's iftd is then called with
+   send_iftd_receiver_choice( *state["choice_args"] ).
+   """
+   
+   send_host = job.get_attr( iftfile.JOB_ATTR_SRC_HOST )
    sender_available_protos = []
    active_flags = []
-   send_xmlrpc = make_XMLRPC_client( host=send_host, port=iftd_remote_port, xmlrpc_dir=iftd_xmlrpc_path, timeout = user_timeout )
-   
-   xmlrpc_response_time = 0
-   remote_iftd = True
-   if job_attrs.get(iftfile.JOB_ATTR_REMOTE_IFTD) == False:
-      remote_iftd = False
-
+   chunk_hashes = None
+   weak_sums = None
+   remote_iftd = (dat != None)
    best_proto = None
-   try:
-      if remote_iftd == False:
-         raise socket.error(111)
-
-      t1 = time.time()
-      rc, remote_chunk_dir, file_size, file_hash, file_type, sender_available_protos, active_flags, chunk_hashes = send_xmlrpc.get_iftd_sender_data( xmit_id, job.attrs, receivers( available_protocols ), connect_dict )
-      t2 = time.time()
-      xmlrpc_response_time = t2 - t1      # how long did it take to respond?  use this to calculate receiver startup delay
-      if rc != xmit_id:
-         iftlog.log(5, "iftreceive: ERROR: corrupt data from sender!")
-         return E_NO_CONNECT
-      
-      # record remote dir
-      job.set_attr( iftfile.JOB_ATTR_SRC_CHUNK_DIR, remote_chunk_dir )
-      
-      # is the size tolerable?
-      if job.get_attr( iftfile.JOB_ATTR_FILE_SIZE ) != None and job.get_attr( iftfile.JOB_ATTR_FILE_SIZE ) != file_size:
-         iftlog.log(5, "iftreceive: ERROR: file size reported by remote host (" + str(file_size) + ") does not match given file size of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_SIZE )) + "!")
-         return E_NO_CONNECT
-      
-      if job.get_attr( iftfile.JOB_ATTR_FILE_MIN_SIZE ) != None and job.get_attr( iftfile.JOB_ATTR_FILE_MIN_SIZE ) > file_size:
-         iftlog.log(5, "iftreceive: ERROR: file size reported by remote host (" + str(file_size) + ") is smaller than minimum file size of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_MIN_SIZE )) + "!")
-         return E_NO_CONNECT
-     
-      if job.get_attr( iftfile.JOB_ATTR_FILE_MAX_SIZE ) != None and job.get_attr( iftfile.JOB_ATTR_FILE_MAX_SIZE ) < file_size:
-         iftlog.log(5, "iftreceive: ERROR: file size reported by remote host (" + str(file_size) + ") is bigger than maximum file size of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_MAX_SIZE )) + "!")
-         return E_NO_CONNECT
-      
-      # record file size
-      job.set_attr( iftfile.JOB_ATTR_FILE_SIZE, file_size )
-      
-      # record the file hash
-      if job.get_attr( iftfile.JOB_ATTR_FILE_HASH ) == None:
-         job.set_attr( iftfile.JOB_ATTR_FILE_HASH, file_hash )
-      elif job.get_attr( iftfile.JOB_ATTR_FILE_HASH) != file_hash:
-         iftlog.log(5, "iftreceive: ERROR: file hash reported by remote host (" + str(file_hash) + ") does not match given hash of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_HASH) ) + "!")
-         return E_NO_CONNECT
-      
-      # record file type
-      if job.get_attr( iftfile.JOB_ATTR_FILE_TYPE ) == None:
-         job.set_attr( iftfile.JOB_ATTR_FILE_TYPE, file_type )
-      elif job.get_attr( iftfile.JOB_ATTR_FILE_TYPE ) != file_type:
-         iftlog.log(5, "iftreceive: ERROR: file type reported by remote host (" + str(file_type) + ") does not match given file type of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_TYPE) ) + "!")
-         return E_NO_CONNECT
+   
+   if remote_iftd:
+      try:
+         rc, remote_chunk_dir, file_size, file_hash, file_type, sender_available_protos, active_flags, chunk_hashes = dat[0:8]
          
-      # record chunk hashes
-      job.set_attr( iftfile.JOB_ATTR_CHUNK_HASHES, chunk_hashes )
+         # a sender from before Merkle roots (or delta mode) replies with just the above
+         merkle_root = None
+         if len(dat) > 8:
+            merkle_root = dat[8]
+         if len(dat) > 9:
+            weak_sums = dat[9]      # we asked for a delta transfer
+         if rc != xmit_id:
+            iftlog.log(5, "iftreceive: ERROR: corrupt data from sender!")
+            return (E_NO_CONNECT, None)
          
-      #print "src chunk dir: " + remote_chunk_dir
-      
-      iftlog.log(5, "iftreceive: receive " + str(file_size) + " bytes from " + remote_chunk_dir + " via " + str(sender_available_protos))
-   except socket.error, inst:
+         # record remote dir
+         job.set_attr( iftfile.JOB_ATTR_SRC_CHUNK_DIR, remote_chunk_dir )
+         
+         # is the size tolerable?
+         if job.get_attr( iftfile.JOB_ATTR_FILE_SIZE ) != None and job.get_attr( iftfile.JOB_ATTR_FILE_SIZE ) != file_size:
+            iftlog.log(5, "iftreceive: ERROR: file size reported by remote host (" + str(file_size) + ") does not match given file size of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_SIZE )) + "!")
+            return (E_NO_CONNECT, None)
+         
+         if job.get_attr( iftfile.JOB_ATTR_FILE_MIN_SIZE ) != None and job.get_attr( iftfile.JOB_ATTR_FILE_MIN_SIZE ) > file_size:
+            iftlog.log(5, "iftreceive: ERROR: file size reported by remote host (" + str(file_size) + ") is smaller than minimum file size of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_MIN_SIZE )) + "!")
+            return (E_NO_CONNECT, None)
+        
+         if job.get_attr( iftfile.JOB_ATTR_FILE_MAX_SIZE ) != None and job.get_attr( iftfile.JOB_ATTR_FILE_MAX_SIZE ) < file_size:
+            iftlog.log(5, "iftreceive: ERROR: file size reported by remote host (" + str(file_size) + ") is bigger than maximum file size of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_MAX_SIZE )) + "!")
+            return (E_NO_CONNECT, None)
+         
+         # record file size
+         job.set_attr( iftfile.JOB_ATTR_FILE_SIZE, file_size )
+         
+         # record the file hash
+         if job.get_attr( iftfile.JOB_ATTR_FILE_HASH ) == None:
+            job.set_attr( iftfile.JOB_ATTR_FILE_HASH, file_hash )
+         elif job.get_attr( iftfile.JOB_ATTR_FILE_HASH) != file_hash:
+            iftlog.log(5, "iftreceive: ERROR: file hash reported by remote host (" + str(file_hash) + ") does not match given hash of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_HASH) ) + "!")
+            return (E_NO_CONNECT, None)
+         
+         # record file type
+         if job.get_attr( iftfile.JOB_ATTR_FILE_TYPE ) == None:
+            job.set_attr( iftfile.JOB_ATTR_FILE_TYPE, file_type )
+         elif job.get_attr( iftfile.JOB_ATTR_FILE_TYPE ) != file_type:
+            iftlog.log(5, "iftreceive: ERROR: file type reported by remote host (" + str(file_type) + ") does not match given file type of " + str(job.get_attr( iftfile.JOB_ATTR_FILE_TYPE) ) + "!")
+            return (E_NO_CONNECT, None)
+            
+         # record chunk hashes (or the root of their Merkle tree)
+         job.set_attr( iftfile.JOB_ATTR_CHUNK_HASHES, chunk_hashes )
+         if merkle_root != None:
+            job.set_attr( iftfile.JOB_ATTR_MERKLE_ROOT, merkle_root )
+         
+         if not chunk_hashes_match_root( job.attrs ):
+            iftlog.log(5, "iftreceive: ERROR: chunk hashes reported by remote host do not match its Merkle root!")
+            return (E_NO_CONNECT, None)
+         
+         if weak_sums != None:
+            job.set_attr( iftfile.JOB_ATTR_WEAK_SUMS, weak_sums )
+            
+         iftlog.log(5, "iftreceive: receive " + str(file_size) + " bytes from " + remote_chunk_dir + " via " + str(sender_available_protos))
+      except Exception, inst:
+         iftlog.exception( "iftreceive: could not get sender data", inst)
+         return (E_NO_CONNECT, None)
+   
+   else:
       # if the connection was simply refused or timed out, then there is no remote IFTD.
       # receive the file with any protocol
       iftlog.log(5, "iftreceive: no remote IFTD detected, attempting all active receivers to get " + str(job.get_attr( iftfile.JOB_ATTR_SRC_NAME )) + " from " + str(job.get_attr( iftfile.JOB_ATTR_SRC_HOST )) )
       job.set_attr( iftfile.JOB_ATTR_REMOTE_IFTD, False )
       sender_available_protos = available_protocols
-      remote_iftd = False
-      pass
-         
-   except Exception, inst:
-      iftlog.exception( "iftreceive: could not get sender data", inst)
-      return E_NO_CONNECT
    
 
    proto_active_table = {}
@@ -707,7 +1589,7 @@ def iftreceive(  job, available_protocols, connect_dict=None, iftd_remote_port =
       rc = iftfile.make_chunks_dir( job.get_attr( iftfile.JOB_ATTR_DEST_NAME ), job.get_attr( iftfile.JOB_ATTR_FILE_HASH ) )
       if rc != 0:
          iftlog.log(5, "iftreceive: could not make chunks directory")
-         return rc
+         return (rc, None)
       
       # record local chunk dir
       job.set_attr( iftfile.JOB_ATTR_DEST_CHUNK_DIR, iftfile.get_chunks_dir( job.get_attr( iftfile.JOB_ATTR_DEST_NAME ), job.get_attr( iftfile.JOB_ATTR_FILE_HASH ), remote_iftd ))
@@ -722,7 +1604,7 @@ def iftreceive(  job, available_protocols, connect_dict=None, iftd_remote_port =
       proto = proto + "_receiver"   # if it's available, then there's a receiver available
       p = None
       try:
-         p = copy.deepcopy( PROTOCOLS[proto] )
+         p = clone_protocol( proto )
       except Exception, inst:
          iftlog.log(5, "iftreceive: ERROR: could not clone protocol " + proto)
          continue
@@ -741,28 +1623,54 @@ def iftreceive(  job, available_protocols, connect_dict=None, iftd_remote_port =
       job.set_attr( iftfile.JOB_ATTR_DEST_CHUNK_DIR, path )
       
    
-   # get an iftfile reference
+   # get an iftfile reference (copying in what we can from the old copy of the file, in delta mode)
+   old_copy = open_delta_basis( job.attrs )
    iftfile_ref = iftfile.acquire_iftfile_recv( xmit_id, job.get_attr( iftfile.JOB_ATTR_DEST_NAME ), job.attrs )
    job.set_attr( iftfile.JOB_ATTR_IFTFILE, iftfile_ref ) 
+   apply_delta_basis( job.attrs, old_copy, iftfile_ref )
+   
+   state = {
+      "xmit_id": xmit_id,
+      "iftfile_ref": iftfile_ref,
+      "chunk_hashes": chunk_hashes,
+      "protos": [],
+      "choice_args": None
+   }
+   
+   # verify chunks against the Merkle root, asking the sender for proofs as we go (unless we have all the hashes anyway)
+   if remote_iftd and needs_merkle_verifier( job.attrs ) and iftfile_ref != None and iftfile_ref.verifier == None:
+      proof_xmlrpc = iftutil.control_client( send_host, iftd_remote_port, iftd_xmlrpc_path, user_timeout )
+      iftfile_ref.verifier = make_merkle_verifier( xmit_id, job, proof_xmlrpc )
+   
+   # remember how to start this transfer again, in case iftd stops before it finishes
+   if iftfile_ref != None and iftfile_ref.journal != None:
+      saved_connect_dict = None
+      if connect_dict != None:
+         saved_connect_dict = iftjournal.saved_attrs( connect_dict )
+      
+      iftfile_ref.journal.set_resume( {"connect_dict": saved_connect_dict,
+                                       "iftd_remote_port": iftd_remote_port,
+                                       "iftd_xmlrpc_path": iftd_xmlrpc_path,
+                                       "user_timeout": user_timeout} )
    
    # start up the receiving protocols
    iftlog.log(1, "iftreceive: protocol instances: " + str([p.name for p in proto_instances]))
+   job.set_attr( iftfile.JOB_ATTR_XMIT_ID, xmit_id )
    connected_protos = start_protos( user_job=job, connect_dict=connect_dict, protos=proto_instances, timeout=xmlrpc_response_time*2 )
    connected_proto_names = [p.name for p in connected_protos]
    if len(connected_proto_names) == 0:
       iftlog.log(5, "iftreceive: no receiving protocols could be activated")
       iftfile.release_iftfile_recv( xmit_id, iftfile_ref.path )
       iftfile.cleanup_chunks_dir( job.get_attr( iftfile.JOB_ATTR_DEST_NAME ), job.get_attr( iftfile.JOB_ATTR_FILE_HASH ) )
-      return E_NO_CONNECT
+      return (E_NO_CONNECT, None)
 
    # begin listening for the sender (both actively and passively)
-   rc = TransferCore.begin_ift_recv( xmit_id, job, connected_protos, remote_iftd, -1, job.get_attr( iftfile.JOB_ATTR_TRANSFER_TIMEOUT ) )
+   state["protos"] = connected_protos
+   rc = TransferCore.begin_ift_recv( xmit_id, job, connected_protos, remote_iftd, -1, job.get_attr( iftfile.JOB_ATTR_TRANSFER_TIMEOUT ), release=PROTOCOL_POOL.checkin )
    if rc != 0:
       iftlog.log(1, "iftreceive: begin_ift_recv rc = " + str(rc))
-      TransferCore.cleanup_recv( xmit_id )
-      iftfile.release_iftfile_recv( xmit_id, iftfile_ref.path )
-      iftfile.cleanup_chunks_dir( job.get_attr( iftfile.JOB_ATTR_DEST_NAME ), job.get_attr( iftfile.JOB_ATTR_FILE_HASH ) )
-      return rc
+      abort_receive( job, state )
+      return (rc, None)
       
    
    # tell active senders to start up
@@ -782,30 +1690,51 @@ def iftreceive(  job, available_protocols, connect_dict=None, iftd_remote_port =
             sender_known_protocols.append( p.name )
          
       iftlog.log(1, "iftreceive: informing senders about " + str(proto_names(sender_known_protocols)))
-      # inform the sender of our choice
-      try:
-         bp = best_proto
-         if best_proto != None:
-            bp = proto_names( [best_proto] )[0]
-            
-         # temporarily remove the iftfile reference in the job, since we can't send semaphores
-         del job.attrs[ iftfile.JOB_ATTR_IFTFILE ]
-         rc = send_xmlrpc.send_iftd_receiver_choice( xmit_id, job.get_attr( iftfile.JOB_ATTR_DEST_CHUNK_DIR ), bp, proto_names( sender_known_protocols ) )
-         job.attrs[ iftfile.JOB_ATTR_IFTFILE ] = iftfile_ref
-         if rc != xmit_id or chunk_hashes == None:
-            iftlog.log(5, "iftreceive: ERROR: could not inform sender of our protocol choices!" )
-            TransferCore.cleanup_recv( xmit_id )
-            iftfile.release_iftfile_recv( xmit_id, iftfile_ref.path )
-            iftfile.cleanup_chunks_dir( job.get_attr( iftfile.JOB_ATTR_DEST_NAME ), job.get_attr( iftfile.JOB_ATTR_FILE_HASH ) )
-            return E_NO_CONNECT
-         
-         
-      except Exception, inst:
-         iftlog.exception( "iftreceive: could not begin to receive", inst)
-         TransferCore.cleanup_recv( xmit_id )
-         iftfile.release_iftfile_recv( xmit_id, iftfile_ref.path )
-         iftfile.cleanup_chunks_dir( job.get_attr( iftfile.JOB_ATTR_DEST_NAME ), job.get_attr( iftfile.JOB_ATTR_FILE_HASH ) )
-         return E_UNHANDLED_EXCEPTION
+      
+      bp = best_proto
+      if best_proto != None:
+         bp = proto_names( [best_proto] )[0]
+      
+      state["choice_args"] = (xmit_id, job.get_attr( iftfile.JOB_ATTR_DEST_CHUNK_DIR ), bp, proto_names( sender_known_protocols ))
+      
+      # only ask for the chunks we don't have (i.e. we are picking up an earlier attempt)
+      have_chunks = iftfile_ref.written_chunk_runs()
+      if len(have_chunks) > 0:
+         iftlog.log(3, "iftreceive: already have " + str(iftfile_ref.progress()[0]) + " chunks of " + str(job.get_attr( iftfile.JOB_ATTR_DEST_NAME )))
+         state["choice_args"] += (have_chunks,)
+   
+   return (0, state)
+
+
+
+def abort_receive( job, state ):
+   """
+   Clean up after a receive that setup_receive began, but that cannot go on.
+   """
+   for proto in state["protos"]:
+      proto.post_msg( PROTO_MSG_END, None )
+   
+   TransferCore.cleanup_recv( state["xmit_id"] )
+   iftfile.release_iftfile_recv( state["xmit_id"], state["iftfile_ref"].path )
+   iftfile.cleanup_chunks_dir( job.get_attr( iftfile.JOB_ATTR_DEST_NAME ), job.get_attr( iftfile.JOB_ATTR_FILE_HASH ) )
+
+
+
+def run_receive( job, state, choice_rc, send_xmlrpc ):
+   """
+   Receive a file that setup_receive began, given the sender's reply (choice_rc)
+   to send_iftd_receiver_choice (if it was called).
+   Return 0 on success, or the error rc.
+   """
+   
+   xmit_id = state["xmit_id"]
+   iftfile_ref = state["iftfile_ref"]
+   
+   if state["choice_args"] != None:
+      if choice_rc != xmit_id or (state["chunk_hashes"] == None and job.get_attr( iftfile.JOB_ATTR_MERKLE_ROOT ) == None):
+         iftlog.log(5, "iftreceive: ERROR: could not inform sender of our protocol choices!" )
+         abort_receive( job, state )
+         return E_NO_CONNECT
    
    # drive the receiver process!
    TransferCore.finish_negotiation( xmit_id )
@@ -822,11 +1751,11 @@ def iftreceive(  job, available_protocols, connect_dict=None, iftd_remote_port =
    
 
 
-
-def prepare_sender( filename, chunksize ):
+def prepare_sender( filename, chunksize, use_views=False ):
    """
    Prepare the sender to send.
    This includes creating all the chunks.
+   If use_views is True, the chunks are chunk_views onto the file rather than copies.
    Give back file and chunk data
    """
    
@@ -838,6 +1767,18 @@ def prepare_sender( filename, chunksize ):
    chunk_hashes = None
    chunk_data = []    # array of (chunk data, chunk id, chunk local path, chunk remote path)
    
+   if use_views:
+      # serve the chunks straight out of the file
+      rc, file_hash, chunk_hashes, chunk_views = iftfile.make_chunk_views( filename, chunksize )
+      if rc != 0:
+         iftlog.log(5, "prepare_sender: mapping file " + filename + " failed! (rc = " + str(rc) + ")" )
+         return (rc, None, None, None)
+      
+      for chunk_id in xrange(0, len(chunk_views)):
+         chunk_data.append( [chunk_views[chunk_id], chunk_id, None, None] )
+      
+      return (rc, file_hash, chunk_hashes, chunk_data)
+   
    # do we need to chunk the file?  i.e. is there at least one protocol that needs us to do chunking in advance?
    rc, file_hash, chunk_hashes, chunk_paths = iftfile.make_chunks( filename, chunksize )
    
@@ -888,7 +1829,7 @@ def recv_iftd_sender_data( xmit_id, job_attrs, available_protos, receiver_connec
       Dictionary mapping receiver protocol name to connection attributes needed to start up
             
    @arg chunk_hashes:
-      List of SHA-1 hashes of each file chunk
+      List of SHA-1 hashes of each file chunk (empty if job_attrs has a JOB_ATTR_MERKLE_ROOT instead)
       
    @arg sender_xmlrpc_url
       URL for the receiver to contact the sender to ACK the transmission
@@ -908,8 +1849,16 @@ def recv_iftd_sender_data( xmit_id, job_attrs, available_protos, receiver_connec
       iftlog.log(5, "recv_iftd_sender_data: request for " + job_attrs.get(iftfile.JOB_ATTR_SRC_NAME) + " to " + job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ) + " cannot be serviced, since it is not going to be sent to " + RECV_FILES_DIR )
       return error_rc
 
+   if not chunk_hashes_match_root( job_attrs ):
+      iftlog.log(5, "recv_iftd_sender_data: chunk hashes for " + str(job_attrs.get( iftfile.JOB_ATTR_SRC_NAME )) + " do not match their Merkle root")
+      return error_rc
+   
    features = iftstats.extract_features( job_attrs )
    
+   # agree to the codec the sender offered, if we have it
+   codec = iftcodec.accept( job_attrs.get( iftfile.JOB_ATTR_CODEC ), job_attrs.get( iftfile.JOB_ATTR_CODEC_LEVEL ) )
+   job_attrs[ iftfile.JOB_ATTR_CHUNK_CODEC ] = codec
+   
    my_protos = proto_names( receivers( list_protocols() ) )
    
    # get the rank
@@ -926,6 +1875,10 @@ def recv_iftd_sender_data( xmit_id, job_attrs, available_protos, receiver_connec
       if proto in available_proto_names:
          usable_protos.append( proto )
    
+   # if the sender serves chunk views, there are no chunk files for file-based receivers to fetch
+   if job_attrs.get( iftfile.JOB_ATTR_CHUNK_VIEWS ) == True:
+      usable_protos = [proto for proto in usable_protos if chunk_views_usable( [proto + "_receiver"] )]
+   
    
    # the best protocol may not be usable...
    if best_proto != None and best_proto not in usable_protos:
@@ -946,7 +1899,7 @@ def recv_iftd_sender_data( xmit_id, job_attrs, available_protos, receiver_connec
       proto = proto + "_receiver"   # if it's available, then there's a receiver available
       p = None
       try:
-         p = copy.deepcopy( PROTOCOLS[proto] )
+         p = clone_protocol( proto )
       except Exception, inst:
          iftlog.log(5, "ERROR: could not clone protocol " + proto)
          continue
@@ -956,10 +1909,17 @@ def recv_iftd_sender_data( xmit_id, job_attrs, available_protos, receiver_connec
    # start up the protocols
    job = iftfile.iftjob( job_attrs )
    
-   # get an iftfile reference so we can write chunks
+   # get an iftfile reference so we can write chunks (copying in what we can from the old copy of the file, in delta mode)
+   old_copy = open_delta_basis( job_attrs )
    iftfile_ref = iftfile.acquire_iftfile_recv( xmit_id, job.get_attr( iftfile.JOB_ATTR_DEST_NAME ), job_attrs )
    job.set_attr( iftfile.JOB_ATTR_IFTFILE, iftfile_ref )
+   apply_delta_basis( job_attrs, old_copy, iftfile_ref )
+   
+   # verify chunks against the Merkle root, asking the sender for proofs as we go (unless we have all the hashes anyway)
+   if needs_merkle_verifier( job_attrs ) and iftfile_ref != None and iftfile_ref.verifier == None:
+      iftfile_ref.verifier = make_merkle_verifier( xmit_id, job, iftutil.make_control_client( sender_xmlrpc_url, job_attrs.get( iftfile.JOB_ATTR_CHUNK_TIMEOUT ) ) )
    
+   job.set_attr( iftfile.JOB_ATTR_XMIT_ID, xmit_id )
    connected_protos = start_protos( user_job=job, connect_dict=receiver_connect_dict, protos=proto_instances, timeout=5.0 )
    if len(connected_protos) == 0:
       iftlog.log(5, "ERROR: no protocols could be started (tried " + str(usable_protos) + ")")
@@ -976,15 +1936,34 @@ def recv_iftd_sender_data( xmit_id, job_attrs, available_protos, receiver_connec
       return error_rc    # cannot connect
    
    # begin listening for the sender
-   TransferCore.begin_ift_recv(xmit_id, job, connected_protos, True, -1, 1.0, job_attrs.get( iftfile.JOB_ATTR_TRANSFER_TIMEOUT ) )
+   rc = TransferCore.begin_ift_recv(xmit_id, job, connected_protos, True, -1, 1.0, job_attrs.get( iftfile.JOB_ATTR_TRANSFER_TIMEOUT ), release=PROTOCOL_POOL.checkin )
+   if rc != 0:
+      iftlog.log(5, "recv_iftd_sender_data: could not start receiving protocols, rc = " + str(rc))
+      for proto in connected_protos:
+         proto.post_msg( PROTO_MSG_END, None )
+      return error_rc
+   
    #thread.start_new_thread( TransferCore.run_ift_recv, (xmit_id, make_XMLRPC_client2(sender_xmlrpc_url, job_attrs.get( iftfile.JOB_ATTR_CHUNK_TIMEOUT)) ) )
-   started = iftutil.ReceiverThreadPool.start_new_thread( TransferCore.run_ift_recv, (xmit_id, make_XMLRPC_client2(sender_xmlrpc_url, job_attrs.get( iftfile.JOB_ATTR_CHUNK_TIMEOUT)) ) )
+   # waits for room in the receiver pool if it is saturated
+   started = iftutil.ReceiverThreadPool.start_new_thread( TransferCore.run_ift_recv, (xmit_id, iftutil.make_control_client(sender_xmlrpc_url, job_attrs.get( iftfile.JOB_ATTR_CHUNK_TIMEOUT)) ), True, iftutil.POOL_SUBMIT_TIMEOUT )
    if not started:
       iftlog.log(5, "recv_iftd_sender_data: could not start new receiver thread")
+      for proto in connected_protos:
+         proto.post_msg( PROTO_MSG_END, None )
+      TransferCore.cleanup_recv( xmit_id )
       return error_rc
    
-   # give back the information
+   # give back the information, along with the chunks we already have (if any) and the codec we agreed to (if any)
    rc = [xmit_id, iftfile.get_chunks_dir( job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ), job_attrs.get( iftfile.JOB_ATTR_FILE_HASH ), True ), best_proto, connected_proto_names]
+   have_chunks = []
+   if iftfile_ref != None:
+      have_chunks = iftfile_ref.written_chunk_runs()
+   
+   if len(have_chunks) > 0 or codec != None:
+      rc.append( have_chunks )
+   if codec != None:
+      rc.append( codec )
+   
    return rc
 
 
@@ -1002,9 +1981,14 @@ def get_iftd_sender_data( xmit_id, job_attrs, available_protos, connect_dict ):
    
    global TransferCore
    
-   error_rc = (xmit_id, None, None, None, None, None, None, None) 
+   error_rc = (xmit_id, None, None, None, None, None, None, None)
    file_name = job_attrs.get( iftfile.JOB_ATTR_SRC_NAME )
+   
+   # only a receiver that asked for a Merkle root knows to look for one in the reply
+   # (an iftjob asks for one by default, so look at what the receiver sent, not at user_job)
+   wants_merkle_root = (job_attrs.get( iftfile.JOB_ATTR_MERKLE_HASHES ) == True)
    user_job = iftfile.iftjob( job_attrs )
+   user_job.set_attr( iftfile.JOB_ATTR_CHUNK_CODEC, None )     # chunks are only compressed when we start the transfer
    
    # does the file exist?
    if not os.path.exists( file_name ):
@@ -1048,7 +2032,7 @@ def get_iftd_sender_data( xmit_id, job_attrs, available_protos, connect_dict ):
          p = None
          # start this passive sender
          try:
-            p = copy.deepcopy( PROTOCOLS.get(proto) )
+            p = clone_protocol( proto )
          except:
             iftlog.log(5, "get_iftd_sender_data: could not start passive sender " + proto)
             continue
@@ -1070,12 +2054,27 @@ def get_iftd_sender_data( xmit_id, job_attrs, available_protos, connect_dict ):
    
 
    # set up
-   rc, file_hash, chunk_hashes, chunk_data = prepare_sender( file_name, user_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )
+   rc, file_hash, chunk_hashes, chunk_data = prepare_sender( file_name, user_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ), user_job.get_attr( iftfile.JOB_ATTR_CHUNK_VIEWS ) == True )
    if rc != 0:
       iftlog.log(5, "get_iftd_sender_data: could not prepare to send")
       return error_rc
 
    
+   # give the receiver just the root of the chunk hashes' Merkle tree, if it wants it
+   # (and all the hashes anyway if it will look for chunks it already has, along with
+   # weak checksums if it will look in its old copy of the file)
+   merkle_tree = None
+   merkle_root = None
+   weak_sums = None
+   if wants_merkle_root:
+      merkle_tree = iftmerkle.merkle_tree( chunk_hashes )
+      merkle_root = merkle_tree.root()
+      if not wants_chunk_hashes( user_job.attrs ):
+         chunk_hashes = None
+   
+   if user_job.get_attr( iftfile.JOB_ATTR_DELTA ) == True:
+      weak_sums = iftdelta.weak_sums( [iftfile.chunk_data_str( c[0] ) for c in chunk_data] )
+   
    user_job.supply_attr( iftfile.JOB_ATTR_FILE_SIZE, file_size )
    user_job.supply_attr( iftfile.JOB_ATTR_FILE_HASH, file_hash )
    user_job.supply_attr( iftfile.JOB_ATTR_FILE_TYPE, iftstats.filetype( file_name ) )
@@ -1084,8 +2083,9 @@ def get_iftd_sender_data( xmit_id, job_attrs, available_protos, connect_dict ):
    
    
    # start passive protocol handling thread
-   TransferCore.begin_ift_send( xmit_id, user_job, chunk_data, user_job.get_attr( iftfile.JOB_ATTR_CHUNK_TIMEOUT ), connect_dict )
+   TransferCore.begin_ift_send( xmit_id, user_job, chunk_data, user_job.get_attr( iftfile.JOB_ATTR_CHUNK_TIMEOUT ), connect_dict, merkle_tree )
    TransferCore.run_ift_send_passive( xmit_id, user_job, passive_protos, user_job.get_attr( iftfile.JOB_ATTR_CHUNK_TIMEOUT ))
+   release_protocols( passive_protos )
    
    proto_mask = [0] * len(sender_names)
    
@@ -1096,15 +2096,108 @@ def get_iftd_sender_data( xmit_id, job_attrs, available_protos, connect_dict ):
       else:
          proto_mask[i] = False
    
-   return (xmit_id, iftfile.get_chunks_dir( file_name, file_hash, True), file_size, file_hash, iftstats.filetype(file_name), sender_names, proto_mask, chunk_hashes)
+   rc = (xmit_id, iftfile.get_chunks_dir( file_name, file_hash, True), file_size, file_hash, iftstats.filetype(file_name), sender_names, proto_mask, chunk_hashes)
+   if wants_merkle_root or weak_sums != None:
+      rc += (merkle_root,)
+   if weak_sums != None:
+      rc += (weak_sums,)
+   
+   return rc
+
+
+
+def wants_chunk_hashes( job_attrs ):
+   """
+   Does the receiver need every chunk's hash, even with a Merkle root (i.e. to look for chunks it already has)?
+   """
+   return job_attrs.get( iftfile.JOB_ATTR_DELTA ) == True or job_attrs.get( iftfile.JOB_ATTR_CHUNK_STORE ) == True
+
+
+
+def chunk_hashes_match_root( job_attrs ):
+   """
+   If the sender gave every chunk's hash along with the Merkle root, check them against the root (once, up front).
+   Return True if they match, or if there is nothing to check.
+   """
+   if job_attrs.get( iftfile.JOB_ATTR_MERKLE_ROOT ) == None or not job_attrs.get( iftfile.JOB_ATTR_CHUNK_HASHES ):
+      return True
+   
+   return iftmerkle.merkle_tree( job_attrs.get( iftfile.JOB_ATTR_CHUNK_HASHES ) ).root() == job_attrs.get( iftfile.JOB_ATTR_MERKLE_ROOT )
+
+
+
+def needs_merkle_verifier( job_attrs ):
+   """
+   Do received chunks have to be verified with Merkle proofs from the sender?
+   Not if the sender gave every chunk's hash (checked with chunk_hashes_match_root), since chunks are checked against those.
+   """
+   return job_attrs.get( iftfile.JOB_ATTR_MERKLE_ROOT ) != None and not job_attrs.get( iftfile.JOB_ATTR_CHUNK_HASHES )
+
+
+
+def open_delta_basis( job_attrs ):
+   """
+   In delta mode, get hold of the old copy of the file to be received (see iftdelta), or None.
+   Call this before the file is opened for writing, which removes the old copy.
+   """
+   if job_attrs.get( iftfile.JOB_ATTR_DELTA ) != True or not job_attrs.get( iftfile.JOB_ATTR_CHUNK_HASHES ) or not job_attrs.get( iftfile.JOB_ATTR_WEAK_SUMS ):
+      return None
+   
+   return iftdelta.open_basis( job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ) )
+
+
+
+def apply_delta_basis( job_attrs, old_copy, iftfile_ref ):
+   """
+   Copy the chunks found in the old copy of a file (from open_delta_basis) into
+   the new one, before any protocol starts receiving it.
+   """
+   if old_copy == None:
+      return
+   
+   if iftfile_ref == None or job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE ) == None or job_attrs.get( iftfile.JOB_ATTR_FILE_SIZE ) == None:
+      old_copy.close()
+      return
+   
+   iftdelta.apply_basis( old_copy, iftfile_ref, job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE ), job_attrs.get( iftfile.JOB_ATTR_FILE_SIZE ), job_attrs.get( iftfile.JOB_ATTR_CHUNK_HASHES ), job_attrs.get( iftfile.JOB_ATTR_WEAK_SUMS ) )
+
+
+
+def get_merkle_proof( xmit_id, chunk_ids ):
+   """
+   Called by the receiver (remote) on the sender (local) to get the
+   Merkle tree nodes it needs to verify the given chunks.
+   Return a list of [level, index, hash], or None if there is no tree for xmit_id
+   """
+   merkle_tree = TransferCore.get_merkle_tree( xmit_id )
+   if merkle_tree == None:
+      iftlog.log(5, "iftapi.get_merkle_proof: no Merkle tree for xmit ID " + str(xmit_id))
+      return None
+   
+   return merkle_tree.proof( chunk_ids )
+
+
+
+def make_merkle_verifier( xmit_id, job, sender_xmlrpc ):
+   """
+   Make a verifier that checks received chunks against the job's Merkle root,
+   getting proofs from the sender through the given XML-RPC client.
+   """
+   def fetch_proof( chunk_ids ):
+      return sender_xmlrpc.get_merkle_proof( xmit_id, chunk_ids )
+   
+   num_chunks = iftmerkle.num_leaves( job.get_attr( iftfile.JOB_ATTR_FILE_SIZE ), job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )
+   return iftmerkle.merkle_verifier( job.get_attr( iftfile.JOB_ATTR_MERKLE_ROOT ), num_chunks, fetch_proof )
 
 
 
 
-def send_iftd_receiver_choice( xmit_id, receiver_chunk_dir, best_proto, available_protos ):
+def send_iftd_receiver_choice( xmit_id, receiver_chunk_dir, best_proto, available_protos, have_chunks=None ):
    """
    Called by receiver (remote) on the sender (local) to inform
    the sender to begin actively sending, with the prefered protocol.
+   If given, have_chunks is a list of [first ID, last ID] runs of chunks
+   the receiver already has, which are not sent again.
    """
    
    # this had better be a valid call
@@ -1112,9 +2205,13 @@ def send_iftd_receiver_choice( xmit_id, receiver_chunk_dir, best_proto, availabl
       iftlog.log(5, "iftapi.send_iftd_receiver_choice: invalid xmit ID " + str(xmit_id))
       return None
    
+   if have_chunks:
+      TransferCore.set_receiver_chunks( xmit_id, have_chunks )
+   
    connect_dict = TransferCore.get_connection_attrs( xmit_id )
    user_job_attrs = TransferCore.get_job_attrs( xmit_id )
    user_job_attrs[ iftfile.JOB_ATTR_DEST_CHUNK_DIR ] = receiver_chunk_dir
+   user_job_attrs[ iftfile.JOB_ATTR_XMIT_ID ] = xmit_id
    
    user_job = iftfile.iftjob( user_job_attrs )
    if not available_protos:
@@ -1143,7 +2240,7 @@ def send_iftd_receiver_choice( xmit_id, receiver_chunk_dir, best_proto, availabl
             
          p = None
          try:
-            p = copy.deepcopy( PROTOCOLS[proto] )
+            p = clone_protocol( proto )
          except Exception, inst:
             iftlog.log(5, "ERROR: could not clone protocol " + proto)
             continue
@@ -1152,7 +2249,7 @@ def send_iftd_receiver_choice( xmit_id, receiver_chunk_dir, best_proto, availabl
       
       # start up the active protocols
       connected_protos = start_active_protos( user_job=user_job, connect_dict=connect_dict, protos=proto_instances, timeout=0.01 )
-      rc = iftutil.SenderThreadPool.start_new_thread( TransferCore.run_ift_send_active, (xmit_id, user_job, connected_protos, user_job.get_attr( iftfile.JOB_ATTR_TRANSFER_TIMEOUT ), best_proto == None ) )
+      rc = iftutil.SenderThreadPool.start_new_thread( run_send_active, (xmit_id, user_job, connected_protos, user_job.get_attr( iftfile.JOB_ATTR_TRANSFER_TIMEOUT )), True, iftutil.POOL_SUBMIT_TIMEOUT )
       if not rc:
          iftlog.log(5, "send_iftd_receiver_choice: could not start new active sender thread")
          xmit_id = None    # error rc
@@ -1162,6 +2259,44 @@ def send_iftd_receiver_choice( xmit_id, receiver_chunk_dir, best_proto, availabl
    
 
 
+def resume_transfers():
+   """
+   Start again the transfers to this host that were cut short the last time
+   iftd ran (see iftjournal).  Each picks up with the chunks it already has.
+   Transfers the sender started are left for the sender to try again.
+   Return the handles of the transfers started (see submit_ift).
+   """
+   # attributes worked out during the transfer, which it works out anew
+   dropped_attrs = [iftfile.JOB_ATTR_IFTFILE, iftfile.JOB_ATTR_CHUNK_HASHES, iftfile.JOB_ATTR_MERKLE_ROOT, iftfile.JOB_ATTR_WEAK_SUMS, iftfile.JOB_ATTR_CHUNK_CODEC, iftfile.JOB_ATTR_SRC_CHUNK_DIR, iftfile.JOB_ATTR_DEST_CHUNK_DIR, iftfile.JOB_ATTR_REMOTE_IFTD, iftfile.JOB_ATTR_XMIT_ID]
+   
+   handles = []
+   for header in iftjournal.list_journals():
+      resume = header.get("resume")
+      if resume == None:
+         continue
+      
+      job_attrs = dict( header["job_attrs"] )
+      for attr in dropped_attrs:
+         if job_attrs.has_key( attr ):
+            del job_attrs[ attr ]
+      
+      iftlog.log(3, "resume_transfers: picking up " + str(job_attrs.get( iftfile.JOB_ATTR_DEST_NAME )) + " from " + str(job_attrs.get( iftfile.JOB_ATTR_SRC_HOST )))
+      handles.append( submit_ift( job_attrs, resume["connect_dict"], False, True, resume["iftd_remote_port"], resume["iftd_xmlrpc_path"], resume["user_timeout"] ) )
+   
+   return handles
+
+
+
+def run_send_active( xmit_id, user_job, connected_protos, transfer_timeout ):
+   """
+   Send with the active senders the receiver chose (on a sender pool worker),
+   then give them back to the protocol pool.
+   """
+   TransferCore.run_ift_send_active( xmit_id, user_job, connected_protos, transfer_timeout )
+   release_protocols( connected_protos )
+
+
+
 def ack_sender( xmit_id, rc ):
    """
    Once the remote receiver has everything, it will call this on the local sender to acknowledge it
@@ -1171,6 +2306,63 @@ def ack_sender( xmit_id, rc ):
    
 
 
+def cancel_iftd_transfer( xmit_id ):
+   """
+   Called by the iftd at the other end (remote) of a transfer on this one (local)
+   when the transfer has been cancelled there.
+   """
+   TransferCore.cancel_recv( xmit_id )
+   TransferCore.cancel_send( xmit_id )
+   return 0
+
+
+
+def batch_apply( func, calls ):
+   """
+   Call func with each argument list in calls.
+   Return the list of results, with None for each call that raised an exception.
+   """
+   results = []
+   for args in calls:
+      try:
+         results.append( func( *args ) )
+      except Exception, inst:
+         iftlog.exception( "batch_apply: " + func.__name__ + " failed", inst )
+         results.append( None )
+   
+   return results
+
+
+
+def recv_iftd_sender_data_batch( calls ):
+   """
+   Called by the iftd sender (remote) on the iftd receiver (local) to begin several
+   transmissions at once.  calls is a list of recv_iftd_sender_data argument lists;
+   return the list of its results.
+   """
+   return batch_apply( recv_iftd_sender_data, calls )
+
+
+
+def get_iftd_sender_data_batch( calls ):
+   """
+   Called by the receiver (remote) on the sender (local) to get the sender data for
+   several files at once.  calls is a list of get_iftd_sender_data argument lists;
+   return the list of its results.
+   """
+   return batch_apply( get_iftd_sender_data, calls )
+
+
+
+def send_iftd_receiver_choice_batch( calls ):
+   """
+   Called by the receiver (remote) on the sender (local) to start sending several
+   files at once.  calls is a list of send_iftd_receiver_choice argument lists;
+   return the list of its results.
+   """
+   return batch_apply( send_iftd_receiver_choice, calls )
+
+
    
 def list_protocols():
    """
@@ -1183,6 +2375,14 @@ def list_protocols():
       return []
 
 
+def get_pool_stats():
+   """
+   Get the saturation metrics of iftd's worker pools (senders, receivers, and receiving protocols),
+   as a list of dictionaries (see iftutil.iftworkers.stats).
+   """
+   return iftutil.threadpool_stats()
+
+
 def senders( proto_list ):
    """
    Given a list of protocol names, extract the senders.
@@ -1210,6 +2410,20 @@ def receivers( proto_list ):
    return ret
 
 
+def chunk_views_usable( proto_list ):
+   """
+   Given a list of receiver names, determine whether or not they can all receive
+   chunks that the sender serves as views onto the file (i.e. none of them
+   fetch chunk files out of the sender's chunk directory).
+   """
+   for proto in proto_list:
+      p = PROTOCOLS.get( proto )
+      if p != None and p.get_chunking_mode() == PROTO_NO_CHUNKING:
+         return False
+   
+   return True
+
+
 def proto_names( proto_list ):
    """
    Given a list of protocol names, remove the _sender or _receiver suffixes.
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+
+"""
+iftchunks.py
+Copyright (c) 2009 Jude Nelson
+
+Bookkeeping for the chunks of a file being received:  which chunks are
+written, which are reserved (by whom, and until when), and which are
+locked for writing.  Nothing here scans the whole file, so files with
+millions of chunks cost about as much per chunk as files with a few.
+"""
+
+import array
+import heapq
+import thread
+
+
+# number of locks shared among the chunks of a file
+CHUNK_LOCK_STRIPES = 64
+
+
+class chunk_table:
+   """
+   State of each chunk of a file being received.
+
+   Written chunks are kept in a bitmap, along with a count of how many
+   bits are set.  Only reserved and locked chunks take up more space.
+
+   Free chunks (neither written nor reserved) are found with a cursor that
+   only moves forward.  Chunks behind the cursor that come free again--their
+   reservation expired, or was dropped--go on a heap to be handed out first.
+   Reservations are kept on a heap ordered by expiry time to notice this.
+
+   Chunks share a fixed set of locks:  chunk i uses lock i % num_stripes.
+   """
+
+   def __init__( self, num_chunks=0, num_stripes=CHUNK_LOCK_STRIPES ):
+      self.__num_chunks = 0
+      self.__bitmap = array.array('B')
+      self.__num_written = 0
+
+      self.__reservations = {}      # chunk ID --> [expiry time, owner]
+      self.__owned = {}             # owner --> set of chunk IDs it has reserved
+      self.__expiry = []            # heap of (expiry time, chunk ID)
+      self.__locked = {}            # chunk ID --> owner holding its lock
+
+      self.__cursor = 0             # every chunk before this is written, reserved, or in __returned
+      self.__returned = []          # heap of chunk IDs behind the cursor that came free
+      self.__returned_set = set()
+
+      # these are taken several times per chunk, so use plain locks instead of (much slower) semaphores
+      self.__lock = thread.allocate_lock()
+      self.__stripes = [thread.allocate_lock() for i in xrange(0, max(num_stripes, 1))]
+
+      self.grow( num_chunks )
+
+
+   def size( self ):
+      """
+      How many chunks are there?
+      """
+      return self.__num_chunks
+
+
+   def num_written( self ):
+      """
+      How many chunks have been written?
+      """
+      return self.__num_written
+
+
+   def is_complete( self ):
+      """
+      Have all of the chunks been written?
+      """
+      return self.__num_written >= self.__num_chunks
+
+
+   def grow( self, num_chunks ):
+      """
+      Make room for at least num_chunks chunks.
+      """
+      self.__lock.acquire()
+      try:
+         if num_chunks > self.__num_chunks:
+            num_bytes = (num_chunks + 7) / 8
+            if num_bytes > len(self.__bitmap):
+               self.__bitmap.extend( array.array('B', [0]) * (num_bytes - len(self.__bitmap)) )
+
+            self.__num_chunks = num_chunks
+      finally:
+         self.__lock.release()
+
+
+   def is_written( self, chunk_id ):
+      """
+      Has a chunk been written?
+      """
+      if chunk_id < 0 or chunk_id >= self.__num_chunks:
+         return False
+
+      return (self.__bitmap[chunk_id >> 3] >> (chunk_id & 7)) & 1 == 1
+
+
+   def mark_written( self, chunk_id ):
+      """
+      Mark a chunk as written.
+      Return True if it was not written before; False if it was, or if it is out of range
+      """
+      self.__lock.acquire()
+      try:
+         if chunk_id < 0 or chunk_id >= self.__num_chunks:
+            return False
+
+         bit = 1 << (chunk_id & 7)
+         if self.__bitmap[chunk_id >> 3] & bit:
+            return False
+
+         self.__bitmap[chunk_id >> 3] |= bit
+         self.__num_written += 1
+         return True
+      finally:
+         self.__lock.release()
+
+
+   def reservation( self, chunk_id ):
+      """
+      Get the (expiry time, owner) of a chunk's reservation, or (0, None) if it has none.
+      """
+      r = self.__reservations.get( chunk_id )
+      if r == None:
+         return (0, None)
+
+      return (r[0], r[1])
+
+
+   def __is_reserved( self, chunk_id, now ):
+      r = self.__reservations.get( chunk_id )
+      return r != None and r[0] >= now and r[1] != None
+
+
+   def __drop_reservation( self, chunk_id ):
+      """
+      Forget a chunk's reservation.
+      Call with the lock held.
+      """
+      r = self.__reservations.pop( chunk_id, None )
+      if r == None:
+         return
+
+      owned = self.__owned.get( r[1] )
+      if owned != None:
+         owned.discard( chunk_id )
+         if len(owned) == 0:
+            del self.__owned[ r[1] ]
+
+
+   def __came_free( self, chunk_id ):
+      """
+      A chunk may have come free; if the cursor is past it, remember to hand it out again.
+      Call with the lock held.
+      """
+      if chunk_id < self.__cursor and chunk_id not in self.__returned_set and not self.is_written( chunk_id ):
+         self.__returned_set.add( chunk_id )
+         heapq.heappush( self.__returned, chunk_id )
+
+
+   def reserve( self, chunk_id, owner, expiry, now, force=False ):
+      """
+      Reserve a chunk for owner until the given expiry time.
+      Unless force is True, this fails if someone holds an unexpired reservation
+      on the chunk or holds its lock.
+      Return True if reserved
+      """
+      self.__lock.acquire()
+      try:
+         if chunk_id < 0 or chunk_id >= self.__num_chunks:
+            return False
+
+         if not force and (self.__is_reserved( chunk_id, now ) or self.__locked.has_key( chunk_id )):
+            return False
+
+         self.__drop_reservation( chunk_id )
+         self.__reservations[ chunk_id ] = [expiry, owner]
+
+         owned = self.__owned.get( owner )
+         if owned == None:
+            owned = set()
+            self.__owned[ owner ] = owned
+
+         owned.add( chunk_id )
+         heapq.heappush( self.__expiry, (expiry, chunk_id) )
+
+         # dropped reservations leave their entries behind; throw them out once they outnumber the real ones
+         if len(self.__expiry) > 2 * len(self.__reservations) + 1024:
+            self.__expiry = [(r[0], i) for (i, r) in self.__reservations.items()]
+            heapq.heapify( self.__expiry )
+
+         return True
+      finally:
+         self.__lock.release()
+
+
+   def unreserve( self, chunk_id, owner ):
+      """
+      Drop owner's reservation on a chunk.
+      Return True if owner had it reserved
+      """
+      self.__lock.acquire()
+      try:
+         r = self.__reservations.get( chunk_id )
+         if r == None or r[1] != owner:
+            return False
+
+         self.__drop_reservation( chunk_id )
+         self.__came_free( chunk_id )
+         return True
+      finally:
+         self.__lock.release()
+
+
+   def unreserve_all( self, owner ):
+      """
+      Drop every reservation owner holds.
+      """
+      self.__lock.acquire()
+      try:
+         owned = self.__owned.get( owner )
+         if owned == None:
+            return
+
+         for chunk_id in list(owned):
+            self.__drop_reservation( chunk_id )
+            self.__came_free( chunk_id )
+      finally:
+         self.__lock.release()
+
+
+   def lock( self, chunk_id, owner ):
+      """
+      Lock a chunk for writing on behalf of owner.  Blocks until the chunk's lock is free.
+      """
+      self.__stripes[ chunk_id % len(self.__stripes) ].acquire()
+
+      self.__lock.acquire()
+      self.__locked[ chunk_id ] = owner
+      self.__lock.release()
+
+
+   def unlock( self, chunk_id, owner ):
+      """
+      Unlock a chunk owner has locked, dropping owner's reservation on it.
+      Return True if owner had it locked
+      """
+      self.__lock.acquire()
+      try:
+         if not self.__locked.has_key( chunk_id ) or self.__locked[ chunk_id ] != owner:
+            return False
+
+         del self.__locked[ chunk_id ]
+
+         r = self.__reservations.get( chunk_id )
+         if r != None and r[1] == owner:
+            self.__drop_reservation( chunk_id )
+            self.__came_free( chunk_id )
+      finally:
+         self.__lock.release()
+
+      self.__stripes[ chunk_id % len(self.__stripes) ].release()
+      return True
+
+
+   def next_free( self, now, count=1, contiguous=False ):
+      """
+      Get up to count IDs of chunks that are neither written nor reserved,
+      as of the given time.  Nothing is reserved, so the same chunks come
+      back until someone reserves or writes them.
+      If contiguous is True, the IDs are a run of consecutive chunks starting
+      with the first free chunk (so there may be fewer than count of them).
+      """
+      self.__lock.acquire()
+      try:
+         # reservations that ran out free up their chunks
+         while len(self.__expiry) > 0 and self.__expiry[0][0] < now:
+            (expiry, chunk_id) = heapq.heappop( self.__expiry )
+            r = self.__reservations.get( chunk_id )
+            if r != None and r[0] == expiry:
+               self.__came_free( chunk_id )
+
+         # chunks behind the cursor that came free go first
+         ret = []
+         while len(self.__returned) > 0 and len(ret) < count:
+            chunk_id = heapq.heappop( self.__returned )
+            if self.is_written( chunk_id ) or self.__is_reserved( chunk_id, now ):
+               # taken again; if it comes free again, we'll hear about it
+               self.__returned_set.discard( chunk_id )
+               continue
+
+            ret.append( chunk_id )
+
+         # still free, so keep them around
+         for chunk_id in ret:
+            heapq.heappush( self.__returned, chunk_id )
+
+         i = self.__cursor
+         while i < self.__num_chunks and len(ret) < count:
+            if i & 7 == 0 and self.__bitmap[i >> 3] == 0xFF:
+               # 8 written chunks in a row
+               if i == self.__cursor:
+                  self.__cursor = i + 8
+
+               i += 8
+               continue
+
+            if self.is_written( i ) or self.__is_reserved( i, now ):
+               if i == self.__cursor:
+                  self.__cursor = i + 1
+
+            elif i not in self.__returned_set:
+               ret.append( i )
+
+            i += 1
+
+         if contiguous and len(ret) > 0:
+            ret = [ret[0]]
+            i = ret[0] + 1
+            while len(ret) < count and i < self.__num_chunks and not self.is_written( i ) and not self.__is_reserved( i, now ):
+               ret.append( i )
+               i += 1
+
+         return ret
+      finally:
+         self.__lock.release()
+
+
+   def written_runs( self ):
+      """
+      Get the written chunks as a list of [first ID, last ID] runs of consecutive chunks.
+      """
+      ret = []
+      first = -1
+      for byte_index in xrange(0, len(self.__bitmap)):
+         byte = self.__bitmap[ byte_index ]
+         if (byte == 0xFF and first >= 0) or (byte == 0 and first < 0):
+            continue       # the run (or the gap) goes on
+
+         for i in xrange(byte_index * 8, min(byte_index * 8 + 8, self.__num_chunks)):
+            if (byte >> (i & 7)) & 1:
+               if first < 0:
+                  first = i
+            elif first >= 0:
+               ret.append( [first, i - 1] )
+               first = -1
+
+      if first >= 0:
+         ret.append( [first, self.__num_chunks - 1] )
+
+      return ret
+
+
+   def unwritten( self, now ):
+      """
+      Get the IDs of all chunks that are neither written nor reserved, as of the given time.
+      """
+      ret = []
+      for byte_index in xrange(0, len(self.__bitmap)):
+         byte = self.__bitmap[ byte_index ]
+         if byte == 0xFF:
+            continue
+
+         for i in xrange(byte_index * 8, min(byte_index * 8 + 8, self.__num_chunks)):
+            if (byte >> (i & 7)) & 1 == 0 and not self.__is_reserved( i, now ):
+               ret.append( i )
+
+      return ret
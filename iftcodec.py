@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""
+iftcodec.py
+Copyright (c) 2009 Jude Nelson
+
+Compression of chunks on their way over the network.
+
+The sending iftd offers a codec (JOB_ATTR_CODEC and JOB_ATTR_CODEC_LEVEL)
+in recv_iftd_sender_data, and the receiving iftd accepts it if it has it.
+Both then keep the codec they agreed on in JOB_ATTR_CHUNK_CODEC.  Only
+protocols that carry chunk data as it is use it (see
+transmitter.chunk_codec); the others fetch chunk files or byte ranges of
+the file, which can't be compressed behind their backs.
+
+Each encoded chunk starts with a byte that says how it was encoded, so a
+chunk that the codec would make bigger is sent as it is.  The receiver
+decodes chunks before checking their hashes, which are always those of the
+chunks themselves.  It decodes a chunk only as far as the job's chunk size,
+so a small chunk can't decompress to gigabytes.  This bz2 module can't be
+told to stop part way, so bz2 chunks are fed to it a slice at a time, and
+given up on once they decode to too much.
+
+Unless the job asks for a codec, the sender picks one:  none for a file
+whose MIME type (see iftstats.filetype) says it is already compressed, and
+otherwise DEFAULT_CODEC if the first few chunks compress well enough to be
+worth the CPU time.
+"""
+
+import zlib
+import bz2
+
+import iftlog
+
+from iftdata import *
+
+
+"""
+Codecs
+"""
+CODEC_NONE = "none"
+CODEC_ZLIB = "zlib"
+CODEC_BZ2 = "bz2"
+
+"""
+Codec the sender picks when the job doesn't ask for one, and the level each codec uses unless told otherwise
+"""
+DEFAULT_CODEC = CODEC_ZLIB
+DEFAULT_LEVELS = {CODEC_ZLIB: 1, CODEC_BZ2: 9}
+
+"""
+Codecs a receiver can decode chunks off the network with
+"""
+NETWORK_CODECS = [CODEC_ZLIB, CODEC_BZ2]
+
+"""
+How many bytes of a bz2 chunk to decompress at a time, when it must not decode to more than a chunk
+"""
+BZ2_DECODE_SLICE = 1024
+
+"""
+First byte of an encoded chunk, by codec
+"""
+CODEC_TAGS = {CODEC_NONE: "\x00", CODEC_ZLIB: "\x01", CODEC_BZ2: "\x02"}
+
+"""
+How much of the start of a file to compress to see whether the rest is worth compressing
+"""
+CODEC_SAMPLE_CHUNKS = 4
+CODEC_SAMPLE_BYTES = 1048576
+
+"""
+A file whose sample compresses to more than this fraction of its size is sent as it is
+"""
+CODEC_MAX_RATIO = 0.9
+
+"""
+MIME types (or prefixes of them) of files that are compressed already
+"""
+COMPRESSED_TYPES = [
+   "application/x-gzip", "application/gzip", "application/x-bzip2", "application/x-xz", "application/x-lzma",
+   "application/x-compress", "application/zip", "application/x-7z-compressed", "application/x-rar",
+   "application/x-rpm", "application/x-debian-package", "application/vnd.debian.binary-package",
+   "image/jpeg", "image/png", "image/gif", "audio/", "video/"
+]
+
+
+def supported( codec ):
+   """
+   Do we have a codec?
+   """
+   return CODEC_TAGS.has_key( codec )
+
+
+def level_of( codec, level ):
+   """
+   Get the level to use a codec at (its default if level is None)
+   """
+   if level == None:
+      return DEFAULT_LEVELS.get( codec )
+   return level
+
+
+def compress( data, codec, level=None ):
+   """
+   Compress a string with a codec (CODEC_NONE gives it back as it is)
+   """
+   if codec == CODEC_ZLIB:
+      return zlib.compress( data, level_of( codec, level ) )
+   elif codec == CODEC_BZ2:
+      return bz2.compress( data, level_of( codec, level ) )
+   return data
+
+
+def encode( chunk, codec, level=None ):
+   """
+   Encode a chunk (a string) to be sent.
+   It is compressed with the codec, unless that doesn't make it smaller.
+   """
+   if codec != CODEC_NONE:
+      data = compress( chunk, codec, level )
+      if len(data) < len(chunk):
+         return CODEC_TAGS[ codec ] + data
+
+   return CODEC_TAGS[ CODEC_NONE ] + chunk
+
+
+def decode( data, max_size=None ):
+   """
+   Get back the chunk that encode() gave data for.
+   If max_size is given, a chunk that would decode to more than max_size bytes
+   is rejected without decoding more than max_size + 1 bytes of it (so a small
+   frame off the network can't decompress to gigabytes).
+   Raises an exception if data can't be decoded.
+   """
+   tag = data[0:1]
+   if tag == CODEC_TAGS[ CODEC_NONE ]:
+      chunk = data[1:]
+
+   elif tag == CODEC_TAGS[ CODEC_ZLIB ]:
+      if max_size == None:
+         chunk = zlib.decompress( data[1:] )
+      else:
+         d = zlib.decompressobj()
+         chunk = d.decompress( data[1:], max_size + 1 )
+         if len(chunk) <= max_size:
+            chunk += d.flush()
+            if d.unused_data != "":
+               raise ValueError( "trailing data after zlib chunk" )
+
+   elif tag == CODEC_TAGS[ CODEC_BZ2 ]:
+      if max_size == None:
+         chunk = bz2.decompress( data[1:] )
+      else:
+         chunk = decode_bz2( data[1:], max_size )
+
+   else:
+      raise ValueError( "unknown chunk encoding " + repr(tag) )
+
+   if max_size != None and len(chunk) > max_size:
+      raise ValueError( "chunk decodes to more than " + str(max_size) + " bytes" )
+
+   return chunk
+
+
+def decode_bz2( data, max_size ):
+   """
+   Decompress a bz2 stream that must not decompress to more than max_size bytes.
+   This bz2 module decompresses all the input it is given at once, so it is given
+   BZ2_DECODE_SLICE bytes at a time, and the stream is rejected as soon as it is too big.
+   (bz2 decodes a block at a time, so up to one block's worth past max_size may be decoded.)
+   Raises an exception if data can't be decompressed.
+   """
+   d = bz2.BZ2Decompressor()
+   parts = []
+   size = 0
+   for i in xrange(0, len(data), BZ2_DECODE_SLICE):
+      part = d.decompress( data[i : i + BZ2_DECODE_SLICE] )
+      size += len(part)
+      if size > max_size:
+         raise ValueError( "chunk decodes to more than " + str(max_size) + " bytes" )
+
+      parts.append( part )
+
+   if d.unused_data != "":
+      raise ValueError( "trailing data after bz2 chunk" )
+
+   # the decompressor only refuses more input once it has seen the end of the stream
+   try:
+      d.decompress( "" )
+   except EOFError:
+      return "".join( parts )
+
+   raise ValueError( "bz2 chunk is cut short" )
+
+
+def decode_chunks( chunk_table, max_size=None ):
+   """
+   Decode a table of encoded chunks (chunk ID --> data), none of which may decode to more than max_size bytes (if given).
+   Return (table of decoded chunks, list of IDs of chunks that could not be decoded).
+   """
+   decoded = {}
+   bad = []
+   for (chunk_id, data) in chunk_table.items():
+      try:
+         decoded[ chunk_id ] = decode( data, max_size )
+      except Exception, inst:
+         bad.append( chunk_id )
+
+   return (decoded, bad)
+
+
+def is_compressed_type( mime_type ):
+   """
+   Does a MIME type say a file is compressed already?
+   """
+   if not mime_type:
+      return False
+
+   for t in COMPRESSED_TYPES:
+      if mime_type.startswith( t ):
+         return True
+
+   return False
+
+
+def sample_ratio( sample, codec, level=None ):
+   """
+   How well does the start of a file (a list of its first chunks, as strings) compress?
+   Return the size compressed over the size as it is (1.0 if there's nothing to go on).
+   """
+   num_bytes = 0
+   num_compressed = 0
+   for chunk in sample[0:CODEC_SAMPLE_CHUNKS]:
+      if num_bytes >= CODEC_SAMPLE_BYTES:
+         break
+
+      chunk = chunk[0 : CODEC_SAMPLE_BYTES - num_bytes]
+      num_bytes += len(chunk)
+      num_compressed += len(compress( chunk, codec, level ))
+
+   if num_bytes == 0:
+      return 1.0
+
+   return float(num_compressed) / num_bytes
+
+
+def choose( codec, level, mime_type, sample ):
+   """
+   Choose the codec for the sender to offer:  the one asked for, or if codec is None, one
+   that suits the file's MIME type and how well the sample (its first chunks) compresses.
+   Return [codec, level], or None if chunks should be sent as they are.
+   """
+   if codec == None:
+      if is_compressed_type( mime_type ):
+         iftlog.log(1, "iftcodec: " + str(mime_type) + " is compressed already, so chunks will not be")
+         return None
+
+      codec = DEFAULT_CODEC
+      ratio = sample_ratio( sample, codec, level )
+      if ratio > CODEC_MAX_RATIO:
+         iftlog.log(1, "iftcodec: the first chunks only compress to " + str(int(ratio * 100)) + "% with " + codec + ", so chunks will not be compressed")
+         return None
+
+   if codec == CODEC_NONE:
+      return None
+
+   if not supported( codec ):
+      iftlog.log(5, "iftcodec: unknown codec " + str(codec) + ", so chunks will not be compressed")
+      return None
+
+   return [codec, level_of( codec, level )]
+
+
+def accept( codec, level ):
+   """
+   Given the codec (and level) a sender offered, get the [codec, level] to receive chunks with,
+   or None if chunks will come as they are.
+   """
+   if codec == None or codec == CODEC_NONE or not supported( codec ):
+      return None
+
+   if codec not in NETWORK_CODECS:
+      return None
+
+   return [codec, level_of( codec, level )]
@@ -27,10 +27,13 @@ PROTO_USE_DEPRICATED          = "PROTO_USE_DEPRICATED"         # Specify this as
 States of transmission an ifttransmit instance can be in
 """
 PROTO_STATE_DEAD        = 0   # no transmission, and the thread isn't running
+PROTO_STATE_SUSPENDED   = 1   # the thread is running, but waiting to be told to transmit
 PROTO_STATE_RUNNING     = 2   # transmission is occurring
 PROTO_STATE_ENDED       = 3   # no transmission, and there is nothing to do
 PROTO_STATE_TERM        = 4   # no transmission, protocol was terminated
 
+PROTO_IDLE_TIMEOUT      = 0.5 # longest a running protocol with nothing to do waits before looking again (reservations expire without telling anyone)
+
 """
 Common connection (protocol) attributes
 """
@@ -9,6 +9,7 @@ import math
 import copy
 import types
 import hashlib
+import binascii
 import shutil
 import threading
 
@@ -21,6 +22,313 @@ import iftfile
 import iftutil
 import iftloader
 import iftstats
+import iftstore
+import iftcodec
+
+
+"""
+Tuning for how many chunks a receiver asks for at once (see chunk_scheduler)
+"""
+CHUNK_RUN_MAX_BYTES     = 16 * 1024 * 1024   # never ask for more than this much data at once
+CHUNK_RUN_BDP_MULTIPLE  = 4      # ask for this many bandwidth-delay products' worth of data at once
+CHUNK_RUN_GAIN          = 0.1    # throughput must improve by this fraction to keep growing the run
+CHUNK_RUN_BACKOFF       = 0.5    # halve the run if throughput drops below this fraction of its average
+CHUNK_RUN_WINDOW        = 16     # number of recent requests to estimate bandwidth and delay from
+CHUNK_RUN_EWMA_WEIGHT   = 0.25   # weight of the newest request in the throughput average
+
+"""
+Tuning for how received chunks get to disk (see receive_pipeline)
+"""
+RECEIVE_PIPELINE            = True               # verify and write chunks on worker pools, instead of on the protocol's thread
+RECEIVE_PIPELINE_MAX_BYTES  = 64 * 1024 * 1024   # most received data a receiver lets wait to be verified and written
+RECEIVE_BATCH_MAX_BYTES     = 4 * 1024 * 1024    # most data a protocol's add_chunk() calls pile up before it is sent on to disk
+
+
+class chunk_scheduler:
+   """
+   Decides how many chunks a receiver asks its protocol for at once.
+
+   Every request costs a round trip on top of the time spent moving the data,
+   so asking for one chunk at a time wastes most of a fast link.  To keep the
+   link busy, a protocol should ask for a few bandwidth-delay products' worth
+   of chunks at a time.
+
+   To find that size, the run starts at one chunk and doubles while throughput
+   keeps improving.  From then on, the time each request takes is fit to
+   (delay + bytes / bandwidth) over the recent requests, and the run is sized
+   from the fitted bandwidth-delay product (but shrinks by at most half per
+   request, so one noisy fit can't collapse it).  If throughput drops well below
+   its average, the run is halved; if it climbs well above, it grows again.
+   """
+
+   def __init__( self, chunksize, max_bytes=CHUNK_RUN_MAX_BYTES ):
+      self.chunksize = max( int(chunksize), 1 )
+      self.max_run = max( max_bytes / self.chunksize, 1 )
+      self.run = 1               # how many chunks to ask for next
+      self.rate = None           # average throughput (bytes/sec)
+      self.bandwidth = None      # fitted bandwidth (bytes/sec)
+      self.delay = None          # fitted per-request delay (sec)
+
+      self.__probing = True      # still doubling the run?
+      self.__last_rate = None
+      self.__samples = deque()   # (bytes, seconds) of recent requests
+
+
+   def run_length( self ):
+      """
+      How many chunks to ask for next
+      """
+      return self.run
+
+
+   def reservation_time( self, chunk_timeout ):
+      """
+      How long to reserve each chunk of the next run for, given how long one chunk should take
+      """
+      if chunk_timeout == None:
+         return chunk_timeout
+
+      if self.rate == None or self.rate <= 0:
+         return chunk_timeout * self.run
+
+      # leave time for the whole run to arrive
+      return chunk_timeout + 2.0 * self.run * self.chunksize / self.rate
+
+
+   def __fit( self ):
+      """
+      Least-squares fit of seconds = delay + bytes / bandwidth over the recent requests.
+      Return (bandwidth, delay), or (None, None) if the requests don't say enough.
+      """
+      n = float(len(self.__samples))
+      if n < 2:
+         return (None, None)
+
+      mean_b = sum( [b for (b, t) in self.__samples] ) / n
+      mean_t = sum( [t for (b, t) in self.__samples] ) / n
+      var_b = sum( [(b - mean_b) ** 2 for (b, t) in self.__samples] )
+      if var_b <= 0:
+         return (None, None)
+
+      cov = sum( [(b - mean_b) * (t - mean_t) for (b, t) in self.__samples] )
+      if cov <= 0:
+         return (None, None)
+
+      seconds_per_byte = cov / var_b
+      delay = max( mean_t - seconds_per_byte * mean_b, 0.0 )
+      return (1.0 / seconds_per_byte, delay)
+
+
+   def record( self, num_chunks, num_bytes, elapsed ):
+      """
+      Record how long a request for num_chunks chunks (num_bytes bytes in all) took, and size the next run.
+      """
+      if num_chunks <= 0 or num_bytes <= 0:
+         return
+
+      elapsed = max( elapsed, 1e-6 )
+      rate = num_bytes / elapsed
+
+      self.__samples.append( (num_bytes, elapsed) )
+      while len(self.__samples) > CHUNK_RUN_WINDOW:
+         self.__samples.popleft()
+
+      avg_rate = self.rate
+      if self.rate == None:
+         self.rate = rate
+      else:
+         self.rate = CHUNK_RUN_EWMA_WEIGHT * rate + (1.0 - CHUNK_RUN_EWMA_WEIGHT) * self.rate
+
+      (bandwidth, delay) = self.__fit()
+      if bandwidth != None:
+         self.bandwidth = bandwidth
+         self.delay = delay
+
+      run = self.run
+      if self.__probing:
+         if self.__last_rate == None or rate > self.__last_rate * (1.0 + CHUNK_RUN_GAIN):
+            run = self.run * 2
+         else:
+            self.__probing = False
+
+      if not self.__probing:
+         if self.bandwidth != None:
+            # a noisy fit can put the delay near zero, so don't shrink the run by more than half at once
+            run = int( math.ceil( CHUNK_RUN_BDP_MULTIPLE * self.bandwidth * self.delay / self.chunksize ) )
+            run = max( run, self.run / 2 )
+
+         if avg_rate != None and rate < avg_rate * CHUNK_RUN_BACKOFF:
+            # throughput fell off
+            run = min( run, self.run / 2 )
+
+         elif avg_rate != None and rate > avg_rate * (1.0 + 2 * CHUNK_RUN_GAIN) and self.run < self.max_run:
+            # throughput picked up; see if more helps
+            self.__probing = True
+            run = max( run, self.run * 2 )
+
+      self.__last_rate = rate
+      self.run = max( min( run, self.max_run ), 1 )
+
+
+   def failed( self ):
+      """
+      A request failed outright; ask for less next time.
+      """
+      self.__probing = False
+      self.run = max( self.run / 2, 1 )
+
+
+
+class receive_pipeline:
+   """
+   Carries a receiver's chunks from the network to disk in three stages.
+
+   The protocol's own thread receives a batch of chunks and puts it here.
+   A worker in iftutil.VerifyThreadPool checks the batch's hashes, and
+   a worker in iftutil.WriteThreadPool writes the good chunks to the file.
+   So while one batch is hashed and another is written, the protocol is
+   already receiving the next one.
+
+   Each stage is bounded:  the pools' queues make a stage that falls behind
+   slow down the one before it, and no more than max_bytes of a receiver's
+   data waits in the pipeline at once, so put() blocks until there is room.
+
+   The verify function takes a chunk table (and put()'s other arguments)
+   and returns the table of chunks that passed.  The write function takes
+   that table and returns (0, 0) or the (message, rc) that went wrong.
+   Errors are kept for the receiver to pick up with take_error(), and
+   notify is called whenever a batch finishes.
+   """
+
+   def __init__( self, verify, write, notify, max_bytes=RECEIVE_PIPELINE_MAX_BYTES ):
+      self.verify = verify
+      self.write = write
+      self.notify = notify
+      self.max_bytes = max_bytes
+
+      self.__lock = threading.Lock()
+      self.__finished = threading.Condition( self.__lock )     # a batch left the pipeline
+      self.__pending_bytes = 0
+      self.__pending_batches = 0
+      self.__error = None
+      self.__aborted = False
+
+
+   def put( self, chunk_table, *verify_args ):
+      """
+      Send a batch of received chunks on to be verified and written.
+      Blocks while the pipeline holds too much data.
+      """
+      num_bytes = sum( [len(c) for c in chunk_table.values()] )
+
+      self.__lock.acquire()
+      # always let one batch in, so that a batch bigger than the limit can't wedge us
+      while self.__pending_batches > 0 and self.__pending_bytes + num_bytes > self.max_bytes and not self.__aborted:
+         self.__finished.wait()
+
+      self.__pending_bytes += num_bytes
+      self.__pending_batches += 1
+      self.__lock.release()
+
+      if not iftutil.VerifyThreadPool.start_new_thread( self.__verify, (chunk_table, num_bytes, verify_args), True, iftutil.POOL_SUBMIT_TIMEOUT ):
+         # no verifier to be had; do it ourselves
+         self.__verify( chunk_table, num_bytes, verify_args )
+
+
+   def __verify( self, chunk_table, num_bytes, verify_args ):
+      """
+      Verification stage
+      """
+      good = None
+      try:
+         if not self.__aborted:
+            good = self.verify( chunk_table, *verify_args )
+      except Exception, inst:
+         iftlog.exception( "receive_pipeline: could not verify chunks " + str(chunk_table.keys()), inst )
+         self.__done( num_bytes, (PROTO_MSG_ERROR_FATAL, E_UNHANDLED_EXCEPTION) )
+         return
+
+      if not good:
+         self.__done( num_bytes, None )
+         return
+
+      if not iftutil.WriteThreadPool.start_new_thread( self.__write, (good, num_bytes), True, iftutil.POOL_SUBMIT_TIMEOUT ):
+         self.__write( good, num_bytes )
+
+
+   def __write( self, chunk_table, num_bytes ):
+      """
+      Write-behind stage
+      """
+      error = None
+      try:
+         if not self.__aborted:
+            error = self.write( chunk_table )
+      except Exception, inst:
+         iftlog.exception( "receive_pipeline: could not write chunks " + str(chunk_table.keys()), inst )
+         error = (PROTO_MSG_ERROR_FATAL, E_UNHANDLED_EXCEPTION)
+
+      if error == (0, 0):
+         error = None
+      self.__done( num_bytes, error )
+
+
+   def __done( self, num_bytes, error ):
+      """
+      A batch has left the pipeline
+      """
+      self.__lock.acquire()
+      self.__pending_bytes -= num_bytes
+      self.__pending_batches -= 1
+      if error != None and self.__error == None:
+         self.__error = error
+      self.__finished.notifyAll()
+      self.__lock.release()
+
+      self.notify()
+
+
+   def take_error( self ):
+      """
+      Get the first (message, rc) a batch failed with, or (0, 0) if none did.
+      Recoverable errors are handed out once; a fatal one sticks.
+      """
+      self.__lock.acquire()
+      error = self.__error
+      if error != None and error[0] != PROTO_MSG_ERROR_FATAL:
+         self.__error = None
+      self.__lock.release()
+
+      if error == None:
+         return (0, 0)
+      return error
+
+
+   def pending( self ):
+      """
+      How many batches, and how many bytes, are still being verified or written?
+      """
+      self.__lock.acquire()
+      ret = (self.__pending_batches, self.__pending_bytes)
+      self.__lock.release()
+      return ret
+
+
+   def drain( self, abort=False ):
+      """
+      Wait for every batch in the pipeline to leave it.
+      If abort is True, batches not yet verified or written are dropped instead.
+      Don't call this from a verify or write worker.
+      """
+      self.__lock.acquire()
+      if abort:
+         self.__aborted = True
+         self.__finished.notifyAll()
+
+      while self.__pending_batches > 0:
+         self.__finished.wait()
+      self.__lock.release()
+
 
 
 class receiver( iftcore.ifttransmit.transmitter ):
@@ -44,6 +352,16 @@ class receiver( iftcore.ifttransmit.transmitter ):
       self.recv_finish = False    # not done yet
       self.recv_status = 0        # not done yet
       self.has_whole_file = False    # set to true if we suddently get the whole file
+      self.scheduler = None       # chunk_scheduler deciding how many chunks to ask for at once
+      self.pipeline = None        # receive_pipeline verifying and writing what we receive, if RECEIVE_PIPELINE
+      
+      self.__recv_lock = None                # protocols may call add_chunk() from several threads at once (made when first needed)
+      self.__recv_chunks_dict = None
+      self.__recv_files_list = None
+      self.__recv_batch_bytes = 0            # bytes in __recv_chunks_dict
+      self.__recv_batch_stime = 0            # when the chunks in __recv_chunks_dict started arriving
+      self.__recv_counts = (0, 0)            # chunks and bytes received by the current request, including those already sent on
+      self.__recv_error = None               # first (message, rc) that went wrong storing chunks mid-request
       
       # protocol name
       name = "iftreceiver"
@@ -89,7 +407,7 @@ class receiver( iftcore.ifttransmit.transmitter ):
       if rc != 0:
          return rc
       
-      self.transmit_state = TRANSMIT_STATE_DEAD
+      self.set_transmit_state( TRANSMIT_STATE_DEAD )
       self.ift_job = None
       self.iftfile_ref = None
       
@@ -116,28 +434,28 @@ class receiver( iftcore.ifttransmit.transmitter ):
          rc = self.__await_sender( connect_args, connect_timeout )
          if rc < 0:
             iftlog.log(5, self.name + ".on_start: await_sender rc=" + str(rc))
-            self.transmit_state = TRANSMIT_STATE_FAILURE
+            self.set_transmit_state( TRANSMIT_STATE_FAILURE )
             iftcore.ifttransmit.transmitter.on_end( self, connect_args )
             return rc
          else:
             rc = self.open_connection( job )
             if rc < 0:
                iftlog.log(5, self.name + ".on_start: open_connection rc = " + str(rc))
-               self.transmit_state = TRANSMIT_STATE_FAILURE
+               self.set_transmit_state( TRANSMIT_STATE_FAILURE )
                iftcore.ifttransmit.transmitter.on_end( self, connect_args )
                return rc
             
             self.connect_args = connect_args
             
             # we're connected!
-            self.transmit_state = TRANSMIT_STATE_CHUNKS
+            self.set_transmit_state( TRANSMIT_STATE_CHUNKS )
       
             iftcore.ifttransmit.transmitter.on_start( self, connect_args )
             
             return 0
       except Exception, inst:
          iftlog.exception( "iftreceiver.on_start failed!", inst)
-         self.transmit_state = TRANSMIT_STATE_FAILURE
+         self.set_transmit_state( TRANSMIT_STATE_FAILURE )
          iftcore.ifttransmit.transmitter.on_end( self, connect_args )
          return E_UNHANDLED_EXCEPTION
       
@@ -275,6 +593,14 @@ class receiver( iftcore.ifttransmit.transmitter ):
          self.close_connection( TRANSMIT_STATE_FAILURE )
          return E_FILE_NOT_FOUND
       
+      # when we're out of chunks to ask for, wait for others' chunks to arrive or free up
+      self.iftfile_ref.chunks_changed.subscribe( self.wakeup )
+      
+      self.scheduler = chunk_scheduler( self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )
+      
+      self.pipeline = None
+      if RECEIVE_PIPELINE:
+         self.pipeline = receive_pipeline( self.__verify_chunks, self.__write_chunks, self.wakeup.wake )
       return 0
    
    
@@ -286,12 +612,17 @@ class receiver( iftcore.ifttransmit.transmitter ):
       """
       self.__end_receive()
       
+      if self.pipeline != None:
+         # finish writing what we have if we succeeded; otherwise, don't bother
+         self.pipeline.drain( final_state != TRANSMIT_STATE_SUCCESS )
+      
       if self.iftfile_ref != None:
          #print self.name + ".close_connection: releasing my iftfile"
+         self.iftfile_ref.chunks_changed.unsubscribe( self.wakeup )
          self.iftfile_ref.unreserve_all( self )
          self.iftfile_ref = None
       
-      self.transmit_state = final_state
+      self.set_transmit_state( final_state )
       self.ready_to_receive = False
       self.end_time = time.time()
       
@@ -308,6 +639,19 @@ class receiver( iftcore.ifttransmit.transmitter ):
       if self.ift_job == None and (self.ready_to_receive == False or self.transmit_state != TRANSMIT_STATE_CHUNKS):
          return (0, E_BAD_STATE)     # nothing to do
       
+      if self.pipeline != None:
+         # act on whatever went wrong verifying or writing what we received before
+         msg, rc = self.pipeline.take_error()
+         if msg == PROTO_MSG_ERROR_FATAL:
+            self.__recv_cleanup( TRANSMIT_STATE_FAILURE )
+            return (msg, rc)
+         elif msg == PROTO_MSG_ERROR:
+            return (msg, rc)
+         
+         # the last of the file may have been written since
+         if self.iftfile_ref != None and self.iftfile_ref.is_complete():
+            return self.__recv_cleanup( TRANSMIT_STATE_SUCCESS )
+      
       # try to receive a chunk
       chunk_table = None
       recv_rc = 0
@@ -320,6 +664,10 @@ class receiver( iftcore.ifttransmit.transmitter ):
 
          desired_chunk_ids = self.__next_chunks()
          if len(desired_chunk_ids) == 0:
+            # the chunk store may have just filled in the rest of the file
+            if self.iftfile_ref != None and self.iftfile_ref.is_complete():
+               return self.__recv_cleanup( TRANSMIT_STATE_SUCCESS )
+            
             # they're all reserved...
             #print self.name + ": all reserved..."
             return (PROTO_MSG_NONE, E_TRY_AGAIN)
@@ -329,48 +677,35 @@ class receiver( iftcore.ifttransmit.transmitter ):
          recv_rc, chunk_table = self.__recv_chunks( self.ift_job.get_attr( iftfile.JOB_ATTR_SRC_CHUNK_DIR ), desired_chunk_ids )
          etime = time.time()
          
-         status = {}
+         # size the next request from how this one went
+         num_chunks, num_bytes = self.__recv_counts
+         if chunk_table.get("whole_file") == None and num_chunks > 0:
+            self.scheduler.record( num_chunks, num_bytes, etime - stime )
+         elif recv_rc != 0:
+            self.scheduler.failed()
          
          # if by some miracle we got the whole file at once, then check the file and be done with it.
          whole_file_path = chunk_table.get("whole_file")
          if whole_file_path != None:
             iftlog.log(3, self.name + ": got whole file back, saved in " + whole_file_path)
+            if self.pipeline != None:
+               self.pipeline.drain( True )
             shutil.move( whole_file_path, self.iftfile_ref.path )
             iftfile.apply_dir_permissions( self.iftfile_ref.path )
             self.iftfile_ref.mark_complete()
             return self.__recv_cleanup( TRANSMIT_STATE_SUCCESS )
+         
+         # act on whatever went wrong storing the chunks that were sent on while the request was still arriving
+         if self.__recv_error != None:
+            msg, rc = self.__recv_error
+            self.__recv_error = None
+            if msg == PROTO_MSG_ERROR_FATAL:
+               self.__recv_cleanup( TRANSMIT_STATE_FAILURE )
+            return (msg, rc)
 
-         # validate the chunk table otherwise.
-         elif chunk_table and len(chunk_table.keys()) > 0:     
-         
-            # verify chunk hashes if we need to.
-            # record each chunk if that's what we got
-            if self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_HASHES ) != None:
-               # verify each hash
-               chunk_hashes = self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_HASHES )
-               for k in chunk_table.keys():
-                  if len(chunk_hashes) > k:
-                     m = hashlib.sha1()
-                     m.update( chunk_table[k] )
-                     if chunk_hashes[k] != m.hexdigest():
-                        iftlog.log(5, self.name + ": chunk " + str(k) + "'s hash is incorrect!")
-                        status[k] = False
-                     else:
-                        status[k] = True
-         
-         
-            # log chunk data
-            for k in chunk_table.keys():
-               if status == {}:
-                  if recv_rc == 0:
-                     iftstats.log_chunk( self.ift_job, self.name, True, stime, etime, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )    # no way to verify chunk correctness
-                  else:
-                     iftstats.log_chunk( self.ift_job, self.name, False, stime, etime, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )
-               
-               else:
-                  iftstats.log_chunk( self.ift_job, self.name, status[k], stime, etime, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )
-               
-            
+         # validate the rest of the chunk table otherwise.
+         if num_chunks > 0:
+         
             # if we had a non-zero RC, we should warn the user
             if recv_rc != 0:
                # got some data, but still encountered an error so we need to emit a warning
@@ -384,18 +719,16 @@ class receiver( iftcore.ifttransmit.transmitter ):
                if len(not_received) != 0:
                   iftlog.log(5, "WARNING: " + self.name + " did not receive chunks " + str(not_received))
 
-            # store chunks
-            for chunk_id in chunk_table.keys():
-               msg, rc = self.__store_chunk( chunk_table[chunk_id], chunk_id )
-               if rc != E_DUPLICATE and (msg == PROTO_MSG_ERROR or msg == PROTO_MSG_ERROR_FATAL):
+            if len(chunk_table) > 0:
+               msg, rc = self.__send_on( chunk_table, self.__recv_batch_stime, etime, recv_rc )
+               if msg == PROTO_MSG_ERROR or msg == PROTO_MSG_ERROR_FATAL:
                   if msg == PROTO_MSG_ERROR_FATAL:
                      self.__recv_cleanup( TRANSMIT_STATE_FAILURE )
                   return (msg, rc)
-                  
-            # are we done?
-            if self.iftfile_ref.is_complete():
+            
+            # are we done?  (the pipeline tells us when it has written the last of the file)
+            if self.pipeline == None and self.iftfile_ref.is_complete():
                return self.__recv_cleanup( TRANSMIT_STATE_SUCCESS )
-
             
             # are we finished receiving, as indicated by the protocol?
             if self.recv_finish:
@@ -461,6 +794,10 @@ class receiver( iftcore.ifttransmit.transmitter ):
 
          file_names = self.__next_files()
          if len(file_names) == 0:
+            # the chunk store may have just filled in the rest of the file
+            if self.iftfile_ref != None and self.iftfile_ref.is_complete():
+               return self.__recv_cleanup( TRANSMIT_STATE_SUCCESS )
+            
             # they're all reserved...
             #print self.name + ": all reserved..."
             return (PROTO_MSG_NONE, E_TRY_AGAIN)
@@ -510,26 +847,30 @@ class receiver( iftcore.ifttransmit.transmitter ):
          
             else:
                # got one or more chunks, so add them to the file we're reconstructing
+               num_bytes = 0
                for f in files_list:
                   try:
                      fname = self.ift_job.get_attr( iftfile.JOB_ATTR_DEST_CHUNK_DIR ) + "/" + str(f[0])
                      fd = open(fname, "r")
                      chunk = fd.read()
                      fd.close()
+                     num_bytes += len(chunk)
                      msg, rc = self.__store_chunk( chunk, f[0] )
                      if msg != 0 or rc != 0:
                         return (msg, rc)
-                     
-                        
-                     # are we finished receiving, as indicated by the protocol?
-                     if self.recv_finish:
-                        return self.__recv_cleanup( self.recv_status )
-                     
-                     return (0,0)
                
                   except Exception, inst:
                      iftlog.exception( self.name + ".__receive_file_data: could not store chunk " + str(f))
                      return (PROTO_MSG_ERROR_FATAL, E_UNHANDLED_EXCEPTION)
+               
+               # size the next request from how this one went
+               self.scheduler.record( len(files_list), num_bytes, etime - stime )
+               
+               # are we finished receiving, as indicated by the protocol?
+               if self.recv_finish:
+                  return self.__recv_cleanup( self.recv_status )
+               
+               return (0,0)
                   
                
             
@@ -575,9 +916,189 @@ class receiver( iftcore.ifttransmit.transmitter ):
    
    
    
-   def __store_chunk( self, chunk, chunk_id ):
+   def __verify_chunks( self, chunk_table, stime, etime, recv_rc ):
+      """
+      Verification stage:  check the hashes of chunks received between stime and etime, and log how each went.
+      Return the table of chunks that can be written.
+      """
+      
+      status = {}
+      
+      # decode chunks that were compressed on the way, so that their hashes are checked on the chunks themselves
+      undecodable = []
+      if self.chunk_codec and self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_CODEC ) != None:
+         chunk_table, undecodable = iftcodec.decode_chunks( chunk_table, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )
+         for k in undecodable:
+            iftlog.log(5, self.name + ": chunk " + str(k) + " could not be decoded!")
+            iftstats.log_chunk( self.ift_job, self.name, False, stime, etime, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )
+         
+         if len(chunk_table) == 0:
+            return {}
+      
+      # verify chunk hashes if we need to.
+      # record each chunk if that's what we got
+      if self.iftfile_ref != None and self.iftfile_ref.verifier != None:
+         # verify against the Merkle root
+         status = self.iftfile_ref.verifier.verify_chunks( chunk_table )
+         for k in status.keys():
+            if not status[k]:
+               iftlog.log(5, self.name + ": chunk " + str(k) + " does not match the Merkle root!")
+      
+      elif self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_HASHES ) != None:
+         # verify each hash
+         chunk_hashes = self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_HASHES )
+         for k in chunk_table.keys():
+            if len(chunk_hashes) > k:
+               m = hashlib.sha1()
+               m.update( chunk_table[k] )
+               if chunk_hashes[k] != m.hexdigest():
+                  iftlog.log(5, self.name + ": chunk " + str(k) + "'s hash is incorrect!")
+                  status[k] = False
+               else:
+                  status[k] = True
+   
+   
+      # log chunk data, giving each chunk its share of the request's time
+      chunk_time = (etime - stime) / len(chunk_table.keys())
+      chunk_stime = stime
+      for k in chunk_table.keys():
+         chunk_etime = chunk_stime + chunk_time
+         if status == {}:
+            if recv_rc == 0:
+               iftstats.log_chunk( self.ift_job, self.name, True, chunk_stime, chunk_etime, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )    # no way to verify chunk correctness
+            else:
+               iftstats.log_chunk( self.ift_job, self.name, False, chunk_stime, chunk_etime, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )
+         
+         else:
+            iftstats.log_chunk( self.ift_job, self.name, status[k], chunk_stime, chunk_etime, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) )
+         
+         chunk_stime = chunk_etime
+      
+      # don't write the ones we know are bad
+      good = {}
+      for k in chunk_table.keys():
+         if status.get( k ) != False:
+            good[k] = chunk_table[k]
+      
+      return good
+   
+   
+   def __send_on( self, chunk_table, stime, etime, recv_rc ):
+      """
+      Send received chunks on to be verified and written:  through the pipeline if we have one
+      (so that we can receive the next ones meanwhile), or on this thread otherwise.
+      Return (0, 0), or the (message, rc) that went wrong.
+      """
+      if self.pipeline != None:
+         self.pipeline.put( chunk_table, stime, etime, recv_rc )
+         return (0, 0)
+      
+      # store chunks (but not the ones we know are bad)
+      return self.__write_chunks( self.__verify_chunks( chunk_table, stime, etime, recv_rc ) )
+   
+   
+   def __write_chunks( self, chunk_table ):
+      """
+      Write stage:  store verified chunks into the file, in order.
+      Return (0, 0), or the first (message, rc) that went wrong.
+      """
+      
+      chunk_ids = chunk_table.keys()
+      chunk_ids.sort()
+      for chunk_id in chunk_ids:
+         msg, rc = self.__store_chunk( chunk_table[chunk_id], chunk_id, False )
+         if rc != E_DUPLICATE and (msg == PROTO_MSG_ERROR or msg == PROTO_MSG_ERROR_FATAL):
+            return (msg, rc)
+         
+         if msg == 0 and rc == 0:
+            self.__add_to_store( chunk_table[chunk_id], chunk_id )
+      
+      return (0, 0)
+   
+   
+   def __chunk_digest( self, chunk_id ):
+      """
+      Get the SHA-1 (hex) a chunk is known to have, or None if we don't know it.
+      """
+      chunk_hashes = self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_HASHES )
+      if chunk_hashes and chunk_id >= 0 and chunk_id < len(chunk_hashes):
+         return chunk_hashes[ chunk_id ]
+      
+      if self.iftfile_ref != None and self.iftfile_ref.verifier != None:
+         leaf = self.iftfile_ref.verifier.leaf( chunk_id )
+         if leaf != None:
+            return binascii.hexlify( leaf )
+      
+      return None
+   
+   
+   def __add_to_store( self, chunk, chunk_id ):
+      """
+      Add a chunk we received and verified to the chunk store, for later transfers.
+      """
+      if not iftstore.enabled():
+         return
+      
+      digest = self.__chunk_digest( chunk_id )
+      if digest != None:
+         iftstore.put( digest, chunk )
+   
+   
+   def __fill_from_store( self, chunk_ids ):
+      """
+      Store the chunks we can from the chunk store, instead of receiving them.
+      Return the IDs of the chunks that still need to be received.
+      """
+      if not iftstore.enabled() or self.iftfile_ref == None:
+         return chunk_ids
+      
+      remaining = []
+      for chunk_id in chunk_ids:
+         digest = self.__chunk_digest( chunk_id )
+         chunk = None
+         if digest != None:
+            chunk = iftstore.get( digest )
+         
+         if chunk == None:
+            remaining.append( chunk_id )
+            continue
+         
+         rc = self.iftfile_ref.lock_chunk( self, chunk_id, True, 1.0 )
+         if rc == E_DUPLICATE:
+            continue    # someone else stored it
+         elif rc != 0:
+            remaining.append( chunk_id )
+            continue
+         
+         rc = self.iftfile_ref.set_chunk( chunk, chunk_id, self.ift_job.get_attr( iftfile.JOB_ATTR_TRUNICATE ), self.ift_job.get_attr( iftfile.JOB_ATTR_STRICT_CHUNKSIZE ) )
+         self.iftfile_ref.unlock_chunk( self, chunk_id )
+         if rc != 0:
+            remaining.append( chunk_id )
+         else:
+            iftlog.log(1, self.name + ": chunk " + str(chunk_id) + ": taken from the chunk store")
+      
+      return remaining
+   
+   
+   def __unstored_chunk_ids( self ):
+      """
+      Get the next run of chunks to receive, after filling in whatever we can from the chunk store.
+      Return None if there are none.
+      """
+      while True:
+         unreceived = self.unreceived_chunk_ids( self.scheduler.run_length() )
+         if unreceived == None:
+            return None
+         
+         remaining = self.__fill_from_store( unreceived )
+         if len(remaining) > 0:
+            return remaining
+   
+   
+   def __store_chunk( self, chunk, chunk_id, close_on_error=True ):
       """
-      Store a chunk into the file
+      Store a chunk into the file.
+      If it can't be written, close the connection unless close_on_error is False.
       """
       
       iftlog.log(1, self.name + ": chunk " + str(chunk_id) + ": received " + str(len(chunk)) + " bytes")
@@ -607,7 +1128,8 @@ class receiver( iftcore.ifttransmit.transmitter ):
          iftlog.log( 5, self.name + ": could not write chunk " + str(chunk_id) + ", rc=" + str(rc))
          
          # someone's spoofing us
-         self.close_connection( TRANSMIT_STATE_FAILURE )
+         if close_on_error:
+            self.close_connection( TRANSMIT_STATE_FAILURE )
          return (PROTO_MSG_ERROR_FATAL, rc)
       
       if rc2 < 0:
@@ -626,6 +1148,13 @@ class receiver( iftcore.ifttransmit.transmitter ):
       """
       Validate and close the file
       """
+      if self.pipeline != None:
+         # make sure everything we received is written before deciding how it went
+         self.pipeline.drain( default_status != TRANSMIT_STATE_SUCCESS )
+         msg, rc = self.pipeline.take_error()
+         if msg == PROTO_MSG_ERROR_FATAL:
+            default_status = TRANSMIT_STATE_FAILURE
+      
       if self.iftfile_ref != None:
          iftlog.log(3, self.name + ": done receiving chunks for " + str(self.iftfile_ref.path))
       else:
@@ -646,9 +1175,36 @@ class receiver( iftcore.ifttransmit.transmitter ):
    def add_chunk( self, chunk_id, chunk_str ):
       """
       Record that we have indeed received a chunk.
+      Once RECEIVE_BATCH_MAX_BYTES have piled up, they are sent on to disk
+      right away, so that a big request is never held in memory all at once.
       """
-      if self.__recv_chunks_dict != None:
+      if self.__recv_lock == None:
+         return      # not receiving chunks
+      
+      self.__recv_lock.acquire()
+      try:
+         if self.__recv_chunks_dict == None:
+            return
+         
          self.__recv_chunks_dict[ chunk_id ] = chunk_str
+         self.__recv_batch_bytes += len(chunk_str)
+         num_chunks, num_bytes = self.__recv_counts
+         self.__recv_counts = (num_chunks + 1, num_bytes + len(chunk_str))
+         
+         if self.__recv_batch_bytes < RECEIVE_BATCH_MAX_BYTES or self.__recv_chunks_dict.has_key( "whole_file" ):
+            return
+         
+         chunk_table = self.__recv_chunks_dict
+         stime = self.__recv_batch_stime
+         self.__recv_chunks_dict = {}
+         self.__recv_batch_bytes = 0
+         self.__recv_batch_stime = time.time()
+         
+         msg, rc = self.__send_on( chunk_table, stime, self.__recv_batch_stime, 0 )
+         if (msg == PROTO_MSG_ERROR or msg == PROTO_MSG_ERROR_FATAL) and self.__recv_error == None:
+            self.__recv_error = (msg, rc)
+      finally:
+         self.__recv_lock.release()
       
    
    def add_file( self, chunk_id, file_path ):
@@ -664,8 +1220,11 @@ class receiver( iftcore.ifttransmit.transmitter ):
       Sometimes, the receiver will get the entire file back at once.
       Call this method if so.
       """
-      if self.__recv_chunks_dict != None:
-         self.__recv_chunks_dict["whole_file"] = file_path
+      if self.__recv_lock != None:
+         self.__recv_lock.acquire()
+         if self.__recv_chunks_dict != None:
+            self.__recv_chunks_dict["whole_file"] = file_path
+         self.__recv_lock.release()
       
       if self.__recv_files_list != None:
          self.__recv_files_list = [[-1, file_path]] + self.__recv_files_list
@@ -677,12 +1236,26 @@ class receiver( iftcore.ifttransmit.transmitter ):
       """
       The "real" recv_chunks method, which will track the chunks received
       through the add_chunk method called in all subclasses.
+      Return (rc, the chunks received but not yet sent on to disk).
       """
+      if self.__recv_lock == None:
+         self.__recv_lock = threading.Lock()
+      
+      self.__recv_lock.acquire()
       self.__recv_chunks_dict = {}     # dictionary to store received data
       self.__recv_files_list = None
+      self.__recv_batch_bytes = 0
+      self.__recv_batch_stime = time.time()
+      self.__recv_counts = (0, 0)
+      self.__recv_error = None
+      self.__recv_lock.release()
+      
       rc = self.recv_chunks( remote_chunk_dir, desired_chunks )
+      
+      self.__recv_lock.acquire()
       ret_chunks_dict = self.__recv_chunks_dict
       self.__recv_chunks_dict = None
+      self.__recv_lock.release()
       return (rc, ret_chunks_dict)
    
    
@@ -756,32 +1329,45 @@ class receiver( iftcore.ifttransmit.transmitter ):
       """
       transmitter cleanup
       """
+      if self.pipeline != None:
+         self.pipeline.drain( True )
+         self.pipeline = None
+      
       self.proto_clean()
       iftcore.ifttransmit.transmitter.clean(self)
       self.ift_job = None
       self.recv_finish = False
       self.has_whole_file = False
       self.recv_status = 0
-      self.state = PROTO_STATE_DEAD
+      self.set_state( PROTO_STATE_DEAD )
       if self.iftfile_ref != None:
          #print "releasing my iftfile"
+         self.iftfile_ref.chunks_changed.unsubscribe( self.wakeup )
          self.iftfile_ref.unreserve_all( self )
    
 
-   def unreceived_chunk_ids(self):
+   def reset(self):
       """
-      Which chunks are unreceived?
+      Let go of the last transfer's file, too
+      """
+      self.iftfile_ref = None
+      return iftcore.ifttransmit.transmitter.reset(self)
+   
+
+   def unreceived_chunk_ids(self, count=1):
+      """
+      Which chunks are unreceived?  Get a run of up to count of them.
       """
       if self.iftfile_ref == None:
          return None
       
-      rc = self.iftfile_ref.get_unwritten_chunks()
+      rc = self.iftfile_ref.next_unwritten_chunks( count, True )
       if rc < 0:
          iftlog.log(5, self.name + ": could not determine pending file pieces (rc = " + str(rc) + ")")
          return None
   
       if len(rc) > 0: 
-         return [rc[0]]
+         return rc
       return None
    
    
@@ -790,18 +1376,19 @@ class receiver( iftcore.ifttransmit.transmitter ):
       What chunks do we want to receive next?
       """
       if self.ift_job.get_attr( iftfile.JOB_ATTR_REMOTE_IFTD ) or self.get_chunking_mode() != PROTO_NO_CHUNKING:
-         unreceived = self.unreceived_chunk_ids()
+         unreceived = self.__unstored_chunk_ids()
          if unreceived == None:
             return []
 
          if self.get_chunking_mode() != PROTO_NONDETERMINISTIC_CHUNKING:
-            # reserve these in advance
+            # reserve these in advance, for long enough to receive all of them
+            reserve_time = self.scheduler.reservation_time( self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_TIMEOUT ) )
             urc = []
             for i in unreceived:
-               rc = self.iftfile_ref.reserve_chunk( self, i, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_TIMEOUT ) )
+               rc = self.iftfile_ref.reserve_chunk( self, i, reserve_time )
                if rc == E_COMPLETE:
                   # we're done!
-                  self.recv_finish( TRANSMIT_STATE_SUCCESS )
+                  self.recv_finished( TRANSMIT_STATE_SUCCESS )
                   return []
                   
                elif rc != 0:
@@ -825,17 +1412,18 @@ class receiver( iftcore.ifttransmit.transmitter ):
       unreceived = None
       
       if self.ift_job.get_attr( iftfile.JOB_ATTR_REMOTE_IFTD ) or self.get_chunking_mode() != PROTO_NO_CHUNKING:
-         unreceived = self.unreceived_chunk_ids()
+         unreceived = self.__unstored_chunk_ids()
          if unreceived == None:
-            return []   
+            return []
       
 
          tld = self.ift_job.get_attr( iftfile.JOB_ATTR_SRC_CHUNK_DIR )
          if self.get_chunking_mode() != PROTO_NONDETERMINISTIC_CHUNKING:
-            # reserve these in advance
+            # reserve these in advance, for long enough to receive all of them
+            reserve_time = self.scheduler.reservation_time( self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_TIMEOUT ) )
             urc = []
             for i in unreceived:
-               rc = self.iftfile_ref.reserve_chunk( self, i, self.ift_job.get_attr( iftfile.JOB_ATTR_CHUNK_TIMEOUT ) )
+               rc = self.iftfile_ref.reserve_chunk( self, i, reserve_time )
                if rc == E_COMPLETE:
                   # we're done!
                   self.recv_finished( TRANSMIT_STATE_SUCCESS )
@@ -866,5 +1454,5 @@ class receiver( iftcore.ifttransmit.transmitter ):
       """
       Forcibly set my ifttransmit state
       """
-      self.state = newstate
+      iftcore.ifttransmit.transmitter.set_state( self, newstate )
    
@@ -29,6 +29,7 @@ import iftfile
 import iftutil
 import iftloader
 import iftstats
+import iftcodec
 
 class sender( iftcore.ifttransmit.transmitter ):
    
@@ -95,7 +96,7 @@ class sender( iftcore.ifttransmit.transmitter ):
       """
       print "on_start"   
       
-      self.transmit_state = TRANSMIT_STATE_DEAD
+      self.set_transmit_state( TRANSMIT_STATE_DEAD )
       
       # check connection args
       rc = self.validate_attrs( connect_args, self.get_connect_attrs() )
@@ -121,7 +122,7 @@ class sender( iftcore.ifttransmit.transmitter ):
          iftlog.exception( self.name + ": could not send_job", inst )
          
          self.ift_job = None
-         self.transmit_state = TRANSMIT_STATE_FAILURE
+         self.set_transmit_state( TRANSMIT_STATE_FAILURE )
          return result
      
       if result != 0:
@@ -134,7 +135,7 @@ class sender( iftcore.ifttransmit.transmitter ):
          if rc < 0:
             self.connect_args = None
             iftlog.log(5, self.name + ".alert_receiver rc=" + str(rc))
-            self.transmit_state = TRANSMIT_STATE_FAILURE
+            self.set_transmit_state( TRANSMIT_STATE_FAILURE )
             ifttransmit.on_end( self, connect_args )
             return rc
          
@@ -143,19 +144,19 @@ class sender( iftcore.ifttransmit.transmitter ):
             rc = self.open_connection( self.ift_job )
             if rc < 0:
                iftlog.log(5, self.name + ".on_start: open_connection rc=" + str(rc))
-               self.transmit_state = TRANSMIT_STATE_FAILURE
+               self.set_transmit_state( TRANSMIT_STATE_FAILURE )
                iftcore.ifttransmit.transmitter.on_end( self, connect_args )
                return rc
             
             # good to start
             self.connect_args = connect_args
-            self.transmit_state = TRANSMIT_STATE_CHUNKS
+            self.set_transmit_state( TRANSMIT_STATE_CHUNKS )
             iftcore.ifttransmit.transmitter.on_start( self, connect_args )
             
             return 0
       except Exception, inst:
          iftlog.exception( "iftsender.on_start failed!", inst)
-         self.__transmit_state = TRANSMIT_STATE_FAILURE
+         self.set_transmit_state( TRANSMIT_STATE_FAILURE )
          return E_UNHANDLED_EXCEPTION
       
    
@@ -297,7 +298,7 @@ class sender( iftcore.ifttransmit.transmitter ):
       Invalidate any locks or references we have acquired.
       """
       self.__end_transmit()
-      self.transmit_state = final_state
+      self.set_transmit_state( final_state )
       self.ready_to_send = False
       self.end_time = time.time()
       iftlog.log(5, self.name + ": Transmission took " + str(self.end_time - self.start_time) + " ticks" )
@@ -345,8 +346,17 @@ class sender( iftcore.ifttransmit.transmitter ):
          The path to which to send the chunk on the remote host.
       """
       
+      if job == None:
+         job = self.ift_job
+      
+      # compress the chunk on the way, if the receiver agreed to it
+      data = chunk
+      codec = job.get_attr( iftfile.JOB_ATTR_CHUNK_CODEC )
+      if chunk != None and codec != None and self.chunk_codec:
+         data = iftcodec.encode( iftfile.chunk_data_str( chunk ), codec[0], codec[1] )
+      
       stime = time.time()
-      rc = self.send_chunk( chunk, chunk_id, chunk_path, remote_chunk_path )
+      rc = self.send_chunk( data, chunk_id, chunk_path, remote_chunk_path )
       etime = time.time()
       
       status = False
@@ -355,12 +365,11 @@ class sender( iftcore.ifttransmit.transmitter ):
          status = True
       
       if chunk:
-         chunk_len = max( len(chunk), rc )
+         chunk_len = len(chunk)
+         if data is chunk:
+            chunk_len = max( len(chunk), rc )
       else:
          chunk_len = iftfile.get_filesize( self.ift_job.get_attr( iftfile.JOB_ATTR_SRC_NAME ) )
-   
-      if job == None:
-         job = self.ift_job
          
       iftstats.log_chunk( job, self.name, status, stime, etime, chunk_len )
       return rc
@@ -466,5 +475,5 @@ class sender( iftcore.ifttransmit.transmitter ):
       Forcibly set my ifttransmit state
       """
       
-      self.state = newstate
+      iftcore.ifttransmit.transmitter.set_state( self, newstate )
 
@@ -22,6 +22,7 @@ import iftfile
 import iftutil
 import iftloader
 import iftstats
+import iftevent
 
 import iftcore
 from iftcore.consts import *
@@ -44,11 +45,30 @@ class transmitter:
       self.setup_attrs = None
       self.default_run = None
       self.name = "<unknown>"
+      self.reusable = False      # can a pool reset this instance and run another transfer with it (see reset())?
+      self.chunk_codec = False   # does this protocol carry chunk data as it is, so that chunks can be compressed on the way (see iftcodec)?
+      self.wakeup = iftevent.waiter()           # woken when there may be something for run() to do
+      self.state_changed = iftevent.event()     # fired when state or transmit_state changes
       
    
    def get_transmit_state(self):
       return self.transmit_state
    
+   def set_transmit_state(self, transmit_state):
+      """
+      Set the transmit state, and tell whoever is watching
+      """
+      self.transmit_state = transmit_state
+      self.state_changed.fire()
+   
+   def set_state(self, newstate):
+      """
+      Set the protocol state, and tell whoever is watching
+      """
+      self.state = newstate
+      self.state_changed.fire()
+      self.wakeup.wake()
+   
    def isactive(self):
       """
       Are we active?  Do we initiate the transmission?
@@ -201,21 +221,21 @@ class transmitter:
       """
       Default behavior of what to do upon thread startup
       """
-      self.state = PROTO_STATE_RUNNING
+      self.set_state( PROTO_STATE_RUNNING )
    
    
    def on_end( self, args ):
       """
       Default behavior of what to do upon ending
       """
-      self.state = PROTO_STATE_DEAD
+      self.set_state( PROTO_STATE_DEAD )
    
    
    def on_term( self, args ):
       """
       Default behavior for termination
       """
-      self.state = PROTO_STATE_TERM
+      self.set_state( PROTO_STATE_TERM )
    
    def on_error( self, error_code ):
       iftlog.log(5, "Received error (code " + str(error_code) + ")")
@@ -234,8 +254,35 @@ class transmitter:
       """
       self.msg_queue = deque()
       self.check = 0
-      self.state = PROTO_STATE_DEAD
+      self.set_state( PROTO_STATE_DEAD )
+      self.set_transmit_state( TRANSMIT_STATE_DEAD )
+   
+   
+   def reset( self ):
+      """
+      Get ready to run another transfer, once clean() has cleaned up after the last one.
+      Only protocols that set self.reusable (i.e. whose clean() and proto_reset() undo
+      everything a transfer sets up) can be reset.
+      
+      @return
+         0 if this instance can run another transfer; nonzero if not
+      """
+      if not self.reusable or self.state != PROTO_STATE_DEAD:
+         return E_BAD_STATE
+      
+      self.msg_queue = deque()
+      self.check = 0
+      self.last_error = 0
       self.transmit_state = TRANSMIT_STATE_DEAD
+      self.state_changed = iftevent.event()     # whoever watched the last transfer is not watching this one
+      return self.proto_reset()
+   
+   
+   def proto_reset( self ):
+      """
+      Protocol-specific reset, for per-transfer state that proto_clean() leaves alone
+      """
+      return 0
    
    
    def message_handler( self, msg_type, msg_params ):
@@ -265,7 +312,7 @@ class transmitter:
             iftlog.log(5, "   Handler: None")
          iftlog.log(5, "   Message ID:   " + str(msg_type))
          iftlog.log(5, "   Message args: " + str(msg_params))
-         self.transmit_state = TRANSMIT_STATE_FAILURE
+         self.set_transmit_state( TRANSMIT_STATE_FAILURE )
          self.on_error( E_UNHANDLED_EXCEPTION )
       
       return
@@ -284,24 +331,28 @@ class transmitter:
       """
       item = (msg_type, msg_params)
       self.msg_queue.append( item )
+      self.wakeup.wake()
    
    
    def run(self, timeslice ):
       """
       While running, get messages from the encapsulating iftproto instance and handle them.
+      When there is nothing to do, block until a message is posted (or the state changes),
+      instead of spinning.
       @arg timeslice
-         How often to sleep between iterations
+         How long to wait between iterations (a posted message cuts the wait short)
       @return
          last message received
       """
       if self.state == PROTO_STATE_DEAD:
-         self.state = PROTO_STATE_SUSPENDED
+         self.set_state( PROTO_STATE_SUSPENDED )
       end_args = None
       shutdown_args = None
       last_msg = 0
       #print self.name + ": initial state = " + str(self.state)
       while self.state != PROTO_STATE_TERM:
          try:
+            idle = True    # did nothing this time around
             if self.default_run != None and self.state == PROTO_STATE_RUNNING:
                default_msg = None
                default_args = None
@@ -310,7 +361,7 @@ class transmitter:
                   default_msg, default_args  = self.default_run()
                except Exception, inst:
                   iftlog.exception( self.name + ": Default behavior exception", inst)
-                  self.transmit_state = TRANSMIT_STATE_FAILURE
+                  self.set_transmit_state( TRANSMIT_STATE_FAILURE )
                   break
 
                #print self.name + ": msg = " + str(default_msg) + ", args = " + str(default_args)  
@@ -340,7 +391,11 @@ class transmitter:
                if default_msg != None and default_msg != PROTO_MSG_NONE:
                   self.message_handler( default_msg, default_args )
                   if timeslice > 0:
-                     time.sleep( timeslice )
+                     self.wakeup.wait( timeslice )
+               
+               # (PROTO_MSG_NONE, E_TRY_AGAIN) means every chunk is spoken for, and (0, E_BAD_STATE) means we're not ready
+               if not ((default_msg == None or default_msg == PROTO_MSG_NONE) and default_args in (E_TRY_AGAIN, E_BAD_STATE)):
+                  idle = False
             
             msg = None
             try:
@@ -350,6 +405,7 @@ class transmitter:
                pass
             
             if msg != None:
+               idle = False
                if msg[0] == PROTO_MSG_TERM:
                   iftlog.log(3, self.name + ": Got PROTO_MSG_TERM, dying...")
                   shutdown_args = msg[1]
@@ -362,19 +418,22 @@ class transmitter:
                else:
                   self.message_handler( msg[0], msg[1] )
 
-            if timeslice > 0:
-               time.sleep( timeslice )
+            if idle:
+               # nothing to do until someone posts a message, or chunks free up
+               self.wakeup.wait( max( timeslice, PROTO_IDLE_TIMEOUT ) )
+            elif timeslice > 0:
+               self.wakeup.wait( timeslice )
 
             
          except Exception, inst:
             iftlog.exception( self.name + ": Event handler exception", inst )
-            self.transmit_state = TRANSMIT_STATE_FAILURE
+            self.set_transmit_state( TRANSMIT_STATE_FAILURE )
             break
      
          continue
 
       try:
-         self.state = PROTO_STATE_ENDED
+         self.set_state( PROTO_STATE_ENDED )
          self.on_end( end_args )
       except Exception, inst:
          iftlog.exception( self.name + ": could not clean up after myself", inst)
@@ -382,7 +441,7 @@ class transmitter:
       # shutdown if terminated
       if last_msg == PROTO_MSG_TERM:
          try:
-            self.state = PROTO_STATE_DEAD
+            self.set_state( PROTO_STATE_DEAD )
             self.on_term( shutdown_args )
          except Exception, inst:
             iftlog.exception( self.name + ": terminated but could not properly shutdown", inst)
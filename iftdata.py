@@ -38,6 +38,7 @@ E_BAD_STATE       = -110      # we're in the wrong state to do this
 E_WRITE           = -111      # could not write data
 E_COMPLETE        = -112      # received everything, but tried to receive more
 E_TERMINATED      = -200      # request could not be carried out since the thread isn't running
+E_CANCELLED       = -201      # the transfer was cancelled
 E_UNHANDLED_EXCEPTION = -300  # caught unhandled exception
 E_FAILURE         = -400      # transfer has failed
 E_CORRUPT         = -500      # data is corrupt (e.g. bad hash, etc)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+iftdelta.py
+Copyright (c) 2009 Jude Nelson
+
+Delta transfers:  when the receiver already has an older copy of a file,
+chunks of the new file that are somewhere in the old one are copied out of
+it locally, and only the rest cross the network.
+
+The sender gives the receiver a weak checksum (Adler-32) of each chunk along
+with its SHA-1.  The receiver runs a window the size of a chunk over the old
+file as rsync does:  wherever the window's weak checksum is that of a chunk
+it wants, the window is SHA-1'd to be sure, and on a match the window jumps
+ahead a whole chunk.  Otherwise the window slides one byte, and its checksum
+is rolled rather than recomputed, so data that was shifted by inserting or
+deleting bytes is still found.
+"""
+
+import os
+import mmap
+import array
+import zlib
+import hashlib
+
+import iftlog
+
+from iftdata import *
+
+
+"""
+Adler-32 modulus
+"""
+ADLER_MOD = 65521
+
+"""
+How many bytes of the old copy to slide over at a time, between weak checksum matches
+"""
+SCAN_BLOCK_SIZE = 1048576
+
+
+def weak_sum( data ):
+   """
+   Weak checksum of a chunk, as a signed 32-bit int (so it can go over XML-RPC)
+   """
+   return zlib.adler32( data )
+
+
+def weak_sums( chunks ):
+   """
+   Get the weak checksum of each of a sequence of chunks (strings), in order.
+   """
+   return [weak_sum( chunk ) for chunk in chunks]
+
+
+
+class basis:
+   """
+   Read-only handle on the old copy of a file being received.  It stays
+   usable after the old copy is removed to make way for the new one.
+   """
+
+   def __init__( self, path ):
+      self.path = path
+      self.fd = -1
+      self.data = None
+      self.stat = None
+
+
+   def open( self ):
+      """
+      Open and map the old copy.
+      Return 0 on success; negative on error
+      """
+      try:
+         self.fd = os.open( self.path, os.O_RDONLY )
+         self.stat = os.fstat( self.fd )
+         if self.stat.st_size == 0:
+            self.close()
+            return E_NO_DATA
+
+         self.data = mmap.mmap( self.fd, 0, access=mmap.ACCESS_READ )
+         return 0
+      except Exception, inst:
+         iftlog.exception("iftdelta: could not open " + str(self.path), inst)
+         self.close()
+         return E_IOERROR
+
+
+   def is_replaced( self ):
+      """
+      Has the old copy been replaced (so that writing the new one won't overwrite it)?
+      """
+      try:
+         st = os.stat( self.path )
+         return (st.st_dev, st.st_ino) != (self.stat.st_dev, self.stat.st_ino)
+      except OSError:
+         return True
+
+
+   def close( self ):
+      try:
+         if self.data != None:
+            self.data.close()
+         if self.fd >= 0:
+            os.close( self.fd )
+      except Exception, inst:
+         iftlog.exception("iftdelta: could not close " + str(self.path), inst)
+
+      self.data = None
+      self.fd = -1
+
+
+
+def open_basis( path ):
+   """
+   Get hold of the old copy of a file that is about to be received, or None if there isn't one.
+   Do this before the file is opened for writing, which removes the old copy.
+   """
+   if not os.path.isfile( path ):
+      return None
+
+   b = basis( path )
+   if b.open() != 0:
+      return None
+
+   return b
+
+
+
+def find_matches( data, chunksize, file_size, chunk_hashes, chunk_weak_sums ):
+   """
+   Find the chunks of a file in (a string or map of) some other data, i.e. an old copy of the file.
+   chunk_hashes and chunk_weak_sums are the SHA-1 (hex) and weak checksum of each chunk of the file.
+   Return a dictionary mapping the ID of each chunk found to its offset in the data.
+   """
+   num_chunks = len(chunk_hashes)
+   if num_chunks == 0 or len(chunk_weak_sums) != num_chunks:
+      return {}
+
+   # full-sized chunks, by weak checksum
+   wanted = {}
+   for chunk_id in xrange(0, num_chunks):
+      if chunk_id * chunksize + chunksize <= file_size:
+         wanted.setdefault( chunk_weak_sums[chunk_id] & 0xFFFFFFFF, [] ).append( chunk_id )
+
+   found = {}
+   n = len(data)
+   L = chunksize
+   M = ADLER_MOD
+   o = 0
+   a = b = -1       # Adler-32 halves of the window at o, or -1 if they need computing
+
+   while o + L <= n and len(wanted) > 0:
+      if a < 0:
+         weak = zlib.adler32( data[o : o + L] ) & 0xFFFFFFFF
+         a = weak & 0xFFFF
+         b = weak >> 16
+      else:
+         weak = (b << 16) | a
+
+      chunk_ids = wanted.get( weak )
+      if chunk_ids != None:
+         digest = hashlib.sha1( data[o : o + L] ).hexdigest()
+         same = [i for i in chunk_ids if chunk_hashes[i] == digest]
+         if len(same) > 0:
+            for i in same:
+               found[i] = o
+               chunk_ids.remove( i )
+            if len(chunk_ids) == 0:
+               del wanted[ weak ]
+
+            # skip the matched window
+            o += L
+            a = -1
+            continue
+
+      if o + L >= n:
+         break
+
+      # slide the window a byte at a time until its weak checksum is one we want (or
+      # for a block's worth of bytes).  This loop is where a delta spends its time on
+      # data that changed, so it is kept tight.
+      last = min( n - L - o, SCAN_BLOCK_SIZE )
+      window = array.array( 'B', data[o : o + last + L] )
+      i = 0
+      while i < last:
+         out_byte = window[i]
+         a = (a - out_byte + window[i + L]) % M
+         b = (b - L * out_byte + a - 1) % M
+         i += 1
+         if ((b << 16) | a) in wanted:
+            break
+
+      o += i
+
+   # a short last chunk can only be matched against the end of the data, or where it was
+   last_id = num_chunks - 1
+   last_len = file_size - last_id * chunksize
+   if last_len > 0 and last_len < chunksize and not found.has_key( last_id ):
+      for offset in [n - last_len, last_id * chunksize]:
+         if offset >= 0 and offset + last_len <= n and hashlib.sha1( data[offset : offset + last_len] ).hexdigest() == chunk_hashes[last_id]:
+            found[ last_id ] = offset
+            break
+
+   return found
+
+
+
+def apply_basis( old_copy, iftfile_ref, chunksize, file_size, chunk_hashes, chunk_weak_sums ):
+   """
+   Copy the chunks of a file being received that are in its old copy (a basis) into
+   the new file, so they need not be received.  The basis is closed afterwards.
+   Do this before anything else writes to the new file.
+   Return (chunks copied, bytes copied).
+   """
+   copied = 0
+   copied_bytes = 0
+   try:
+      if not old_copy.is_replaced():
+         # the "old copy" is the new file, picked up where it left off (see iftjournal)
+         return (0, 0)
+
+      matches = find_matches( old_copy.data, chunksize, file_size, chunk_hashes, chunk_weak_sums )
+      for chunk_id in sorted( matches.keys() ):
+         length = min( chunksize, file_size - chunk_id * chunksize )
+         offset = matches[ chunk_id ]
+         rc = iftfile_ref.set_chunk( old_copy.data[offset : offset + length], chunk_id )
+         if rc == 0:
+            copied += 1
+            copied_bytes += length
+
+      iftlog.log(3, "iftdelta: copied " + str(copied) + " of " + str(len(chunk_hashes)) + " chunks (" + str(copied_bytes) + " of " + str(file_size) + " bytes) of " + str(iftfile_ref.path) + " from its old copy")
+   except Exception, inst:
+      iftlog.exception("iftdelta: could not copy chunks out of " + str(old_copy.path), inst)
+
+   old_copy.close()
+   return (copied, copied_bytes)
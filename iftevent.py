@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+iftevent.py
+Copyright (c) 2009 Jude Nelson
+
+Notification between iftd's threads, so that a thread with nothing to do
+can block until something happens (a message is posted, a chunk is
+stored, a protocol changes state, a receiver acknowledges a sender)
+instead of sleeping and checking again.
+
+A waiter is what a thread blocks on.  An event is something that can
+happen; waiters subscribe to events, and firing an event wakes every
+waiter subscribed to it.
+"""
+
+import os
+import errno
+import fcntl
+import select
+import thread
+
+
+class waiter:
+   """
+   Something one thread blocks on until it is woken or a timeout passes.
+
+   It is backed by a pipe, so a wait with a timeout is a select() in the
+   kernel.  (Python 2's Condition.wait() polls when given a timeout.)
+   Wakeups are remembered until the next wait, so a thread that checks
+   for work and then waits does not miss a wakeup that came in between.
+   """
+
+   def __init__( self ):
+      self.__fds = None       # (read end, write end) of the pipe, made on first use
+      self.__pending = False  # woken, but not yet waited on
+      self.__lock = thread.allocate_lock()
+
+
+   def __deepcopy__( self, memo ):
+      # a copy has its own pipe
+      return waiter()
+
+
+   def __del__( self ):
+      self.close()
+
+
+   def __open( self ):
+      """
+      Make the pipe, if we don't have one.
+      Call with the lock held.
+      """
+      if self.__fds == None:
+         fds = os.pipe()
+         for fd in fds:
+            fcntl.fcntl( fd, fcntl.F_SETFL, fcntl.fcntl( fd, fcntl.F_GETFL ) | os.O_NONBLOCK )
+
+         self.__fds = fds
+
+      return self.__fds
+
+
+   def wake( self ):
+      """
+      Wake whoever is waiting (or whoever waits next).
+      """
+      self.__lock.acquire()
+      try:
+         if not self.__pending:
+            self.__pending = True
+            try:
+               os.write( self.__open()[1], "x" )
+            except OSError, inst:
+               if inst.errno != errno.EAGAIN:
+                  raise
+      finally:
+         self.__lock.release()
+
+
+   def wait( self, timeout=None ):
+      """
+      Block until woken, or until timeout seconds pass (forever if timeout is None).
+      Return True if woken, False if the timeout passed.
+      """
+      self.__lock.acquire()
+      try:
+         fds = self.__open()
+      finally:
+         self.__lock.release()
+
+      if timeout != None and timeout < 0:
+         timeout = 0
+
+      try:
+         readable = select.select( [fds[0]], [], [], timeout )[0]
+      except select.error, inst:
+         if inst[0] != errno.EINTR:
+            raise
+         readable = []     # interrupted, so look around and wait again
+
+      if len(readable) == 0:
+         return False
+
+      self.__lock.acquire()
+      try:
+         try:
+            while len( os.read( fds[0], 4096 ) ) > 0:
+               pass
+         except OSError, inst:
+            if inst.errno != errno.EAGAIN:
+               raise
+
+         self.__pending = False
+      finally:
+         self.__lock.release()
+
+      return True
+
+
+   def fileno( self ):
+      """
+      Get a descriptor that select() finds readable once the waiter is woken,
+      so a thread can wait for it along with sockets.  Call wait( 0 ) to take the wakeup.
+      """
+      self.__lock.acquire()
+      try:
+         return self.__open()[0]
+      finally:
+         self.__lock.release()
+
+
+   def close( self ):
+      """
+      Release the pipe.  The waiter may still be used afterwards; it will make a new one.
+      """
+      self.__lock.acquire()
+      try:
+         if self.__fds != None:
+            for fd in self.__fds:
+               try:
+                  os.close( fd )
+               except:
+                  pass
+
+            self.__fds = None
+            self.__pending = False
+      finally:
+         self.__lock.release()
+
+
+
+class event:
+   """
+   Something that can happen.  Firing it wakes every waiter subscribed to it.
+   """
+
+   def __init__( self ):
+      self.__waiters = []
+      self.__lock = thread.allocate_lock()
+
+
+   def __deepcopy__( self, memo ):
+      # a copy has no subscribers of its own
+      return event()
+
+
+   def subscribe( self, w ):
+      """
+      Wake the given waiter whenever this event fires.
+      """
+      self.__lock.acquire()
+      try:
+         if w not in self.__waiters:
+            self.__waiters.append( w )
+      finally:
+         self.__lock.release()
+
+
+   def unsubscribe( self, w ):
+      """
+      Stop waking the given waiter.
+      """
+      self.__lock.acquire()
+      try:
+         if w in self.__waiters:
+            self.__waiters.remove( w )
+      finally:
+         self.__lock.release()
+
+
+   def fire( self ):
+      """
+      Wake every subscribed waiter.
+      """
+      self.__lock.acquire()
+      waiters = list(self.__waiters)
+      self.__lock.release()
+
+      for w in waiters:
+         w.wake()
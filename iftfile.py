@@ -12,6 +12,11 @@ import iftlog
 from iftdata import *
 
 import iftutil
+import iftevent
+import iftjournal
+import iftstore
+
+from iftchunks import chunk_table
 
 import math
 import os
@@ -20,6 +25,8 @@ import threading
 import thread
 import time
 import stat
+import mmap
+import cPickle
 
 from Queue import Queue
 
@@ -45,16 +52,27 @@ JOB_ATTR_GIVEN_CHUNKS    = "JOB_ATTR_GIVEN_CHUNKS" # if True, then the protocol
                                                    # If set, then there should be a Queue instance in the job metadata, mapped by this attribute key.
                                                    # Each queued element should be (chunk data, chunk id, path to the chunk), with None in place of any of those if they are not known
 JOB_ATTR_CHUNK_HASHES    = "JOB_ATTR_CHUNK_HASHES" # If given, this is an in-order list of all chunk hashes (INTERNAL USE ONLY by receivers)
+JOB_ATTR_MERKLE_HASHES   = "JOB_ATTR_MERKLE_HASHES"         # True by default; if True, the sender gives the receiver a Merkle root (JOB_ATTR_MERKLE_ROOT) instead of JOB_ATTR_CHUNK_HASHES
+JOB_ATTR_MERKLE_ROOT     = "JOB_ATTR_MERKLE_ROOT"           # If given, this is the hex root of the Merkle tree over the chunk hashes (INTERNAL USE ONLY by receivers)
+JOB_ATTR_DELTA           = "JOB_ATTR_DELTA"                 # if True, chunks of the new file found in the old file at JOB_ATTR_DEST_NAME are copied out of it instead of being received (see iftdelta)
+JOB_ATTR_WEAK_SUMS       = "JOB_ATTR_WEAK_SUMS"             # If given, this is an in-order list of the weak (Adler-32) checksums of all chunks, for JOB_ATTR_DELTA (INTERNAL USE ONLY by receivers)
+JOB_ATTR_CHUNK_STORE     = "JOB_ATTR_CHUNK_STORE"           # if True, the receiver takes what chunks it can from its chunk store (see iftstore), so it is given JOB_ATTR_CHUNK_HASHES even with a Merkle root.  Receivers with a chunk store set this by default.
+JOB_ATTR_CODEC           = "JOB_ATTR_CODEC"                 # codec to compress chunks with on the way ("zlib", "bz2", or "none"; see iftcodec).  If None, the sender picks one from the file type and how well the first chunks compress.
+JOB_ATTR_CODEC_LEVEL     = "JOB_ATTR_CODEC_LEVEL"           # compression level for JOB_ATTR_CODEC (None for the codec's default)
+JOB_ATTR_CHUNK_CODEC     = "JOB_ATTR_CHUNK_CODEC"           # [codec, level] the sender and receiver agreed on, or None (INTERNAL USE ONLY)
 JOB_ATTR_TRANSFER_TIMEOUT= "JOB_ATTR_TRANSFER_TIMEOUT"      # if not null, this is the maximum amount of time that can be spent transferring this file
 JOB_ATTR_SRC_CHUNK_DIR   = "JOB_ATTR_SRC_CHUNK_DIR"         # if two IFTD instances are communicating, this is the chunk directory on the source host (INTERNAL USE ONLY)
 JOB_ATTR_DEST_CHUNK_DIR  = "JOB_ATTR_DEST_CHUNK_DIR"        # if two IFTD instances are communicating, this is the chunk directory on the destination host (INTERNAL USE ONLY)
 
 JOB_ATTR_DO_CHUNKING     = "JOB_ATTR_DO_CHUNKING"           # True by default; if false, then the file is symlinked into the src chunk dir as a single chunk (chunk 0)
+JOB_ATTR_CHUNK_VIEWS     = "JOB_ATTR_CHUNK_VIEWS"           # if True, chunks are (offset, length) views of the source file instead of copies in the src chunk dir
 JOB_ATTR_MIN_BANDWIDTH   = "JOB_ATTR_MIN_BANDWIDTH"         # (connection attribute) minimum transmission bandwidth
 JOB_ATTR_MAX_ATTEMPTS    = "JOB_ATTR_MAX_ATTEMPTS"          # maximum number of times to cycle through the protocols in the event of a failure
 JOB_ATTR_CHUNK_TIMEOUT   = "JOB_ATTR_CHUNK_TIMEOUT"         # how long do we expect a chunk to take to be downloaded?
+JOB_ATTR_FSYNC_CHUNKS    = "JOB_ATTR_FSYNC_CHUNKS"          # if positive, the receiver fsyncs the file after this many chunks are written (and when it is closed); otherwise it never fsyncs
 
 JOB_ATTR_REMOTE_IFTD    = "JOB_ATTR_REMOTE_IFTD"   # if true, there is known to be a remote iftd present
+JOB_ATTR_XMIT_ID        = "JOB_ATTR_XMIT_ID"       # ID of the transmission the job is part of, the same on both iftds (INTERNAL USE ONLY by protocols)
 
 """
 Sentinel value to indicate that the field is optional
@@ -126,6 +144,9 @@ class iftjob:
       if self.get_attr( JOB_ATTR_DO_CHUNKING ) == None:
          self.set_attr( JOB_ATTR_DO_CHUNKING, True )
       
+      if self.get_attr( JOB_ATTR_MERKLE_HASHES ) == None:
+         self.set_attr( JOB_ATTR_MERKLE_HASHES, True )
+      
       if self.get_attr( JOB_ATTR_REMOTE_IFTD ) == None:
          self.set_attr( JOB_ATTR_REMOTE_IFTD, True )
       
@@ -231,10 +252,7 @@ class iftfile:
    
    __num_chunks = 0        # how many chunks are there?
    __chunks_size = 0       # how big is a chunk supposed to be? (used for reading)
-   __chunk_mask = []       # False for unwritten, True for written--bit array of chunks
-   __chunk_locks = []      # array of Semaphores for accessing a particular chunk
-   __chunk_reservations = []  # array of times in the future when a chunk will become available
-   __chunk_owners = []     # array of references to protocols reserving chunks   
+   __chunks = None         # iftchunks.chunk_table of which chunks are written, reserved, and locked
 
    __read_lock = None      # lock to acquire to read the next chunk (used only in READ mode)
    __next_chunk = 0        # ID of chunk that was just read
@@ -244,10 +262,15 @@ class iftfile:
    path = None             # path to file
    
    __bytes_written = 0     # total number of bytes written
+   __fd = -1               # descriptor all chunks are written through (used only in WRITE mode)
+   __write_lock = None     # lock on the descriptor's file offset
+   __fsync_chunks = 0      # fsync after this many chunks are written (0 for never)
+   __unsynced_chunks = 0   # chunks written since the last fsync
    __bytes_max = -1        # maximum number of bytes allowed (optional)
    __open = False
   
    __hash = None           # hash to verify 
+   __hasher = None         # stream_hash over the chunks written so far (used only in WRITE mode)
    __expand_lock = threading.BoundedSemaphore(1)   # lock to allow mutual exclusion in expanding the number of mutices when the file size is unknown
    
    # do we know the size?
@@ -256,11 +279,24 @@ class iftfile:
    # is the file actually complete?
    marked_complete = False
    
+   # if set, chunks are verified against a Merkle root with this iftmerkle.merkle_verifier
+   verifier = None
+   
+   # if set, stored chunks are logged to this iftjournal.journal, so the file can be picked up again if receiving it is cut short
+   journal = None
+   
+   # set if fopen picked up chunks a journal said were stored in the file last time
+   resumed = False
+   
    def __init__( self, file_path ):
       self.path = file_path
       self.__read_lock = threading.BoundedSemaphore(1)
+      self.__write_lock = threading.BoundedSemaphore(1)
+      self.__chunks = chunk_table()
       self.__next_chunk = 0
       self.__mode = 0
+      self.__store_refs = None   # chunk hashes referenced in the chunk store while we're open
+      self.chunks_changed = iftevent.event()     # fired when chunks are stored or come free, or the file is closed or completed
    
    
    def last_error( self ):
@@ -280,6 +316,7 @@ class iftfile:
          return E_ALREADY_OPEN
       
       self.marked_complete = False
+      self.resumed = False
       
       # fill in a chunk size if none was given
       self.__chunk_size = DEFAULT_FILE_CHUNKSIZE
@@ -321,7 +358,14 @@ class iftfile:
             return 0
          
          elif mode == MODE_WRITE:
-            if os.path.exists( self.path ):
+            # did we already get part of this file, before a crash or restart?
+            journal, resumed = (None, False)
+            if self.known_size == True:
+               journal, resumed = iftjournal.open_journal( self.path, file_attrs )
+               resumed = resumed and os.path.exists( self.path )
+               self.resumed = resumed
+            
+            if os.path.exists( self.path ) and not resumed:
                # problem--will overwrite
                iftlog.log(1, "iftfile: WARNING: will overwrite " + self.path)
                try:
@@ -334,21 +378,44 @@ class iftfile:
             if self.known_size == True:
                # we know how big the file is
                self.__num_chunks = int( math.ceil( float( file_attrs[JOB_ATTR_FILE_SIZE] ) / float(self.__chunk_size) ) )
-               self.__chunk_mask = [False] * self.__num_chunks
-               self.__chunk_locks = [threading.BoundedSemaphore(1)] * self.__num_chunks
-               self.__chunk_reservations = [0] * self.__num_chunks
-               self.__chunk_owners = [None] * self.__num_chunks
+               self.__chunks = chunk_table( self.__num_chunks )
                
             else:
-               self.__chunk_mask = []
+               self.__chunks = chunk_table()
                # we don't know how big the file will be!
                self.__num_chunks = -1     # sentinel
                if file_attrs.has_key( JOB_ATTR_NUM_CHUNKS ):
                   self.__num_chunks = file_attrs[ JOB_ATTR_NUM_CHUNKS ]
-                  self.__chunk_mask = [False] * self.__num_chunks
-                  self.__chunk_locks = [threading.BoundedSemaphore(1)] * self.__num_chunks
-                  self.__chunk_reservations = [0] * self.__num_chunks
-                  self.__chunk_owners = [None] * self.__num_chunks
+                  self.__chunks = chunk_table( self.__num_chunks )
+            
+            # keep the file open for all of its chunks, and make room for them up front
+            self.__fd = os.open( self.path, os.O_WRONLY | os.O_CREAT, 0666 )
+            if self.known_size == True:
+               preallocate( self.__fd, file_attrs[JOB_ATTR_FILE_SIZE] )
+            
+            self.__fsync_chunks = 0
+            self.__unsynced_chunks = 0
+            if file_attrs.get( JOB_ATTR_FSYNC_CHUNKS ) != None and file_attrs.get( JOB_ATTR_FSYNC_CHUNKS ) > 0:
+               self.__fsync_chunks = file_attrs.get( JOB_ATTR_FSYNC_CHUNKS )
+            
+            # hash the file as it arrives
+            self.__hasher = stream_hash( self.path, self.__chunk_size )
+            
+            # keep the chunks we got last time that are still good, and log the ones to come
+            self.journal = None
+            if journal != None:
+               kept = []
+               if resumed:
+                  kept = self.__resume_chunks( journal.chunks() )
+               
+               if journal.open( kept ) == 0:
+                  self.journal = journal
+            
+            # keep the chunks we want from being evicted from the chunk store until we're done
+            self.__release_store_refs()
+            if file_attrs.get( JOB_ATTR_CHUNK_HASHES ):
+               self.__store_refs = file_attrs.get( JOB_ATTR_CHUNK_HASHES )
+               iftstore.ref( self.__store_refs )
             
             iftlog.log(1, "iftfile: opened " + self.path + " for WRITING, expecting " + str(self.__num_chunks) + " chunks")
             self.__open = True
@@ -373,16 +440,26 @@ class iftfile:
       """
       self.__expand_lock.acquire()
       self.__open = False
-      rc = 0
+      rc = self.__close_fd()
+      
+      # an incomplete file's journal stays behind, so receiving it can pick up from here
+      if self.journal != None:
+         if self.__mode == MODE_WRITE and self.is_complete():
+            self.journal.remove()
+         else:
+            self.journal.close()
+         self.journal = None
+      
+      self.__release_store_refs()
       self.__num_chunks = 0
       self.__next_chunk = 0
-      self.__chunk_mask = []
-      self.__chunk_locks = []
-      self.__chunk_reservations = []
-      self.__chunk_owners = []
+      self.__chunks = chunk_table()
+      self.__hasher = None
+      self.verifier = None
       #self.cleanup_chunks()
       self.path = None
       self.__expand_lock.release()
+      self.chunks_changed.fire()
       return rc
    
    
@@ -392,23 +469,57 @@ class iftfile:
       """
       self.__expand_lock.acquire()
       self.__open = False
+      self.__close_fd()
       try:
          os.remove( self.path)
       except Exception, inst:
          iftlog.exception("iftfile: could not fpurge " + self.path, inst)
       
+      if self.journal != None:
+         self.journal.remove()
+         self.journal = None
+      
+      self.__release_store_refs()
       self.__num_chunks = 0
       self.__next_chunk = 0
       self.__mode = 0
-      self.__chunk_mask = []
-      self.__chunk_locks = []
-      self.__chunk_reservations = []
-      self.__chunk_owners = []
+      self.__chunks = chunk_table()
+      self.__hasher = None
       #self.cleanup_chunks()
       self.path = None
       self.__expand_lock.release()
       
 
+   def __close_fd(self):
+      """
+      Flush (if we're supposed to) and close the descriptor we write chunks through.
+      Return 0 on success; negative on error
+      """
+      rc = 0
+      self.__write_lock.acquire()
+      try:
+         if self.__fd >= 0:
+            try:
+               if self.__fsync_chunks > 0 and self.__unsynced_chunks > 0:
+                  os.fsync( self.__fd )
+            except Exception, inst:
+               iftlog.exception("iftfile: could not fsync " + str(self.path), inst)
+               rc = E_IOERROR
+            
+            try:
+               os.close( self.__fd )
+            except Exception, inst:
+               iftlog.exception("iftfile: could not close " + str(self.path), inst)
+               rc = E_IOERROR
+            
+            self.__fd = -1
+            self.__unsynced_chunks = 0
+      finally:
+         self.__write_lock.release()
+      
+      return rc
+   
+   
    def is_open(self):
       """
       Is the file open?
@@ -416,11 +527,99 @@ class iftfile:
       return self.__open
    
    
+   def __resume_chunks(self, logged_chunks):
+      """
+      Take back the chunks a journal says were stored in the file last time,
+      given as a list of (chunk ID, binary SHA-1) in order.  Each one is read
+      back and checked against its SHA-1, since the data may not have made it
+      to disk before the crash.
+      Return the (chunk ID, binary SHA-1) of the chunks that are still good.
+      """
+      kept = []
+      try:
+         fd = open( self.path, "rb" )
+      except Exception, inst:
+         iftlog.exception("iftfile: could not read back " + self.path, inst)
+         return kept
+      
+      try:
+         for (chunk_id, digest) in logged_chunks:
+            if chunk_id < 0 or chunk_id >= self.__num_chunks:
+               continue
+            
+            fd.seek( chunk_id * self.__chunk_size )
+            chunk = fd.read( self.__chunk_size )
+            if len(chunk) == 0 or hashlib.sha1( chunk ).digest() != digest:
+               continue
+            
+            self.__chunks.mark_written( chunk_id )
+            self.__hasher.add_chunk( chunk_id, chunk )
+            kept.append( (chunk_id, digest) )
+      finally:
+         fd.close()
+      
+      iftlog.log(3, "iftfile: picking up " + self.path + " with " + str(len(kept)) + " of " + str(self.__num_chunks) + " chunks already stored (" + str(len(logged_chunks) - len(kept)) + " did not check out)")
+      return kept
+   
+   
+   def __release_store_refs(self):
+      """
+      Drop our references on chunks in the chunk store.
+      """
+      if self.__store_refs != None:
+         iftstore.unref( self.__store_refs )
+         self.__store_refs = None
+   
+   
+   def discard_journal(self):
+      """
+      Throw away our journal (i.e. because what we received can't be trusted), so the file is received from scratch next time.
+      """
+      if self.journal != None:
+         self.journal.remove()
+         self.journal = None
+   
+   
+   def remove_partial(self):
+      """
+      Remove what we received of the file (i.e. because receiving it was cancelled), so that
+      a full-size file with holes in it isn't left behind.  A file we were picking up from
+      last time, or that is complete, is left alone.
+      """
+      if self.resumed or self.path == None or self.is_complete():
+         return 0
+      
+      try:
+         os.remove( self.path )
+         iftlog.log(3, "iftfile: removed partially received " + self.path)
+      except OSError, inst:
+         if os.path.exists( self.path ):
+            iftlog.exception("iftfile: could not remove partially received " + self.path, inst)
+            return E_IOERROR
+      
+      return 0
+   
+   
+   def written_chunk_runs(self):
+      """
+      Get the chunks that have been written, as a list of [first ID, last ID] runs of consecutive chunks.
+      """
+      return self.__chunks.written_runs()
+   
+   
    def mark_complete(self):
       """
       We have all the data, even if we didn't get it via conventional means
       """
       self.marked_complete = True
+      
+      # the file was replaced, so whatever we hashed (or journaled) is stale
+      if self.__hasher != None:
+         self.__hasher = stream_hash( self.path, self.__chunk_size )
+      
+      self.discard_journal()
+      
+      self.chunks_changed.fire()
    
    
    def is_complete(self):
@@ -437,11 +636,13 @@ class iftfile:
       if self.__mode == MODE_READ or self.__mode == 0:
          return True
       
-      for chunk in self.__chunk_mask:
-         if chunk == False:
-            return False
-      
-      return True
+      return self.__chunks.is_complete()
+   
+   def progress(self):
+      """
+      How much of the file do we have?  Return (chunks written, number of chunks, chunk size).
+      """
+      return (self.__chunks.num_written(), self.__chunks.size(), self.__chunk_size)
    
    def is_valid_chunk(self, chunk_id ):
       if chunk_id >= 0 and (self.known_size and chunk_id < self.__num_chunks):
@@ -524,7 +725,7 @@ class iftfile:
 
    def __grow_metadata( self, chunk_id ):
       """
-      Atomically allocate more chunk masks, locks, and reservations.
+      Atomically make room for more chunks.
       """
       self.__expand_lock.acquire()
       
@@ -534,18 +735,7 @@ class iftfile:
          self.__expand_lock.release()
          return
       
-      num_mutexes = len(self.__chunk_locks)
-      if num_mutexes < chunk_id + 1:
-         self.__chunk_locks = self.__chunk_locks + [threading.BoundedSemaphore(1)] * (chunk_id + 1 - num_mutexes)
-
-      num_reservations = len(self.__chunk_reservations)
-      if num_reservations < chunk_id + 1:
-         self.__chunk_reservations = self.__chunk_reservations + [0] * (chunk_id + 1 - num_reservations)
-      
-      num_owners = len(self.__chunk_owners)
-      if num_owners < chunk_id + 1:
-         self.__chunk_owners = self.__chunk_owners + [None] * (chunk_id + 1 - num_owners)
-
+      self.__chunks.grow( chunk_id + 1 )
       self.__expand_lock.release()
 
 
@@ -558,10 +748,7 @@ class iftfile:
       
       else:
          if self.known_size:
-            if chunk_id >= len(self.__chunk_mask):
-               return False
-            else:
-               return self.__chunk_mask[ chunk_id ]
+            return self.__chunks.is_written( chunk_id )
             
          else:
             if self.__bytes_max >= 0 and chunk_id * self.__chunk_size < self.__bytes_max:
@@ -575,7 +762,11 @@ class iftfile:
       """
       Is a chunk reserved by a given owner?
       """
-      if not self.marked_complete and self.__chunk_reservations[ chunk_id ] != 0 and self.__chunk_owners[ chunk_id ] == owner:
+      if self.marked_complete:
+         return False
+      
+      (expiry, reserver) = self.__chunks.reservation( chunk_id )
+      if expiry != 0 and reserver == owner:
          return True
       return False
 
@@ -609,19 +800,10 @@ class iftfile:
             # positive chunk id--do we need to add more locks?
             self.__grow_metadata( chunk_id )
          
-         # someone else had better not own this
-         if self.__chunk_reservations[chunk_id] >= time.time() and self.__chunk_owners[ chunk_id ] != None:
-            return E_TRY_AGAIN
-         
-         # can't reserve if someone else locked the chunk
-         if not self.__chunk_locks[ chunk_id ].acquire(False):
+         # someone else had better not own or lock this
+         now = time.time()
+         if not self.__chunks.reserve( chunk_id, owner, now + t, now ):
             return E_TRY_AGAIN
-         
-         # reserve the chunk
-         self.__chunk_reservations[ chunk_id ] = time.time() + t
-         self.__chunk_owners[ chunk_id ] = owner
-         
-         self.__chunk_locks[ chunk_id ].release()
       except Exception, inst:
          # only happens if another thread closed the file
          iftlog.exception("iftfile.reserve_chunk: could not resrve chunk " + str(chunk_id) + " for " + str(owner), inst)
@@ -636,15 +818,8 @@ class iftfile:
       """
       try:
          if self.__mode == MODE_WRITE:
-            for i in xrange(0, len(self.__chunk_locks)):
-               if self.__chunk_owners[i] == owner:
-                  self.__chunk_locks[i].acquire()
-                  self.__chunk_owners[i] = None
-                  self.__chunk_reservations[i] = 0
-                  self.__chunk_locks[i].release() 
-               
-            
-         
+            self.__chunks.unreserve_all( owner )
+            self.chunks_changed.fire()
       except Exception, inst:
          pass     # closed under us
          
@@ -681,20 +856,26 @@ class iftfile:
             self.__grow_metadata( chunk_id )
          
          # can't lock the chunk if it already has data
-         if self.__chunk_mask[ chunk_id ]:
+         if self.__chunks.is_written( chunk_id ):
             return E_DUPLICATE
          
-         self.__chunk_locks[ chunk_id ].acquire()
-         
+         chunks = self.__chunks
+         chunks.lock( chunk_id, owner )
+
+         # someone may have written it while we waited for the lock
+         if chunks.is_written( chunk_id ):
+            chunks.unlock( chunk_id, owner )
+            return E_DUPLICATE
+
          # we're takin' over
          if override:
-            self.__chunk_reservations[ chunk_id ] = time.time() + t
-            self.__chunk_owners[ chunk_id ] = owner
+            now = time.time()
+            chunks.reserve( chunk_id, owner, now + t, now, True )
          
          # sanity check again (in case this was called after fclose())
-         if self.__mode != MODE_WRITE:
+         if self.__mode != MODE_WRITE or chunks != self.__chunks:
             self.__error = E_BAD_MODE
-            self.__chunk_locks[ chunk_id ].release()
+            chunks.unlock( chunk_id, owner )
             return E_BAD_MODE
          
          # when we return, this thread holds the lock
@@ -726,10 +907,8 @@ class iftfile:
             self.__error = E_INVAL
             return E_OVERFLOW
          
-         if self.__chunk_owners[ chunk_id ] == owner:
-            self.__chunk_reservations[ chunk_id ] = 0
-            self.__chunk_owners[ chunk_id ] = None
-            self.__chunk_locks[ chunk_id ].release()
+         if self.__chunks.unlock( chunk_id, owner ):
+            self.chunks_changed.fire()
             return 0
 
          return E_INVAL
@@ -760,7 +939,7 @@ class iftfile:
          
          # can we write?
          # don't overwrite what's already there
-         if chunk_id < self.__num_chunks and chunk_id >= 0 and self.__chunk_mask[ chunk_id ] == True:
+         if chunk_id < self.__num_chunks and chunk_id >= 0 and self.__chunks.is_written( chunk_id ):
             self.__error = E_BAD_STATE
             return E_BAD_STATE
             
@@ -774,13 +953,14 @@ class iftfile:
                iftlog.log(3, "iftfile: attempted to write " + str(self.__chunk_size) + " more bytes beyond required maximum of " + str(self.__bytes_max) + ", will not mark chunk " + str(chunk_id) )
                return E_OVERFLOW
             
-            num_chunks = len(self.__chunk_mask)
-            if num_chunks < chunk_id + 1:
-               self.__chunk_mask = self.__chunk_mask + [False] * (chunk_id + 1 - num_chunks)
-            
-            self.__num_chunks = len( self.__chunk_mask )
+            self.__chunks.grow( chunk_id + 1 )
+            self.__num_chunks = self.__chunks.size()
+         
+         if not self.__chunks.mark_written( chunk_id ):
+            # someone beat us to it
+            self.__error = E_BAD_STATE
+            return E_BAD_STATE
          
-         self.__chunk_mask[ chunk_id ] = True
          return 0
       except Exception, inst:
          if self.__open == False:
@@ -822,21 +1002,16 @@ class iftfile:
          
          if trunicate and len(chunk) > self.__chunk_size:
             iftlog.log(3, "iftfile: got chunk of length " + str(len(chunk)) + ", trunicating to " + str(self.__chunk_size))
-            chunk = chunk[0 : self.__chunk_size-1]
+            chunk = chunk[0 : self.__chunk_size]
          
          if len(chunk) < self.__chunk_size and strict:
             return E_UNDERFLOW
          
          
-         # write to disk
-         try:
-            fd = open(self.path, "ab")
-            fd.seek( self.__chunk_size * chunk_id )
-            fd.write( chunk )
-            fd.close()
-         except Exception, inst:
-            iftlog.exception("iftfile.set_chunk: could not write to " + self.path, inst)
-            return E_IOERROR
+         # write to disk, at the chunk's place in the file
+         rc = self.__write_at( chunk, self.__chunk_size * chunk_id )
+         if rc != 0:
+            return rc
    
          # do not receive this chunk again
          rc = self.mark_chunk( chunk_id, True )
@@ -844,6 +1019,17 @@ class iftfile:
             iftlog.log(3, "iftfile: will not write chunk " + str(chunk_id))
             return rc
          
+         if self.__hasher != None:
+            self.__hasher.add_chunk( chunk_id, chunk )
+         
+         journal = self.journal
+         if journal != None:
+            known = None
+            if self.verifier != None:
+               known = self.verifier.leaf( chunk_id )
+            journal.record( chunk_id, chunk, known )
+         
+         self.chunks_changed.fire()
          return 0
       except Exception, inst:
          if self.__open == False:
@@ -854,6 +1040,35 @@ class iftfile:
    
    
    
+   def __write_at( self, data, offset ):
+      """
+      Write data at the given offset through our descriptor, and fsync if it's time to.
+      Return 0 on success; negative on error
+      """
+      self.__write_lock.acquire()
+      try:
+         try:
+            if self.__fd < 0:
+               return E_BAD_STATE
+            
+            os.lseek( self.__fd, offset, 0 )
+            written = 0
+            while written < len(data):
+               written += os.write( self.__fd, data[written:] )
+            
+            self.__unsynced_chunks += 1
+            if self.__fsync_chunks > 0 and self.__unsynced_chunks >= self.__fsync_chunks:
+               os.fsync( self.__fd )
+               self.__unsynced_chunks = 0
+            
+            return 0
+         except Exception, inst:
+            iftlog.exception("iftfile.set_chunk: could not write to " + str(self.path), inst)
+            return E_IOERROR
+      finally:
+         self.__write_lock.release()
+   
+   
    def get_mode(self):
       """
       Get the mode we opened in
@@ -864,16 +1079,16 @@ class iftfile:
    def calc_hash(self):
       """
       Calculate our SHA-1 hash from all of our received chunks.
+      Chunks are hashed as they are written, so only the data
+      that has not yet been hashed gets read back from disk.
       Return a string of the hex digest
       """
       try:
-         m = hashlib.sha1()
-         read_fd = open( self.path, "r")
-         buff = read_fd.read()
-         m.update( buff )
-         read_fd.close() 
+         hasher = self.__hasher
+         if hasher == None:
+            hasher = stream_hash( self.path, self.__chunk_size )
          
-         return m.hexdigest()
+         return hasher.hexdigest()
       except Exception, inst:
          iftlog.exception("iftfile.calc_hash", inst)
          return ""
@@ -890,28 +1105,360 @@ class iftfile:
             self.__error = E_BAD_MODE
             return E_BAD_MODE
          
-         index = 0
-         ret = []
-         for i in xrange(0, len(self.__chunk_mask)):
-            if self.__chunk_reservations[i] >= time.time():
-               continue
-
-            try:
-               chunk = self.__chunk_mask[i]
-               if chunk == False:
-                  ret.append( i )
-            except:
-               break
+         ret = self.__chunks.unwritten( time.time() )
          
          if len(ret) == 0 and self.known_size == False:
             # if we don't know the size, add the chunks required to reach __bytes_max
-            ret.append( len(self.__chunk_mask) )
+            ret.append( self.__chunks.size() )
          
          return ret
       except Exception, inst:
          iftlog.exception("iftfile.get_unwritten_chunks", inst)
          return []
    
+   
+   def next_unwritten_chunks(self, count=1, contiguous=False):
+      """
+      Get up to count of the lowest-numbered chunks that are neither received nor reserved.
+      If contiguous is True, they are a run of consecutive chunks.
+      Unlike get_unwritten_chunks(), this does not look at every chunk in the file.
+      Note: this list will possibly be outdated as soon as it is returned!
+      """
+      try:
+         # sanity check
+         if self.__mode != MODE_WRITE:
+            self.__error = E_BAD_MODE
+            return E_BAD_MODE
+         
+         ret = self.__chunks.next_free( time.time(), count, contiguous )
+         
+         if len(ret) == 0 and self.known_size == False:
+            # if we don't know the size, add the chunks required to reach __bytes_max
+            ret.append( self.__chunks.size() )
+         
+         return ret
+      except Exception, inst:
+         iftlog.exception("iftfile.next_unwritten_chunks", inst)
+         return []
+
+
+
+try:
+   import ctypes
+   import ctypes.util
+   __libc = ctypes.CDLL( ctypes.util.find_library("c") )
+   __fallocate = __libc.fallocate64
+   __fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except:
+   __fallocate = None
+
+
+def preallocate( fd, size ):
+   """
+   Reserve size bytes for the open file fd, so chunks can be written into it in any order.
+   Uses fallocate(2) if we can, and otherwise just sets the file size.
+   Return 0 on success; negative on error
+   """
+   try:
+      if size == None or size <= 0 or os.fstat( fd ).st_size >= size:
+         return 0
+      
+      if __fallocate != None and __fallocate( fd, 0, 0, size ) == 0:
+         return 0
+      
+      # no fallocate (or not supported here)
+      os.ftruncate( fd, size )
+      return 0
+   except Exception, inst:
+      iftlog.exception("iftfile.preallocate: could not preallocate " + str(size) + " bytes", inst)
+      return E_IOERROR
+
+
+
+class chunk_source:
+   """
+   A read-only handle on a file whose chunks are being served as byte ranges.
+   The file is opened once and shared by all of its chunk views.  If possible,
+   the file is mapped into memory so views can be sent without copying.
+   """
+
+   def __init__( self, path ):
+      self.path = path
+      self.__fd = -1
+      self.__map = None
+      self.__lock = threading.BoundedSemaphore(1)
+
+
+   def open( self ):
+      """
+      Open (and try to map) the file.
+      Return 0 on success; negative on error
+      """
+      try:
+         self.__fd = os.open( self.path, os.O_RDONLY )
+      except Exception, inst:
+         iftlog.exception("chunk_source: could not open " + str(self.path), inst)
+         return E_IOERROR
+
+      try:
+         if os.fstat( self.__fd ).st_size > 0:
+            self.__map = mmap.mmap( self.__fd, 0, access=mmap.ACCESS_READ )
+      except Exception, inst:
+         # not fatal; fall back to positional reads
+         iftlog.log(3, "chunk_source: could not map " + str(self.path) + ", will read it instead")
+         self.__map = None
+
+      return 0
+
+
+   def get_map( self ):
+      """
+      Get the memory map of the file, or None if it is not mapped
+      """
+      return self.__map
+
+
+   def pread( self, offset, length ):
+      """
+      Read length bytes at offset without disturbing other readers.
+      """
+      if self.__map != None:
+         return self.__map[ offset : offset + length ]
+
+      if self.__fd < 0:
+         return None
+
+      self.__lock.acquire()
+      try:
+         os.lseek( self.__fd, offset, 0 )
+         buffs = []
+         remaining = length
+         while remaining > 0:
+            buff = os.read( self.__fd, remaining )
+            if len(buff) == 0:
+               break
+            buffs.append( buff )
+            remaining -= len(buff)
+      finally:
+         self.__lock.release()
+
+      return "".join( buffs )
+
+
+   def close( self ):
+      """
+      Release the file
+      """
+      if self.__map != None:
+         try:
+            self.__map.close()
+         except:
+            pass
+         self.__map = None
+
+      if self.__fd >= 0:
+         try:
+            os.close( self.__fd )
+         except:
+            pass
+         self.__fd = -1
+
+
+
+class chunk_view:
+   """
+   A chunk that is an (offset, length) window onto its source file, rather than
+   a copy of the data.  Protocols receive these in place of chunk strings when
+   JOB_ATTR_CHUNK_VIEWS is set, and should read the data only when they send it.
+   """
+
+   def __init__( self, source, offset, length ):
+      self.source = source
+      self.offset = offset
+      self.length = length
+
+
+   def __len__( self ):
+      return self.length
+
+
+   def read( self ):
+      """
+      Get the chunk data as a string
+      """
+      return self.source.pread( self.offset, self.length )
+
+
+   def send( self, soc ):
+      """
+      Write the chunk to a connected socket, straight out of the mapped file if possible.
+      Return the number of bytes sent.
+      """
+      m = self.source.get_map()
+      if m != None:
+         soc.sendall( buffer( m, self.offset, self.length ) )
+      else:
+         soc.sendall( self.read() )
+
+      return self.length
+
+
+
+def chunk_data_str( chunk ):
+   """
+   Given a chunk string or a chunk_view, get the chunk data as a string.
+   """
+   if isinstance( chunk, chunk_view ):
+      return chunk.read()
+
+   return chunk
+
+
+class stream_hash:
+   """
+   SHA-1 hash of a file that is being written chunk by chunk, in any order.
+   A chunk is hashed when it is written if every chunk before it has been
+   hashed; chunks that arrive early are read back from disk once the gap
+   before them is filled.  At most one chunk is held in memory at a time.
+   """
+
+   def __init__( self, path, chunk_size ):
+      self.path = path
+      self.chunk_size = chunk_size
+      self.__sha = hashlib.sha1()
+      self.__next_chunk = 0      # ID of the next chunk to hash
+      self.__pending = {}        # IDs of written chunks beyond __next_chunk
+      self.__stopped = False     # set once a short chunk is reached; the rest comes from disk
+      self.__lock = threading.BoundedSemaphore(1)
+
+
+   def add_chunk( self, chunk_id, chunk ):
+      """
+      Record that a chunk was written to the file.
+      """
+      self.__lock.acquire()
+      try:
+         if self.__stopped or chunk_id < self.__next_chunk:
+            return
+
+         if chunk_id > self.__next_chunk:
+            self.__pending[ chunk_id ] = True
+            return
+
+         if len(chunk) != self.chunk_size:
+            # short (i.e. last) chunk; hexdigest() will pick it up from disk
+            self.__stopped = True
+            return
+
+         self.__sha.update( chunk )
+         self.__next_chunk += 1
+         try:
+            self.__catch_up()
+         except Exception, inst:
+            iftlog.exception("stream_hash: could not read back " + str(self.path), inst)
+            self.__stopped = True
+      finally:
+         self.__lock.release()
+
+
+   def __catch_up( self ):
+      """
+      Hash the written chunks that directly follow the ones hashed so far.
+      Call with the lock held.
+      """
+      if not self.__pending.has_key( self.__next_chunk ):
+         return
+
+      fd = open( self.path, "rb" )
+      try:
+         fd.seek( self.__next_chunk * self.chunk_size )
+         while self.__pending.has_key( self.__next_chunk ):
+            del self.__pending[ self.__next_chunk ]
+            chunk = fd.read( self.chunk_size )
+            if len(chunk) != self.chunk_size:
+               self.__stopped = True
+               break
+
+            self.__sha.update( chunk )
+            self.__next_chunk += 1
+      finally:
+         fd.close()
+
+
+   def hexdigest( self ):
+      """
+      Get the hash of the file as it is on disk now, reading only what
+      has not been hashed yet.
+      """
+      self.__lock.acquire()
+      try:
+         m = self.__sha.copy()
+         fd = open( self.path, "rb" )
+         try:
+            fd.seek( self.__next_chunk * self.chunk_size )
+            while True:
+               buff = fd.read( DEFAULT_FILE_CHUNKSIZE )
+               if len(buff) == 0:
+                  break
+               m.update( buff )
+         finally:
+            fd.close()
+
+         return m.hexdigest()
+      finally:
+         self.__lock.release()
+
+
+
+def hash_file_chunks( filename, chunksize, chunk_func=None ):
+   """
+   Read a file once, computing its SHA-1 hash and the SHA-1 hashes of each
+   of its chunks together.  If given, chunk_func( chunk_id, offset, chunk ) is
+   called on each chunk as it is read, and a nonzero return aborts the scan.
+   Only one chunk is held in memory at a time.
+   Returns (0, file_hash, chunk_hashes) on success; (nonzero, None, None) on error.
+   """
+   try:
+      fd = open( filename, "rb" )
+   except Exception, inst:
+      iftlog.exception("hash_file_chunks: could not open " + str(filename), inst)
+      return (E_IOERROR, None, None)
+
+   file_m = hashlib.sha1()
+   chunk_hashes = []
+   chunk_id = 0
+   offset = 0
+   try:
+      try:
+         while True:
+            chunk = fd.read( chunksize )
+            file_m.update( chunk )
+
+            m = hashlib.sha1()
+            m.update( chunk )
+            chunk_hashes.append( m.hexdigest() )
+
+            if chunk_func != None:
+               rc = chunk_func( chunk_id, offset, chunk )
+               if rc != 0:
+                  return (rc, None, None)
+
+            chunk_id += 1
+            offset += len(chunk)
+
+            if len(chunk) != chunksize:
+               # last chunk; EOF reached
+               break
+
+      except Exception, inst:
+         iftlog.exception("hash_file_chunks: could not read " + str(filename), inst)
+         return (E_IOERROR, None, None)
+   finally:
+      fd.close()
+
+   return (0, file_m.hexdigest(), chunk_hashes)
+
+
 
 def get_hash( filename ):
    """
@@ -937,12 +1484,41 @@ Location of the directory to store file chunks
 """
 __file_chunks_dir = "/tmp/iftd/files/"
 
+"""
+Location of the persistent index of chunked files (None if there is no index).
+This outlives the file chunks directory, which is removed on shutdown.
+Each entry is a file named after the SHA-1 of a path and chunk size, so a
+file that changes replaces its entry.
+"""
+__chunk_index_dir = None
+
+"""
+Most entries to keep in the chunk index.  When there are more, the least
+recently used ones are removed, down to CHUNK_INDEX_PRUNE_TARGET of this.
+"""
+CHUNK_INDEX_MAX_ENTRIES = 10000
+CHUNK_INDEX_PRUNE_TARGET = 0.9
+
+"""
+Number of entries in the chunk index, and a lock for it
+"""
+__chunk_index_entries = 0
+__chunk_index_lock = threading.Lock()
+
+"""
+Files modified this recently (in seconds) are not indexed, since they could
+change again without changing their modification time.
+"""
+CHUNK_INDEX_MIN_AGE = 2
+
 
-def startup( file_chunks_dir = "/tmp/iftd/files/" ):
+def startup( file_chunks_dir = "/tmp/iftd/files/", chunk_index_dir = "/tmp/iftd/index/" ):
    """
    Start up the file I/O system
    """
    global __file_chunks_dir
+   global __chunk_index_dir
+   global __chunk_index_entries
    
    # set up the chunk directory
    rc = os.popen("mkdir -p " + file_chunks_dir ).close()
@@ -954,6 +1530,20 @@ def startup( file_chunks_dir = "/tmp/iftd/files/" ):
    if __file_chunks_dir[-1] != "/":
       __file_chunks_dir += "/"
    
+   # set up the chunk index
+   __chunk_index_dir = None
+   if chunk_index_dir:
+      rc = os.popen("mkdir -p " + chunk_index_dir ).close()
+      if rc != 0 and rc != None:
+         iftlog.log(3, "iftfile: could not create chunk index " + chunk_index_dir + " (rc = " + str(rc) + "), so files will be re-chunked on every send")
+      else:
+         __chunk_index_dir = chunk_index_dir
+         if __chunk_index_dir[-1] != "/":
+            __chunk_index_dir += "/"
+         
+         __chunk_index_entries = len(os.listdir( __chunk_index_dir ))
+         prune_chunk_index()
+   
    return 0
    
 
@@ -992,6 +1582,197 @@ def get_chunks_dir( filename=None, filehash=None, remote_iftd=None ):
       return __file_chunks_dir
 
 
+def file_identity( filename ):
+   """
+   Get what identifies the contents of a file without reading it:
+   (device, inode, size, modification time), or None on error.
+   """
+   try:
+      sb = os.stat( filename )
+      return (sb.st_dev, sb.st_ino, sb.st_size, sb.st_mtime)
+   except:
+      return None
+
+
+def __chunk_index_path( filename, chunksize ):
+   """
+   Path to the chunk index entry for a file and chunk size
+   """
+   m = hashlib.sha1()
+   m.update( repr( (os.path.abspath( filename ), chunksize) ) )
+   return __chunk_index_dir + m.hexdigest()
+
+
+def lookup_chunk_index( filename, chunksize ):
+   """
+   Look up the hashes of a file we have chunked before with the given chunk size.
+   Return (file_hash, chunk_hashes) if the file has not changed since; (None, None) if not.
+   """
+   if __chunk_index_dir == None:
+      return (None, None)
+   
+   identity = file_identity( filename )
+   if identity == None:
+      return (None, None)
+   
+   entry = None
+   index_path = __chunk_index_path( filename, chunksize )
+   try:
+      fd = open( index_path, "rb" )
+      entry = cPickle.load( fd )
+      fd.close()
+   except:
+      return (None, None)
+   
+   try:
+      if entry["identity"] != identity or entry["chunksize"] != chunksize or entry["path"] != os.path.abspath( filename ):
+         return (None, None)
+      
+      if len(entry["chunk_hashes"]) != identity[2] / chunksize + 1:
+         return (None, None)
+      
+      # just used (for pruning)
+      try:
+         os.utime( index_path, None )
+      except OSError:
+         pass
+      
+      return (entry["file_hash"], entry["chunk_hashes"])
+   except Exception, inst:
+      iftlog.exception("lookup_chunk_index: corrupt entry for " + str(filename), inst)
+      return (None, None)
+
+
+def update_chunk_index( filename, chunksize, identity, file_hash, chunk_hashes ):
+   """
+   Remember the hashes of a file, given its identity (from file_identity) from
+   before it was hashed, in place of what was remembered about it before.
+   Nothing is recorded if the file has changed since then.
+   Return 0 on success or if there is no index; negative on error
+   """
+   global __chunk_index_entries
+   
+   if __chunk_index_dir == None or identity == None:
+      return 0
+   
+   if file_identity( filename ) != identity or time.time() - identity[3] < CHUNK_INDEX_MIN_AGE:
+      # changed under us, or might still be changing
+      return 0
+   
+   entry = {
+      "path": os.path.abspath( filename ),
+      "identity": identity,
+      "chunksize": chunksize,
+      "file_hash": file_hash,
+      "chunk_hashes": chunk_hashes
+   }
+   
+   index_path = __chunk_index_path( filename, chunksize )
+   tmp_path = index_path + ".tmp." + str(os.getpid()) + "." + str(thread.get_ident())
+   try:
+      fd = open( tmp_path, "wb" )
+      cPickle.dump( entry, fd, cPickle.HIGHEST_PROTOCOL )
+      fd.close()
+      
+      __chunk_index_lock.acquire()
+      try:
+         if not os.path.exists( index_path ):
+            __chunk_index_entries += 1
+         os.rename( tmp_path, index_path )
+      finally:
+         __chunk_index_lock.release()
+   except Exception, inst:
+      iftlog.exception("update_chunk_index: could not index " + str(filename), inst)
+      try:
+         os.remove( tmp_path )
+      except:
+         pass
+      return E_IOERROR
+   
+   if __chunk_index_entries > CHUNK_INDEX_MAX_ENTRIES:
+      prune_chunk_index()
+   
+   return 0
+
+
+def prune_chunk_index():
+   """
+   If the chunk index has more than CHUNK_INDEX_MAX_ENTRIES entries, remove the least recently used ones.
+   """
+   global __chunk_index_entries
+   
+   if __chunk_index_dir == None or __chunk_index_entries <= CHUNK_INDEX_MAX_ENTRIES:
+      return 0
+   
+   __chunk_index_lock.acquire()
+   try:
+      entries = []
+      for name in os.listdir( __chunk_index_dir ):
+         try:
+            entries.append( (os.stat( __chunk_index_dir + name ).st_mtime, name) )
+         except OSError:
+            pass
+      
+      entries.sort()
+      num_removed = len(entries) - int(CHUNK_INDEX_MAX_ENTRIES * CHUNK_INDEX_PRUNE_TARGET)
+      for (mtime, name) in entries[0 : max( num_removed, 0 )]:
+         try:
+            os.remove( __chunk_index_dir + name )
+         except OSError:
+            pass
+      
+      __chunk_index_entries = len(os.listdir( __chunk_index_dir ))
+   finally:
+      __chunk_index_lock.release()
+   
+   iftlog.log(1, "iftfile: pruned the chunk index to " + str(__chunk_index_entries) + " entries")
+   return 0
+
+
+def __have_chunk_files( chunk_dir, file_size, chunksize, num_chunks ):
+   """
+   Are all of a file's chunks (still) in the given chunk directory?
+   """
+   try:
+      if len(os.listdir( chunk_dir )) != num_chunks:
+         return False
+      
+      last_id = num_chunks - 1
+      return os.stat( chunk_dir + "/" + str(last_id) ).st_size == file_size - last_id * chunksize
+   except:
+      return False
+
+
+def __link_stored_chunks( filename, chunk_dir, chunk_hashes ):
+   """
+   Make a chunk directory out of links to chunks in the chunk store.
+   Return 0 on success; negative if the store doesn't have them all (in which case nothing is made)
+   """
+   if not iftstore.enabled():
+      return E_UNAVAIL
+   
+   stage_dir = __file_chunks_dir + os.path.basename(filename) + ".partial." + str(os.getpid()) + "." + str(thread.get_ident())
+   rc = os.popen("rm -rf " + stage_dir + "; mkdir -p " + stage_dir ).close()
+   if rc != None:
+      return E_IOERROR
+   
+   for chunk_id in xrange(0, len(chunk_hashes)):
+      rc = iftstore.link( chunk_hashes[chunk_id], stage_dir + "/" + str(chunk_id) )
+      if rc != 0:
+         os.popen("rm -rf " + stage_dir ).close()
+         return rc
+   
+   try:
+      os.popen("rm -rf " + chunk_dir ).close()
+      os.rename( stage_dir, chunk_dir )
+   except Exception, inst:
+      iftlog.exception("ERROR: could not move chunks for " + filename + " into " + chunk_dir, inst)
+      os.popen("rm -rf " + stage_dir ).close()
+      return E_IOERROR
+   
+   return 0
+
+
 def make_chunks_dir( filename, filehash ):
    """
    Make a directory from the filename and filehash to store incoming chunks into.
@@ -1035,6 +1816,9 @@ def cleanup_chunks_dir( filename, filehash ):
    
    os.popen("rm -rf " + chunk_dir + "/*").close()
    os.popen("rmdir " + chunk_dir).close()
+   
+   # the chunks it linked to in the chunk store can be evicted now
+   iftstore.links_dropped()
    return 0
    
    
@@ -1058,6 +1842,11 @@ def get_filesize( path ):
 def make_chunks( filename, chunksize ):
    """
    Split the given file into chunks and store them in the chunks directory.
+   The file is read only once: the chunks are written to a staging directory
+   while the file hash is computed, and the staging directory is renamed
+   once the hash is known.  If the file is in the chunk index, and its chunks
+   are still around (i.e. another send of it is under way) or in the chunk
+   store, they are used without reading the file at all.
    Returns (0, file_hash, chunk_hashes, chunk_paths) on success; (nonzero, None, None, None) on error.
    """
    # sanity check
@@ -1069,14 +1858,43 @@ def make_chunks( filename, chunksize ):
       iftlog.log(3, "Skipping " + filename + " since I do not have read permission")
       return (E_IOERROR, None, None, None)
    
-   # get file hash
-   file_hash = get_hash( filename )
+   # have we chunked this file already?
+   identity = file_identity( filename )
+   file_hash, chunk_hashes = lookup_chunk_index( filename, chunksize )
+   if file_hash != None:
+      chunk_dir = __file_chunks_dir + os.path.basename(filename) + "." + str(file_hash)
+      if __have_chunk_files( chunk_dir, identity[2], chunksize, len(chunk_hashes) ):
+         iftlog.log(1, "Reusing " + str(len(chunk_hashes)) + " chunks of " + filename + " in " + chunk_dir + "/" )
+         return (0, file_hash, chunk_hashes, [chunk_dir + "/" + str(i) for i in xrange(0, len(chunk_hashes))])
+      
+      if __link_stored_chunks( filename, chunk_dir, chunk_hashes ) == 0:
+         iftlog.log(1, "Linked " + str(len(chunk_hashes)) + " stored chunks of " + filename + " into " + chunk_dir + "/" )
+         return (0, file_hash, chunk_hashes, [chunk_dir + "/" + str(i) for i in xrange(0, len(chunk_hashes))])
+   
+   # make the staging directory
+   stage_dir = __file_chunks_dir + os.path.basename(filename) + ".partial." + str(os.getpid()) + "." + str(thread.get_ident())
+   rc = os.popen("rm -rf " + stage_dir + "; mkdir -p " + stage_dir ).close()
+   if rc != None:
+      iftlog.log(5, "ERROR: could not make chunk directory " + stage_dir )
+      return (E_IOERROR, None, None, None)
+   
+   # write out chunks as we hash them
+   def write_chunk( chunk_id, offset, chunk ):
+      try:
+         chunk_fd = open( stage_dir + "/" + str(chunk_id), "wb" )
+         chunk_fd.write( chunk )
+         chunk_fd.close()
+         return 0
+      except Exception, inst:
+         iftlog.exception("ERROR: could not write chunk " + str(chunk_id) + " of " + filename, inst)
+         return E_IOERROR
+   
+   rc, file_hash, chunk_hashes = hash_file_chunks( filename, chunksize, write_chunk )
+   if rc != 0:
+      iftlog.log(5, "ERROR: could not chunk " + filename )
+      os.popen("rm -rf " + stage_dir ).close()
+      return (rc, None, None, None)
    
-   first_char = ""
-   if filename[0] == "/":
-      filename = filename[1:]
-      first_char = "/"
-      
    file_dir = os.path.basename(filename) + "." + str(file_hash)
    
    # does the directory exist?
@@ -1085,59 +1903,100 @@ def make_chunks( filename, chunksize ):
       rc = os.popen("rm -rf " + __file_chunks_dir + file_dir ).close()
       if rc != None:
          iftlog.log(5, "ERROR: could not make chunks for " + filename + "; " + __file_chunks_dir + file_dir + " could not be removed!")
+         os.popen("rm -rf " + stage_dir ).close()
          return (E_IOERROR, None, None, None)
-      
-   
    
-   # make the directory and populate it with chunks
-   rc = os.popen("mkdir -p " + __file_chunks_dir + file_dir ).close()
-   if rc != None:
-      iftlog.log(5, "ERROR: could not make chunk directory " + __file_chunks_dir + file_dir )
-      return (E_IOERROR, None, None, None)
-   
-   # open the file
-   fd = None
    try:
-      fd = open(first_char + filename, "rb")
-      if not fd:
-         iftlog.log(5, "ERROR: could not open " + filename + " for reading!")
-         cleanup_chunks( filename, file_hash )
-         return (E_IOERROR, None, None, None)
+      os.rename( stage_dir, __file_chunks_dir + file_dir )
    except Exception, inst:
-      iftlog.exception("ERROR: could not open " + filename + " for reading!", inst)
-      cleanup_chunks( filename, file_hash )
-      return (E_UNHANDLED_EXCEPTION, None, None, None)
+      iftlog.exception("ERROR: could not move chunks for " + filename + " into " + __file_chunks_dir + file_dir, inst)
+      os.popen("rm -rf " + stage_dir ).close()
+      return (E_IOERROR, None, None, None)
    
-   # write out chunks
-   chunk_id = 0
-   chunk_hashes = []
    chunk_paths = []
-   while True:
-      chunk = fd.read( chunksize )
-      chunk_name = str(chunk_id)
-      chunk_fd = open( __file_chunks_dir + file_dir + "/" + chunk_name, "wb" )
-      chunk_fd.write( chunk )
-      chunk_fd.close()
-      chunk_id += 1
-      
-      m = hashlib.sha1()
-      m.update( chunk )
-      chunk_hash = m.hexdigest()
-      chunk_hashes.append( chunk_hash )
-      
-      chunk_paths.append( __file_chunks_dir + file_dir + "/" + chunk_name )
-      
-      if len(chunk) != chunksize:
-         # last chunk; EOF reached
-         break
+   for chunk_id in xrange(0, len(chunk_hashes)):
+      chunk_paths.append( __file_chunks_dir + file_dir + "/" + str(chunk_id) )
+   
+   # keep one copy of each chunk on disk, shared with other files' chunks and the chunk store
+   if iftstore.enabled():
+      for chunk_id in xrange(0, len(chunk_hashes)):
+         iftstore.share_file( chunk_hashes[chunk_id], chunk_paths[chunk_id] )
    
-   fd.close()
+   update_chunk_index( filename, chunksize, identity, file_hash, chunk_hashes )
    
-   iftlog.log(1, "Broke " + filename + " into " + str(chunk_id) + " chunks in " + __file_chunks_dir + file_dir + "/" )
+   iftlog.log(1, "Broke " + filename + " into " + str(len(chunk_paths)) + " chunks in " + __file_chunks_dir + file_dir + "/" )
    return (0, file_hash, chunk_hashes, chunk_paths)
 
 
 
+def make_chunk_views( filename, chunksize ):
+   """
+   Split the given file into chunks without copying it.  Each chunk is a chunk_view
+   onto the original file; nothing is written to the chunks directory.
+   Release the views with release_chunk_views() once they have been sent.
+   Returns (0, file_hash, chunk_hashes, chunk_views) on success; (nonzero, None, None, None) on error.
+   """
+   # sanity check
+   if not os.path.exists(filename):
+      iftlog.log(3, "Skipping " + filename + " since it cannot be found")
+      return (E_IOERROR, None, None, None)
+
+   if not (stat.S_IWUSR & os.stat( filename ).st_mode):
+      iftlog.log(3, "Skipping " + filename + " since I do not have read permission")
+      return (E_IOERROR, None, None, None)
+
+   source = chunk_source( filename )
+   rc = source.open()
+   if rc != 0:
+      iftlog.log(5, "ERROR: could not open " + filename + " for reading!")
+      return (rc, None, None, None)
+
+   chunk_views = []
+
+   # if we have hashed this file already, then there is nothing to read
+   identity = file_identity( filename )
+   file_hash, chunk_hashes = lookup_chunk_index( filename, chunksize )
+   if file_hash != None:
+      for chunk_id in xrange(0, len(chunk_hashes)):
+         offset = chunk_id * chunksize
+         chunk_views.append( chunk_view( source, offset, min( chunksize, identity[2] - offset ) ) )
+
+      iftlog.log(1, "Mapped " + filename + " into " + str(len(chunk_views)) + " indexed chunks" )
+      return (0, file_hash, chunk_hashes, chunk_views)
+
+   # hash the file and each would-be chunk, and remember where each chunk is
+   def add_view( chunk_id, offset, chunk ):
+      chunk_views.append( chunk_view( source, offset, len(chunk) ) )
+      return 0
+
+   rc, file_hash, chunk_hashes = hash_file_chunks( filename, chunksize, add_view )
+   if rc != 0:
+      source.close()
+      return (rc, None, None, None)
+
+   update_chunk_index( filename, chunksize, identity, file_hash, chunk_hashes )
+
+   iftlog.log(1, "Mapped " + filename + " into " + str(len(chunk_views)) + " chunks" )
+   return (0, file_hash, chunk_hashes, chunk_views)
+
+
+
+def release_chunk_views( chunk_data ):
+   """
+   Close the source files behind any chunk views in a list of
+   (chunk, chunk id, chunk path, remote chunk path) entries.
+   """
+   if not chunk_data:
+      return 0
+
+   for entry in chunk_data:
+      if isinstance( entry[0], chunk_view ):
+         entry[0].source.close()
+
+   return 0
+
+
+
 def get_chunks( filename, chunksize ):
    """
    Determine the chunks and sha-1 hashes of the would-be chunks of a file.
@@ -1152,22 +2011,14 @@ def get_chunks( filename, chunksize ):
       return (E_IOERROR, None)
    
    chunks = []
-   chunk_hashes = []
-   fd = open( filename, "rb" )
-   while True:
-      chunk = fd.read( chunksize )
-      
-      m = hashlib.sha1()
-      m.update( chunk )
-      chunk_hash = m.hexdigest()
-      chunk_hashes.append( chunk_hash )
+   def keep_chunk( chunk_id, offset, chunk ):
       chunks.append( chunk )
-      
-      if len(chunk) != chunksize:
-         # last chunk; EOF reached
-         break
+      return 0
+   
+   rc, file_hash, chunk_hashes = hash_file_chunks( filename, chunksize, keep_chunk )
+   if rc != 0:
+      return (rc, None)
    
-   fd.close()
    return (0, chunks, chunk_hashes)
    
 
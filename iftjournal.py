@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+"""
+iftjournal.py
+Copyright (c) 2009 Jude Nelson
+
+On-disk journals of files being received, so that a transfer cut short by
+a crash or a restart picks up where it left off instead of starting over.
+
+A file's journal is two files in the journal directory, named after the
+file's path:  a header (<name>.job) holding the job's attributes and chunk
+hashes, and a log (<name>.log) with a fixed-size record of each chunk stored
+in the file:  its ID and the SHA-1 of its data.  A chunk's record is appended
+once its data has been written, and every logged chunk is checked against
+its SHA-1 before it is trusted again, so a record for data that never made
+it to disk only costs the chunk being received again.  A record cut short
+by a crash is ignored.
+"""
+
+import os
+import struct
+import hashlib
+import binascii
+import threading
+import cPickle
+
+import iftlog
+
+from iftdata import *
+
+
+"""
+Location of the journals (None if there are none)
+"""
+__journal_dir = None
+
+"""
+A log record:  chunk ID, then the chunk's binary SHA-1
+"""
+RECORD_FORMAT = "!q20s"
+RECORD_SIZE = struct.calcsize( RECORD_FORMAT )
+
+"""
+Job attributes that can't or shouldn't be saved (names match iftfile.JOB_ATTR_*)
+"""
+UNSAVED_ATTRS = ["JOB_ATTR_IFTFILE"]
+
+
+def startup( journal_dir = "/tmp/iftd/journal/" ):
+   """
+   Start keeping journals in the given directory (None for no journals)
+   """
+   global __journal_dir
+
+   __journal_dir = None
+   if not journal_dir:
+      return 0
+
+   rc = os.popen("mkdir -p " + journal_dir ).close()
+   if rc != 0 and rc != None:
+      iftlog.log(5, "iftjournal: could not create " + journal_dir + " (rc = " + str(rc) + "), so transfers cannot be resumed")
+      return E_IOERROR
+
+   __journal_dir = journal_dir
+   if __journal_dir[-1] != "/":
+      __journal_dir += "/"
+
+   return 0
+
+
+def enabled():
+   """
+   Are journals being kept?
+   """
+   return __journal_dir != None
+
+
+def journal_path( file_path ):
+   """
+   Path (minus extension) of the journal for the file at the given path
+   """
+   m = hashlib.sha1()
+   m.update( os.path.abspath( file_path ) )
+   return __journal_dir + m.hexdigest()
+
+
+def saved_attrs( job_attrs ):
+   """
+   The job attributes that can be written to a journal
+   """
+   ret = {}
+   for (key, value) in job_attrs.items():
+      if key in UNSAVED_ATTRS:
+         continue
+
+      try:
+         cPickle.dumps( value, cPickle.HIGHEST_PROTOCOL )
+         ret[ key ] = value
+      except:
+         pass
+
+   return ret
+
+
+def write_header( path, header ):
+   """
+   Atomically (re)write a journal header.
+   Return 0 on success; negative on error
+   """
+   tmp_path = path + ".job.tmp"
+   try:
+      fd = open( tmp_path, "wb" )
+      cPickle.dump( header, fd, cPickle.HIGHEST_PROTOCOL )
+      fd.flush()
+      os.fsync( fd.fileno() )
+      fd.close()
+      os.rename( tmp_path, path + ".job" )
+   except Exception, inst:
+      iftlog.exception("iftjournal: could not write " + path + ".job", inst)
+      try:
+         os.remove( tmp_path )
+      except:
+         pass
+      return E_IOERROR
+
+   return 0
+
+
+def read_header( path ):
+   """
+   Read a journal header, or None if there isn't a readable one
+   """
+   try:
+      fd = open( path + ".job", "rb" )
+      header = cPickle.load( fd )
+      fd.close()
+      return header
+   except:
+      return None
+
+
+
+class journal:
+   """
+   Journal of the chunks stored in one file being received.
+   """
+
+   def __init__( self, path, header ):
+      self.path = path
+      self.header = header
+      self.__fd = -1
+      self.__lock = threading.Lock()
+      self.__chunk_hashes = None
+
+      chunk_hashes = header["job_attrs"].get( "JOB_ATTR_CHUNK_HASHES" )
+      if chunk_hashes:
+         self.__chunk_hashes = chunk_hashes
+
+
+   def matches( self, file_path, file_attrs ):
+      """
+      Is this the journal of receiving the same file, in the same chunks?
+      """
+      try:
+         job_attrs = self.header["job_attrs"]
+         return (self.header["path"] == os.path.abspath( file_path ) and
+                 job_attrs.get( "JOB_ATTR_FILE_HASH" ) == file_attrs.get( "JOB_ATTR_FILE_HASH" ) and
+                 job_attrs.get( "JOB_ATTR_FILE_SIZE" ) == file_attrs.get( "JOB_ATTR_FILE_SIZE" ) and
+                 job_attrs.get( "JOB_ATTR_CHUNKSIZE" ) == file_attrs.get( "JOB_ATTR_CHUNKSIZE" ))
+      except Exception, inst:
+         iftlog.exception("iftjournal: corrupt header in " + self.path, inst)
+         return False
+
+
+   def chunks( self ):
+      """
+      Get the (chunk ID, binary SHA-1) of each chunk logged so far, in order, without duplicates.
+      """
+      ret = {}
+      try:
+         fd = open( self.path + ".log", "rb" )
+         try:
+            while True:
+               record = fd.read( RECORD_SIZE )
+               if len(record) < RECORD_SIZE:
+                  break       # end of the log (or a record cut short)
+
+               (chunk_id, digest) = struct.unpack( RECORD_FORMAT, record )
+               ret[ chunk_id ] = digest
+         finally:
+            fd.close()
+      except IOError:
+         pass     # nothing logged yet
+
+      chunk_ids = ret.keys()
+      chunk_ids.sort()
+      return [(i, ret[i]) for i in chunk_ids]
+
+
+   def open( self, chunks=None ):
+      """
+      Start logging chunks.  If chunks (a list of (chunk ID, binary SHA-1)) is given,
+      the log is started over with just them.
+      Return 0 on success; negative on error
+      """
+      try:
+         if chunks != None:
+            tmp_path = self.path + ".log.tmp"
+            fd = open( tmp_path, "wb" )
+            for (chunk_id, digest) in chunks:
+               fd.write( struct.pack( RECORD_FORMAT, chunk_id, digest ) )
+            fd.flush()
+            os.fsync( fd.fileno() )
+            fd.close()
+            os.rename( tmp_path, self.path + ".log" )
+
+         self.__fd = os.open( self.path + ".log", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600 )
+         return 0
+      except Exception, inst:
+         iftlog.exception("iftjournal: could not open " + self.path + ".log", inst)
+         return E_IOERROR
+
+
+   def digest( self, chunk_id, chunk, known=None ):
+      """
+      Binary SHA-1 of a chunk:  the known one if given (i.e. from verifying it),
+      from the job's chunk hashes if we have them, or computed.
+      """
+      if known != None:
+         return known
+
+      if self.__chunk_hashes != None and chunk_id < len(self.__chunk_hashes):
+         return binascii.unhexlify( self.__chunk_hashes[chunk_id] )
+
+      return hashlib.sha1( chunk ).digest()
+
+
+   def record( self, chunk_id, chunk, known=None ):
+      """
+      Log that a chunk's data has been written to the file.
+      known is the chunk's binary SHA-1, if the caller has it already.
+      Return 0 on success; negative on error
+      """
+      record = struct.pack( RECORD_FORMAT, chunk_id, self.digest( chunk_id, chunk, known ) )
+      self.__lock.acquire()
+      try:
+         try:
+            if self.__fd < 0:
+               return E_BAD_STATE
+
+            os.write( self.__fd, record )
+            return 0
+         except Exception, inst:
+            iftlog.exception("iftjournal: could not log chunk " + str(chunk_id) + " in " + self.path + ".log", inst)
+            return E_IOERROR
+      finally:
+         self.__lock.release()
+
+
+   def set_resume( self, resume_args ):
+      """
+      Remember how the transfer was started, so iftd can start it again after a restart.
+      Return 0 on success; negative on error
+      """
+      self.header["resume"] = resume_args
+      return write_header( self.path, self.header )
+
+
+   def close( self ):
+      """
+      Stop logging chunks, leaving the journal for the next time the file is opened.
+      """
+      self.__lock.acquire()
+      try:
+         if self.__fd >= 0:
+            os.close( self.__fd )
+      except Exception, inst:
+         iftlog.exception("iftjournal: could not close " + self.path + ".log", inst)
+
+      self.__fd = -1
+      self.__lock.release()
+
+
+   def remove( self ):
+      """
+      Throw the journal away (the transfer finished, or can't be resumed).
+      """
+      self.close()
+      for ext in [".job", ".log"]:
+         try:
+            os.remove( self.path + ext )
+         except OSError:
+            pass
+
+
+
+def open_journal( file_path, file_attrs ):
+   """
+   Get the journal for receiving a file with the given job attributes.
+   Return (journal, resumed), where resumed is True if the journal was
+   already there from receiving the same file before (see journal.chunks()),
+   or (None, False) if there are no journals or the file can't be journaled.
+   The journal is not yet open for logging (see journal.open()).
+   """
+   if __journal_dir == None:
+      return (None, False)
+
+   # only files whose contents and layout are known in advance can be picked up again
+   if file_attrs.get( "JOB_ATTR_FILE_HASH" ) in (None, "JOB_ATTR_OPTIONAL") or file_attrs.get( "JOB_ATTR_FILE_SIZE" ) in (None, "JOB_ATTR_OPTIONAL") or file_attrs.get( "JOB_ATTR_CHUNKSIZE" ) == None:
+      return (None, False)
+
+   path = journal_path( file_path )
+   header = read_header( path )
+   if header != None:
+      j = journal( path, header )
+      if j.matches( file_path, file_attrs ):
+         return (j, True)
+
+      # from receiving something else
+      j.remove()
+
+   header = {
+      "path": os.path.abspath( file_path ),
+      "job_attrs": saved_attrs( file_attrs ),
+      "resume": None
+   }
+
+   j = journal( path, header )
+   try:
+      os.remove( path + ".log" )
+   except OSError:
+      pass
+
+   if write_header( path, header ) != 0:
+      return (None, False)
+
+   return (j, False)
+
+
+
+def list_journals():
+   """
+   Get the headers of every journal (i.e. every transfer that can be picked up again)
+   """
+   if __journal_dir == None:
+      return []
+
+   ret = []
+   try:
+      names = os.listdir( __journal_dir )
+   except Exception, inst:
+      iftlog.exception("iftjournal: could not list " + __journal_dir, inst)
+      return []
+
+   for name in names:
+      if not name.endswith( ".job" ):
+         continue
+
+      header = read_header( __journal_dir + name[:-len(".job")] )
+      if header != None:
+         ret.append( header )
+
+   return ret
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+"""
+iftmerkle.py
+Copyright (c) 2009 Jude Nelson
+
+Merkle hash trees over file chunks.  Instead of sending every chunk hash
+to the receiver up front, the sender can send just the root of the tree
+built over the chunk hashes.  The receiver then asks for the sibling hashes
+("proofs") of the chunks it gets, and verifies each chunk against the root.
+"""
+
+import hashlib
+import binascii
+import threading
+
+import iftlog
+
+
+def node_hash( left, right ):
+   """
+   Hash of an interior node, given the (binary) digests of its children.
+   """
+   m = hashlib.sha1()
+   m.update( "\x01" )
+   m.update( left )
+   m.update( right )
+   return m.digest()
+
+
+def level_widths( num_leaves ):
+   """
+   Number of nodes on each level of a tree with num_leaves leaves, from the leaves up to the root.
+   """
+   widths = [max(num_leaves, 1)]
+   while widths[-1] > 1:
+      widths.append( (widths[-1] + 1) / 2 )
+
+   return widths
+
+
+def num_leaves( file_size, chunksize ):
+   """
+   Number of chunks (leaves) iftfile.make_chunks gives for a file of the given size.
+   The last chunk is always short, so a file whose size is a multiple of the
+   chunk size ends with an empty chunk.
+   """
+   return int(file_size) / int(chunksize) + 1
+
+
+
+class merkle_tree:
+   """
+   Merkle tree built by the sender over the SHA-1 hashes of a file's chunks.
+   Interior nodes hash their two children; a node without a right sibling is
+   carried up to the next level unchanged.
+   """
+
+   def __init__( self, chunk_hashes ):
+      self.levels = [[binascii.unhexlify( h ) for h in chunk_hashes]]
+      if len(self.levels[0]) == 0:
+         self.levels[0].append( hashlib.sha1().digest() )
+
+      while len(self.levels[-1]) > 1:
+         below = self.levels[-1]
+         above = []
+         for i in xrange(0, len(below), 2):
+            if i + 1 < len(below):
+               above.append( node_hash( below[i], below[i+1] ) )
+            else:
+               above.append( below[i] )
+
+         self.levels.append( above )
+
+
+   def root( self ):
+      """
+      Hex digest of the root of the tree
+      """
+      return binascii.hexlify( self.levels[-1][0] )
+
+
+   def proof( self, chunk_ids ):
+      """
+      Get the nodes a receiver needs to verify the given chunks against the root.
+      Nodes that can be computed from the other chunks in chunk_ids are left out,
+      so asking for a contiguous range costs about as much as asking for one chunk.
+      Returns a list of [level, index, hex digest]
+      """
+      ret = []
+      covered = set()
+      for chunk_id in chunk_ids:
+         chunk_id = int(chunk_id)
+         if chunk_id >= 0 and chunk_id < len(self.levels[0]):
+            covered.add( chunk_id )
+
+      for level in xrange(0, len(self.levels) - 1):
+         width = len(self.levels[level])
+         for index in covered:
+            sibling = index ^ 1
+            if sibling < width and sibling not in covered:
+               ret.append( [level, sibling, binascii.hexlify( self.levels[level][sibling] )] )
+
+         covered = set( [index / 2 for index in covered] )
+
+      return ret
+
+
+
+class merkle_verifier:
+   """
+   Receiver-side verification of chunks against a Merkle root.
+   Nodes that have been authenticated are remembered, so once a chunk is
+   verified its neighbors usually need little or no further proof.
+   fetch_proof( chunk_ids ) is called to get proofs (as from merkle_tree.proof)
+   for chunks that cannot be verified with what we know so far.
+   """
+
+   def __init__( self, root, num_leaves, fetch_proof=None ):
+      self.__widths = level_widths( num_leaves )
+      self.__known = { (len(self.__widths) - 1, 0): binascii.unhexlify( root ) }     # authenticated nodes
+      self.__hints = {}       # nodes from proofs, not yet authenticated
+      self.__fetch_proof = fetch_proof
+      self.__lock = threading.BoundedSemaphore(1)
+
+
+   def __lookup( self, level, index ):
+      node = self.__known.get( (level, index) )
+      if node == None:
+         node = self.__hints.get( (level, index) )
+
+      return node
+
+
+   def __can_verify( self, chunk_id ):
+      """
+      Do we know enough to verify this chunk without asking for a proof?
+      """
+      index = chunk_id
+      for level in xrange(0, len(self.__widths)):
+         if self.__known.has_key( (level, index) ):
+            return True
+
+         sibling = index ^ 1
+         if sibling < self.__widths[level] and self.__lookup( level, sibling ) == None:
+            return False
+
+         index = index / 2
+
+      return False
+
+
+   def leaf( self, chunk_id ):
+      """
+      Get the binary SHA-1 of a chunk that has been verified, or None if it has not been.
+      """
+      return self.__known.get( (0, chunk_id) )
+
+
+   def add_proof( self, nodes ):
+      """
+      Remember the nodes of a proof, to be checked when they are used.
+      """
+      for (level, index, h) in nodes:
+         if not self.__known.has_key( (level, index) ):
+            self.__hints[ (level, index) ] = binascii.unhexlify( h )
+
+
+   def __verify( self, chunk_id, chunk ):
+      """
+      Verify one chunk.  Return True or False, or None if we need a proof.
+      Call with the lock held.
+      """
+      if chunk_id < 0 or chunk_id >= self.__widths[0]:
+         return False
+
+      m = hashlib.sha1()
+      m.update( chunk )
+      digest = m.digest()
+
+      path = []
+      index = chunk_id
+      for level in xrange(0, len(self.__widths)):
+         known = self.__known.get( (level, index) )
+         if known != None:
+            if known != digest:
+               # don't trust the hints we used again
+               for (node_level, node_index, node) in path:
+                  if self.__hints.has_key( (node_level, node_index) ):
+                     del self.__hints[ (node_level, node_index) ]
+               return False
+
+            for (node_level, node_index, node) in path:
+               self.__known[ (node_level, node_index) ] = node
+               if self.__hints.has_key( (node_level, node_index) ):
+                  del self.__hints[ (node_level, node_index) ]
+            return True
+
+         path.append( (level, index, digest) )
+
+         sibling = index ^ 1
+         if sibling < self.__widths[level]:
+            node = self.__lookup( level, sibling )
+            if node == None:
+               return None
+
+            path.append( (level, sibling, node) )
+            if index & 1:
+               digest = node_hash( node, digest )
+            else:
+               digest = node_hash( digest, node )
+
+         index = index / 2
+
+      return False
+
+
+   def verify_chunks( self, chunk_table ):
+      """
+      Verify a dictionary of chunk IDs to chunk data, fetching one proof for all
+      of the chunks that need one.  Chunks in the same table vouch for each other,
+      so a contiguous range needs no more proof than a single chunk.
+      Return a dictionary mapping each chunk ID to True (valid) or False (invalid or unverifiable).
+      """
+      self.__lock.acquire()
+      try:
+         status = self.__verify_batch( chunk_table )
+         
+         # a bad chunk spoils the verification of its neighbors, so try the failures again on their own
+         failed = [k for k in status.keys() if not status[k]]
+         if len(failed) > 0 and len(failed) < len(chunk_table.keys()):
+            for k in failed:
+               status[k] = self.__verify_batch( {k: chunk_table[k]} )[k]
+         
+         return status
+      finally:
+         self.__lock.release()
+
+
+   def __derive_hints( self, chunk_ids ):
+      """
+      Compute what we can of the ancestors of the given chunks from the
+      hints we have, so chunks in the same batch can vouch for each other.
+      Call with the lock held.
+      """
+      covered = set( chunk_ids )
+      for level in xrange(0, len(self.__widths) - 1):
+         parents = set()
+         for index in covered:
+            node = self.__lookup( level, index )
+            if node == None:
+               continue
+
+            sibling = index ^ 1
+            if sibling < self.__widths[level]:
+               other = self.__lookup( level, sibling )
+               if other == None:
+                  continue
+
+               if index & 1:
+                  node = node_hash( other, node )
+               else:
+                  node = node_hash( node, other )
+
+            if not self.__known.has_key( (level + 1, index / 2) ):
+               self.__hints[ (level + 1, index / 2) ] = node
+
+            parents.add( index / 2 )
+
+         covered = parents
+
+
+   def __verify_batch( self, chunk_table ):
+      """
+      Verify a table of chunks, fetching a proof if need be.
+      Call with the lock held.
+      """
+      chunk_ids = [k for k in chunk_table.keys() if k >= 0 and k < self.__widths[0]]
+      for k in chunk_ids:
+         if not self.__known.has_key( (0, k) ):
+            m = hashlib.sha1()
+            m.update( chunk_table[k] )
+            self.__hints[ (0, k) ] = m.digest()
+
+      self.__derive_hints( chunk_ids )
+
+      need_proof = [k for k in chunk_ids if not self.__can_verify( k )]
+      if len(need_proof) > 0 and self.__fetch_proof != None:
+         need_proof.sort()
+         try:
+            self.add_proof( self.__fetch_proof( need_proof ) )
+            self.__derive_hints( chunk_ids )
+         except Exception, inst:
+            iftlog.exception("merkle_verifier: could not get proof for chunks " + str(need_proof), inst)
+
+      status = {}
+      for k in chunk_table.keys():
+         status[k] = (self.__verify( k, chunk_table[k] ) == True)
+
+      # whatever we could not authenticate is not to be trusted later
+      self.__hints = {}
+      return status
@@ -25,7 +25,11 @@ from classifiers.probability import *
 from classifiers.api import *
 
 import time
+import array
+import thread
 import threading
+from collections import deque
+
 import iftlog
 import iftfile
 
@@ -44,15 +48,20 @@ IFTSTATS_STATUS         = "IFTSTATS_STATUS"
 IFTSTATS_PROTO_SENDER   = "IFTSTATS_PROTO_SENDER"
 IFTSTATS_PROTO_RECEIVER = "IFTSTATS_PROTO_RECEIVER"
 
-# list of (protocol, status, start, end, size) tuples for each chunk sent
+# chunk_log of (protocol, status, start, end, size) for each chunk sent
 IFTSTATS_PROTO_LIST     = "IFTSTATS_PROTO_LIST"
-IFTSTATS_PROTO_LIST_LOCK= "IFTSTATS_PROTO_LIST_LOCK"
 PROTO_LIST_NAME   = 0      # protocol name
 PROTO_LIST_STATUS = 1      # success or failure
 PROTO_LIST_START  = 2      # start time
 PROTO_LIST_END    = 3      # end time
 PROTO_LIST_SIZE   = 4      # amount of data sent
 
+# weight of each chunk in a protocol's moving average bandwidth
+IFTSTATS_EWMA_WEIGHT = 0.125
+
+# how many seconds back a protocol's recent bandwidth looks
+IFTSTATS_BANDWIDTH_WINDOW = 10.0
+
 # size estimatation step
 FSIZE_STEP = 65536
 
@@ -184,6 +193,175 @@ class iftNaiveBayesClassifier( classifiers.naivebayes.NaiveBayesClassifier ):
    
 
 
+class proto_totals:
+   """
+   Running totals of how one protocol did in one transfer.
+   """
+   
+   def __init__( self ):
+      self.attempts = 0             # chunks tried
+      self.successes = 0            # chunks sent
+      self.data = 0                 # bytes sent
+      self.time = 0.0               # time spent on all chunks tried
+      self.success_time = 0.0       # time spent on chunks sent
+      self.ewma_bandwidth = None    # moving average of the bandwidth of each chunk sent
+      self.__window = deque()       # (start, end, size) of chunks sent in the last IFTSTATS_BANDWIDTH_WINDOW seconds
+      self.__window_data = 0        # bytes in __window
+   
+   
+   def add( self, status, start, end, size ):
+      """
+      Count a chunk.
+      """
+      self.attempts += 1
+      self.time += end - start
+      if not status:
+         return
+      
+      self.successes += 1
+      self.data += size
+      self.success_time += end - start
+      
+      if end > start:
+         bandwidth = size / (end - start)
+         if self.ewma_bandwidth == None:
+            self.ewma_bandwidth = bandwidth
+         else:
+            self.ewma_bandwidth += IFTSTATS_EWMA_WEIGHT * (bandwidth - self.ewma_bandwidth)
+      
+      self.__window.append( (start, end, size) )
+      self.__window_data += size
+      self.__expire( end )
+   
+   
+   def __expire( self, now ):
+      """
+      Forget chunks that started before the window.
+      """
+      while len(self.__window) > 0 and self.__window[0][0] < now - IFTSTATS_BANDWIDTH_WINDOW:
+         self.__window_data -= self.__window.popleft()[2]
+   
+   
+   def window_bandwidth( self, now ):
+      """
+      Bandwidth over the last IFTSTATS_BANDWIDTH_WINDOW seconds before now,
+      or None if nothing was sent in that time.
+      """
+      self.__expire( now )
+      if len(self.__window) == 0:
+         return None
+      
+      span = min( now - self.__window[0][0], IFTSTATS_BANDWIDTH_WINDOW )
+      if span <= 0:
+         return None
+      
+      return self.__window_data / span
+
+
+
+class chunk_log:
+   """
+   Log of every chunk sent in a transfer, as (protocol, status, start, end, size).
+   The fields are kept in arrays, one per field, and running totals are kept
+   for each protocol, so nothing needs to look through the whole log.
+   """
+   
+   def __init__( self ):
+      self.__names = []                   # protocol names, by index
+      self.__index = {}                   # protocol name --> index
+      self.__proto = array.array('H')
+      self.__status = array.array('B')
+      self.__start = array.array('d')
+      self.__end = array.array('d')
+      self.__size = array.array('L')
+      self.__totals = {}                  # protocol name --> proto_totals
+      self.__lock = thread.allocate_lock()
+   
+   
+   def append( self, proto, status, start, end, size ):
+      """
+      Log a chunk.
+      """
+      self.__lock.acquire()
+      try:
+         i = self.__index.get( proto )
+         if i == None:
+            i = len(self.__names)
+            self.__names.append( proto )
+            self.__index[ proto ] = i
+            self.__totals[ proto ] = proto_totals()
+         
+         self.__proto.append( i )
+         self.__status.append( status and 1 or 0 )
+         self.__start.append( start )
+         self.__end.append( end )
+         self.__size.append( size )
+         self.__totals[ proto ].add( status, start, end, size )
+      finally:
+         self.__lock.release()
+   
+   
+   def __len__( self ):
+      return len(self.__proto)
+   
+   
+   def __getitem__( self, i ):
+      return (self.__names[ self.__proto[i] ], self.__status[i] == 1, self.__start[i], self.__end[i], self.__size[i])
+   
+   
+   def protos( self ):
+      """
+      Names of the protocols that have logged chunks
+      """
+      return list(self.__names)
+   
+   
+   def performance( self, proto ):
+      """
+      Get (bytes sent, time spent on all chunks tried) for a protocol, or (0, 0.0) if it logged nothing
+      """
+      self.__lock.acquire()
+      try:
+         t = self.__totals.get( proto )
+         if t == None:
+            return (0, 0.0)
+         
+         return (t.data, t.time)
+      finally:
+         self.__lock.release()
+   
+   
+   def bandwidth( self, proto, now=None ):
+      """
+      Get (moving average bandwidth, bandwidth over the last IFTSTATS_BANDWIDTH_WINDOW seconds)
+      for a protocol.  Either may be None if there is no data.
+      """
+      if now == None:
+         now = time.time()
+      
+      self.__lock.acquire()
+      try:
+         t = self.__totals.get( proto )
+         if t == None:
+            return (None, None)
+         
+         return (t.ewma_bandwidth, t.window_bandwidth( now ))
+      finally:
+         self.__lock.release()
+   
+   
+   def totals( self ):
+      """
+      Get a list of (protocol name, attempts, successes, bytes sent, time spent on chunks sent)
+      """
+      self.__lock.acquire()
+      try:
+         return [(name, t.attempts, t.successes, t.data, t.success_time) for (name, t) in self.__totals.items()]
+      finally:
+         self.__lock.release()
+      
+
+
 def startup(proto_list, retrain_freq, classifier_type, num_best_protos):
    """
    Start up stats
@@ -255,8 +433,7 @@ def begin_transfer( job, sender=False, receiver=False ):
    """
    
    job.set_stat( IFTSTATS_BEGIN_TIME, time.time() )
-   job.set_stat( IFTSTATS_PROTO_LIST, [] )
-   job.set_stat( IFTSTATS_PROTO_LIST_LOCK, threading.BoundedSemaphore(1))  # need to be thread-safe for appending data
+   job.set_stat( IFTSTATS_PROTO_LIST, chunk_log() )
    job.set_stat( IFTSTATS_PROTO_SENDER, sender )
    job.set_stat( IFTSTATS_PROTO_RECEIVER, receiver )
    job.set_stat( IFTSTATS_DO_STATS, True )
@@ -284,14 +461,14 @@ def log_chunk( job, proto, status, start, end, size ):
       Stop time
    
    @param size
-      Amount of data sent
+      Amount of data sent (negative or None if it isn't known, e.g. because the file is gone)
    """
    
+   if size == None or size < 0:
+      size = 0
    
    if job.get_stat( IFTSTATS_DO_STATS ) == True:
-      job.get_stat( IFTSTATS_PROTO_LIST_LOCK ).acquire(True)
-      job.get_stat( IFTSTATS_PROTO_LIST ).append( (proto, status, start, end, size) )
-      job.get_stat( IFTSTATS_PROTO_LIST_LOCK ).release()
+      job.get_stat( IFTSTATS_PROTO_LIST ).append( proto, status, start, end, size )
    
    OWLD_LOCK.acquire(True)
    
@@ -330,17 +507,7 @@ def proto_performance( job, proto ):
    if not stats:
       return (None, None)
    
-   stat_len = len(stats)
-   data_cnt = 0
-   time_cnt = 0.0
-   for i in xrange(0, stat_len):
-      if proto != stats[i][0]:
-         continue    # wrong proto
-      
-      time_cnt += stats[i][3] - stats[i][2]     # end time - start time
-      if stats[i][1]:      # successful transmit?
-         data_cnt += stats[i][4]    # transmission len
-   
+   data_cnt, time_cnt = stats.performance( proto )
    if time_cnt == 0.0:  # no usage?
       return (None, None)
    
@@ -348,6 +515,19 @@ def proto_performance( job, proto ):
 
 
 
+def proto_bandwidth( job, proto ):
+   """
+   Get a protocol's (moving average bandwidth, bandwidth over the last
+   IFTSTATS_BANDWIDTH_WINDOW seconds) in this transfer.  Either may be None.
+   """
+   stats = job.get_stat( IFTSTATS_PROTO_LIST )
+   if not stats:
+      return (None, None)
+   
+   return stats.bandwidth( proto )
+
+
+
 
 def extract_features( job_attrs, file_success = True ):
    """
@@ -418,24 +598,13 @@ def end_transfer( job, file_success=True):
    proto_data = job.get_stat( IFTSTATS_PROTO_LIST )
    proto_data_time = {}    # map protocols to (total data sent, total time spent)
    proto_successes = {}    # map protocols to success counts
-   for (proto, success, start, end, size) in proto_data:
-      if proto_successes.has_key( proto ):
-         proto_successes[proto][1] += 1      # one transmission
-      else:
-         proto_successes[proto] = [0, 1]       # one transmission
+   for (proto, attempts, successes, size, t) in proto_data.totals():
+      proto_successes[proto] = [successes, attempts]
       
-      if not success:
-         continue    # don't bother if the chunk was a failure
+      if successes == 0:
+         continue    # don't bother if every chunk was a failure
       
-      # count successes
-      proto_successes[proto][0] += 1
-      
-      # count up data sent and time taken
-      if proto_data_time.has_key( proto ):
-         proto_data_time[proto][0] += size
-         proto_data_time[proto][1] += end - start
-      else:
-         proto_data_time[proto] = [size, end - start]
+      proto_data_time[proto] = [size, t]
    
    # now find the bandwidths
    proto_bandwidths = {}
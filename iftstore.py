@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+
+"""
+iftstore.py
+Copyright (c) 2009 Jude Nelson
+
+Content-addressed store of chunks, shared by every transfer on this host.
+
+Each chunk is kept once, in a file named after its SHA-1, no matter how many
+files (or versions of a file) it turns up in.  Senders link the files in
+their chunk directories to it instead of writing more copies, and receivers
+take chunks out of it instead of receiving them again (see
+iftcore.iftreceiver), and add every chunk they verify.
+
+A chunk is pinned while a file being received wants it (see
+iftfile.fopen()), or while a sender's chunk directory links to it (evicting
+it would free nothing).  When the store grows past its size cap, the least
+recently used chunks that are not pinned are evicted.  The store keeps count
+of the pinned bytes, so it doesn't look for chunks to evict when there
+aren't enough to be worth it.
+"""
+
+import os
+import time
+import errno
+import hashlib
+import thread
+import threading
+
+import iftlog
+
+from iftdata import *
+
+
+"""
+The store (None if there is none)
+"""
+__store = None
+
+"""
+Default size cap of the store
+"""
+DEFAULT_STORE_MAX_BYTES = 1024 * 1048576
+
+"""
+When evicting, make this fraction of the size cap free (so eviction doesn't happen on every chunk added)
+"""
+STORE_EVICT_TARGET = 0.9
+
+
+class chunk_store:
+   """
+   Chunks on disk, by SHA-1, with reference counts and LRU eviction.
+   """
+
+   def __init__( self, store_dir, max_bytes ):
+      self.store_dir = store_dir
+      self.max_bytes = max_bytes
+      self.__lock = threading.Lock()
+      self.__chunks = {}         # SHA-1 --> [size, time last used]
+      self.__refs = {}           # SHA-1 --> number of references
+      self.__linked = {}         # SHA-1 --> True, for chunks a sender's chunk directory links to
+      self.__num_bytes = 0
+      self.__pinned_bytes = 0    # bytes of chunks that are referenced or linked to
+      self.__hits = 0
+      self.__misses = 0
+      self.__evictions = 0
+
+
+   def path( self, digest ):
+      """
+      Where a chunk is (or would be) stored
+      """
+      return self.store_dir + digest[0:2] + "/" + digest
+
+
+   def load( self ):
+      """
+      Take stock of the chunks already in the store (i.e. from before a restart).
+      Return 0 on success; negative on error
+      """
+      self.__lock.acquire()
+      try:
+         try:
+            for subdir in os.listdir( self.store_dir ):
+               if not os.path.isdir( self.store_dir + subdir ):
+                  continue
+
+               for name in os.listdir( self.store_dir + subdir ):
+                  path = self.store_dir + subdir + "/" + name
+                  if len(name) != 40:
+                     os.remove( path )    # left over from a chunk being added
+                     continue
+
+                  sb = os.stat( path )
+                  self.__chunks[ name ] = [sb.st_size, sb.st_mtime]
+                  self.__num_bytes += sb.st_size
+
+            self.__evict()
+         except Exception, inst:
+            iftlog.exception("iftstore: could not read " + self.store_dir, inst)
+            return E_IOERROR
+      finally:
+         self.__lock.release()
+
+      iftlog.log(3, "iftstore: " + str(len(self.__chunks)) + " chunks (" + str(self.__num_bytes) + " bytes) in " + self.store_dir)
+      return 0
+
+
+   def has( self, digest ):
+      """
+      Is a chunk in the store?
+      """
+      return self.__chunks.has_key( digest )
+
+
+   def get( self, digest ):
+      """
+      Get a chunk's data, or None if it isn't in the store.
+      The data is checked against the SHA-1, so it can be used as if it were received and verified.
+      """
+      self.__lock.acquire()
+      entry = self.__chunks.get( digest )
+      if entry == None:
+         self.__misses += 1
+         self.__lock.release()
+         return None
+
+      entry[1] = time.time()
+      self.__lock.release()
+
+      chunk = None
+      try:
+         fd = open( self.path( digest ), "rb" )
+         chunk = fd.read()
+         fd.close()
+      except Exception, inst:
+         iftlog.exception("iftstore: could not read chunk " + digest, inst)
+
+      self.__lock.acquire()
+      try:
+         if chunk == None or hashlib.sha1( chunk ).hexdigest() != digest:
+            # gone, or corrupt
+            iftlog.log(5, "iftstore: chunk " + digest + " is damaged; removing it")
+            self.__remove( digest )
+            self.__misses += 1
+            return None
+
+         self.__hits += 1
+         return chunk
+      finally:
+         self.__lock.release()
+
+
+   def put( self, digest, chunk ):
+      """
+      Add a chunk, whose SHA-1 the caller has already checked.
+      Return 0 on success (or if the chunk was already there); negative on error
+      """
+      if self.__touch( digest ):
+         return 0
+
+      if len(chunk) > self.max_bytes:
+         return E_OVERFLOW
+
+      path = self.path( digest )
+      tmp_path = path + ".tmp." + str(os.getpid()) + "." + str(thread.get_ident())
+      try:
+         if not os.path.isdir( os.path.dirname( path ) ):
+            try:
+               os.mkdir( os.path.dirname( path ) )
+            except OSError:
+               pass     # made by someone else just now
+
+         fd = open( tmp_path, "wb" )
+         fd.write( chunk )
+         fd.close()
+         os.rename( tmp_path, path )
+      except Exception, inst:
+         iftlog.exception("iftstore: could not add chunk " + digest, inst)
+         try:
+            os.remove( tmp_path )
+         except:
+            pass
+         return E_IOERROR
+
+      self.__add( digest, len(chunk) )
+      return 0
+
+
+   def share_file( self, digest, path ):
+      """
+      Share a chunk file (i.e. in a sender's chunk directory) with the store:  if the store has the
+      chunk, the file is replaced with a link to it; otherwise the file is linked into the store.
+      Either way, there is one copy of the chunk on disk.
+      Return 0 on success; negative on error (in which case the file is left as it was)
+      """
+      store_path = self.path( digest )
+      try:
+         if self.link( digest, path ) == 0:
+            return 0
+
+         if not os.path.isdir( os.path.dirname( store_path ) ):
+            try:
+               os.mkdir( os.path.dirname( store_path ) )
+            except OSError:
+               pass
+
+         os.link( path, store_path )
+         self.__add( digest, os.stat( path ).st_size )
+         self.__link( digest )
+         return 0
+      except OSError, inst:
+         if inst.errno == errno.EEXIST:
+            return 0    # someone else added it just now
+
+         iftlog.exception("iftstore: could not share " + path, inst)
+         return E_IOERROR
+
+
+   def link( self, digest, path ):
+      """
+      Put a link to a stored chunk at path (i.e. in a sender's chunk directory), in place of whatever is there.
+      Return 0 on success; negative if the store doesn't have the chunk, or on error
+      """
+      if not self.__touch( digest ):
+         return E_FILE_NOT_FOUND
+
+      tmp_path = path + ".tmp"
+      try:
+         if os.path.exists( tmp_path ):
+            os.remove( tmp_path )
+         os.link( self.path( digest ), tmp_path )
+         os.rename( tmp_path, path )
+      except OSError, inst:
+         iftlog.exception("iftstore: could not link chunk " + digest + " to " + path, inst)
+         return E_IOERROR
+
+      self.__link( digest )
+      return 0
+
+
+   def ref( self, digests ):
+      """
+      Reference chunks (which need not be in the store yet), so they are not evicted
+      """
+      self.__lock.acquire()
+      for digest in digests:
+         was_pinned = self.__is_pinned( digest )
+         self.__refs[ digest ] = self.__refs.get( digest, 0 ) + 1
+         self.__repin( digest, was_pinned )
+      self.__lock.release()
+
+
+   def unref( self, digests ):
+      """
+      Drop references taken with ref()
+      """
+      self.__lock.acquire()
+      for digest in digests:
+         was_pinned = self.__is_pinned( digest )
+         count = self.__refs.get( digest, 0 ) - 1
+         if count > 0:
+            self.__refs[ digest ] = count
+         elif self.__refs.has_key( digest ):
+            del self.__refs[ digest ]
+         self.__repin( digest, was_pinned )
+
+      self.__evict()
+      self.__lock.release()
+
+
+   def links_dropped( self ):
+      """
+      Sender chunk directories were removed, so chunks they linked to may be evictable again
+      """
+      self.__lock.acquire()
+      self.__linked = {}
+      self.__pinned_bytes = 0
+      for digest in self.__refs.keys():
+         if self.__chunks.has_key( digest ):
+            self.__pinned_bytes += self.__chunks[ digest ][0]
+
+      self.__evict()
+      self.__lock.release()
+
+
+   def stats( self ):
+      """
+      How big is the store, and how well is it doing?
+      """
+      self.__lock.acquire()
+      ret = {"chunks": len(self.__chunks), "bytes": self.__num_bytes, "max_bytes": self.max_bytes, "referenced": len(self.__refs), "pinned_bytes": self.__pinned_bytes,
+             "hits": self.__hits, "misses": self.__misses, "evictions": self.__evictions}
+      self.__lock.release()
+      return ret
+
+
+   def __touch( self, digest ):
+      """
+      Mark a chunk as just used.  Return True if it is in the store.
+      """
+      self.__lock.acquire()
+      entry = self.__chunks.get( digest )
+      if entry != None:
+         entry[1] = time.time()
+      self.__lock.release()
+      return entry != None
+
+
+   def __add( self, digest, size ):
+      """
+      Take stock of a chunk just added to the store
+      """
+      self.__lock.acquire()
+      if not self.__chunks.has_key( digest ):
+         self.__num_bytes += size
+         if self.__is_pinned( digest ):
+            self.__pinned_bytes += size
+      self.__chunks[ digest ] = [size, time.time()]
+      self.__evict()
+      self.__lock.release()
+
+
+   def __link( self, digest ):
+      """
+      Take note that a sender's chunk directory links to a chunk
+      """
+      self.__lock.acquire()
+      was_pinned = self.__is_pinned( digest )
+      self.__linked[ digest ] = True
+      self.__repin( digest, was_pinned )
+      self.__lock.release()
+
+
+   def __is_pinned( self, digest ):
+      """
+      Is a chunk kept from eviction?  Call with the lock held.
+      """
+      return self.__refs.has_key( digest ) or self.__linked.has_key( digest )
+
+
+   def __repin( self, digest, was_pinned ):
+      """
+      Count a chunk's bytes as pinned or not, now that it may have been pinned or unpinned.  Call with the lock held.
+      """
+      entry = self.__chunks.get( digest )
+      if entry == None or was_pinned == self.__is_pinned( digest ):
+         return
+
+      if was_pinned:
+         self.__pinned_bytes -= entry[0]
+      else:
+         self.__pinned_bytes += entry[0]
+
+
+   def __remove( self, digest ):
+      """
+      Take a chunk out of the store.  Call with the lock held.
+      """
+      entry = self.__chunks.get( digest )
+      if entry == None:
+         return
+
+      try:
+         os.remove( self.path( digest ) )
+      except OSError:
+         pass
+
+      if self.__is_pinned( digest ):
+         self.__pinned_bytes -= entry[0]
+      if self.__linked.has_key( digest ):
+         del self.__linked[ digest ]
+
+      self.__num_bytes -= entry[0]
+      del self.__chunks[ digest ]
+
+
+   def __evict( self ):
+      """
+      If the store is over its size cap, evict the least recently used chunks that are not pinned.
+      Call with the lock held.
+      """
+      if self.__num_bytes <= self.max_bytes:
+         return
+
+      # looking for chunks to evict means looking at all of them, so only do so if
+      # there are enough unpinned bytes to free a good share of the cap
+      target = self.max_bytes * STORE_EVICT_TARGET
+      if self.__num_bytes - self.__pinned_bytes < self.max_bytes - target:
+         return
+
+      candidates = [(entry[1], digest) for (digest, entry) in self.__chunks.items() if not self.__is_pinned( digest )]
+      candidates.sort()
+      for (last_used, digest) in candidates:
+         if self.__num_bytes <= target:
+            break
+
+         try:
+            if os.stat( self.path( digest ) ).st_nlink > 1:
+               # linked from a chunk directory we didn't know of (i.e. from before a restart)
+               self.__linked[ digest ] = True
+               self.__repin( digest, False )
+               continue
+         except OSError:
+            pass
+
+         self.__remove( digest )
+         self.__evictions += 1
+
+      if self.__num_bytes > self.max_bytes:
+         iftlog.log(3, "iftstore: " + str(self.__num_bytes) + " bytes are in use, over the cap of " + str(self.max_bytes))
+
+
+
+def startup( store_dir = "/tmp/iftd/store/", max_bytes = DEFAULT_STORE_MAX_BYTES ):
+   """
+   Start keeping chunks in the given directory (None for no store), up to max_bytes of them
+   """
+   global __store
+
+   __store = None
+   if not store_dir:
+      return 0
+
+   rc = os.popen("mkdir -p " + store_dir ).close()
+   if rc != 0 and rc != None:
+      iftlog.log(5, "iftstore: could not create " + store_dir + " (rc = " + str(rc) + "), so there is no chunk store")
+      return E_IOERROR
+
+   if store_dir[-1] != "/":
+      store_dir += "/"
+
+   store = chunk_store( store_dir, max_bytes )
+   rc = store.load()
+   if rc != 0:
+      return rc
+
+   __store = store
+   return 0
+
+
+def enabled():
+   """
+   Is there a chunk store?
+   """
+   return __store != None
+
+
+def get_store():
+   """
+   Get the chunk store, or None if there is none
+   """
+   return __store
+
+
+def get( digest ):
+   """
+   Get a chunk's data by SHA-1 (hex), or None if it isn't stored
+   """
+   if __store == None:
+      return None
+
+   return __store.get( digest )
+
+
+def put( digest, chunk ):
+   """
+   Add a chunk whose SHA-1 (hex) is known to be digest
+   """
+   if __store == None:
+      return 0
+
+   return __store.put( digest, chunk )
+
+
+def share_file( digest, path ):
+   """
+   Share a chunk file with the store (see chunk_store.share_file())
+   """
+   if __store == None:
+      return 0
+
+   return __store.share_file( digest, path )
+
+
+def link( digest, path ):
+   """
+   Link a stored chunk to path (see chunk_store.link())
+   """
+   if __store == None:
+      return E_UNAVAIL
+
+   return __store.link( digest, path )
+
+
+def links_dropped():
+   """
+   Tell the store that sender chunk directories (which link to its chunks) were removed
+   """
+   if __store != None:
+      __store.links_dropped()
+
+
+def ref( digests ):
+   """
+   Keep chunks from being evicted until unref()'ed
+   """
+   if __store != None:
+      __store.ref( digests )
+
+
+def unref( digests ):
+   """
+   Drop references taken with ref()
+   """
+   if __store != None:
+      __store.unref( digests )
+
+
+def stats():
+   """
+   Statistics on the chunk store (empty if there is none)
+   """
+   if __store == None:
+      return {}
+
+   return __store.stats()
@@ -20,6 +20,7 @@ import iftfile
 import iftlog
 import iftstats
 import iftutil
+import iftevent
 from iftdata import *
 import iftloader
 import iftcore
@@ -27,6 +28,7 @@ from iftcore.consts import *
 
 import threading
 import thread
+import math
 
 import protocols
 
@@ -47,6 +49,8 @@ class ReceiverData:
    start_time = None
    remote_iftd = False
    negotiated = False      # set to true once the content negotiation completes
+   cancelled = False       # set to true if the transfer is cancelled
+   changed = None          # iftevent.event fired when protocols are added, negotiation completes, or the transfer is cancelled
    
    def __init__(self, user_job, proto_insts, iftfile_ref, remote_iftd, connect_timeout, transfer_timeout, start_time):
       self.job = user_job
@@ -57,6 +61,8 @@ class ReceiverData:
       self.start_time = start_time
       self.remote_iftd = remote_iftd
       self.negotiated = False
+      self.cancelled = False
+      self.changed = iftevent.event()
    
    
    def update(self, user_job, proto_insts, remote_iftd ):
@@ -69,13 +75,208 @@ class ReceiverData:
       
       # we may have detected one....
       self.remote_iftd = remote_iftd
+      self.changed.fire()
    
    
    def finish_negotiation(self):
       self.negotiated = True
+      self.changed.fire()
+   
+   
+   def cancel(self):
+      self.cancelled = True
+      self.changed.fire()
       
 
 
+# how many seconds of work (at its measured rate) a striping sender takes from the queue at once
+STRIPE_BATCH_TIME = 0.25
+
+# weight of each batch in a striping sender's measured rate
+STRIPE_RATE_WEIGHT = 0.5
+
+
+class stripe_queue:
+
+   """
+   Chunks waiting to be sent by several active senders at once.
+   Each sender takes chunks in batches sized to its measured rate, so
+   faster senders take more of the file, and puts back any chunk it
+   could not send for another sender to try.
+   """
+   
+   def __init__(self, chunk_data, senders, max_failures):
+      self.__pending = deque( chunk_data )
+      self.__outstanding = 0           # chunks taken but not yet reported on
+      self.__failures = {}             # chunk ID --> number of failed attempts to send it
+      self.__max_failures = max_failures
+      self.__rates = {}                # sender --> measured chunks per second (None until measured)
+      for sender in senders:
+         self.__rates[ sender ] = None
+      
+      self.__failed = False
+      self.__cancelled = False
+      self.__num_chunks = len(chunk_data)
+      self.__sent = 0                  # chunks sent so far
+      self.__sent_bytes = 0            # bytes sent so far
+      self.__cond = threading.Condition()
+   
+   
+   def __batch_size( self, sender ):
+      """
+      How many chunks should the given sender take?  Call with the lock held.
+      """
+      rate = self.__rates.get( sender )
+      if rate == None:
+         return 1    # not measured yet
+      
+      batch = max( 1, int( rate * STRIPE_BATCH_TIME ) )
+      
+      # near the end, split what is left in proportion to the senders' rates
+      total_rate = 0.0
+      for r in self.__rates.values():
+         if r != None:
+            total_rate += r
+         else:
+            total_rate += rate
+      
+      share = int( math.ceil( len(self.__pending) * rate / total_rate ) )
+      return max( 1, min( batch, share ) )
+   
+   
+   def take( self, sender ):
+      """
+      Get the next batch of chunks for a sender to send.
+      Blocks while other senders have chunks that may yet come back.
+      Return an empty list once there is nothing left for this sender to do.
+      """
+      self.__cond.acquire()
+      try:
+         while len(self.__pending) == 0 and self.__outstanding > 0 and not self.__failed:
+            self.__cond.wait()
+         
+         if self.__failed or not self.__rates.has_key( sender ):
+            return []
+         
+         batch = []
+         for i in xrange(0, min( self.__batch_size( sender ), len(self.__pending) )):
+            batch.append( self.__pending.popleft() )
+         
+         self.__outstanding += len(batch)
+         return batch
+      finally:
+         self.__cond.release()
+   
+   
+   def __put_back( self, chunks ):
+      """
+      Put unsent chunks back at the front of the queue.  Call with the lock held.
+      """
+      for i in xrange( len(chunks) - 1, -1, -1 ):
+         self.__pending.appendleft( chunks[i] )
+   
+   
+   def done( self, sender, num_sent, failed, elapsed, num_bytes=0 ):
+      """
+      A sender sent num_sent chunks (num_bytes bytes) of its batch in elapsed seconds, and failed to send the chunks in failed.
+      """
+      self.__cond.acquire()
+      try:
+         self.__outstanding -= num_sent + len(failed)
+         self.__sent += num_sent
+         self.__sent_bytes += num_bytes
+         
+         if num_sent > 0 and elapsed > 0 and self.__rates.has_key( sender ):
+            rate = num_sent / elapsed
+            if self.__rates[ sender ] == None:
+               self.__rates[ sender ] = rate
+            else:
+               self.__rates[ sender ] += STRIPE_RATE_WEIGHT * (rate - self.__rates[ sender ])
+         
+         for chunk in failed:
+            chunk_id = chunk[1]
+            self.__failures[ chunk_id ] = self.__failures.get( chunk_id, 0 ) + 1
+            if self.__failures[ chunk_id ] > self.__max_failures:
+               iftlog.log(5, "stripe_queue: chunk " + str(chunk_id) + " failed " + str(self.__failures[ chunk_id ]) + " times; giving up")
+               self.__failed = True
+         
+         self.__put_back( failed )
+         self.__cond.notifyAll()
+      finally:
+         self.__cond.release()
+   
+   
+   def retire( self, sender, unsent ):
+      """
+      A sender will send no more.  Put back the chunks it took but did not send.
+      """
+      self.__cond.acquire()
+      try:
+         self.__outstanding -= len(unsent)
+         self.__put_back( unsent )
+         
+         if self.__rates.has_key( sender ):
+            del self.__rates[ sender ]
+         
+         if len(self.__rates) == 0 and not self.__cancelled and (len(self.__pending) > 0 or self.__outstanding > 0):
+            iftlog.log(5, "stripe_queue: no senders left, but " + str(len(self.__pending)) + " chunks are unsent")
+            self.__failed = True
+         
+         self.__cond.notifyAll()
+      finally:
+         self.__cond.release()
+   
+   
+   def cancel( self ):
+      """
+      Stop handing out chunks.  Senders finish the batches they have, then stop.
+      """
+      self.__cond.acquire()
+      try:
+         self.__cancelled = True
+         self.__failed = True
+         self.__cond.notifyAll()
+      finally:
+         self.__cond.release()
+   
+   
+   def cancelled( self ):
+      """
+      Was sending cancelled?
+      """
+      return self.__cancelled
+   
+   
+   def progress( self ):
+      """
+      How far along is sending?  Return (chunks sent, number of chunks, bytes sent, names of the senders still sending).
+      """
+      self.__cond.acquire()
+      try:
+         return (self.__sent, self.__num_chunks, self.__sent_bytes, [sender.name for sender in self.__rates.keys()])
+      finally:
+         self.__cond.release()
+   
+   
+   def succeeded( self ):
+      """
+      Was every chunk sent?
+      """
+      return not self.__failed and len(self.__pending) == 0 and self.__outstanding == 0
+
+
+
+def run_protocol( proto, niceness, release=None ):
+   """
+   Run a receiving protocol until its transfer ends.  If it ended cleanly
+   (i.e. it was told PROTO_MSG_END, and has cleaned up), hand it to release.
+   """
+   last_msg = proto.run( niceness )
+   if release != None and last_msg == PROTO_MSG_END:
+      release( proto )
+
+
+
 class SenderData:
    
    """
@@ -85,12 +286,34 @@ class SenderData:
    chunk_timeout = None
    connect_attrs = None
    job_attrs = None
+   merkle_tree = None
+   queue = None            # stripe_queue of the chunks, once active senders start
+   cancelled = False       # set to true if the transfer is cancelled
+   have_chunks = None      # [first ID, last ID] runs of chunks the receiver already has (i.e. from an earlier attempt)
    
-   def __init__(self, chunk_data, chunk_timeout, connect_attrs, job_attrs ):
+   def __init__(self, chunk_data, chunk_timeout, connect_attrs, job_attrs, merkle_tree=None ):
       self.chunk_data = chunk_data
       self.chunk_timeout = chunk_timeout
       self.connect_attrs = connect_attrs
       self.job_attrs = job_attrs
+      self.merkle_tree = merkle_tree
+      self.queue = None
+      self.cancelled = False
+      self.have_chunks = None
+   
+   
+   def unsent_chunk_data( self ):
+      """
+      Get the chunk data of the chunks the receiver does not have yet.
+      """
+      if not self.have_chunks:
+         return self.chunk_data
+      
+      have = set()
+      for (first, last) in self.have_chunks:
+         have.update( xrange(first, last + 1) )
+      
+      return [entry for entry in self.chunk_data if entry[1] not in have]
       
       
 
@@ -109,6 +332,7 @@ class TRANSFER_CORE:
    
    __sender_ack_buff = deque()   # thread-safe buffer of received xmit IDs from the receiver, from which the sender expect acknowledgement
    __sender_ack_rc = {}          # map receiver xmit_ids to the receiver RCs as they arrive.
+   __ack_received = iftevent.event()   # fired when a receiver's acknowledgement arrives
 
 
 
@@ -121,6 +345,8 @@ class TRANSFER_CORE:
          self.__sender_ack_buff.remove( xmit_id )
       except:
          pass
+      
+      self.__ack_received.fire()
          
    
    def sender_valid_xmit_id( self, xmit_id ):
@@ -159,6 +385,20 @@ class TRANSFER_CORE:
          return None
          
          
+   def get_merkle_tree( self, xmit_id ):
+      """
+      Look up the Merkle tree over the chunks being sent, if there is one
+      """
+      try:
+         sd = self.__active_senders.get( xmit_id )
+         if sd:
+            return sd.merkle_tree
+         
+         return None
+      except:
+         return None
+      
+      
    def await_receiver_ack( self, xmit_id, timeout ):
       """
       Wait for the receiver to acknowledge that all chunks have been transferred.
@@ -168,11 +408,16 @@ class TRANSFER_CORE:
       
       rc = 0
       # now wait until timeout seconds have passed until the receiver acknowledges us
-      while xmit_id in self.__sender_ack_buff and time.time() < timeout:
-         time.sleep(0.01)
-         continue
+      waiter = iftevent.waiter()
+      self.__ack_received.subscribe( waiter )
+      try:
+         while xmit_id in self.__sender_ack_buff and time.time() < timeout:
+            waiter.wait( timeout - time.time() )
+      finally:
+         self.__ack_received.unsubscribe( waiter )
+         waiter.close()
       
-      if time.time() > timeout:
+      if xmit_id in self.__sender_ack_buff:
          rc = E_TIMEOUT
 
       else:
@@ -198,13 +443,94 @@ class TRANSFER_CORE:
       except:
          pass
       
+      # if the receiver gave up, there is no point in sending it any more
+      sd = self.__active_senders.get( xmit_id )
+      if rc != TRANSMIT_STATE_SUCCESS and sd != None and sd.queue != None:
+         sd.queue.cancel()
+      
+      self.__ack_received.fire()
       return 
+   
+   
+   def cancel_send( self, xmit_id ):
+      """
+      Cancel sending xmit_id:  active senders stop after the chunks they have
+      taken, and nobody waits for the receiver's acknowledgement any more.
+      Return True if xmit_id was being sent.
+      """
+      sd = self.__active_senders.get( xmit_id )
+      if sd == None:
+         return False
+      
+      sd.cancelled = True
+      if sd.queue != None:
+         sd.queue.cancel()
+      
+      self.remove_receiver_ack( xmit_id )
+      return True
+   
+   
+   def set_receiver_chunks( self, xmit_id, have_chunks ):
+      """
+      Tell the sender of xmit_id which chunks the receiver already has, as a
+      list of [first ID, last ID] runs, so active senders only send the rest.
+      Return True if xmit_id is being sent.
+      """
+      sd = self.__active_senders.get( xmit_id )
+      if sd == None:
+         return False
+      
+      sd.have_chunks = have_chunks
+      return True
+   
+   
+   def cancel_recv( self, xmit_id ):
+      """
+      Cancel receiving xmit_id:  run_ift_recv stops its protocols and returns E_CANCELLED.
+      Return True if xmit_id was being received.
+      """
+      xmit = self.__active_transmissions.get( xmit_id )
+      if xmit == None:
+         return False
+      
+      xmit.cancel()
+      return True
+   
+   
+   def send_progress( self, xmit_id ):
+      """
+      How far along is sending xmit_id?
+      Return (chunks sent, number of chunks, bytes sent, names of the protocols sending), or None if it is not being sent.
+      """
+      sd = self.__active_senders.get( xmit_id )
+      if sd == None:
+         return None
+      
+      if sd.queue == None:
+         return (0, len(sd.chunk_data), 0, [])
+      
+      return sd.queue.progress()
+   
+   
+   def recv_progress( self, xmit_id ):
+      """
+      How far along is receiving xmit_id?
+      Return (chunks received, number of chunks, chunk size, names of the protocols receiving), or None if it is not being received.
+      """
+      xmit = self.__active_transmissions.get( xmit_id )
+      if xmit == None or xmit.file == None:
+         return None
+      
+      chunks_written, num_chunks, chunk_size = xmit.file.progress()
+      running = [proto.name for proto in xmit.protos if proto.get_transmit_state() not in (TRANSMIT_STATE_SUCCESS, TRANSMIT_STATE_FAILURE, TRANSMIT_STATE_DEAD)]
+      return (chunks_written, num_chunks, chunk_size, running)
       
 
-   def begin_ift_send( self, xmit_id, user_job, chunk_data, chunk_timeout, connect_attrs ):
+   def begin_ift_send( self, xmit_id, user_job, chunk_data, chunk_timeout, connect_attrs, merkle_tree=None ):
       """
       Begin to send data.  This method will buffer up the job, chunk data, chunk timeout, and xmit_id of
       a pending transfer, to which more data can be added later by the run_ift_send_* methods.
+      If given, merkle_tree is used to answer the receiver's requests for chunk proofs.
       """
       
       if self.__active_transmissions.get( xmit_id ) != None:
@@ -222,7 +548,7 @@ class TRANSFER_CORE:
          else:
             # begin to gather stats
             iftstats.begin_transfer( user_job, sender=True )
-            self.__active_senders[ xmit_id ] = SenderData( chunk_data, chunk_timeout, connect_attrs, user_job.attrs )
+            self.__active_senders[ xmit_id ] = SenderData( chunk_data, chunk_timeout, connect_attrs, user_job.attrs, merkle_tree )
             
          self.__active_sending_lock.release()
          
@@ -307,7 +633,7 @@ class TRANSFER_CORE:
       
    
    
-   def run_ift_send_active( self, xmit_id, user_job, connected_protos, timeout=0.0, has_best_proto = False):
+   def run_ift_send_active( self, xmit_id, user_job, connected_protos, timeout=0.0 ):
       """
       Begin to send data, provided that there is an iftd instance
       on both the sender and receiver.
@@ -315,6 +641,9 @@ class TRANSFER_CORE:
       This only runs active senders, which actually move the data.  Consequently, the
       receiver must acknowledge the sender.  This method will wait until timeout seconds
       have passed, or the acknowledgement has been received.
+      
+      All of the connected protocols send at once, each taking chunks in proportion
+      to how fast it sends them (see stripe_send).
          
       @arg user_job
          an iftjob instance
@@ -328,6 +657,8 @@ class TRANSFER_CORE:
       @arg timeout
          how long we should wait for receiver acknowledgement
       
+      @return
+         (TRANSMIT_STATE_SUCCESS or TRANSMIT_STATE_FAILURE, receiver's rc)
       """
       
       print "run_ift_send_active: connected: " + str(connected_protos) 
@@ -351,76 +682,116 @@ class TRANSFER_CORE:
       # get the chunks
       chunk_data = sender_data.chunk_data
       
-      curr_proto = 0    # start with the best protocol
-      cycles = 0        # how many times have we looped through the protocols? (only if we have a best protocol)
-      fails = 0         # how many failures have we had? (only used if we don't have a best protocol)
-      max_rc = 0
-      
-      # start sending.  start up protocols as needed.
-      # TODO: round-robin between protocols if there is no favorite
-      print len(chunk_data)
-      for (chunk, chunk_id, local_chunk_path, remote_chunk_path) in chunk_data:
-         #print "send (" + str(chunk_id) + ", " + str(chunk) + ") from " + str(local_chunk_path) + " to " + str(remote_chunk_path)
-         if len(connected_protos) == 0:
-            break
-            
-         try:
-            
-            # if there is no "best" proto, then just cycle through them all
-            if not has_best_proto:
-               curr_proto = (curr_proto + 1) % len(connected_protos)
-            
-            rc = connected_protos[curr_proto].send_one_chunk( chunk, chunk_id, local_chunk_path, remote_chunk_path )
-            
-            if rc < 0:
-               max_rc = abs(rc)
-               old_proto_name = connected_protos[curr_proto].name
-               
-               if has_best_proto:
-                  # only change protocols if we have a best protocol (otherwise we're already cycling through them)
-                  curr_proto = (curr_proto + 1) % len(connected_protos)
-               
-                  iftlog.log(5, "run_ift_send_active: sending chunk with " + old_proto_name + " failed with rc=" + str(rc) + ", switching to " + connected_protos[curr_proto].name )
-               
-                  if curr_proto == 0:
-                     cycles += 1
-                  
-                  if cycles >= max_attempts:
-                     # stop after three full rounds
-                     iftlog.log(5, "run_ift_send_active: attempted and failed with all available protocols " + str(max_attempts) + " times already; it must be impossible to send")
-                     max_rc = TRANSMIT_STATE_FAILURE
-                     for proto in connected_protos:
-                        proto.clean()
-                     
-                     break
-                  
-               else:
-                  # no best protocol, so we're failed if we have a negative RC occurrence more than 3x the number of chunks
-                  fails += 1
-                  if fails > max_attempts * len(chunk_data):
-                     iftlog.log(5, "run_ift_send_active: attempted and failed with all available protocols " + str(max_attempts) + " each; it must be impossible to send")
-                     max_rc = TRANSMIT_STATE_FAILURE
-                     for proto in connected_protos:
-                        proto.clean()
-                     
-                     break
-            
-         except Exception, inst:
-            iftlog.exception( "run_ift_send_active: could not send chunk with protocol " + str(curr_proto) + " of " + str(len(connected_protos)) + " (" + str([p.name for p in connected_protos]) + ")", inst)
-            connected_protos[curr_proto].clean()
-            print "removing..."
-            connected_protos.remove( connected_protos[curr_proto] )
-            continue
+      max_rc = self.stripe_send( connected_protos, sender_data.unsent_chunk_data(), max_attempts, sender_data )
       
       # all chunks sent!
       for proto in connected_protos:
          proto.clean()
       
-      # get receiver acknowledgement
-      receiver_rc = self.await_receiver_ack( xmit_id, timeout )
+      # chunk views are no longer needed
+      iftfile.release_chunk_views( chunk_data )
+      
+      # get receiver acknowledgement (unless we gave up)
+      receiver_rc = E_CANCELLED
+      if not sender_data.cancelled:
+         receiver_rc = self.await_receiver_ack( xmit_id, timeout )
       iftlog.log(1, "run_ift_send_active: ACK is " + str(max_rc))
       
       return (max_rc, receiver_rc)
+   
+   
+   
+   def stripe_send( self, connected_protos, chunk_data, max_attempts=3, sender_data=None ):
+      """
+      Send chunks with all of the given active protocols at once, one thread per protocol.
+      The protocols share a stripe_queue of the chunks, so each sends as much of the file as
+      its speed allows, and chunks that one protocol fails to send are sent by another.
+      A protocol that fails max_attempts times in a row (or raises an exception) stops sending.
+      
+      @arg connected_protos
+         list of connected active protocol instances
+      
+      @arg chunk_data
+         list of (chunk, chunk id, local chunk path, remote chunk path)
+      
+      @arg sender_data
+         the transfer's SenderData, if any, through which the sending can be watched and cancelled
+      
+      @return
+         TRANSMIT_STATE_SUCCESS if every chunk was sent; TRANSMIT_STATE_FAILURE if not
+      """
+      
+      queue = stripe_queue( chunk_data, connected_protos, max_attempts * len(connected_protos) )
+      if sender_data != None:
+         sender_data.queue = queue
+         if sender_data.cancelled:
+            queue.cancel()
+      
+      workers = []
+      for proto in connected_protos:
+         worker = threading.Thread( target=self.__stripe_worker, args=(proto, queue, max_attempts) )
+         worker.setDaemon( True )
+         worker.start()
+         workers.append( worker )
+      
+      for worker in workers:
+         worker.join()
+      
+      if queue.succeeded():
+         return TRANSMIT_STATE_SUCCESS
+      
+      if queue.cancelled():
+         iftlog.log(5, "stripe_send: cancelled")
+         return TRANSMIT_STATE_FAILURE
+      
+      iftlog.log(5, "stripe_send: attempted and failed with all available protocols (" + str([p.name for p in connected_protos]) + "); it must be impossible to send")
+      return TRANSMIT_STATE_FAILURE
+   
+   
+   
+   def __stripe_worker( self, proto, queue, max_attempts ):
+      """
+      Send chunks from the queue with one protocol until the queue is empty or the protocol gives out.
+      """
+      
+      fails = 0         # failures in a row
+      while True:
+         batch = queue.take( proto )
+         if len(batch) == 0:
+            break
+         
+         num_sent = 0
+         num_bytes = 0
+         failed = []
+         stime = time.time()
+         
+         try:
+            for (chunk, chunk_id, local_chunk_path, remote_chunk_path) in batch:
+               rc = proto.send_one_chunk( chunk, chunk_id, local_chunk_path, remote_chunk_path )
+               if rc < 0:
+                  iftlog.log(5, "stripe_send: sending chunk " + str(chunk_id) + " with " + proto.name + " failed with rc=" + str(rc) )
+                  failed.append( batch[num_sent + len(failed)] )
+                  fails += 1
+               else:
+                  num_sent += 1
+                  if chunk != None:
+                     num_bytes += len(chunk)
+                  fails = 0
+               
+         except Exception, inst:
+            iftlog.exception( "stripe_send: could not send chunk with protocol " + proto.name, inst )
+            queue.done( proto, num_sent, failed, time.time() - stime, num_bytes )
+            queue.retire( proto, batch[num_sent + len(failed):] )
+            return
+         
+         queue.done( proto, num_sent, failed, time.time() - stime, num_bytes )
+         
+         if fails >= max_attempts:
+            iftlog.log(5, "stripe_send: " + proto.name + " failed " + str(fails) + " times in a row; no longer sending with it")
+            queue.retire( proto, [] )
+            return
+      
+      queue.retire( proto, [] )
 
 
 
@@ -433,7 +804,7 @@ class TRANSFER_CORE:
          xmit.finish_negotiation()
 
 
-   def begin_ift_recv( self, xmit_id, user_job, proto_insts, remote_iftd, niceness=-1, connect_timeout=1.0, transfer_timeout=3600.0, threaded=True ):
+   def begin_ift_recv( self, xmit_id, user_job, proto_insts, remote_iftd, niceness=-1, connect_timeout=1.0, transfer_timeout=3600.0, threaded=True, release=None ):
       """
       Start running some protocols and store the data assocated with the active transmission.
       
@@ -457,6 +828,9 @@ class TRANSFER_CORE:
 
       @arg transfer_timeout
          Maximum amount of time this transfer is allowed to take
+
+      @arg release
+         If given, called with each protocol instance whose run ends with the transfer (so it can be used again)
       """
        
       if not transfer_timeout:
@@ -485,12 +859,20 @@ class TRANSFER_CORE:
       #   return rc
 
       start_time = time.time()
+      
+      # a protocol may start a transfer of its own (e.g. iftcache on a miss).  It holds a
+      # protocol worker until that transfer ends, so that transfer's protocols can't wait for one.
+      pool = iftutil.ProtocolThreadPool
+      if pool.is_worker():
+         pool = iftutil.NestedThreadPool
        
       for proto in proto_insts:
-         # start threads to receive concurrently
+         # run the protocols concurrently, each on a protocol pool worker
          proto.post_msg( PROTO_MSG_USER, PROTO_STATE_RUNNING )       # switch to running state
          #proto.run(niceness)
-         thread.start_new_thread( proto.run, (niceness,) )
+         if not pool.start_new_thread( run_protocol, (proto, niceness, release), True, iftutil.POOL_SUBMIT_TIMEOUT ):
+            iftlog.log(5, "begin_ift_recv: no protocol worker free to run " + proto.name)
+            return E_NO_CONNECT
       
       
       rc = 0
@@ -532,7 +914,7 @@ class TRANSFER_CORE:
          Identifier for this transmission
          
       @arg sender_xmlrpc
-         xmlrpclib.Server instance that can talk to the sender
+         iftutil.control_client (or xmlrpclib.Server) instance that can talk to the sender
          
       @return
          0 on success, negative on error
@@ -557,6 +939,10 @@ class TRANSFER_CORE:
       
       last_bw_check = time.time()
       
+      # instead of polling, wait for a chunk to arrive, a protocol to change state, or the transmission to change
+      waiter = iftevent.waiter()
+      watched = []
+      
       while time.time() - start_time < transfer_timeout and transfer_rc == 0:
          active_count = 0
          data_xmit = 0
@@ -571,6 +957,7 @@ class TRANSFER_CORE:
                pass
             
             iftlog.log(5, "run_ift_recv: ERROR: no active transmission matching " + str(xmit_id))
+            self.__unwatch( waiter, watched )
             return TRANSMIT_STATE_FAILURE    # we're done
          
          transfer_rc = 0
@@ -581,6 +968,17 @@ class TRANSFER_CORE:
          connect_timeout = active_xmit.connect_timeout
          iftfile_ref = active_xmit.file
          negotiated = active_xmit.negotiated
+         
+         if active_xmit.cancelled:
+            transfer_rc = E_CANCELLED
+            iftlog.log(5, "run_ift_recv: transmission " + str(xmit_id) + " was cancelled")
+            break
+         
+         # protocols may have been added since we last looked
+         for event in [active_xmit.changed, iftfile_ref.chunks_changed] + [proto.state_changed for proto in proto_insts]:
+            if event not in watched:
+               event.subscribe( waiter )
+               watched.append( event )
 
          for proto in proto_insts:
             
@@ -652,10 +1050,16 @@ class TRANSFER_CORE:
             break
          
             
-         # yield
-         time.sleep(0.000001)
+         # wait for something to happen, but look at the bandwidth and the timeout now and then
+         wait_time = transfer_timeout - (time.time() - start_time)
+         if connect_timeout:
+            wait_time = min( wait_time, connect_timeout )
+         
+         waiter.wait( wait_time )
+      
+      self.__unwatch( waiter, watched )
 
-      if time.time() - start_time >= transfer_timeout:
+      if transfer_rc != E_CANCELLED and time.time() - start_time >= transfer_timeout:
          # transfer took too long
          iftlog.log(5, "run_ift_recv: ERROR: transfer has taken longer than " + str(transfer_timeout) + " seconds." )
          transfer_rc = TRANSMIT_STATE_FAILURE
@@ -666,7 +1070,12 @@ class TRANSFER_CORE:
       for proto in active_xmit.protos:
          proto.post_msg( PROTO_MSG_END, None )
 
-      if not iftfile_ref.is_complete() and iftfile_ref.known_size:
+      if transfer_rc == E_CANCELLED:
+         # whatever we have is abandoned
+         iftfile_ref.discard_journal()
+         iftfile_ref.remove_partial()
+      
+      elif not iftfile_ref.is_complete() and iftfile_ref.known_size:
          transfer_rc = TRANSMIT_STATE_FAILURE
          iftlog.log(5, "run_ift_recv: did not completely download " + str(iftfile_ref.path))
          iftlog.log(1, "run_ift_recv: still missing " + str(iftfile_ref.get_unwritten_chunks()))
@@ -682,6 +1091,9 @@ class TRANSFER_CORE:
             else:
                iftlog.log(5, "run_ift_recv: expected file hash " + str(my_hash) + ", but got " + str(file_hash))
                transfer_rc = TRANSMIT_STATE_FAILURE
+               
+               # what we got is no good, so don't pick it up again
+               iftfile_ref.discard_journal()
 
       
       
@@ -707,6 +1119,16 @@ class TRANSFER_CORE:
       return transfer_rc   
 
 
+   def __unwatch( self, waiter, events ):
+      """
+      Stop waking the given waiter on the given events, and release it.
+      """
+      for event in events:
+         event.unsubscribe( waiter )
+      
+      waiter.close()
+   
+   
    def cleanup_recv( self, xmit_id ):
       """
       Erase data for a receiver transmission
@@ -19,8 +19,13 @@ import protocols
 from collections import deque
 import threading
 
-import StringIO
+import cStringIO
 import cPickle
+import httplib
+import socket
+import errno
+import time
+import urlparse
 
 import traceback
 
@@ -65,89 +70,258 @@ class SafeUnpickler(object):
  
     @classmethod
     def loads(cls, pickle_string):
-        pickle_obj = cPickle.Unpickler(StringIO.StringIO(pickle_string))
+        pickle_obj = cPickle.Unpickler(cStringIO.StringIO(pickle_string))
         pickle_obj.find_global = cls.find_class
         return pickle_obj.load()
 
 
 
-class iftthreading:
+class iftworkers:
    """
-   Implementation of a thread control mechanism in which IFTD can
-   limit the total number of threads that are running.  
-   
-   This implementation prevents a malicious user from placing 
-   arbitrarily many transfer requests, crashing IFTD or the system or both.
+   A pool of reusable worker threads, fed from a bounded queue of tasks.
+
+   At most num_workers tasks run at once; the rest wait in the queue,
+   in order.  Workers are started as they are needed and then kept.
+   When the queue is full, whoever submits a task waits for room
+   (back-pressure), so a flood of transfer requests slows its senders
+   down instead of crashing IFTD or the system or both.
    """
 
-   __threads = None
-   __alive = None
-   __num_threads = 0
-   __threads_lock = threading.BoundedSemaphore(1)
-   
-   def __purge_dead(self):
+   def __init__(self, name, num_workers, max_queued=None):
+      if max_queued == None:
+         max_queued = num_workers * POOL_QUEUE_FACTOR
+
+      self.name = name
+      self.num_workers = max( num_workers, 1 )
+      self.max_queued = max( max_queued, 1 )
+
+      self.__tasks = deque()
+      self.__local = threading.local()    # marks this pool's worker threads
+      self.__lock = threading.Lock()
+      self.__not_empty = threading.Condition( self.__lock )
+      self.__not_full = threading.Condition( self.__lock )
+      self.__running = True
+      self.__saturated = False   # has the queue filled up since it was last empty?
+
+      self.__workers = 0         # worker threads started
+      self.__busy = 0            # workers running a task
+      self.__submitted = 0       # tasks queued
+      self.__completed = 0       # tasks run to completion (or exception)
+      self.__failed = 0          # tasks that raised an exception
+      self.__rejected = 0        # tasks turned away (full queue, or shut down)
+      self.__blocked = 0         # submissions that had to wait for room in the queue
+      self.__peak_queued = 0
+      self.__total_wait = 0.0    # time tasks spent queued
+      self.__max_wait = 0.0
+
+
+   def __work(self):
       """
-      Remove all non-running threads from the threadpool
+      Worker thread:  run queued tasks until the pool is shut down.
       """
-      
-      self.__alive.clear()
-      for t in self.__threads:
-         if t.isAlive():
-            self.__alive.append( t )
-         
-      
-      self.__threads = copy.copy(self.__alive)
-            
-      
-   def __init__(self, num_threads):
-      self.__threads = deque( [] )
-      self.__alive = deque( [] )
-      self.__num_threads = num_threads
-   
-   
-   def start_new_thread(self, func, arguments, block=False):
+      self.__local.is_worker = True
+      self.__lock.acquire()
+      while True:
+         while self.__running and len(self.__tasks) == 0:
+            self.__not_empty.wait()
+
+         if not self.__running:
+            self.__workers -= 1
+            self.__lock.release()
+            return
+
+         func, arguments, queued_at = self.__tasks.popleft()
+         wait = time.time() - queued_at
+         self.__total_wait += wait
+         self.__max_wait = max( self.__max_wait, wait )
+         self.__busy += 1
+         if len(self.__tasks) == 0:
+            self.__saturated = False
+         self.__not_full.notify()
+         self.__lock.release()
+
+         failed = False
+         try:
+            func( *arguments )
+         except Exception, inst:
+            iftlog.exception( "iftworkers: " + self.name + " task " + str(func) + " failed", inst )
+            failed = True
+
+         self.__lock.acquire()
+         self.__busy -= 1
+         self.__completed += 1
+         if failed:
+            self.__failed += 1
+
+
+   def start_new_thread(self, func, arguments, block=True, timeout=None):
       """
-      Start a new thread to call the given function with
-      the given arguments.
+      Queue a call to the given function with the given arguments,
+      to be run by the next free worker.
+
+      If the queue is full and block is True, wait up to timeout
+      seconds (forever if None) for room.  Return True if the task
+      was queued, or False if it was not.
       """
+      self.__lock.acquire()
       try:
-         good = True
-         self.__threads_lock.acquire()
-         self.__purge_dead()
-         if len(self.__threads) >= self.__num_threads:
-            good = False
-         self.__threads_lock.release()
-         
-         if not good:
-            return good
-            
-         t = threading.Thread( target=func, args=arguments )
-         self.__threads.append(t)
-         t.start()
-         
+         if self.__running and len(self.__tasks) >= self.max_queued:
+            if not block:
+               self.__rejected += 1
+               return False
+
+            self.__blocked += 1
+            if not self.__saturated:
+               self.__saturated = True
+               iftlog.log(3, "iftworkers: " + self.name + " pool is saturated (" + str(len(self.__tasks)) + " tasks queued)")
+            deadline = None
+            if timeout != None:
+               deadline = time.time() + timeout
+
+            while self.__running and len(self.__tasks) >= self.max_queued:
+               if deadline == None:
+                  self.__not_full.wait()
+               else:
+                  remaining = deadline - time.time()
+                  if remaining <= 0:
+                     self.__rejected += 1
+                     return False
+                  self.__not_full.wait( remaining )
+
+         if not self.__running:
+            self.__rejected += 1
+            return False
+
+         self.__tasks.append( (func, arguments, time.time()) )
+         self.__submitted += 1
+         self.__peak_queued = max( self.__peak_queued, len(self.__tasks) )
+
+         # start another worker if the idle ones can't take everything queued
+         if self.__workers - self.__busy < len(self.__tasks) and self.__workers < self.num_workers:
+            t = threading.Thread( target=self.__work, name="iftworkers-" + self.name + "-" + str(self.__workers) )
+            t.setDaemon( True )
+            t.start()
+            self.__workers += 1
+
+         self.__not_empty.notify()
          return True
-      except:
-         print "fatal exception"
-         traceback.print_exc()
-         return False      # no space left on queue
-      
+      finally:
+         self.__lock.release()
+
+
+   def is_worker(self):
+      """
+      Is the calling thread one of this pool's workers?
+      """
+      return getattr( self.__local, "is_worker", False )
+
+
+   def stats(self):
+      """
+      Get a dictionary describing how busy this pool is.
+      """
+      self.__lock.acquire()
+      started = self.__completed + self.__busy
+      mean_wait = 0.0
+      if started > 0:
+         mean_wait = self.__total_wait / started
+
+      ret = {
+         "name": self.name,
+         "max_workers": self.num_workers,
+         "workers": self.__workers,
+         "busy": self.__busy,
+         "idle": self.__workers - self.__busy,
+         "queued": len(self.__tasks),
+         "max_queued": self.max_queued,
+         "peak_queued": self.__peak_queued,
+         "submitted": self.__submitted,
+         "completed": self.__completed,
+         "failed": self.__failed,
+         "rejected": self.__rejected,
+         "blocked": self.__blocked,
+         "mean_wait": mean_wait,
+         "max_wait": self.__max_wait,
+         "saturation": float(self.__busy) / self.num_workers
+      }
+      self.__lock.release()
+      return ret
+
+
+   def shutdown(self):
+      """
+      Stop the workers once their current tasks finish, dropping anything still queued.
+      """
+      self.__lock.acquire()
+      self.__running = False
+      self.__rejected += len(self.__tasks)
+      self.__tasks.clear()
+      self.__not_empty.notifyAll()
+      self.__not_full.notifyAll()
+      self.__lock.release()
       
 
-SenderThreadPool = None
-ReceiverThreadPool = None
 
 MAX_SENDER_THREADS = 10
 MAX_RECEIVER_THREADS = 10
-
-def init_threadpools( num_sending_threads, num_receiving_threads ):
+MAX_PROTOCOL_THREADS = 40     # receiving protocols run one per worker for the whole transfer
+MAX_VERIFY_THREADS = 4        # workers hashing received chunks, shared by every receiver
+MAX_WRITE_THREADS = 2         # workers writing verified chunks to disk, shared by every receiver
+MAX_SUBMIT_THREADS = 16       # transfers given to submit_ift (or resumed) that run at once; the rest wait their turn
+MAX_NESTED_THREADS = 8        # receiving protocols of transfers that other protocols start (e.g. iftcache on a miss)
+POOL_QUEUE_FACTOR = 4         # a pool queues up to this many tasks per worker before making submitters wait
+POOL_SUBMIT_TIMEOUT = 60.0    # longest a transfer waits for room in a full pool before giving up
+
+SenderThreadPool = iftworkers( "sender", MAX_SENDER_THREADS )
+ReceiverThreadPool = iftworkers( "receiver", MAX_RECEIVER_THREADS )
+ProtocolThreadPool = iftworkers( "protocol", MAX_PROTOCOL_THREADS )
+VerifyThreadPool = iftworkers( "verify", MAX_VERIFY_THREADS )
+WriteThreadPool = iftworkers( "write", MAX_WRITE_THREADS )
+SubmitThreadPool = iftworkers( "submit", MAX_SUBMIT_THREADS )
+NestedThreadPool = iftworkers( "nested", MAX_NESTED_THREADS )
+
+def init_threadpools( num_sending_threads, num_receiving_threads, num_protocol_threads=None, num_verify_threads=None, num_write_threads=None, num_submit_threads=None, num_nested_threads=None ):
    """
-   Initialize the global thread pools for senders and receivers
+   Initialize the global thread pools for senders, receivers, receiving protocols,
+   the verify and write stages of receiving, submitted transfers, and the
+   receiving protocols of transfers started by other protocols
    """
    global SenderThreadPool
    global ReceiverThreadPool
+   global ProtocolThreadPool
+   global VerifyThreadPool
+   global WriteThreadPool
+   global SubmitThreadPool
+   global NestedThreadPool
+   
+   if num_protocol_threads == None:
+      num_protocol_threads = MAX_PROTOCOL_THREADS
+   if num_verify_threads == None:
+      num_verify_threads = MAX_VERIFY_THREADS
+   if num_write_threads == None:
+      num_write_threads = MAX_WRITE_THREADS
+   if num_submit_threads == None:
+      num_submit_threads = MAX_SUBMIT_THREADS
+   if num_nested_threads == None:
+      num_nested_threads = MAX_NESTED_THREADS
+   
+   for pool in [SenderThreadPool, ReceiverThreadPool, ProtocolThreadPool, VerifyThreadPool, WriteThreadPool, SubmitThreadPool, NestedThreadPool]:
+      pool.shutdown()
    
-   SenderThreadPool = iftthreading( num_sending_threads )
-   ReceiverThreadPool = iftthreading( num_receiving_threads )
+   SenderThreadPool = iftworkers( "sender", num_sending_threads )
+   ReceiverThreadPool = iftworkers( "receiver", num_receiving_threads )
+   ProtocolThreadPool = iftworkers( "protocol", num_protocol_threads )
+   VerifyThreadPool = iftworkers( "verify", num_verify_threads )
+   WriteThreadPool = iftworkers( "write", num_write_threads )
+   SubmitThreadPool = iftworkers( "submit", num_submit_threads )
+   NestedThreadPool = iftworkers( "nested", num_nested_threads )
+
+
+def threadpool_stats():
+   """
+   Get the stats of each global thread pool
+   """
+   return [SenderThreadPool.stats(), ReceiverThreadPool.stats(), ProtocolThreadPool.stats(), VerifyThreadPool.stats(), WriteThreadPool.stats(), SubmitThreadPool.stats(), NestedThreadPool.stats()]
 
 
 
@@ -314,6 +488,293 @@ def create_server( portnum, funcs, request_handler = local_request_handler ):
 
 
 
+"""
+Inter-iftd control channel.
+
+Negotiating a transfer takes several calls between the sending and receiving
+iftds.  Rather than open a new HTTP/1.0 connection for each one (as
+xmlrpclib does), control clients keep persistent HTTP/1.1 connections to
+each peer, and encode calls with cPickle instead of XML when the peer
+understands it (falling back to XML-RPC when it does not).
+"""
+
+CONTROL_BINARY_TYPE = "application/x-iftd-pickle"     # Content-Type of pickled calls and results
+CONTROL_BINARY = True           # if False, control clients only speak XML-RPC
+CONTROL_SERVER_IDLE = 60.0      # seconds the server keeps an idle control connection open
+CONTROL_POOL_IDLE = 30.0        # seconds a client keeps an idle control connection (less than the server, so the client gives up first)
+CONTROL_POOL_MAX = 8            # most idle control connections kept per peer
+
+
+class remote_request_handler( SimpleXMLRPCServer.SimpleXMLRPCRequestHandler ):
+   """
+   Request handler for the inter-iftd API.  Connections are kept open
+   between calls (HTTP/1.1), and calls may be pickled instead of XML.
+   """
+
+   protocol_version = "HTTP/1.1"
+   timeout = CONTROL_SERVER_IDLE
+   wbufsize = -1              # send each response in one go (it is flushed once written)
+   disable_nagle_algorithm = True
+
+   def __dispatch_binary( self, data ):
+      """
+      Run a pickled call, and pickle its result (or fault).
+      """
+      try:
+         params, method = SafeUnpickler.loads( data )
+         result = ("ok", self.server._dispatch( method, params ))
+      except Fault, fault:
+         iftlog.log(5, "remote_request_handler: fault " + str(fault))
+         result = ("fault", fault.faultCode, fault.faultString)
+      except Exception, inst:
+         iftlog.exception( "remote_request_handler: exception encountered", inst )
+         result = ("fault", 1, "%s:%s" % (sys.exc_type, sys.exc_value))
+
+      return cPickle.dumps( result, cPickle.HIGHEST_PROTOCOL )
+
+
+   def do_POST( self ):
+      if not self.is_rpc_path_valid():
+         self.report_404()
+         return
+
+      try:
+         length = int( self.headers.get( "content-length", 0 ) )
+         data = self.rfile.read( length )
+
+         if self.headers.get( "content-type" ) == CONTROL_BINARY_TYPE:
+            response = self.__dispatch_binary( data )
+            content_type = CONTROL_BINARY_TYPE
+         else:
+            response = self.server._marshaled_dispatch( data, getattr(self, '_dispatch', None) )
+            content_type = "text/xml"
+      except Exception, inst:
+         iftlog.exception( "remote_request_handler: exception encountered", inst )
+         self.send_response(500)
+         self.send_header("Content-length", "0")
+         self.end_headers()
+         self.close_connection = 1
+         return
+
+      self.send_response(200)
+      self.send_header("Content-type", content_type)
+      self.send_header("Content-length", str(len(response)))
+      self.end_headers()
+      self.wfile.write(response)
+      self.wfile.flush()
+
+
+class control_pool:
+   """
+   Idle control connections, by peer, and which peers only speak XML-RPC.
+   """
+
+   def __init__( self, lifetime ):
+      self.lifetime = lifetime
+      self.xml_only = set([])
+      self.__idle = {}        # (host, port): [(httplib.HTTPConnection, time it went idle)]
+      self.__lock = threading.Lock()
+
+
+   def take( self, peer ):
+      """
+      Get an idle connection to a peer, or None if there isn't one.
+      """
+      now = time.time()
+      self.__lock.acquire()
+      try:
+         idle = self.__idle.get( peer, [] )
+         while len(idle) > 0:
+            conn, idle_since = idle.pop()
+            if now - idle_since < self.lifetime:
+               return conn
+
+            conn.close()
+
+         return None
+      finally:
+         self.__lock.release()
+
+
+   def give( self, peer, conn ):
+      """
+      Keep a connection to a peer for its next call.
+      """
+      self.__lock.acquire()
+      try:
+         idle = self.__idle.setdefault( peer, [] )
+         if len(idle) < CONTROL_POOL_MAX:
+            idle.append( (conn, time.time()) )
+            return
+      finally:
+         self.__lock.release()
+
+      conn.close()
+
+
+   def close_all( self ):
+      """
+      Close every idle connection.
+      """
+      self.__lock.acquire()
+      try:
+         for idle in self.__idle.values():
+            for (conn, idle_since) in idle:
+               conn.close()
+
+         self.__idle = {}
+      finally:
+         self.__lock.release()
+
+
+CONTROL_POOL = control_pool( CONTROL_POOL_IDLE )
+
+
+class control_method:
+   # a method of a control_client
+   def __init__( self, client, name ):
+      self.__client = client
+      self.__name = name
+
+   def __call__( self, *args ):
+      return self.__client.call( self.__name, args )
+
+
+class control_connection( httplib.HTTPConnection ):
+   """
+   HTTP connection to another iftd that connects with a timeout
+   (httplib can't be given one before Python 2.6).
+   """
+
+   def __init__( self, host, port, timeout ):
+      httplib.HTTPConnection.__init__( self, host, port )
+      self.connect_timeout = timeout
+
+
+   def connect( self ):
+      msg = "getaddrinfo returns an empty list"
+      for (family, socktype, proto, canonname, addr) in socket.getaddrinfo( self.host, self.port, 0, socket.SOCK_STREAM ):
+         soc = None
+         try:
+            soc = socket.socket( family, socktype, proto )
+            soc.settimeout( self.connect_timeout )
+            soc.connect( addr )
+            self.sock = soc
+            return
+         except socket.error, msg:
+            if soc != None:
+               soc.close()
+
+      raise socket.error, msg
+
+
+class control_client:
+   """
+   Client for another iftd's inter-iftd API, used like an xmlrpclib.Server.
+   Calls share the pooled connections to the peer.
+   """
+
+   def __init__( self, host, port, xmlrpc_dir="RPC2", timeout=20, binary=None ):
+      self.peer = (host, int(port))
+      self.path = "/" + xmlrpc_dir.lstrip("/")
+      self.timeout = timeout
+      self.binary = binary
+      if binary == None:
+         self.binary = CONTROL_BINARY
+
+
+   def __getattr__( self, name ):
+      if name.startswith("_"):
+         raise AttributeError( name )
+
+      return control_method( self, name )
+
+
+   def __encode( self, method, params, binary ):
+      if binary:
+         return (cPickle.dumps( (params, method), cPickle.HIGHEST_PROTOCOL ), CONTROL_BINARY_TYPE)
+
+      return (xmlrpclib.dumps( params, method, allow_none=True ), "text/xml")
+
+
+   def __post( self, body, content_type ):
+      """
+      POST a call on a kept connection if there is one (or a new one if not).
+      Return (content type, body) of the response.
+      """
+      while True:
+         conn = CONTROL_POOL.take( self.peer )
+         reused = (conn != None)
+         if not reused:
+            conn = control_connection( self.peer[0], self.peer[1], self.timeout )
+
+         try:
+            if conn.sock != None:
+               conn.sock.settimeout( self.timeout )
+
+            conn.request( "POST", self.path, body, {"Content-Type": content_type} )
+            try:
+               resp = conn.getresponse( buffering=True )      # (unbuffered, the headers are read a byte at a time)
+            except TypeError:
+               resp = conn.getresponse()                      # (httplib can't be asked to buffer before Python 2.7)
+            data = resp.read()
+         except (socket.error, httplib.HTTPException), inst:
+            conn.close()
+            if reused and (isinstance( inst, httplib.BadStatusLine ) or getattr( inst, "errno", None ) in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)):
+               # the peer closed the kept connection while it was idle; the call didn't get there
+               continue
+
+            raise
+
+         if resp.will_close:
+            conn.close()
+         else:
+            CONTROL_POOL.give( self.peer, conn )
+
+         if resp.status != 200:
+            raise xmlrpclib.ProtocolError( "%s:%s%s" % (self.peer[0], self.peer[1], self.path), resp.status, resp.reason, resp.msg )
+
+         return (resp.getheader( "content-type" ), data)
+
+
+   def call( self, method, params ):
+      """
+      Call a method on the peer, and return its result (raising xmlrpclib.Fault on a fault).
+      """
+      binary = self.binary and self.peer not in CONTROL_POOL.xml_only
+      body, content_type = self.__encode( method, params, binary )
+      response_type, data = self.__post( body, content_type )
+
+      if response_type == CONTROL_BINARY_TYPE:
+         result = SafeUnpickler.loads( data )
+         if result[0] == "fault":
+            raise Fault( result[1], result[2] )
+
+         return result[1]
+
+      if binary:
+         # the peer only speaks XML-RPC (it couldn't parse our call, so it didn't run it)
+         iftlog.log(3, "control_client: " + str(self.peer) + " does not take pickled calls, using XML-RPC")
+         CONTROL_POOL.xml_only.add( self.peer )
+         body, content_type = self.__encode( method, params, False )
+         response_type, data = self.__post( body, content_type )
+
+      return xmlrpclib.loads( data )[0][0]
+
+
+def make_control_client( url, timeout=20 ):
+   """
+   Create a control_client for the inter-iftd API at the given http:// URL.
+   """
+   parts = urlparse.urlsplit( url )
+   port = parts.port
+   if port == None:
+      port = 80
+
+   return control_client( parts.hostname, port, parts.path, timeout )
+
+
+
 
 """
 # HTTP proxy server
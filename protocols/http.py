@@ -22,10 +22,13 @@ import re
 import cgi
 import httplib
 import thread
+import threading
+import math
 import iftlog
 import time
 import copy
 import iftfile
+import iftutil
 import iftcore
 import iftcore.iftsender
 import iftcore.iftreceiver
@@ -37,60 +40,536 @@ from cStringIO import StringIO
 
 from Queue import Queue
 import cPickle
-from BaseHTTPServer import HTTPServer
-from SimpleHTTPServer import SimpleHTTPRequestHandler
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 
 import socket
+import select
+import errno
+import heapq
 
 USE_PARTIAL_GETS = "USE_PARTIAL_GETS"
 HTTP_SERVER_VERSION = "HTTP_SERVER_VERSION"
+HTTP_CONNECTIONS = "HTTP_CONNECTIONS"           # (connection attribute) how many persistent connections the receiver keeps to the server
+HTTP_PIPELINE_DEPTH = "HTTP_PIPELINE_DEPTH"     # (connection attribute) how many range requests can be outstanding on each connection
 
-class ift_http_server( HTTPServer ):
+HTTP_DEFAULT_CONNECTIONS = 4
+HTTP_DEFAULT_PIPELINE_DEPTH = 4
+HTTP_SOCKET_TIMEOUT = 10.0       # seconds to wait on the server before giving up on a connection
+
+HTTP_WHOLE_FILE = 1              # http_connection.fetch() got the whole file instead of a range
+
+HTTP_PUBLISH_LIFETIME = 600.0    # seconds a published file stays available without being requested
+HTTP_KEEPALIVE_TIMEOUT = 60.0    # seconds the server keeps an idle connection open
+HTTP_SENDFILE_MAX = 1 << 30      # most bytes to hand to one sendfile() call
+HTTP_MAX_RANGES = 64             # most ranges (once overlapping ones are merged) to serve in one response; more gets the whole file
+
+
+class http_connection:
+   """
+   A persistent HTTP/1.1 connection to a server, over which range requests are
+   pipelined:  up to a window of requests are sent before their responses are read.
+   If the server closes the connection, unanswered requests are sent again on a new one.
+   """
+   
+   def __init__( self, host, port ):
+      self.host = host
+      self.port = port
+      self.soc = None
+      self.rfile = None
+   
+   
+   def connect( self ):
+      """
+      Connect to the server.  Return 0 on success, negative on error.
+      """
+      self.close()
+      try:
+         self.soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+         self.soc.settimeout( HTTP_SOCKET_TIMEOUT )
+         self.soc.connect( (self.host, self.port) )
+         self.soc.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+         self.rfile = self.soc.makefile( "rb", 65536 )
+         return 0
+      except Exception, inst:
+         iftlog.exception( "http_connection: could not connect to " + str(self.host) + ":" + str(self.port), inst )
+         self.close()
+         return E_NO_CONNECT
+   
+   
+   def close( self ):
+      """
+      Close the connection (if open).
+      """
+      if self.rfile != None:
+         try:
+            self.rfile.close()
+         except:
+            pass
+         
+      if self.soc != None:
+         try:
+            self.soc.close()
+         except:
+            pass
+      
+      self.rfile = None
+      self.soc = None
+   
+   
+   def __read_headers( self ):
+      """
+      Read a response's status line and headers.
+      Return (HTTP version, status, {lowercase header name: value})
+      """
+      line = self.rfile.readline()
+      if len(line) == 0:
+         raise socket.error( "connection closed" )
+      
+      parts = line.split( None, 2 )
+      version = parts[0]
+      status = int( parts[1] )
+      
+      headers = {}
+      while True:
+         line = self.rfile.readline()
+         if len(line) == 0:
+            raise socket.error( "connection closed" )
+         
+         line = line.strip()
+         if len(line) == 0:
+            break
+         
+         name, value = line.split( ":", 1 )
+         headers[ name.strip().lower() ] = value.strip()
+      
+      return (version, status, headers)
+   
+   
+   def __read_response( self, byte_range, chunksize, add_chunk, save_file ):
+      """
+      Read the response to a request for the given (first byte, last byte).
+      Each chunk in the body goes to add_chunk( chunk_id, chunk ) as soon as it is read.
+      If the server sends the whole file instead, it goes to save_file( file object, length ).
+      Return (rc, whether the connection can be used again)
+      """
+      version, status, headers = self.__read_headers()
+      
+      keep_alive = (version == "HTTP/1.1" and headers.get( "connection", "" ).lower() != "close")
+      length = headers.get( "content-length" )
+      if length != None:
+         length = int(length)
+      
+      if status == 206:
+         content_range = headers.get( "content-range", "" )
+         first_byte = int( content_range[ content_range.find("bytes ") + 6 : content_range.find("-") ] )
+         if first_byte != byte_range[0] or length == None:
+            iftlog.log(5, "http_connection: asked for bytes " + str(byte_range) + ", but got " + content_range)
+            return (E_CORRUPT, False)
+         
+         # hand over the chunks as they arrive
+         offset = first_byte
+         while length > 0:
+            chunk = self.rfile.read( min( chunksize, length ) )
+            if len(chunk) == 0:
+               raise socket.error( "connection closed" )
+            
+            add_chunk( offset / chunksize, chunk )
+            offset += len(chunk)
+            length -= len(chunk)
+         
+         return (0, keep_alive)
+      
+      elif status == 200:
+         # the server ignored the range, and is sending everything
+         rc = save_file( self.rfile, length )
+         if rc == 0:
+            rc = HTTP_WHOLE_FILE
+         
+         return (rc, False)
+      
+      else:
+         iftlog.log(3, "http_connection: asked for bytes " + str(byte_range) + ", but got status " + str(status))
+         return (E_NO_CONNECT, False)
+   
+   
+   def fetch( self, path, byte_ranges, window, chunksize, add_chunk, save_file ):
+      """
+      Get the given list of (first byte, last byte) ranges of the file at path, keeping up to
+      window requests outstanding.  First bytes must be on chunk boundaries.
+      Return 0 on success, HTTP_WHOLE_FILE if the server sent the whole file instead, or negative on error.
+      """
+      todo = deque( byte_ranges )      # not yet asked for
+      asked = deque()                  # asked for on this connection, and not yet answered
+      fresh = False                    # did we connect without getting a response since?
+      
+      while len(todo) > 0 or len(asked) > 0:
+         if self.soc == None:
+            if fresh:
+               # the server hung up on us without answering
+               return E_NO_CONNECT
+            
+            rc = self.connect()
+            if rc != 0:
+               return rc
+            
+            # whatever was asked on the old connection must be asked again
+            while len(asked) > 0:
+               todo.appendleft( asked.pop() )
+            
+            fresh = True
+         
+         try:
+            # keep the window full
+            requests = []
+            while len(todo) > 0 and len(asked) < window:
+               byte_range = todo.popleft()
+               asked.append( byte_range )
+               requests.append( "GET " + path + " HTTP/1.1\r\nHost: " + self.host + ":" + str(self.port) + "\r\nRange: bytes=" + str(byte_range[0]) + "-" + str(byte_range[1]) + "\r\n\r\n" )
+            
+            if len(requests) > 0:
+               self.soc.sendall( "".join( requests ) )
+            
+            rc, keep_alive = self.__read_response( asked[0], chunksize, add_chunk, save_file )
+            asked.popleft()
+            fresh = False
+            
+         except (socket.error, socket.timeout, ValueError, IndexError), inst:
+            iftlog.log(3, "http_connection: lost connection to " + str(self.host) + ":" + str(self.port) + " (" + str(inst) + ")")
+            self.close()
+            continue
+         
+         if rc != 0:
+            self.close()
+            return rc
+         
+         if not keep_alive:
+            self.close()
+      
+      return 0
+
+
+class publication_registry:
    """
-   Default IFTD http server (if cherrypy is not available)
+   The files and directories the http sender makes available, each until it
+   has gone unrequested for its lifetime.  Lookups are by path (a file is
+   also available if its directory is), and expired entries are found with
+   a heap of expiry times instead of a scan.
    """
+   
+   def __init__( self, lifetime=HTTP_PUBLISH_LIFETIME ):
+      self.lifetime = lifetime
+      self.__expiry = {}         # path: time it expires
+      self.__heap = []           # (time it expires, path), possibly stale
+      self.__lock = threading.Lock()
+   
+   
+   def publish( self, path, lifetime=None ):
+      """
+      Make a file or directory available.
+      """
+      if lifetime == None:
+         lifetime = self.lifetime
       
-   # available files (chunk directories)
-   available_files = []
+      path = os.path.normpath( path )
+      expiry = time.time() + lifetime
+      self.__lock.acquire()
+      try:
+         self.__expiry[ path ] = expiry
+         heapq.heappush( self.__heap, (expiry, path) )
+      finally:
+         self.__lock.release()
+   
+   
+   def withdraw( self, path ):
+      """
+      Stop making a file or directory available.
+      """
+      self.__lock.acquire()
+      try:
+         self.__expiry.pop( os.path.normpath( path ), None )
+      finally:
+         self.__lock.release()
+   
+   
+   def is_published( self, path ):
+      """
+      Is the file at path available (by itself or through its directory)?
+      A request for it keeps it available for another lifetime.
+      """
+      path = os.path.normpath( path )
+      now = time.time()
+      self.__lock.acquire()
+      try:
+         self.__expire( now )
+         for key in (path, os.path.dirname( path )):
+            if self.__expiry.has_key( key ):
+               self.__expiry[ key ] = max( self.__expiry[ key ], now + self.lifetime )
+               return True
+         
+         return False
+      finally:
+         self.__lock.release()
+   
+   
+   def __expire( self, now ):
+      """
+      Forget what has expired.  Call with the lock held.
+      """
+      while len(self.__heap) > 0 and self.__heap[0][0] <= now:
+         expiry, path = heapq.heappop( self.__heap )
+         current = self.__expiry.get( path )
+         if current == None or current == expiry:
+            self.__expiry.pop( path, None )
+         elif current > now:
+            # it was requested since; look at it again when it is due
+            heapq.heappush( self.__heap, (current, path) )
+         else:
+            del self.__expiry[ path ]
+   
+   
+   def __len__( self ):
+      self.__lock.acquire()
+      try:
+         self.__expire( time.time() )
+         return len(self.__expiry)
+      finally:
+         self.__lock.release()
+
+
+
+def _find_sendfile():
+   """
+   Find the kernel's sendfile(2), if ctypes can get at it.
+   Return a function (out fd, in fd, offset, count) -> bytes sent (negative on error), or None.
+   """
+   try:
+      import ctypes
+      import ctypes.util
+      libc = ctypes.CDLL( ctypes.util.find_library("c"), use_errno=True )
+      c_sendfile = getattr( libc, "sendfile64", None )
+      if c_sendfile == None:
+         c_sendfile = libc.sendfile
+      
+      c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+      c_sendfile.restype = ctypes.c_ssize_t
+      
+      def sendfile( out_fd, in_fd, offset, count ):
+         off = ctypes.c_int64( offset )
+         rc = c_sendfile( out_fd, in_fd, ctypes.byref( off ), count )
+         if rc < 0:
+            return -ctypes.get_errno()
+         
+         return rc
+      
+      return sendfile
+   except Exception, inst:
+      iftlog.log(3, "http: sendfile not available (" + str(inst) + "), will copy files through user space")
+      return None
+
+
+_sendfile = _find_sendfile()
+
+
+class ift_http_server( ThreadingMixIn, HTTPServer ):
+   """
+   Default IFTD http server (if cherrypy is not available).
+   Each connection gets its own thread, and is kept alive between requests.
+   """
+   
+   daemon_threads = True
+   allow_reuse_address = True
    
    def __init__(self, server_addr, handler):
-      os.chdir("/")
-      self.protocol_version = 'HTTP/1.0'
+      self.published = publication_registry()     # available files (and chunk directories)
       HTTPServer.__init__(self, server_addr, handler)
 
 
    
-class ift_http_request_handler( SimpleHTTPRequestHandler ):
+class ift_http_request_handler( BaseHTTPRequestHandler ):
    """
    Request handler specific to iftd.
+   Serves published files over HTTP/1.1, with single and multipart byte ranges.
    """
    
-   def do_GET(self):
-      # file request?
+   protocol_version = "HTTP/1.1"
+   timeout = HTTP_KEEPALIVE_TIMEOUT       # hang up on idle connections
+   
+   def log_message( self, format, *args ):
+      iftlog.log(1, "http_sender: " + self.address_string() + " " + (format % args) )
+   
+   
+   def __send_empty( self, status, headers=[] ):
+      self.send_response( status )
+      for (name, value) in headers:
+         self.send_header( name, value )
+      
+      self.send_header( "Content-Length", "0" )
+      self.end_headers()
+   
+   
+   def __parse_ranges( self, range_header, size ):
+      """
+      Parse a Range header into a list of (first byte, last byte), in order, with
+      overlapping and adjacent ranges merged (so no byte is sent twice).
+      Return None if it's not a byte range we understand or there are more than
+      HTTP_MAX_RANGES ranges (so the whole file is sent), or [] if none of the
+      ranges can be satisfied.
+      """
+      range_header = range_header.strip()
+      if not range_header.startswith( "bytes=" ):
+         return None
+      
+      ranges = []
       try:
-         
-         # which pieces were requested?
-         if True or os.path.dirname( self.path.strip() ) in self.server.available_files:
-            if os.path.basename( self.path.strip() ) == "done":
-               # receiver is done with this file
-               #del self.server.available_files[ os.path.dirname( self.path.strip() ) ]
-               self.send_response( 200 )
-            
+         for spec in range_header[6:].split(","):
+            first, last = spec.strip().split("-")
+            if first == "":
+               # the last n bytes
+               first = max( 0, size - int(last) )
+               last = size - 1
+            elif last == "":
+               first = int(first)
+               last = size - 1
             else:
-               # file has been made available
-               SimpleHTTPRequestHandler.do_GET(self)
+               first = int(first)
+               last = min( int(last), size - 1 )
             
-            return
-         
+            if first > last:
+               if first >= size:
+                  continue      # unsatisfiable; skip it
+               return None      # malformed
+            
+            ranges.append( (first, last) )
+      except ValueError:
+         return None
+      
+      ranges.sort()
+      merged = []
+      for (first, last) in ranges:
+         if len(merged) > 0 and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max( merged[-1][1], last ))
          else:
-            self.send_response(404)    # nothing to send
-            return
+            merged.append( (first, last) )
       
-      except Exception, inst:
-         iftlog.exception( "Could not fully transmit " + self.path, inst)
-         self.send_response(404)
+      if len(merged) > HTTP_MAX_RANGES:
+         iftlog.log(3, "http_sender: " + str(len(merged)) + " ranges requested, so sending the whole file")
+         return None
+      
+      return merged
+   
+   
+   def __copy( self, fd, offset, length ):
+      """
+      Send length bytes of the open file, starting at offset, to the client.
+      """
+      self.wfile.flush()
+      out_fd = self.connection.fileno()
+      in_fd = fd.fileno()
+      
+      while length > 0 and _sendfile != None:
+         sent = _sendfile( out_fd, in_fd, offset, min( length, HTTP_SENDFILE_MAX ) )
+         if sent == -errno.EAGAIN:
+            # the socket has a timeout, so it's non-blocking underneath
+            if len( select.select( [], [out_fd], [], self.timeout )[1] ) == 0:
+               raise socket.timeout( "timed out sending " + self.path )
+            continue
+         
+         if sent <= 0:
+            break       # let the copy below take over (or report the error)
+         
+         offset += sent
+         length -= sent
+      
+      # no sendfile:  read at offset and write
+      while length > 0:
+         fd.seek( offset )
+         data = fd.read( min( length, 65536 ) )
+         if len(data) == 0:
+            raise IOError( "file " + self.path + " shrank while it was being sent" )
+         
+         self.wfile.write( data )
+         offset += len(data)
+         length -= len(data)
+   
+   
+   def do_GET(self):
+      path = urllib.unquote( self.path.split("?", 1)[0] )
+      
+      if os.path.basename( path ) == "done":
+         # receiver is done with this file
+         self.server.published.withdraw( os.path.dirname( path ) )
+         self.__send_empty( 200 )
          return
+      
+      if not self.server.published.is_published( path ):
+         self.__send_empty( 404 )   # nothing to send
+         return
+      
+      try:
+         fd = open( path, "rb" )
+      except IOError, inst:
+         self.__send_empty( 404 )
+         return
+      
+      try:
+         try:
+            size = os.fstat( fd.fileno() ).st_size
+            ranges = None
+            if self.headers.getheader( "range" ) != None:
+               ranges = self.__parse_ranges( self.headers.getheader( "range" ), size )
+            
+            if ranges == None:
+               # the whole file
+               self.send_response( 200 )
+               self.send_header( "Content-Type", "application/octet-stream" )
+               self.send_header( "Content-Length", str(size) )
+               self.send_header( "Accept-Ranges", "bytes" )
+               self.end_headers()
+               self.__copy( fd, 0, size )
+            
+            elif len(ranges) == 0:
+               self.__send_empty( 416, [("Content-Range", "bytes */" + str(size))] )
+            
+            elif len(ranges) == 1:
+               first, last = ranges[0]
+               self.send_response( 206 )
+               self.send_header( "Content-Type", "application/octet-stream" )
+               self.send_header( "Content-Range", "bytes %d-%d/%d" % (first, last, size) )
+               self.send_header( "Content-Length", str(last - first + 1) )
+               self.end_headers()
+               self.__copy( fd, first, last - first + 1 )
+            
+            else:
+               # multipart/byteranges; work out the length before sending anything
+               boundary = "iftd" + os.urandom(8).encode("hex")
+               part_headers = ["\r\n--%s\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" % (boundary, first, last, size) for (first, last) in ranges]
+               trailer = "\r\n--" + boundary + "--\r\n"
+               length = len(trailer)
+               for i in xrange(0, len(ranges)):
+                  length += len(part_headers[i]) + ranges[i][1] - ranges[i][0] + 1
+               
+               self.send_response( 206 )
+               self.send_header( "Content-Type", "multipart/byteranges; boundary=" + boundary )
+               self.send_header( "Content-Length", str(length) )
+               self.end_headers()
+               for i in xrange(0, len(ranges)):
+                  self.wfile.write( part_headers[i] )
+                  self.__copy( fd, ranges[i][0], ranges[i][1] - ranges[i][0] + 1 )
+               
+               self.wfile.write( trailer )
          
+         except (socket.error, socket.timeout), inst:
+            # the receiver went away
+            iftlog.log(3, "http_sender: could not fully transmit " + path + " (" + str(inst) + ")")
+            self.close_connection = 1
+         
+         except Exception, inst:
+            iftlog.exception( "Could not fully transmit " + path, inst)
+            self.close_connection = 1
+      
+      finally:
+         fd.close()
          
 
 
@@ -104,9 +583,19 @@ class http_sender( iftcore.iftsender.sender ):
       self.setactive(False)
       self.job_attrs = None
       self.name = "http_sender"
-      self.available_files = []
+      self.http_server = None
+      self.reusable = True
       self.set_chunking_mode( PROTO_DETERMINISTIC_CHUNKING )
 
+   def __deepcopy__( self, memo ):
+      """
+      On deep copy, share the HTTP server (there is one per port).
+      """
+      ret = http_sender()
+      ret.setup_attrs = copy.deepcopy( self.setup_attrs, memo )
+      ret.http_server = self.http_server
+      return ret
+
    # what do we need to know about setting up?
    def get_setup_attrs(self):
       return [PROTO_PORTNUM]
@@ -140,7 +629,10 @@ class http_sender( iftcore.iftsender.sender ):
    def send_job( self, job ):
       # this file is to be made available
       try:
-         self.http_server.available_files.append( job.get_attr( iftfile.JOB_ATTR_SRC_CHUNK_DIR ) )
+         for path in (job.get_attr( iftfile.JOB_ATTR_SRC_NAME ), job.get_attr( iftfile.JOB_ATTR_SRC_CHUNK_DIR )):
+            if path != None:
+               self.http_server.published.publish( path )
+         
          return 0
       except Exception, inst:
          iftlog.exception( self.name + ": could not make " + str(job.get_attr( iftfile.JOB_ATTR_SRC_CHUNK_DIR )) + " available", inst)
@@ -163,7 +655,7 @@ class http_sender( iftcore.iftsender.sender ):
    def kill(self, shutdown_args):
       if self.http_server != None:
          try:
-            self.http_server.socket.close()
+            self.http_server.server_close()
          except Exception, inst:
             iftlog.exception( "http_sender: could not shut down http server", inst)
             
@@ -186,6 +678,11 @@ class http_receiver( iftcore.iftreceiver.receiver ):
       self.received = False         # set to true once the file has been received (if we don't use chunking)
       self.file_size = -1           # size of remote file
       self.portnum = 80       # sensible default
+      self.connect_args = None
+      self.connections = []         # persistent connections to the server (http_connection)
+      self.fetchers = None          # workers fetching over the connections, one per connection (kept for the transfer)
+      self.__whole_file_lock = None  # held while saving the whole file, if the server sends it
+      self.reusable = True
       # receiver is active
       self.setactive(True)
       self.set_chunking_mode( PROTO_DETERMINISTIC_CHUNKING )
@@ -334,134 +831,163 @@ class http_receiver( iftcore.iftreceiver.receiver ):
          
      
   
+   def __setting( self, name, default ):
+      """
+      Get an integer setting from the connection attributes, then the job, else use the default.
+      """
+      value = None
+      if self.connect_args != None and self.connect_args.has_key( name ):
+         value = self.connect_args[ name ]
+      elif self.job_attrs != None and self.job_attrs.has_key( name ):
+         value = self.job_attrs[ name ]
+      
+      try:
+         value = int(value)
+         if value > 0:
+            return value
+      except:
+         pass
+      
+      return default
+   
+   
+   def __save_whole_file( self, rfile, length ):
+      """
+      The server sent us the whole file instead of a range; save it and tell iftd.
+      Only the first connection to get it saves it.
+      """
+      self.__whole_file_lock.acquire()
+      try:
+         if self.has_whole_file:
+            return 0
+         
+         local_path = iftfile.get_chunks_dir( self.job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ), self.job_attrs.get( iftfile.JOB_ATTR_FILE_HASH ) ) + "/" + os.path.basename( self.job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ) )
+         if length != None:
+            data = rfile.read( length )
+         else:
+            data = rfile.read()
+         
+         rc = self.__write_file( local_path, data )
+         if rc == 0:
+            self.whole_file( local_path )
+         else:
+            iftlog.log(5, self.name + ": could not save " + local_path + ", rc = " + str(rc) )
+            self.recv_finished( TRANSMIT_STATE_FAILURE )
+         
+         return rc
+      finally:
+         self.__whole_file_lock.release()
+   
+   
+   def __fetch( self, connection, remote_file, byte_ranges, window, chunksize, results, index, done ):
+      """
+      Fetcher task:  get byte ranges over one connection, record how it went, and set done.
+      """
+      try:
+         results[index] = connection.fetch( remote_file, byte_ranges, window, chunksize, self.add_chunk, self.__save_whole_file )
+      except Exception, inst:
+         iftlog.exception( self.name + ": could not fetch " + str(byte_ranges), inst )
+         connection.close()
+         results[index] = E_UNHANDLED_EXCEPTION
+      
+      done.set()
+   
+   
    # get chunks from the remote host.
    # chunks can be actual IFTD-generated chunks, or files in a common directory
    def recv_chunks( self, remote_chunk_dir, desired_chunks ):
       
-      # receive chunks in fragments, since no remote IFTD and the server is HTTP/1.1
+      # receive chunks as byte ranges, spread across persistent connections and pipelined on each
       try:
-         byte_ranges = []     # determine byte ranges corresponding to the chunk
+         chunksize = self.job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE )
+         num_connections = self.__setting( HTTP_CONNECTIONS, HTTP_DEFAULT_CONNECTIONS )
+         window = self.__setting( HTTP_PIPELINE_DEPTH, HTTP_DEFAULT_PIPELINE_DEPTH )
          
-         if len(desired_chunks) > 1:
-            desired_chunks.sort()
-            curr_range = -1
-            for chunk in desired_chunks:
-               byte_ranges.append( [ self.job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE ) * chunk, min( self.job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE ) * (chunk+1) - 1, self.file_size - 1 ) ] )
+         # merge adjacent chunks into runs, as [first chunk, last chunk]
+         runs = []
+         desired_chunks.sort()
+         for chunk in desired_chunks:
+            if len(runs) > 0 and runs[-1][1] + 1 == chunk:
+               runs[-1][1] = chunk
+            elif len(runs) == 0 or runs[-1][1] != chunk:
+               runs.append( [chunk, chunk] )
          
-         else:
-            byte_ranges = [[ self.job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE ) * desired_chunks[0], min( self.job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE ) * (desired_chunks[0]+1) - 1, self.file_size - 1 ) ]]
-            
-         # translate the byte range into a string
-         byte_range_str = "bytes="
+         # split big runs so that every connection has a share, and translate them into byte ranges.
+         # (separate runs are pipelined on a connection; one run is best asked for as one range.)
+         self.__whole_file_lock = threading.Lock()
+         num_chunks = len(desired_chunks)
+         pieces = max( len(runs), min( num_connections, num_chunks ) )
+         per_piece = max( 1, int( math.ceil( num_chunks / float(pieces) ) ) )
          
-         for brange in byte_ranges:
-            byte_range_str += str(brange[0]) + "-" + str(brange[1]) + ","
-
-         byte_range_str = byte_range_str[:-1]      # remove last ,
+         byte_ranges = []
+         for (first, last) in runs:
+            while first <= last:
+               end = min( first + per_piece - 1, last )
+               byte_ranges.append( (chunksize * first, min( chunksize * (end + 1) - 1, self.file_size - 1 )) )
+               first = end + 1
          
          remote_file = self.job_attrs.get( iftfile.JOB_ATTR_SRC_NAME )
          if remote_file[0] != '/':
             remote_file = '/' + remote_file
          
-         iftlog.log(3, self.name + ": request " + byte_range_str + " of " + remote_file + " from " + self.job_attrs.get( iftfile.JOB_ATTR_SRC_HOST ) )
+         # the path goes into the request line as-is, so it can't have spaces and such in it
+         remote_file = urllib.quote( remote_file )
          
-         req = urllib2.Request( "http://" + self.job_attrs.get( iftfile.JOB_ATTR_SRC_HOST ) + ":" + str(self.portnum) + remote_file )
-         req.add_header( "range", byte_range_str )
-         resp = urllib2.urlopen( req )
+         iftlog.log(3, self.name + ": request " + str(len(byte_ranges)) + " ranges of " + remote_file + " from " + self.remote_host + " over " + str(num_connections) + " connections")
          
-         if resp.code < 200 or resp.code > 400:
-            # error!
-            return E_NO_CONNECT
+         # deal the ranges out to the connections
+         while len(self.connections) < min( num_connections, len(byte_ranges) ):
+            self.connections.append( http_connection( self.remote_host, self.portnum ) )
          
-         # get the data
-         #resp_data = resp.read()
-         #data = StringIO( resp_data )
-         #resp.close()
-         data = resp
-
-         num_chunks = 0
-
-         content_type = resp.headers.getheader('content-type')
-         content_range = resp.headers.getheader('content-range')
-         if "multipart/byteranges" in content_type:
-            # multipart response
-            # get xxxxx from boundary=xxxxx
-
-            boundary = content_type[ content_type.find("boundary=") + 9 : ].strip()
-            chunk_dict = {}
-            CRLF = "\r\n"
+         if self.fetchers == None:
+            self.fetchers = iftutil.iftworkers( self.name + "-fetch", num_connections )
+         
+         assigned = [[] for c in self.connections]
+         for i in xrange(0, len(byte_ranges)):
+            assigned[ i % len(self.connections) ].append( byte_ranges[i] )
+         
+         # each connection's ranges are fetched by one of our fetchers, while we wait
+         results = [0] * len(self.connections)
+         waiting = []
+         for i in xrange(0, len(self.connections)):
+            if len(assigned[i]) == 0:
+               continue
             
-            # read the data
-            read_offset = 0
-            while True:
-
-               line = data.readline()
-               if len(line) == 0:
-                  break
-
-               if line == CRLF:
-                  continue
-               
-               line = line[ : len(line) - 2 ]
-               
-               start_byte = -1
-               stop_byte = -1
-               
-               if line == "--" + boundary + "--":
-                  break
-               
-               elif line == "--" + boundary:
-                  while True:
-                     line = data.readline()
-                     if line.lower().startswith("content-range"):
-                        content_range = line[ line.find("bytes ") + 6 : line.find("/") ]
-                        start_byte = int( content_range[0: content_range.find("-")] )
-                        stop_byte = int( content_range[ content_range.find("-") + 1 : ] ) + 1
-                        
-                     if line == CRLF:
-                        break
-                     
-                  
-                  # read data
-                  chunk_id = start_byte / self.job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE )
-                  #t1 = time.time()
-                  chunk = data.read( stop_byte - start_byte )
-                  #t2 = time.time()
-                  #print "chunk took " + str(t2 - t1)
-                  num_chunks += 1
-                  self.add_chunk( chunk_id, chunk )
+            done = threading.Event()
+            args = (self.connections[i], remote_file, assigned[i], window, chunksize, results, i, done)
+            if not self.fetchers.start_new_thread( self.__fetch, args, False ):
+               self.__fetch( *args )
             
-            if num_chunks > 0:
-               resp.close()
-               return 0
-            else:
-               resp.close()
-               return E_NO_DATA
-         
-         elif content_range != None:
-            # only one range given, and it's only one chunk
-            start_byte = int( content_range[ 6 : content_range.find("-") ] )
-            chunk_id = start_byte / self.job_attrs.get( iftfile.JOB_ATTR_CHUNKSIZE )
-            self.add_chunk( chunk_id, resp.read() )
-            resp.close()
+            waiting.append( done )
+         
+         for done in waiting:
+            done.wait()
+         
+         if HTTP_WHOLE_FILE in results:
             return 0
-
-         # not a multipart response, even though we expected it!
-         else:
-            # byterange request either encompassed the whole file, or this was an HTTP/1.0 server and we got the whole file back.
-            local_path = iftfile.get_chunks_dir( self.job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ), self.job_attrs.get( iftfile.JOB_ATTR_FILE_HASH ) ) + "/" + os.path.basename( self.job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ) )
-            rc = self.__write_file( local_path, resp.read() )
-            if rc == 0:
-               self.whole_file( local_path )
-            else:
-               iftlog.log(5, self.name + ": could not save " + local_path + ", rc = " + str(rc) )
-               self.recv_finished( TRANSMIT_STATE_FAILURE )
-               
-            return rc
+         
+         for rc in results:
+            if rc != 0:
+               return rc
+         
+         return 0
             
       except Exception, inst:
          iftlog.exception( self.name + ": could not receive chunks " + str(desired_chunks), inst)
          return E_UNHANDLED_EXCEPTION
+   
+   
+   def __close_connections( self ):
+      """
+      Hang up on the server, and let our fetchers go.
+      """
+      for connection in self.connections:
+         connection.close()
+      
+      self.connections = []
+      if self.fetchers != None:
+         self.fetchers.shutdown()
+         self.fetchers = None
             
             
    # clean up
@@ -488,6 +1014,7 @@ class http_receiver( iftcore.iftreceiver.receiver ):
             pass
          
       
+      self.__close_connections()
       self.job_attrs = None
       self.remote_host = ""
       self.bytes_received = 0
@@ -4,18 +4,35 @@
 iftcache.py
 Copyright (c) 2009 Jude Nelson
 
-Squid proxy plugin.
+Whole-file cache plugin.
+
+The cache is a directory of files that iftd keeps itself.  Each file is
+stored once, under its SHA-1, so two files with the same name don't collide
+and one file fetched under two names is kept once.  The names files were
+cached under (the source host and path) are a second index, for jobs that
+don't know the hash of the file they want.  A file older than
+IFTCACHE_MAX_AGE is not served, and when the cache grows past its byte
+budget, the least recently used files are evicted.
+
+A file is added by writing it under a temporary name and renaming it into
+place, so a crash never leaves part of a file in the cache; anything left
+over is cleared out when the cache is next loaded.  A hit is served by
+linking the cached file into the receiver's directory, so its data is not
+copied.
+
+The sender puts a file into the cache.  The receiver gets a file out of it,
+and on a miss, receives the file from the remote iftd with the other
+protocols into the cache, and serves it from there.
 """
 
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 import os
 import copy
+import errno
+import shutil
+import hashlib
 import thread
 import threading
-import heapq
 import time
-import urllib2
-import socket
 
 import iftapi
 import iftcore
@@ -29,17 +46,10 @@ from iftdata import *
 
 
 # file cache base directory
-# (the PID will be appended to it to make it unique)
 IFTCACHE_BASEDIR = "IFTCACHE_BASEDIR"
 
-# squid port number attribute tag
-IFTCACHE_SQUID_PORTNUM = "IFTCACHE_SQUID_PORTNUM"
-
-# http port
-IFTCACHE_HTTP_PORTNUM = "IFTCACHE_HTTP_PORTNUM"
-
-# Squid port
-IFTCACHE_SQUID_PORT = 31128      # not 3128, since its blocked on PlanetLab
+# most bytes of files to cache
+IFTCACHE_MAX_BYTES = "IFTCACHE_MAX_BYTES"
 
 # remote RPC dir
 IFTCACHE_REMOTE_RPC_DIR = "IFTCACHE_REMOTE_RPC_DIR"
@@ -50,8 +60,21 @@ IFTCACHE_REMOTE_IFTD_PORT = "IFTCACHE_REMOTE_IFTD_PORT"
 # user timeout
 IFTCACHE_USER_TIMEOUT = "IFTCACHE_USER_TIMEOUT"
 
-# HTTP cache server instance
-cache_server = None
+# maximum allowable age for a file (in seconds; a job's overrides the receiver's setup one)
+IFTCACHE_MAX_AGE = "IFTCACHE_MAX_AGE"
+
+# defaults
+IFTCACHE_DEFAULT_BASEDIR = "/tmp/iftd/cache/"
+IFTCACHE_DEFAULT_MAX_BYTES = 1024 * 1048576
+
+# when evicting, make this fraction of the byte budget free (so eviction doesn't happen on every file added)
+IFTCACHE_EVICT_TARGET = 0.9
+
+# how much of a file to copy into the cache at a time
+IFTCACHE_COPY_BLOCK = 1048576
+
+# the cache (None if it is not running)
+cache = None
 
 # cache reference count
 cache_ref = 0
@@ -59,107 +82,98 @@ cache_ref = 0
 # cache semaphore for reference counting
 cache_sem = threading.Semaphore(1)
 
-# cache directory
-cache_dir = ""
-
-# maximum allowable age for a file
-IFTCACHE_MAX_AGE = "IFTCACHE_MAX_AGE"
-
-# temporary connection attributes and job attributes
-# used only in receiving, between the call-out to Squid and the file retrieval.
-tmp_job_attrs = {}
-tmp_connect_args = {}
 
 """
-Cache sender--put a file into the Squid cache
+Cache sender--put a file into the cache
 """
 class iftcache_sender( iftcore.iftsender.sender ):
    def __init__(self):
       iftcore.iftsender.sender.__init__(self)
       self.name = "iftcache_sender"
       self.file_to_send = ""
+      self.file_hash = None
+      self.cache_name = None
       self.sent = False
-      
+
       # sender is active
       self.setactive(True)
-      
+
       # non-resumable
       self.set_chunking_mode( PROTO_NO_CHUNKING )
-      
-   
+
+
    # we need nothing to start up
    def get_setup_attrs(self):
       return []
-   
+
    # we need nothing to connect
    def get_connect_attrs(self):
       return []
-   
+
    # we need the source name to send the file to the cache
    def get_send_attrs(self):
       return [iftfile.JOB_ATTR_SRC_NAME]
-   
+
    # what are the attributes this sender recognizes?
    def get_all_attrs(self):
-      return self.get_setup_attrs() + self.get_connect_attrs() + self.get_send_attrs() + [IFTCACHE_BASEDIR]
-   
+      return self.get_setup_attrs() + self.get_connect_attrs() + self.get_send_attrs() + [IFTCACHE_BASEDIR, IFTCACHE_MAX_BYTES]
+
    # one-time setup
    def setup( self, setup_attrs ):
       # start up the cache
       if setup_attrs.has_key(IFTCACHE_BASEDIR) == False:
-         setup_attrs[IFTCACHE_BASEDIR] = "/tmp/iftcache_" + str(os.getpid())
-         
-      self.http_port = 18090
-      if setup_attrs.get( IFTCACHE_HTTP_PORTNUM ) != None:
-         self.http_port = int(setup_attrs.get( IFTCACHE_HTTP_PORTNUM ) )
-         
-      return cache_startup( setup_attrs[IFTCACHE_BASEDIR], self.http_port )
-      
-   
+         setup_attrs[IFTCACHE_BASEDIR] = IFTCACHE_DEFAULT_BASEDIR
+
+      if setup_attrs.get(IFTCACHE_MAX_BYTES) == None:
+         setup_attrs[IFTCACHE_MAX_BYTES] = IFTCACHE_DEFAULT_MAX_BYTES
+
+      return cache_startup( setup_attrs[IFTCACHE_BASEDIR], setup_attrs[IFTCACHE_MAX_BYTES] )
+
+
    # nothing to do
    def send_job( self, job ):
       return 0
-   
+
    # prepare for transmission--make sure the file that will be received is available
    def prepare_transmit( self, job, resume ):
       if not os.path.exists( job.get_attr(iftfile.JOB_ATTR_SRC_NAME) ):
          iftlog.log(5, self.name + ": file " + job.get_attr( iftfile.JOB_ATTR_SRC_NAME ) + " does not exist!" )
          return E_FILE_NOT_FOUND
-      
+
       if not os.access( job.get_attr(iftfile.JOB_ATTR_SRC_NAME), os.R_OK ):
          iftlog.log(5, self.name + ": file " + job.get_attr( iftfile.JOB_ATTR_SRC_NAME ) + " is not readable!" )
          return E_FILE_NOT_FOUND
-      
-      self.file_to_send = job.get_attr( iftfile.JOB_ATTR_SRC_NAME )
-      self.squid_portnum = job.get_attr( IFTCACHE_SQUID_PORTNUM )
-      if self.squid_portnum == None:
-         self.squid_portnum = IFTCACHE_SQUID_PORT
 
+      self.file_to_send = job.get_attr( iftfile.JOB_ATTR_SRC_NAME )
+      self.file_hash = job.get_attr( iftfile.JOB_ATTR_FILE_HASH )
+      self.cache_name = cache_key( job.get_attr( iftfile.JOB_ATTR_SRC_HOST ), self.file_to_send )
       return 0
-   
-   # clean up 
+
+   # clean up
    def proto_clean( self ):
       self.sent = False
       self.file_to_send = ""
+      self.file_hash = None
+      self.cache_name = None
       return
-   
+
    # transmission has stopped or suspended (either way, kill transmission if it still is going)
    def end_transmit( self, suspend ):
       return 0
-   
+
    # put the file into the cache
    def send_chunk( self, chunk, chunk_id, chunk_path, remote_chunk_path ):
-      
+
       # we cache the entire file, so we'll ignore chunks altogether
-      
-      rc = cache_put_file( self.file_to_send, self.squid_portnum, self.http_port )
+
+      rc = cache_put_file( self.file_to_send, self.cache_name, self.file_hash )
       if rc < 0:
          return E_NO_DATA  # couldn't put the file
-      
+
       self.sent = 1
       return 0
 
-      
+
    # clean up
    def kill( self, kill_args ):
       cache_shutdown()
@@ -169,443 +183,578 @@ class iftcache_sender( iftcore.iftsender.sender ):
 Cache receiver--get a file if it is cached and not stale
 """
 class iftcache_receiver( iftcore.iftreceiver.receiver ):
-   
+
    def __init__(self):
       iftcore.iftreceiver.receiver.__init__(self)
       self.name = "iftcache_receiver"
       self.file_to_recv = ""
+      self.file_hash = None
+      self.cache_name = None
       self.max_age = 0
       self.chunk_size = 0
-      
+      self.connect_args = {}
+
       # we're active
       self.setactive(True)
       # we're not resumable
       self.set_chunking_mode( PROTO_NO_CHUNKING )
-      
-   
+
+
    # get path we save the file to
    def get_local_file_path(self):
       return self.file_to_recv
-   
+
    # need to know nothing to set up
    def get_setup_attrs(self):
       return []
-   
+
    # give everything up front so we can create a fake job
    def get_connect_attrs(self):
       return [IFTCACHE_REMOTE_RPC_DIR, IFTCACHE_REMOTE_IFTD_PORT, IFTCACHE_USER_TIMEOUT]
-   
+
    def get_recv_attrs( self ):
       # note: supply absolute file paths
       return [iftfile.JOB_ATTR_SRC_NAME, iftfile.JOB_ATTR_DEST_NAME]
-   
+
    # what attributes does this receiver recognize?
    def get_all_attrs( self ):
-      return self.get_setup_attrs() + self.get_connect_attrs() + self.get_recv_attrs() + [iftfile.JOB_ATTR_CHUNKSIZE, IFTCACHE_HTTP_PORTNUM, IFTCACHE_SQUID_PORTNUM, IFTCACHE_BASEDIR]
-   
-   
+      return self.get_setup_attrs() + self.get_connect_attrs() + self.get_recv_attrs() + [iftfile.JOB_ATTR_CHUNKSIZE, iftfile.JOB_ATTR_FILE_HASH, IFTCACHE_MAX_AGE, IFTCACHE_BASEDIR, IFTCACHE_MAX_BYTES]
+
+
    # start up the cache if it is not running
    def setup( self, setup_attrs ):
-      
+
       # start up the cache
       if setup_attrs.has_key(IFTCACHE_BASEDIR) == False:
-         setup_attrs[IFTCACHE_BASEDIR] = "/tmp/iftcache_" + str(os.getpid())
-      
-      # port number
-      if setup_attrs.has_key(IFTCACHE_SQUID_PORTNUM) == False:
-         global IFTCACHE_SQUID_PORT
-         setup_attrs[IFTCACHE_SQUID_PORTNUM] = IFTCACHE_SQUID_PORT
+         setup_attrs[IFTCACHE_BASEDIR] = IFTCACHE_DEFAULT_BASEDIR
+
+      if setup_attrs.get(IFTCACHE_MAX_BYTES) == None:
+         setup_attrs[IFTCACHE_MAX_BYTES] = IFTCACHE_DEFAULT_MAX_BYTES
 
       self.setup_attrs = setup_attrs
-      
-      self.http_port = 18090
-      if setup_attrs.get( IFTCACHE_HTTP_PORTNUM ) != None:
-         self.http_port = setup_attrs.get( IFTCACHE_HTTP_PORTNUM )
-      
-      return cache_startup( setup_attrs[IFTCACHE_BASEDIR], self.http_port )
-      
-   
+
+      return cache_startup( setup_attrs[IFTCACHE_BASEDIR], setup_attrs[IFTCACHE_MAX_BYTES] )
+
+
    def await_sender( self, connect_attrs, timeout ):
       self.connect_args = connect_attrs
+      if self.connect_args == None:
+         self.connect_args = {}
       return 0
-   
+
    # receive file attributes
    def recv_job( self, job ):
-      
+
       self.file_to_recv = job.get_attr( iftfile.JOB_ATTR_SRC_NAME )
       self.file_hash = job.get_attr( iftfile.JOB_ATTR_FILE_HASH )
+      self.cache_name = cache_key( job.get_attr( iftfile.JOB_ATTR_SRC_HOST ), self.file_to_recv )
       self.remote_iftd = job.get_attr( iftfile.JOB_ATTR_REMOTE_IFTD )
       self.max_age = job.get_attr( IFTCACHE_MAX_AGE )
-      self.job_attrs = job.attrs
+      if self.max_age == None and self.setup_attrs != None:
+         self.max_age = self.setup_attrs.get( IFTCACHE_MAX_AGE )
       if self.max_age == None:
          self.max_age = -1
+      self.job_attrs = job.attrs
       self.chunk_size = job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE )
-      self.squid_port = job.get_attr( IFTCACHE_SQUID_PORTNUM )
-      if self.squid_port == None:
-         self.squid_port = self.setup_attrs[IFTCACHE_SQUID_PORTNUM]
-      if self.squid_port == None:
-         self.squid_port = IFTCACHE_SQUID_PORT 
 
       return 0
-   
+
    def proto_clean( self ):
       self.file_to_recv = ""
+      self.file_hash = None
+      self.cache_name = None
       self.max_age = 0
       self.chunk_size = 0
       return
-   
+
    def recv_files( self, remote_file_paths, local_file_dir ):
-      global cache_dir
-      
-      # get the file from the cache and write it to disk, if possible
-      file_fd = cache_get_file( cache_path(self.file_to_recv), self.max_age, self.connect_args, self.job_attrs, self.squid_port, self.http_port )
-      
-      if file_fd == None:
+
+      tmp_file_name = local_file_dir + "/" + os.path.basename( self.job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ) )
+
+      # get the file from the cache, or failing that, into the cache from the remote iftd
+      rc = cache_get_file( tmp_file_name, self.file_hash, self.cache_name, self.max_age )
+      if rc != 0:
+         rc = self.__fetch()
+         if rc == 0:
+            rc = cache_get_file( tmp_file_name, self.file_hash, self.cache_name, -1 )
+
+      if rc != 0:
          iftlog.log(3, self.name + ": could not receive " + self.file_to_recv )
          self.recv_finished( TRANSMIT_STATE_FAILURE )
          return E_NO_DATA      # not in cache ==> protocol failure
-      
-      data = file_fd.read()
-      file_fd.close()
-      
-      tmp_file_name = ""
-      
-      
-      try:
-         tmp_file_name = local_file_dir + "/" + os.path.basename( self.job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ) )
-         fd = open( tmp_file_name, "wb" )
-         fd.write( data )
-         fd.close()
-      except Exception, inst:
-         iftlog.exception(self.name + ".recv_files: failed to save " + self.file_to_recv + " to " + tmp_file_name, inst)
-         return E_IOERROR
-      
+
       self.whole_file( tmp_file_name )
       self.recv_finished( TRANSMIT_STATE_SUCCESS )
-      
+
       return 0
-   
+
+
+   def __fetch( self ):
+      """
+      On a cache miss, receive the file from the remote iftd with the other protocols, and cache it.
+      (We hold a protocol worker meanwhile, so those protocols run on iftutil.NestedThreadPool.)
+      Return 0 on success; negative on error
+      """
+      if cache == None or self.connect_args.get( IFTCACHE_REMOTE_IFTD_PORT ) == None:
+         return E_UNAVAIL      # no remote iftd to get it from
+
+      # don't use any iftcache protocol
+      protolist = [p for p in iftapi.list_protocols() if p.find("iftcache") == -1]
+      proto_connect_args = {}
+      for proto_name in protolist:
+         proto_connect_args[proto_name] = copy.deepcopy( self.connect_args )
+
+      # receive to the cache directory
+      job_attrs = iftfile.iftjob.get_attrs_copy( self.job_attrs )
+      cached_filepath = cache.tmp_path()
+      job_attrs[ iftfile.JOB_ATTR_DEST_NAME ] = cached_filepath
+      job_attrs[ iftfile.JOB_ATTR_PROTOS ] = protolist
+
+      iftlog.log(5, "iftcache: cache miss on " + str(self.cache_name) + ", so trying all other available protocols")
+      try:
+         rc = iftapi.begin_ift( job_attrs, proto_connect_args, False, True, self.connect_args.get( IFTCACHE_REMOTE_IFTD_PORT ), self.connect_args.get( IFTCACHE_REMOTE_RPC_DIR, "/RPC2" ), self.connect_args.get( IFTCACHE_USER_TIMEOUT, 60 ) )
+         if rc != TRANSMIT_STATE_SUCCESS and rc != 0:
+            iftlog.log(5, "iftcache: could not receive file " + str(self.file_to_recv) + " (rc = " + str(rc) + ")")
+            return E_NO_DATA
+
+         rc, digest = cache.put_file( cached_filepath, self.cache_name, self.file_hash, True )
+         return rc
+
+      except Exception, inst:
+         iftlog.exception( "iftcache: could not retrieve " + str(self.file_to_recv), inst )
+         return E_UNHANDLED_EXCEPTION
+
+      finally:
+         if os.path.exists( cached_filepath ):
+            os.remove( cached_filepath )
+
    # clean up
    def kill( self, kill_args ):
       cache_shutdown()
 
 
 
-"""
-HTTP cache server request handler
-Squid will request files from this server when it gets a cache miss.
-"""
-class HTTPCacheServerHandler( BaseHTTPRequestHandler ):
-   
-   
-   def do_GET(self):
-      global cache_dir
-      global tmp_connect_args
-      global tmp_job_attrs
-      
-      # only pay attention to local requests
-      if self.client_address[0] != "127.0.0.1" and self.client_address[0] != "localhost":
-         iftlog.log(5, "HTTPCacheServerHandler: unauthorized GET from " + self.client_address[0])
-         self.send_response( 403 )
-         return
 
-      get_filename = os.path.basename( self.path )
-      
-      connect_args = tmp_connect_args.get( get_filename )
-      job_attrs = tmp_job_attrs.get( get_filename )
-      
-      if job_attrs == None:
-         # not found...
-         iftlog.log(5, "HTTPCacheServerHandler: job_attrs not found for '" + get_filename + "'" )
-         self.send_response( 404 )
-         return
-      
-      if connect_args == None:
-         # not found
-         iftlog.log(5, "HTTPCacheServerHandler: connect_args not found for '" + get_filename + "'" )
-         print tmp_connect_args
-         self.send_response( 404 )
-         return
-      
-      chunks_dir = job_attrs.get( iftfile.JOB_ATTR_DEST_CHUNK_DIR )
-      file_name = job_attrs.get(iftfile.JOB_ATTR_DEST_NAME)
-      
-      # file request for cache miss!
+
+
+class file_cache:
+   """
+   Files on disk, by SHA-1 and by name, with a byte budget, LRU eviction, and crash-safe inserts.
+   """
+
+   def __init__( self, cache_dir, max_bytes ):
+      self.cache_dir = cache_dir
+      self.max_bytes = max_bytes
+      self.__lock = threading.Lock()
+      self.__files = {}          # SHA-1 --> [size, time cached (the file's mtime), time last used]
+      self.__names = {}          # SHA-1 of a name --> SHA-1 of its file
+      self.__num_bytes = 0
+      self.__hits = 0
+      self.__misses = 0
+      self.__evictions = 0
+
+
+   def path( self, digest ):
+      """
+      Where a file is (or would be) cached
+      """
+      return self.cache_dir + digest[0:2] + "/" + digest
+
+
+   def name_path( self, name_digest ):
+      """
+      Where the link from a name (by its SHA-1) to its file is (or would be) kept
+      """
+      return self.cache_dir + "names/" + name_digest
+
+
+   def tmp_path( self ):
+      """
+      Get a new path in the cache's scratch directory (on the same filesystem as the cache)
+      """
+      return self.cache_dir + "tmp/" + str(os.getpid()) + "." + str(thread.get_ident()) + "." + str(time.time())
+
+
+   def load( self ):
+      """
+      Take stock of the files already in the cache (i.e. from before a restart), and clear
+      out whatever a crash left behind.
+      Return 0 on success; negative on error
+      """
+      self.__lock.acquire()
       try:
-         # get the file via iftd, but don't check the cache
-         all_protolist = iftapi.list_protocols()
-         protolist = []
-         
-         # don't use any iftcache protocol
-         for p in all_protolist:
-            if p.find("iftcache") == -1:
-               protolist.append( p )
-         
-         # map each protocol to the given connection args
-         proto_connect_args = {}
-         for proto_name in protolist:
-            proto_connect_args[proto_name] = connect_args
-         
-         # put in a request to get the file
-         iftlog.log(5, "iftcache: Squid cache miss, so trying all other available protocols")
-         
-         # receive to the cache directory
-         cached_filepath = cache_dir.rstrip("/") + "/" + os.path.basename( job_attrs.get( iftfile.JOB_ATTR_DEST_NAME ))
-         job_attrs[ iftfile.JOB_ATTR_DEST_NAME ] = cached_filepath
-         job_attrs[ iftfile.JOB_ATTR_PROTOS ] = protolist
-         rc = iftapi.begin_ift( job_attrs, proto_connect_args, False, True, connect_args[iftapi.CONNECT_ATTR_REMOTE_PORT], connect_args[iftapi.CONNECT_ATTR_REMOTE_RPC], connect_args[iftapi.CONNECT_ATTR_USER_TIMEOUT] )
-         
-         # success or failure?
-         if rc != TRANSMIT_STATE_SUCCESS and rc != 0:
-            iftlog.log(5, "iftcache: could not receive file " + file_name + " (rc = " + str(rc) + ")")
-            self.send_response(500)
-            return
-         
-         # open the file and write it back
-         file_buff = []
          try:
-            fd = open( cached_filepath, "rb" )
-            file_buff = fd.read()
-            fd.close()
+            for subdir in ["names", "tmp"]:
+               if not os.path.isdir( self.cache_dir + subdir ):
+                  os.mkdir( self.cache_dir + subdir )
+
+            # files that were being added when we stopped
+            for name in os.listdir( self.cache_dir + "tmp" ):
+               os.remove( self.cache_dir + "tmp/" + name )
+
+            for subdir in os.listdir( self.cache_dir ):
+               if len(subdir) != 2 or not os.path.isdir( self.cache_dir + subdir ):
+                  continue
+
+               for digest in os.listdir( self.cache_dir + subdir ):
+                  sb = os.stat( self.cache_dir + subdir + "/" + digest )
+                  self.__files[ digest ] = [sb.st_size, sb.st_mtime, sb.st_mtime]
+                  self.__num_bytes += sb.st_size
+
+            # names, less any whose file is gone
+            for name_digest in os.listdir( self.cache_dir + "names" ):
+               digest = os.path.basename( os.readlink( self.name_path( name_digest ) ) )
+               if self.__files.has_key( digest ):
+                  self.__names[ name_digest ] = digest
+               else:
+                  os.remove( self.name_path( name_digest ) )
+
+            self.__evict()
          except Exception, inst:
-            iftlog.exception("iftcache: received file to " + cached_filepath + ", but could not read it")
-            self.send_response(500)
-            return
-         
-         # reply the file
-         self.send_response(200)
-         self.send_header( 'Content-type', 'application/octet-stream' ) # force raw bytes
-         self.send_header( 'Last-Modified', time.ctime( os.stat( cached_filepath ).st_mtime ) )
-         self.end_headers()
-         self.wfile.write( file_buff )
-         
-         # recreate the chunks directory, since we might have lost it...
-         if chunks_dir != None and not os.path.exists( chunks_dir ):
+            iftlog.exception("iftcache: could not read " + self.cache_dir, inst)
+            return E_IOERROR
+      finally:
+         self.__lock.release()
+
+      iftlog.log(3, "iftcache: " + str(len(self.__files)) + " files (" + str(self.__num_bytes) + " bytes) in " + self.cache_dir)
+      return 0
+
+
+   def lookup( self, file_hash, name, max_age=-1 ):
+      """
+      Find a cached file:  by its SHA-1 if file_hash is given, and by the name it was cached under
+      otherwise.  Files cached more than max_age seconds ago are not found (unless max_age <= 0).
+      Return the file's SHA-1, or None on a miss.
+      """
+      self.__lock.acquire()
+      try:
+         digest = file_hash
+         if digest == None and name != None:
+            digest = self.__names.get( hashlib.sha1( name ).hexdigest() )
+
+         entry = self.__files.get( digest )
+         if entry == None:
+            self.__misses += 1
+            return None
+
+         # the file is linked out to receivers, so make sure none of them changed it
+         try:
+            sb = os.stat( self.path( digest ) )
+            changed = (sb.st_size != entry[0] or sb.st_mtime != entry[1])
+         except OSError:
+            changed = True
+
+         if changed:
+            iftlog.log(5, "iftcache: cached file " + digest + " was changed or removed; dropping it")
+            self.__remove( digest )
+            self.__misses += 1
+            return None
+
+         if max_age > 0 and time.time() - entry[1] > max_age:
+            iftlog.log(3, "iftcache: cached file " + digest + " is older than " + str(max_age) + " seconds")
+            self.__misses += 1
+            return None
+
+         entry[2] = time.time()
+         self.__hits += 1
+         return digest
+      finally:
+         self.__lock.release()
+
+
+   def link_out( self, digest, dest_path ):
+      """
+      Put a cached file at dest_path without copying it (it is hard-linked, unless dest_path is on another filesystem).
+      Return 0 on success; negative on error
+      """
+      try:
+         if os.path.exists( dest_path ):
+            os.remove( dest_path )
+
+         try:
+            os.link( self.path( digest ), dest_path )
+         except OSError, inst:
+            if inst.errno != errno.EXDEV and inst.errno != errno.EPERM:
+               raise
+
+            shutil.copyfile( self.path( digest ), dest_path )
+
+         return 0
+      except Exception, inst:
+         iftlog.exception("iftcache: could not serve " + digest + " to " + dest_path, inst)
+         return E_IOERROR
+
+
+   def put_file( self, path, name=None, file_hash=None, move=False ):
+      """
+      Cache the file at path, under name (if given).  If file_hash is given, the file must have it.
+      The file is copied into the cache, or if move is True (and path is in the scratch directory),
+      moved there.  Either way it only appears once it is all there.
+      Return (0, SHA-1) on success; (negative, None) on error
+      """
+      tmp_path = None
+      try:
+         m = hashlib.sha1()
+         if move:
+            fd = open( path, "rb" )
+            while True:
+               buf = fd.read( IFTCACHE_COPY_BLOCK )
+               if len(buf) == 0:
+                  break
+               m.update( buf )
+            fd.close()
+            tmp_path = path
+
+         else:
+            tmp_path = self.tmp_path()
+            src = open( path, "rb" )
+            dest = open( tmp_path, "wb" )
+            while True:
+               buf = src.read( IFTCACHE_COPY_BLOCK )
+               if len(buf) == 0:
+                  break
+               m.update( buf )
+               dest.write( buf )
+
+            src.close()
+            dest.flush()
+            os.fsync( dest.fileno() )
+            dest.close()
+
+         digest = m.hexdigest()
+         if file_hash != None and file_hash != digest:
+            iftlog.log(5, "iftcache: " + path + " has hash " + digest + ", not " + file_hash + "; not caching it")
+            if not move:
+               os.remove( tmp_path )
+            return (E_CORRUPT, None)
+
+         cached_path = self.path( digest )
+         if not os.path.isdir( os.path.dirname( cached_path ) ):
+            try:
+               os.mkdir( os.path.dirname( cached_path ) )
+            except OSError:
+               pass     # made by someone else just now
+
+         os.utime( tmp_path, None )
+         os.rename( tmp_path, cached_path )
+         tmp_path = None
+         sb = os.stat( cached_path )
+
+         # index it by name, replacing whatever the name was for before
+         if name != None:
+            name_digest = hashlib.sha1( name ).hexdigest()
+            link_tmp = self.tmp_path()
+            os.symlink( "../" + digest[0:2] + "/" + digest, link_tmp )
+            os.rename( link_tmp, self.name_path( name_digest ) )
+
+      except Exception, inst:
+         iftlog.exception("iftcache: could not cache " + path, inst)
+         if tmp_path != None and not move and os.path.exists( tmp_path ):
+            os.remove( tmp_path )
+         return (E_IOERROR, None)
+
+      self.__lock.acquire()
+      if self.__files.has_key( digest ):
+         self.__num_bytes -= self.__files[ digest ][0]
+      self.__files[ digest ] = [sb.st_size, sb.st_mtime, time.time()]
+      self.__num_bytes += sb.st_size
+      if name != None:
+         self.__names[ name_digest ] = digest
+      self.__evict( digest )
+      self.__lock.release()
+
+      iftlog.log(3, "iftcache: cached " + path + " as " + digest)
+      return (0, digest)
+
+
+   def purge( self, file_hash, name ):
+      """
+      Drop a file from the cache, by SHA-1 if file_hash is given and by name otherwise
+      """
+      self.__lock.acquire()
+      digest = file_hash
+      if digest == None and name != None:
+         digest = self.__names.get( hashlib.sha1( name ).hexdigest() )
+      if digest != None:
+         self.__remove( digest )
+      self.__lock.release()
+
+
+   def stats( self ):
+      """
+      How big is the cache, and how well is it doing?
+      """
+      self.__lock.acquire()
+      ret = {"files": len(self.__files), "names": len(self.__names), "bytes": self.__num_bytes, "max_bytes": self.max_bytes,
+             "hits": self.__hits, "misses": self.__misses, "evictions": self.__evictions}
+      self.__lock.release()
+      return ret
+
+
+   def __remove( self, digest ):
+      """
+      Take a file (and the names it is cached under) out of the cache.  Call with the lock held.
+      """
+      entry = self.__files.get( digest )
+      if entry == None:
+         return
+
+      for (name_digest, d) in self.__names.items():
+         if d == digest:
             try:
-               os.popen("mkdir -p " + chunks_dir).close()
-            except:
+               os.remove( self.name_path( name_digest ) )
+            except OSError:
                pass
-            
-         # done with this...
-         tmp_connect_args[get_filename] = None
-         tmp_job_attrs[get_filename] = None
+            del self.__names[ name_digest ]
+
+      try:
+         os.remove( self.path( digest ) )
+      except OSError:
+         pass
+
+      self.__num_bytes -= entry[0]
+      del self.__files[ digest ]
+
+
+   def __evict( self, keep=None ):
+      """
+      If the cache is over its byte budget, evict the least recently used files (other than keep).
+      Call with the lock held.
+      """
+      if self.__num_bytes <= self.max_bytes:
          return
-         
-      except Exception, inst:
-         iftlog.exception( "iftcache: could not retrieve " + self.path, inst)
-         self.send_response(500)
-         
 
+      target = self.max_bytes * IFTCACHE_EVICT_TARGET
+      candidates = [(entry[2], digest) for (digest, entry) in self.__files.items() if digest != keep]
+      candidates.sort()
+      for (last_used, digest) in candidates:
+         if self.__num_bytes <= target:
+            break
+
+         self.__remove( digest )
+         self.__evictions += 1
 
 
-def cache_startup( cache_basedir, cache_server_portnum ):
+
+def cache_startup( cache_basedir, max_bytes=IFTCACHE_DEFAULT_MAX_BYTES ):
    """
-   Start up the caching system if not running.  Start the HTTP cache server and ensure that Squid is running.
-   
+   Start up the cache if it is not running, keeping up to max_bytes of files in cache_basedir.
+
    @return
       0 on success, negative on failure
    """
-   
+
    global cache_ref
-   global cache_sem
-   global cache_server
-   global cache_dir
-   
+   global cache
+
+   cache_sem.acquire()
    try:
       # are we running?
-      cache_sem.acquire()
-      if cache_ref != 0 or cache_server != None:
+      if cache != None:
          iftlog.log(3, "iftcache: already running (refs = " + str(cache_ref) + ")")
-         cache_sem.release()
-         return 0    # already running
-   
-      # is Squid running?
-      # TODO: is there a less kludgy way to do this?
-      procs = os.popen( "ps -A | grep -i squid" ).readlines()
-      if len(procs) <= 1:
-         # only found our "grep" statement
-         iftlog.log(5, "iftcache: Squid does not appear to be running...")
-         cache_sem.release()
-         return E_INVAL
-   
-      # attempt to make base directory, but fall back to a sensible default if that doesn't work
+         cache_ref += 1
+         return 0
+
+      if cache_basedir[-1] != "/":
+         cache_basedir += "/"
+
       try:
          if not os.path.exists( cache_basedir ):
             os.makedirs( cache_basedir )
-         else:
-            iftlog.log(3, "iftcache: WARNING: using existing directory " + cache_basedir + " as cache directory")
-         cache_dir = cache_basedir
       except Exception, inst:
-         try:
-            os.makedirs( "/tmp/iftcache_" + str(os.getpid()))
-            cache_dir = "/tmp/iftcache_" + str(os.getpid())
-            iftlog.log(5, "iftcache: WARNING: " + cache_basedir + " is not valid, using /tmp/iftcache_" + str(os.getpid()) + " as base cache directory path")
-         except Exception, inst:
-            iftlog.exception("iftcache: Could not create cache directory!", inst)
-            cache_sem.release()
-            cache_shutdown()
-            return E_UNHANDLED_EXCEPTION
-      
-      # start the HTTP server
-      if cache_server == None:
-         cache_server = HTTPServer( ('', cache_server_portnum), HTTPCacheServerHandler )
-         thread.start_new_thread( cache_server.serve_forever, () )
-      else:
-         # HTTP server is already running...
-         iftlog.log(3, "iftcache: caching system is already running...")
-      
+         iftlog.exception("iftcache: Could not create cache directory " + cache_basedir, inst)
+         return E_IOERROR
+
+      c = file_cache( cache_basedir, max_bytes )
+      rc = c.load()
+      if rc != 0:
+         return rc
+
+      cache = c
+      cache_ref = 1
       iftlog.log(3, "iftcache: started")
-      
-      cache_ref += 1
+      return 0
+   finally:
       cache_sem.release()
-   except Exception, inst:
-      iftlog.exception("iftcache: could not start cache", inst)
-      return E_UNHANDLED_EXCEPTION
-   
-   return 0
 
 
 
 def cache_shutdown():
    """
-   Shut down the caching system if no one is using it
-   
+   Shut down the cache if no one is using it.  The cached files stay on disk for next time.
+
    @return
       0 on success; negative on failure
-   
    """
-   
+
    global cache_ref
-   global cache_sem
-   global cache_server
-   global cache_dir 
-   
-   try:
-      cache_sem.acquire()
+   global cache
+
+   cache_sem.acquire()
+   if cache_ref > 0:
       cache_ref -= 1
 
-      # TODO: less kludgy way?
-      os.popen("rm -rf " + cache_dir).close()
+   if cache_ref == 0:
+      cache = None
+   cache_sem.release()
+   return 0
 
-      if cache_ref == 0:
-         # stop our cache server
-         if cache_server != None:
-            cache_server.socket.close()
 
-         del cache_server
-         cache_server = None
-   
-   
-      
-      cache_sem.release()
-   except Exception, inst:
-      iftlog.log("iftcache: could not shut down cache", inst)
-      return E_UNHANDLED_EXCEPTION
-
-   return 0
 
+def cache_key( host, file_path ):
+   """
+   Name a file is cached under:  the host it came from, and its path there
+   """
+   if host == None:
+      host = ""
+   return host + ":" + os.path.abspath( file_path )
 
 
 
-def cache_purge_file( file_path, http_port ):
+def cache_purge_file( file_path, host=None, file_hash=None ):
    """
    Eliminate the given file from the cache.
-   
+
    @return
       0 on success; negative on error
    """
-   
-   # tell Squid to lose the file
-   rc = os.popen( "squidclient -m PURGE http://127.0.0.1:" + str(http_port) + "/" + os.path.abspath(file_path) ).close()
-   
-   if rc != 0:
-      iftlog.log(5, "iftcache.cache_purge_file: squidclient rc=" + str(rc) )
-   
-   return rc
-   
-   
+   if cache == None:
+      return E_UNAVAIL
+
+   cache.purge( file_hash, cache_key( host, file_path ) )
+   return 0
+
 
 
-def cache_put_file( file_path, squid_port, http_port ):
+def cache_put_file( file_path, name=None, file_hash=None ):
    """
-   Put the given file into the cache
-   
+   Put the given file into the cache, under the given name (see cache_key()).
+
    @return
       0 on success; negative on error
    """
-   
-   # get the file from HTTPCacheServer through Squid so it goes into Squid's cache
-   try:
-      file_path = file_path.lstrip('/')
-      request = urllib2.Request( "http://127.0.0.1:" + str(http_port) + "/" + file_path )
-      request.set_proxy( "127.0.0.1:" + str(squid_port), "http" )
-      urllib2.urlopen( request ).close()
-      return 0
-   
-   except Exception, inst:
-      iftlog.exception("iftcache.cache_put_file: could not cache file " + file_path, inst)
-      return -1
-   
+   if cache == None:
+      return E_UNAVAIL
+
+   rc, digest = cache.put_file( file_path, name, file_hash )
+   return rc
+
 
 
-def cache_get_file( file_path, max_age, connect_args, job_attrs, squid_port, http_port ):
+def cache_get_file( dest_path, file_hash, name, max_age ):
    """
-   Get the given file (file_path) from the cache and return a file handle to it (via urllib2) if it is
-   younger than max_age (where max_age is in seconds)
-   
+   Get a file from the cache (by SHA-1 if file_hash is given, or else by name), if it was cached
+   less than max_age seconds ago (any age if max_age <= 0), and put it at dest_path.
+
+   @return
+      0 on success; negative on a miss or error
    """
-   
-   # get the file from squid
-   global tmp_connect_args
-   global tmp_job_attrs
-   try:
-      if tmp_job_attrs == None:
-         tmp_job_attrs = {}
-      if tmp_connect_args == None:
-         tmp_connect_args = {}
-         
-      tmp_connect_args[os.path.basename(file_path)] = copy.deepcopy(connect_args)
-      tmp_job_attrs[os.path.basename(file_path)] = iftfile.iftjob.get_attrs_copy(job_attrs)
-      
-      proxy_handler = urllib2.ProxyHandler( {'http': 'http://127.0.0.1:' + str(squid_port)} )
-      opener = urllib2.build_opener( proxy_handler )
-      
-      if max_age > 0:
-         opener.addheaders = [("Cache-Control","max-age=" + str(max_age))]
-      
-      cached_file_fd = opener.open( "http://127.0.0.1:" + str(http_port) + os.path.abspath( file_path ) )
-      return cached_file_fd
-   
-   except urllib2.HTTPError, inst:
+   if cache == None:
+      return E_UNAVAIL
+
+   digest = cache.lookup( file_hash, name, max_age )
+   if digest == None:
       iftlog.log(1, "iftcache.cache_get_file: file not in cache")
-      tmp_connect_args[os.path.basename(file_path)] = None
-      tmp_job_attrs[os.path.basename(file_path)] = None
-      return None
-   
-   except socket.error, inst:
-      # if the connection was simply refused, then just fail
-      if inst.args[0] == 111:
-         # receive the file with any protocol
-         iftlog.log(5, "iftcache.cache_get_file: could not query cache on port " + str(http_port) + ", 111 connection refused" )
-         return None
-         
-      else:
-         iftlog.exception( "iftcache.cache_get_file: socket error", inst)
-         return None     # some other error
-         
-   
-   except Exception, inst:
-      iftlog.exception( "iftcache.cache_get_file: could not query cache on port " + str(http_port), inst)
-      tmp_connect_args[os.path.basename(file_path)] = None
-      tmp_job_attrs[os.path.basename(file_path)] = None
-      return None
-   
-
-
-def cache_path( filename ):
-   """
-   Given a filename, find out where it would go in the cache.
-   """
-   
-   return cache_dir + "/" + os.path.basename(filename)
+      return E_FILE_NOT_FOUND
 
+   return cache.link_out( digest, dest_path )
@@ -36,6 +36,13 @@ IFTSCP_IDENTITY_FILE = "IFTSCP_IDENTITY_FILE"
 # option to supply remote login name
 IFTSCP_REMOTE_LOGIN = "IFTSCP_REMOTE_LOGIN"
 
+
+def shell_quote( s ):
+   """
+   Quote a string so that a shell reads it back as one word, as it is.
+   """
+   return "'" + str(s).replace( "'", "'\\''" ) + "'"
+
 """
 Sender--SCP a file over
 """
@@ -129,6 +136,24 @@ class iftscp_sender( iftcore.iftsender.sender ):
       if chunk_path:
          local = chunk_path
          remote = remote_chunk_path
+      
+      elif isinstance( chunk, iftfile.chunk_view ) and remote_chunk_path:
+         # there is no chunk file to copy, so stream the chunk's byte range over ssh
+         # (the remote command is run by the remote shell, so the remote path is quoted for it, and then the whole command for ours)
+         cmd = "tail -c +" + str(chunk.offset + 1) + " " + shell_quote( chunk.source.path ) + " | head -c " + str(len(chunk)) + " | ssh -p " + str(self.port)
+         if self.identity_file != "":
+            cmd += " -i " + shell_quote( self.identity_file )
+         
+         cmd += " " + shell_quote( self.remote_user + "@" + self.remote_host ) + " " + shell_quote( "cat > " + shell_quote( remote_chunk_path ) )
+         
+         iftlog.log(1, self.name + ": " + cmd)
+         pipe = os.popen( cmd )
+         rc = pipe.close()
+         if rc != None:
+            iftlog.log(5, "iftscp_sender: ssh returned " + str(rc))
+            return -rc
+         
+         return len(chunk)
          
       # shell out and scp
       cmd = "/usr/bin/scp -P " + str(self.port)
@@ -4,16 +4,38 @@
 iftsocket.py
 Copyright (c) 2009 Jude Nelson
 
-This package defines a transfer protocol over a simple TCP socket.
-It is push technology--the sender initiates the connection, and moves the data.
+This package defines a transfer protocol over simple TCP sockets.
+It is push technology--the sender initiates the connections, and moves the data.
+
+Each chunk is sent as a frame:  a fixed-size binary header (see
+IFTSOCKET_HEADER) followed by the chunk data.  The header carries the
+chunk ID, the data length, and (unless turned off) a CRC-32 of the data.
+
+A transfer may use several TCP streams at once (IFTSOCKET_STREAMS), with
+each chunk going over whichever stream can take it.  Streams are kept open
+between transfers to the same peer, so the next transfer does not pay for
+new connections.  The first frame a sender puts on a stream for a transfer
+is a hello frame naming the transmission (by the ID both iftds know it by),
+so that the receiver knows which transfer the stream now carries, even if
+another transfer of the same file is under way.  A stream that said hello
+to a receiver on the same port is handed off to the right one.
+
+If the two iftds agreed on a codec (see iftcodec), the chunk data in each
+frame is encoded with it.
 """
 
 import os
 import sys
 import protocols
 import socket
+import select
 import cPickle
+import struct
+import threading
+import time
+import zlib
 import iftfile
+import iftevent
 
 import iftlog
 
@@ -27,172 +49,544 @@ from iftcore.consts import *
 """
 Additional constants
 """
-IFTSOCKET_LEN_DELIM = chr(0x01)        # delimits between length of chunk and message content
-IFTSOCKET_CHUNK_DELIM = chr(0x02)      # delimits between chunk ID and length
-
 IFTSOCKET_TIMEOUT = "IFTSOCKET_TIMEOUT"
+IFTSOCKET_CHECKSUM = "IFTSOCKET_CHECKSUM"       # (job attribute) if False, the sender does not checksum frames
+IFTSOCKET_STREAMS = "IFTSOCKET_STREAMS"         # (job attribute) how many TCP streams the sender opens to the receiver
+IFTSOCKET_KEEPALIVE = "IFTSOCKET_KEEPALIVE"     # (job attribute) if False, streams are closed after the transfer instead of kept for the next one
+
+IFTSOCKET_DEFAULT_STREAMS = 4
+IFTSOCKET_BACKLOG = 16                # connections the receiver's listening socket queues
+IFTSOCKET_POOL_IDLE = 60.0            # seconds a receiver keeps an idle stream (senders keep theirs half as long, so they give up first)
+IFTSOCKET_POOL_MAX = 16               # most idle streams a sender keeps per receiver
+IFTSOCKET_RECEIVER_POOL_MAX = 256     # most streams a receiver keeps per port (some may already carry the next transfer)
+
+# frame header:  magic, version, flags, chunk ID, data length, CRC-32 of the data
+IFTSOCKET_HEADER = struct.Struct( "!4sBBxxQQI" )
+IFTSOCKET_MAGIC = "IFTS"
+IFTSOCKET_VERSION = 1
+IFTSOCKET_FLAG_CHECKSUM = 0x01        # the header's CRC-32 is valid
+IFTSOCKET_FLAG_HELLO = 0x02           # the frame starts a transfer on this stream; its data is the transmission's ID (or empty)
+
+IFTSOCKET_COALESCE_MAX = 65536        # chunks up to this size go out in one send with their header
+IFTSOCKET_FRAME_SLACK = 4096          # bytes a frame may hold beyond the job's chunk size (codec tag, hello data)
+
+# can we receive straight into a preallocated buffer?  (not before Python 2.7; older ones join strings instead)
+try:
+   HAVE_RECV_INTO = hasattr( socket.socket, "recv_into" ) and memoryview != None
+except NameError:
+   HAVE_RECV_INTO = False
+
+
+def frame_header( chunk_id, chunk, checksum=True, flags=0 ):
+   """
+   Make the header for a frame holding the given chunk (a string or iftfile.chunk_view).
+   """
+   crc = 0
+   if checksum:
+      flags |= IFTSOCKET_FLAG_CHECKSUM
+      if isinstance( chunk, iftfile.chunk_view ):
+         m = chunk.source.get_map()
+         if m != None:
+            crc = zlib.crc32( buffer( m, chunk.offset, chunk.length ) )
+         else:
+            crc = zlib.crc32( chunk.read() )
+      else:
+         crc = zlib.crc32( chunk )
+
+   return IFTSOCKET_HEADER.pack( IFTSOCKET_MAGIC, IFTSOCKET_VERSION, flags, chunk_id, len(chunk), crc & 0xffffffff )
+
+
+def hello_frame( key ):
+   """
+   Make the frame that starts the transmission with the given ID on a stream.
+   """
+   if key == None:
+      key = ""
+
+   return frame_header( 0, key, True, IFTSOCKET_FLAG_HELLO ) + key
+
+
+def recv_exactly( soc, view, length ):
+   """
+   Fill the first length bytes of view (a memoryview onto a preallocated buffer) from soc.
+   Return 0 on success, E_EOF if the connection closed first, or E_NO_DATA on error.
+   """
+   got = 0
+   while got < length:
+      try:
+         n = soc.recv_into( view[got:length], length - got )
+      except socket.timeout:
+         return E_NO_DATA
+      except socket.error, inst:
+         iftlog.log(3, "iftsocket: receive failed (" + str(inst) + ")")
+         return E_NO_DATA
+
+      if n == 0:
+         return E_EOF
+
+      got += n
+
+   return 0
+
+
+def recv_string( soc, length ):
+   """
+   Read exactly length bytes from soc, for Pythons without recv_into (see HAVE_RECV_INTO).
+   Return (0, data) on success, (E_EOF, None) if the connection closed first, or (E_NO_DATA, None) on error.
+   """
+   parts = []
+   got = 0
+   while got < length:
+      try:
+         part = soc.recv( length - got )
+      except socket.timeout:
+         return (E_NO_DATA, None)
+      except socket.error, inst:
+         iftlog.log(3, "iftsocket: receive failed (" + str(inst) + ")")
+         return (E_NO_DATA, None)
+
+      if len(part) == 0:
+         return (E_EOF, None)
+
+      parts.append( part )
+      got += len(part)
+
+   return (0, "".join( parts ))
+
+
+def is_alive( soc ):
+   """
+   Is a stream we are not reading from still connected?  (It is, unless reading it would find the end of the stream.)
+   """
+   try:
+      if len( select.select( [soc], [], [], 0 )[0] ) == 0:
+         return True
+
+      return len( soc.recv( 1, socket.MSG_PEEK ) ) > 0
+   except:
+      return False
+
+
+def close_quietly( soc ):
+   try:
+      soc.close()
+   except:
+      pass
+
+
+
+class stream_pool:
+   """
+   Idle, connected streams, by peer, waiting to be used by the next transfer.
+   Streams that have been idle longer than the pool's lifetime are closed.
+   """
+
+   def __init__( self, lifetime, max_streams ):
+      self.lifetime = lifetime
+      self.max_streams = max_streams
+      self.__idle = {}        # peer: [(socket, time it went idle)]
+      self.__lock = threading.Lock()
+
+
+   def __expire( self, now ):
+      """
+      Close what has been idle too long.  Call with the lock held.
+      """
+      for peer in self.__idle.keys():
+         keep = []
+         for (soc, idle_since) in self.__idle[peer]:
+            if now - idle_since < self.lifetime:
+               keep.append( (soc, idle_since) )
+            else:
+               close_quietly( soc )
+
+         if len(keep) > 0:
+            self.__idle[peer] = keep
+         else:
+            del self.__idle[peer]
+
+
+   def take( self, peer, count ):
+      """
+      Get up to count idle streams to a peer.
+      """
+      self.__lock.acquire()
+      try:
+         self.__expire( time.time() )
+         idle = self.__idle.get( peer, [] )
+         taken = [soc for (soc, idle_since) in idle[:count]]
+         if len(idle) > count:
+            self.__idle[peer] = idle[count:]
+         elif self.__idle.has_key( peer ):
+            del self.__idle[peer]
+      finally:
+         self.__lock.release()
+
+      return taken
+
+
+   def give( self, peer, streams ):
+      """
+      Keep streams to a peer for the next transfer (closing any beyond max_streams).
+      """
+      now = time.time()
+      self.__lock.acquire()
+      try:
+         self.__expire( now )
+         idle = self.__idle.setdefault( peer, [] )
+         for soc in streams:
+            if len(idle) < self.max_streams:
+               idle.append( (soc, now) )
+            else:
+               close_quietly( soc )
+      finally:
+         self.__lock.release()
+
+
+   def __len__( self ):
+      return len(self.__idle)
+
+
+   def close_all( self ):
+      """
+      Close every idle stream.
+      """
+      self.__lock.acquire()
+      try:
+         for idle in self.__idle.values():
+            for (soc, idle_since) in idle:
+               close_quietly( soc )
+
+         self.__idle = {}
+      finally:
+         self.__lock.release()
+
+
+# senders' idle streams, by (host, port)
+SENDER_POOL = stream_pool( IFTSOCKET_POOL_IDLE / 2, IFTSOCKET_POOL_MAX )
+
+# receivers' idle streams, by port
+RECEIVER_POOL = stream_pool( IFTSOCKET_POOL_IDLE, IFTSOCKET_RECEIVER_POOL_MAX )
+
+# streams a receiver accepted for another transfer on its port, by (port, transmission ID), for that transfer's receiver to take
+HANDOFF_POOL = stream_pool( IFTSOCKET_POOL_IDLE, IFTSOCKET_RECEIVER_POOL_MAX )
+
+# fired whenever a stream is put in HANDOFF_POOL, to wake the receivers waiting for streams
+HANDOFF_EVENT = iftevent.event()
+
+# receivers' listening sockets, by port (kept open so that kept streams' senders can add more)
+LISTENERS = {}
+LISTENERS_LOCK = threading.Lock()
+
+
+def get_listener( port ):
+   """
+   Get the listening socket for a port, making it if need be.
+   """
+   LISTENERS_LOCK.acquire()
+   try:
+      soc = LISTENERS.get( port )
+      if soc == None:
+         soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+         soc.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+         soc.bind( ("", port) )
+         soc.listen( IFTSOCKET_BACKLOG )
+         soc.setblocking( 0 )
+         LISTENERS[port] = soc
+         iftlog.log(1, "iftsocket_receiver: Listening on port " + str(port) )
+
+      return soc
+   finally:
+      LISTENERS_LOCK.release()
+
+
+def close_idle_streams():
+   """
+   Close every kept stream and listening socket (e.g. on shutdown).
+   """
+   SENDER_POOL.close_all()
+   RECEIVER_POOL.close_all()
+   HANDOFF_POOL.close_all()
+   LISTENERS_LOCK.acquire()
+   try:
+      for soc in LISTENERS.values():
+         close_quietly( soc )
+
+      LISTENERS.clear()
+   finally:
+      LISTENERS_LOCK.release()
+
+
 
 """
-Sender for a TCP socket.
+Sender for TCP sockets.
 Requires:
    PROTO_PORTNUM          the port on which to send
 """
 class iftsocket_sender( iftcore.iftsender.sender ):
-   
+
    def __init__(self):
       iftcore.iftsender.sender.__init__(self)
-      self.soc = None
+      self.streams = []             # connected streams carrying this transfer
+      self.next_stream = 0          # where to start looking for a stream that can take a chunk
+      self.peer = None              # (host, port) we're sending to
       self.name = "iftsocket_sender"
       self.port = 0
+      self.timeout = 5
+      self.checksum = True
+      self.keepalive = True
+      self.reusable = True
+      self.chunk_codec = True       # frames carry chunks as given, so they can be compressed
       # sender is active
       self.setactive(True)
       self.set_chunking_mode( PROTO_DETERMINISTIC_CHUNKING )
-   
+
    def get_setup_attrs(self):
       return [PROTO_PORTNUM]
-   
+
    def get_connect_attrs(self):
       return []
-   
+
    def get_send_attrs(self):
       return [iftfile.JOB_ATTR_SRC_NAME, iftfile.JOB_ATTR_SRC_HOST, iftfile.JOB_ATTR_FILE_SIZE]
-   
+
    # what does this sender recognize?
    def get_all_attrs(self):
-      return self.get_setup_attrs() + self.get_connect_attrs() + self.get_send_attrs() + [PROTO_PORTNUM]
-   
+      return self.get_setup_attrs() + self.get_connect_attrs() + self.get_send_attrs() + [PROTO_PORTNUM, IFTSOCKET_TIMEOUT, IFTSOCKET_CHECKSUM, IFTSOCKET_STREAMS, IFTSOCKET_KEEPALIVE]
+
    def setup(self, connect_args):
       self.port = connect_args.get(PROTO_PORTNUM)
       return 0
-         
-      
+
+
+   def add_stream( self, soc, key=None ):
+      """
+      Start sending this transfer (the transmission with ID key) on a connected stream.
+      Return 0 on success, or E_NO_CONNECT if the stream is broken.
+      """
+      try:
+         soc.sendall( hello_frame( key ) )
+      except socket.error, inst:
+         close_quietly( soc )
+         return E_NO_CONNECT
+
+      self.streams.append( soc )
+      return 0
+
+
+   def __connect( self, remote_host ):
+      """
+      Open a new stream to the receiver.
+      """
+      soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+      try:
+         iftlog.log(1, self.name + ": connecting to " + remote_host + " on port " + str(self.port))
+         soc.settimeout( self.timeout )
+         soc.connect( (remote_host, self.port) )
+         return soc
+      except Exception, inst:
+         iftlog.exception( self.name + ": could not connect", inst)
+         close_quietly( soc )
+         return None
+
+
    # prepare for transmission
    def prepare_transmit( self, job ):
       # file should have remote hostname
       p = job.get_attr( PROTO_PORTNUM )
       if p != None:
          self.port = p
-         
+
       remote_host = None
       try:
          remote_host = job.attrs[ iftfile.JOB_ATTR_DEST_HOST]
       except Exception, inst:
          iftlog.exception( self.name + ": No remote host specified", inst )
          return E_NO_CONNECT
-      
+
       timeout = job.get_attr( IFTSOCKET_TIMEOUT )
-      if timeout == None:
-         timeout = 5
-      
-      self.soc = None
-      if remote_host != None and self.port != None:
-         # try to connect to the remote host
-         self.soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
-         self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-         
-         connect_rc = 0
-         try:
-            iftlog.log(1, self.name + ": connecting to " + remote_host + " on port " + str(self.port))
-            self.soc.settimeout( 5 )
-            self.soc.connect( (remote_host, self.port) )
-         except Exception, inst:
-            iftlog.exception( self.name + ": could not connect", inst)
-            return E_NO_CONNECT
-         
-         if connect_rc != 0:
-            return E_NO_CONNECT
-         else:
-            return 0
-      else:
+      if timeout != None:
+         self.timeout = timeout
+
+      num_streams = IFTSOCKET_DEFAULT_STREAMS
+      if job.get_attr( IFTSOCKET_STREAMS ) != None:
+         num_streams = max( 1, int( job.get_attr( IFTSOCKET_STREAMS ) ) )
+
+      self.checksum = (job.get_attr( IFTSOCKET_CHECKSUM ) != False)
+      self.keepalive = (job.get_attr( IFTSOCKET_KEEPALIVE ) != False)
+
+      if remote_host == None or self.port == None:
          return E_NO_VALUE
-         
-   
+
+      self.streams = []
+      self.next_stream = 0
+      self.peer = (remote_host, self.port)
+      key = job.get_attr( iftfile.JOB_ATTR_XMIT_ID )
+
+      # reuse what streams we kept to this receiver, then make the rest
+      reused = 0
+      for soc in SENDER_POOL.take( self.peer, num_streams ):
+         if is_alive( soc ):
+            if self.add_stream( soc, key ) == 0:
+               reused += 1
+         else:
+            close_quietly( soc )
+
+      while len(self.streams) < num_streams:
+         soc = self.__connect( remote_host )
+         if soc == None:
+            break
+
+         self.add_stream( soc, key )
+
+      if len(self.streams) == 0:
+         return E_NO_CONNECT
+
+      iftlog.log(1, self.name + ": sending over " + str(len(self.streams)) + " streams (" + str(reused) + " reused)")
+      return 0
+
+
    # clean up
    def proto_clean( self ):
-      # close up and nullify
-      if self.soc != None:
-         self.soc.close()
-      self.soc = None
-      
-   
+      # keep the streams for the next transfer to this receiver, or close them
+      if self.keepalive and self.peer != None:
+         SENDER_POOL.give( self.peer, self.streams )
+      else:
+         for soc in self.streams:
+            close_quietly( soc )
+
+      self.streams = []
+      self.peer = None
+
+
+   # on shutdown, close what we kept
+   def kill( self, args ):
+      self.keepalive = False
+      self.proto_clean()
+      close_idle_streams()
+
+
+   def __writable_stream( self ):
+      """
+      Get a stream that can take more data, waiting up to the timeout for one.
+      Streams are tried in turn, so that they share the chunks.
+      """
+      if len(self.streams) == 1:
+         return self.streams[0]
+
+      writable = select.select( [], self.streams, [], self.timeout )[1]
+      if len(writable) == 0:
+         return None
+
+      # take the first writable stream at or after next_stream
+      for i in xrange(0, len(self.streams)):
+         j = (self.next_stream + i) % len(self.streams)
+         if self.streams[j] in writable:
+            self.next_stream = (j + 1) % len(self.streams)
+            return self.streams[j]
+
+      return None
+
+
    # Send a chunk
    def send_chunk( self, chunk, chunk_id, chunk_path, remote_chunk_path ):
       # ignore chunk paths, since we send actual chunks
-      
-      if self.soc != None:
-         total_sent = 0
-         # send the length and chunk id
-         header_str = str(chunk_id) + IFTSOCKET_CHUNK_DELIM + str(len( chunk )) + IFTSOCKET_LEN_DELIM
-         header_sent = self.soc.send( header_str )
-         if header_sent != len( header_str ):
-            # problem...
-            return E_NO_CONNECT
-         
-         while total_sent < len(chunk):
-            sent = self.soc.send( chunk[total_sent:] )
-            if sent == 0:
-               return total_sent
-            total_sent = total_sent + sent
-         
-         return total_sent
-      else:
+
+      if len(self.streams) == 0:
          return E_INVAL
-      
+
+      header = frame_header( chunk_id, chunk, self.checksum )
+
+      while len(self.streams) > 0:
+         soc = self.__writable_stream()
+         if soc == None:
+            iftlog.log(5, self.name + ": timed out waiting to send chunk " + str(chunk_id))
+            return E_TIMEOUT
+
+         try:
+            if isinstance( chunk, iftfile.chunk_view ):
+               # send straight out of the file
+               soc.sendall( header )
+               return chunk.send( soc )
+
+            if len(chunk) <= IFTSOCKET_COALESCE_MAX:
+               soc.sendall( header + chunk )
+            else:
+               soc.sendall( header )
+               soc.sendall( chunk )
+
+            return len(chunk)
+
+         except socket.error, inst:
+            # part of a frame may have gone out, so the receiver can't find its place on this stream again.
+            # drop it, and try the others.
+            iftlog.log(5, self.name + ": could not send chunk " + str(chunk_id) + " (" + str(inst) + "), closing stream")
+            self.streams.remove( soc )
+            close_quietly( soc )
+            self.next_stream = 0
+
+      return E_NO_CONNECT
+
 
 
 """
-Receiver for a socket
+Receiver for TCP sockets
 Requires:
    PROTO_PORTNUM            The port to listen on
- 
+
 """
 
 class iftsocket_receiver( iftcore.iftreceiver.receiver ):
-   
+
    def __init__(self):
       iftcore.iftreceiver.receiver.__init__(self)
-      self.client_soc = None
-      self.soc = None
+      self.soc = None               # listening socket (shared by every receiver on the port)
+      self.streams = []             # streams carrying this transfer
+      self.unclaimed = []           # streams that have not yet said which transfer they carry
       self.name = "iftsocket_receiver"
       self.port = 0
       self.job = None
-      self.connected = False
+      self.timeout = 1
+      self.buf = None               # reused for receiving chunk data (grown as needed)
+      self.handoff = iftevent.waiter()   # woken when another receiver hands off a stream (maybe ours)
+      self.reusable = True
+      self.chunk_codec = True
       # receiver is not active
       self.setactive(False)
       self.set_chunking_mode( PROTO_DETERMINISTIC_CHUNKING )
-      
-      
+
+
    def get_setup_attrs(self):
       return [PROTO_PORTNUM]
-   
+
    def get_connect_attrs(self):
       return []
-   
+
    def get_recv_attrs( self ):
       return [iftfile.JOB_ATTR_DEST_NAME, iftfile.JOB_ATTR_DEST_HOST, iftfile.JOB_ATTR_FILE_SIZE, iftfile.JOB_ATTR_FILE_HASH]
-   
+
    # what does this receiver recognize?
    def get_all_attrs( self ):
       return self.get_setup_attrs() + self.get_connect_attrs() + self.get_recv_attrs() + [iftfile.JOB_ATTR_CHUNKSIZE, IFTSOCKET_TIMEOUT]
-   
+
    def setup( self, setup_attrs ):
       try:
          self.port = setup_attrs[PROTO_PORTNUM]
          iftlog.log(1, "iftsocket_receiver.setup: will receive on port " + str(self.port))
       except:
          return E_NO_VALUE
-      
+
       # nothing to do...
       return 0
-   
+
    # receive file attributes from an iftsocket_sender
    def recv_job( self, job ):
       self.job = job
       if job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE ) == None:
          self.job.attrs[ iftfile.JOB_ATTR_CHUNKSIZE ] = iftfile.DEFAULT_FILE_CHUNKSIZE
-      
+
       return 0
-   
+
    # wait for a connection (we're on our own thread by now)
    def await_sender( self, connection_attrs, timeout ):
       if connection_attrs != None:
@@ -202,156 +596,294 @@ class iftsocket_receiver( iftcore.iftreceiver.receiver ):
                self.port = int(p)
             except:
                pass
-      
-      # set up a server socket to the remote host
-      self.soc = None
-      self.connected = False
-      
-      if connection_attrs.get( IFTSOCKET_TIMEOUT ) != None:
+
+      self.streams = []
+      self.unclaimed = []
+
+      if connection_attrs != None and connection_attrs.get( IFTSOCKET_TIMEOUT ) != None:
          self.timeout = connection_attrs.get( IFTSOCKET_TIMEOUT )
       else:
          self.timeout = 1
-         
+
       if self.port != None:
-         
+
          try:
-            self.soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
-            self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.soc.settimeout( self.timeout )      # use the given timeout
-            self.soc.bind( ("localhost", self.port) )
-            self.soc.listen(1)      # only one remote host should talk to me
-            iftlog.log(1, "iftsocket_receiver: Listening on localhost:" + str(self.port) )
+            self.soc = get_listener( self.port )
          except Exception, inst:
-            iftlog.exception( "iftsocket_receiver: could not set up server socket", str(inst) )
+            iftlog.exception( "iftsocket_receiver: could not set up server socket", inst )
             return E_NO_CONNECT
-         
+
+         # streams kept from earlier transfers may carry this one
+         self.unclaimed = RECEIVER_POOL.take( self.port, IFTSOCKET_RECEIVER_POOL_MAX )
          return 0
       else:
          return E_NO_VALUE
-      
-   
+
+
+   def add_stream( self, soc ):
+      """
+      Receive on a connected stream, once it says it carries this transfer.
+      """
+      self.unclaimed.append( soc )
+
+
    def proto_clean( self ):
-      if self.soc != None:
-         self.soc.close()
-         
-      if self.client_soc != None:
-         self.client_soc.close()
-      
-      
-      self.client_soc = None
+      # keep the streams for the next transfer on this port (unless their senders hung up)
+      for soc in self.streams + self.unclaimed:
+         if self.port != None and is_alive( soc ):
+            RECEIVER_POOL.give( self.port, [soc] )
+         else:
+            close_quietly( soc )
+
+      self.streams = []
+      self.unclaimed = []
       self.soc = None
-      self.connected = False
-      
-      
-   
-   def recv_chunks( self, remote_chunk_dir, desired_chunks ):
-   
-      # wait for data...
-      if not self.connected:   
+      self.buf = None
+
+
+   # on shutdown, close what we kept
+   def kill( self, args ):
+      for soc in self.streams + self.unclaimed:
+         close_quietly( soc )
+
+      self.streams = []
+      self.unclaimed = []
+      close_idle_streams()
+
+
+   def __drop( self, soc ):
+      """
+      Stop receiving on a stream, and close it.
+      """
+      if soc in self.streams:
+         self.streams.remove( soc )
+      if soc in self.unclaimed:
+         self.unclaimed.remove( soc )
+
+      close_quietly( soc )
+
+
+   def __recv_data( self, soc, length ):
+      """
+      Read length bytes of frame data from a stream.
+      Return (0, data) on success, or (negative, None) on error.
+      """
+      chunk = ""
+      if length > 0 and hasattr( socket, "MSG_WAITALL" ):
+         # have the kernel fill a string of the right size directly (if the socket blocks)
          try:
-            (self.client_soc, addr) = self.soc.accept()
-            self.connected = True
+            chunk = soc.recv( length, socket.MSG_WAITALL )
          except socket.timeout:
-            iftlog.log(5, "iftsocket_receiver: timed out (waited " + str(self.timeout) + " seconds)")
-            return E_TIMEOUT
-         
+            chunk = ""
+         except socket.error, inst:
+            iftlog.log(3, self.name + ": receive failed (" + str(inst) + ")")
+            return (E_NO_DATA, None)
+
+         if len(chunk) == length:
+            return (0, chunk)
+
+         if len(chunk) == 0 and soc.gettimeout() == None:
+            return (E_EOF, None)
+
+      if not HAVE_RECV_INTO:
+         rc, rest = recv_string( soc, length - len(chunk) )
+         if rc != 0:
+            return (rc, None)
+
+         return (0, chunk + rest)
+
+      # read the rest into our buffer
+      if self.buf == None or len(self.buf) < length:
+         self.buf = bytearray( length )
+
+      self.buf[0:len(chunk)] = chunk
+      view = memoryview( self.buf )
+      rc = recv_exactly( soc, view[len(chunk):], length - len(chunk) )
+      if rc != 0:
+         return (rc, None)
+
+      return (0, str( buffer( self.buf, 0, length ) ))
+
+
+   def __frame_max( self ):
+      """
+      Get the most data a frame for our job may hold.
+      """
+      chunksize = None
+      if self.job != None:
+         chunksize = self.job.get_attr( iftfile.JOB_ATTR_CHUNKSIZE )
+      if chunksize == None:
+         chunksize = iftfile.DEFAULT_FILE_CHUNKSIZE
+
+      return chunksize + IFTSOCKET_FRAME_SLACK
+
+
+   def __recv_frame( self, soc ):
+      """
+      Read a whole frame from a stream.
+      Return (0, flags, chunk ID, data, whether the checksum matched) on success, or (negative, ...) on error.
+      """
+      rc, header = self.__recv_data( soc, IFTSOCKET_HEADER.size )
+      if rc != 0:
+         return (rc, 0, 0, None, False)
+
+      magic, version, flags, chunk_id, chunk_len, crc = IFTSOCKET_HEADER.unpack( header )
+      if magic != IFTSOCKET_MAGIC or version != IFTSOCKET_VERSION or chunk_len > self.__frame_max():
+         # we've lost our place in the stream; nothing after this can be trusted
+         iftlog.log(5, self.name + ": bad frame header (magic " + repr(magic) + ", version " + str(version) + ", length " + str(chunk_len) + ")")
+         return (E_CORRUPT, 0, 0, None, False)
+
+      rc, chunk = self.__recv_data( soc, chunk_len )
+      if rc != 0:
+         return (rc, 0, 0, None, False)
+
+      ok = not (flags & IFTSOCKET_FLAG_CHECKSUM) or (zlib.crc32( chunk ) & 0xffffffff) == crc
+      return (0, flags, chunk_id, chunk, ok)
+
+
+   def __accept( self ):
+      """
+      Take any new streams waiting on the listening socket.
+      """
+      while True:
+         try:
+            soc, addr = self.soc.accept()
+         except socket.error:
+            return
+
+         soc.setblocking( 1 )
+         self.unclaimed.append( soc )
+
+
+   def recv_chunks( self, remote_chunk_dir, desired_chunks ):
+      HANDOFF_EVENT.subscribe( self.handoff )
+      try:
+         return self.__recv_streams( desired_chunks )
+      finally:
+         HANDOFF_EVENT.unsubscribe( self.handoff )
+
+
+   def __recv_streams( self, desired_chunks ):
+      """
+      Receive the given chunks from whichever of our streams have them.
+      Return 0 on success, or negative on error.
+      """
       status = 0
-      
-      # receive every chunk in desired_chunks
-      while status == 0:
-         
-         # receive a chunk
-         c = ''
-         chunk_str = ''
-         len_str = ''
-      
-         # read chunk id
-         while True:
-            
-            recved = ''
-            try:
-               recved = self.client_soc.recv( 1 )
-               if recved == IFTSOCKET_CHUNK_DELIM:
-                  break
-            
-               if recved == '':
-                  status = E_EOF
-                  break
-               
-            except:
-               status = E_NO_DATA
-               break
-            
-            chunk_str = chunk_str + recved
-         
-         # can't go on if we have nonzero status
-         if status != 0:
-            break
-         
-         # read length
-         while True:
-            
-            try:
-               recved = self.client_soc.recv( 1 )
-               if recved == IFTSOCKET_LEN_DELIM:
-                  break
-            
-               if recved == '':
-                  status = E_EOF
-                  break
-               
-            except:
-               status = E_NO_DATA
-               break
-            
-            len_str = len_str + recved
-         
-         # can't go on if we have nonzero status
-         if status != 0:
-            break
-         
-         # read remainder of chunk
-         chunk_len = int(len_str)
-         chunk_id = int(chunk_str)
-         chunk = ''
-         recv_cnt = 0
-         while chunk_len > recv_cnt:
-            recved = ''
-            
-            try:
-               recved = self.client_soc.recv( chunk_len - recv_cnt )
-               if recved == '':
-                  status = E_EOF
-                  break
-               
-            except:
-               status = E_NO_DATA
-               break
-            
-            # store chunk bytes
-            chunk = chunk + recved
-            recv_cnt = recv_cnt + len(recved)
-         
-         # store our chunk in the table
-         if status == 0:
+      remaining = set( desired_chunks )
+      key = None
+      if self.job != None:
+         key = self.job.get_attr( iftfile.JOB_ATTR_XMIT_ID )
+
+      # receive every chunk in desired_chunks, from whichever streams have them
+      idle_since = time.time()
+      lost = 0          # why we last lost all our streams
+      corrupted = False # whether a chunk failed its checksum
+      while len(remaining) > 0:
+
+         if len(HANDOFF_POOL) > 0 and self.port != None:
+            # streams another receiver accepted for us
+            self.streams += HANDOFF_POOL.take( (self.port, key), IFTSOCKET_RECEIVER_POOL_MAX )
+
+         watch = self.streams + self.unclaimed
+         if self.soc != None:
+            watch = watch + [self.soc]
+
+         if self.port != None:
+            # another receiver on our port may hand us streams
+            watch = watch + [self.handoff]
+
+         if len(watch) == 0:
+            return E_BAD_STATE
+
+         try:
+            readable = select.select( watch, [], [], max( 0, self.timeout - (time.time() - idle_since) ) )[0]
+         except select.error, inst:
+            continue       # interrupted
+
+         if self.handoff in readable:
+            # a stream was handed off; look for ours next time around
+            self.handoff.wait( 0 )
+            readable.remove( self.handoff )
+
+         if len(readable) == 0:
+            if time.time() - idle_since >= self.timeout:
+               if len(self.streams) == 0 and lost != 0:
+                  return lost
+
+               iftlog.log(5, "iftsocket_receiver: timed out (waited " + str(self.timeout) + " seconds)")
+               return E_TIMEOUT
+
+            continue
+
+         idle_since = time.time()
+
+         for soc in readable:
+            if soc is self.soc:
+               self.__accept()
+               continue
+
+            rc, flags, chunk_id, chunk, ok = self.__recv_frame( soc )
+            if rc != 0:
+               claimed = soc in self.streams
+               self.__drop( soc )
+               if claimed and rc == E_CORRUPT:
+                  status = E_CORRUPT
+
+               if claimed and len(self.streams) == 0:
+                  # the sender went away (or we lost our place with it)
+                  if status != 0:
+                     return status
+
+                  lost = rc
+                  if self.soc == None and len(self.unclaimed) == 0:
+                     return rc
+
+                  # ...unless its other streams are still on their way
+
+               continue
+
+            if flags & IFTSOCKET_FLAG_HELLO:
+               # a stream starting a transfer.  Is it ours?
+               if ok and (not key or not chunk or chunk == key):
+                  if soc in self.unclaimed:
+                     self.unclaimed.remove( soc )
+                  if soc not in self.streams:
+                     self.streams.append( soc )
+               elif ok and self.port != None:
+                  # pass it to the receiver for that transfer
+                  iftlog.log(5, self.name + ": stream is for another transfer (" + str(chunk) + "), handing it off")
+                  if soc in self.unclaimed:
+                     self.unclaimed.remove( soc )
+                  if soc in self.streams:
+                     self.streams.remove( soc )
+                  HANDOFF_POOL.give( (self.port, chunk), [soc] )
+                  HANDOFF_EVENT.fire()
+               else:
+                  iftlog.log(5, self.name + ": stream is for another transfer (" + str(chunk) + "), dropping it")
+                  self.__drop( soc )
+
+               continue
+
+            if soc in self.unclaimed:
+               # chunks before a hello; we can't know what transfer they belong to
+               iftlog.log(5, self.name + ": got chunk " + str(chunk_id) + " on a stream that has not said hello, dropping it")
+               self.__drop( soc )
+               continue
+
+            remaining.discard( chunk_id )
+            if not ok:
+               # the frame is intact, so keep going without it.  The sender won't send it again,
+               # so another protocol will have to fetch it.
+               iftlog.log(5, self.name + ": chunk " + str(chunk_id) + " failed its checksum, discarding")
+               status = E_CORRUPT
+               corrupted = True
+               continue
+
+            # store our chunk in the table
             self.add_chunk( chunk_id, chunk )
-            
-            # clear the chunk_id in the desired_chunks array
-            for i in range(0,len(desired_chunks)):
-               if desired_chunks[i] == chunk_id:
-                  desired_chunks[i] = 0
-                  break
-            
-            # do we have everything?  sum(desired_chunks) == 0 if so
-            sum = 0
-            for i in desired_chunks:
-               if i != 0:
-                  sum = i
-                  break
-            
-            if sum == 0:
-               break    # got everything!
-            
-            
-      return status
 
+      if corrupted:
+         # keep what we got, but we're done
+         self.recv_finished( TRANSMIT_STATE_FAILURE )
+
+      return status
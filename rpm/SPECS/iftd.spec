@@ -4,7 +4,7 @@ Version: 0.99
 Release: 1
 License: GPL
 Group: Development/Tools
-Requires: python, iftd-common, squid, python-lxml
+Requires: python, iftd-common, python-lxml
 BuildArch: noarch
 Buildroot: /tmp/iftd/
 Source: iftd.tar.gz
@@ -20,26 +20,6 @@ mkdir -p $RPM_BUILD_ROOT/%{instdir}
 tar xvf $RPM_SOURCE_DIR/iftd.tar.gz -C $RPM_BUILD_ROOT/%{instdir}
 
 %post
-SQUID_CONF="/etc/squid/squid.conf"
-IFTD_SQUIDCONF="/etc/iftd/squid.conf"
-IFTD_CONF="/etc/iftd/iftd.xml"
-SQUID_LOCKFILE="/var/lock/subsys/squid"
-
-if [ -f $SQUID_CONF ]; then 
-   mv $SQUID_CONF $SQUID_CONF.bak
-fi
-
-ln -s $IFTD_SQUIDCONF $SQUID_CONF
-
-if ! [ -f $SQUID_LOCKFILE ]; then
-   echo "Squid lockfile $SQUID_LOCKFILE not found."
-   echo "Attempting to start Squid."
-   /etc/init.d/squid start
-else
-   echo "Reconfiguring Squid to use IFTD's squid.conf"
-   /usr/sbin/squid -k reconfigure $SQUID_CONF
-fi
-
 /etc/init.d/iftd stop
 
 mkdir /tmp/iftd-files
@@ -60,6 +40,5 @@ chmod 666 /tmp/iftd-recv
 %{instdir}/usr/sbin/iftd
 %{instdir}/usr/bin/iftool
 %{instdir}/etc/iftd/iftd.xml
-%{instdir}/etc/iftd/squid.conf
 %{instdir}/etc/init.d/iftd
 %{instdir}/etc/cron.daily/iftd
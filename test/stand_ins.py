@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+
+"""
+Stand-ins for iftd objects that the tests need, but that are too heavy
+to build for real.
+"""
+
+class stand_in_job:
+	# stands in for an iftjob:  its attributes and stats, and nothing else
+	def __init__( self, attrs ):
+		self.attrs = attrs
+		self.stats = {}
+
+	def get_attr( self, attr ):
+		return self.attrs.get( attr )
+
+	def set_attr( self, attr, value ):
+		self.attrs[ attr ] = value
+
+	def get_stat( self, attr ):
+		return self.stats.get( attr )
+
+	def set_stat( self, attr, value ):
+		self.stats[ attr ] = value
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import threading
+
+sys.path.append( "../" )
+
+import iftfile
+import iftutil
+import iftapi
+from iftdata import *
+
+class batch_job:
+	# stands in for an iftjob
+	def __init__( self, attrs ):
+		self.attrs = attrs
+
+	def get_attr( self, attr ):
+		return self.attrs.get( attr )
+
+iftfile.iftjob = batch_job
+iftapi.PROTOCOLS = {}
+
+batch_sizes = []
+
+def recv_iftd_sender_data_batch( calls ):
+	batch_sizes.append( len(calls) )
+	return [[args[0], "/tmp/chunks/" + args[0], "iftsocket", ["iftsocket"]] for args in calls]
+
+def get_iftd_sender_data_batch( calls ):
+	batch_sizes.append( len(calls) )
+	return [[args[0]] for args in calls]
+
+def send_iftd_receiver_choice_batch( calls ):
+	batch_sizes.append( len(calls) )
+	return [args[0] for args in calls]
+
+def echo( x ):
+	if x == "fail":
+		raise Exception( "failed" )
+	return x
+
+server = iftutil.create_server( 0, [recv_iftd_sender_data_batch, get_iftd_sender_data_batch, send_iftd_receiver_choice_batch, echo], request_handler = iftutil.remote_request_handler )
+server.logRequests = False
+t = threading.Thread( target=server.serve_forever )
+t.setDaemon( True )
+t.start()
+port = server.server_address[1]
+
+# stand-ins for the per-file steps
+def prepare_send( job, available_protocols, connect_dict, user_timeout ):
+	if job.get_attr( "id" ) == "bad":
+		return (E_INVAL, None)
+	return (0, {"call_args": (job.get_attr( "id" ),)})
+
+running = [0, 0]
+on_pool = []
+lock = threading.Lock()
+
+def finish_send( job, state, dat, xmlrpc_response_time, user_timeout ):
+	lock.acquire()
+	running[0] += 1
+	running[1] = max( running[0], running[1] )
+	on_pool.append( iftutil.SubmitThreadPool.is_worker() )
+	lock.release()
+	time.sleep( 0.1 + 0.05 * (int(job.get_attr( "id" )) % 3) )
+	lock.acquire()
+	running[0] -= 1
+	lock.release()
+	if dat[0] != job.get_attr( "id" ):
+		return E_NO_CONNECT
+	return 0
+
+iftapi.prepare_send = prepare_send
+iftapi.finish_send = finish_send
+
+# files go max_concurrent at a time, negotiated in groups, with results in order
+jobs = [{iftfile.JOB_ATTR_DEST_HOST:"127.0.0.1", "id":str(i)} for i in xrange(0, 10)] + [{iftfile.JOB_ATTR_DEST_HOST:"127.0.0.1", "id":"bad"}]
+results = iftapi.begin_ift_batch( jobs, None, True, False, port, "/RPC2", 5, 3 )
+assert results == [0] * 10 + [E_INVAL], "Wrong results " + str(results)
+assert running[1] == 3, "Ran " + str(running[1]) + " transfers at once"
+assert batch_sizes[0] == 3, "First negotiation was for " + str(batch_sizes[0]) + " files"
+assert sum(batch_sizes) == 10 and len(batch_sizes) < 10, "Files were not negotiated together: " + str(batch_sizes)
+assert on_pool == [True] * 10, "Transfers did not run on the submit pool"
+
+# ...and they share the submit pool's limit
+submit_pool = iftutil.SubmitThreadPool
+iftutil.SubmitThreadPool = iftutil.iftworkers( "submit", 2 )
+running[1] = 0
+results = iftapi.begin_ift_batch( jobs, None, True, False, port, "/RPC2", 5, 3 )
+assert results == [0] * 10 + [E_INVAL], "Wrong results on a small submit pool " + str(results)
+assert running[1] == 2, "Ran " + str(running[1]) + " transfers at once on a pool of 2"
+iftutil.SubmitThreadPool.shutdown()
+iftutil.SubmitThreadPool = submit_pool
+
+# receiving takes two rounds per group
+def prepare_receive( job, available_protocols ):
+	return (0, job.get_attr( "id" ))
+
+def setup_receive( job, available_protocols, connect_dict, xmit_id, dat, xmlrpc_response_time, iftd_remote_port, iftd_xmlrpc_path, user_timeout ):
+	if dat[0] != xmit_id:
+		return (E_NO_CONNECT, None)
+	return (0, {"choice_args": (xmit_id,)})
+
+def run_receive( job, state, choice_rc, send_xmlrpc ):
+	if choice_rc != job.get_attr( "id" ):
+		return E_NO_CONNECT
+	return 0
+
+iftapi.prepare_receive = prepare_receive
+iftapi.setup_receive = setup_receive
+iftapi.run_receive = run_receive
+
+del batch_sizes[:]
+jobs = [{iftfile.JOB_ATTR_SRC_HOST:"127.0.0.1", "id":str(i)} for i in xrange(0, 4)]
+results = iftapi.begin_ift_batch( jobs, None, False, True, port, "/RPC2", 5, 4 )
+assert results == [0] * 4, "Wrong receive results " + str(results)
+assert batch_sizes == [4, 4], "Receives were not negotiated together: " + str(batch_sizes)
+
+# a batch must either send or receive
+assert iftapi.begin_ift_batch( jobs, None, True, True ) == [-1] * 4, "Sent and received at once"
+
+# iftds without batch calls get one call per file
+client = iftutil.control_client( "127.0.0.1", port, "/RPC2", 5 )
+assert iftapi.call_batch( client, "echo", [("a",), ("fail",), ("b",)] ) == ["a", None, "b"], "Calls were not made one at a time"
+assert iftapi.batch_apply( echo, [("a",), ("fail",)] ) == ["a", None], "batch_apply did not catch the failure"
+
+iftutil.CONTROL_POOL.close_all()
+server.server_close()
+
+print "test_batch_transfer passed"
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import sys
+
+sys.path.append( "../" )
+
+import iftcore
+from iftcore import *
+from iftcore.iftreceiver import chunk_scheduler
+import iftcore.iftreceiver
+
+chunksize = 65536
+
+def request_time( num_chunks, bandwidth, delay ):
+	return delay + num_chunks * chunksize / float(bandwidth)
+
+# a link with a 10ms round trip and 50 MB/s of bandwidth
+bandwidth = 50 * 1024 * 1024
+delay = 0.01
+scheduler = chunk_scheduler( chunksize )
+assert scheduler.run_length() == 1, "Did not start with one chunk"
+
+for i in xrange(0, 40):
+	n = scheduler.run_length()
+	scheduler.record( n, n * chunksize, request_time( n, bandwidth, delay ) )
+
+bdp_chunks = iftcore.iftreceiver.CHUNK_RUN_BDP_MULTIPLE * bandwidth * delay / chunksize
+assert abs( scheduler.delay - delay ) < delay * 0.05, "Wrong delay estimate " + str(scheduler.delay)
+assert abs( scheduler.bandwidth - bandwidth ) < bandwidth * 0.05, "Wrong bandwidth estimate " + str(scheduler.bandwidth)
+assert abs( scheduler.run_length() - bdp_chunks ) <= 1, "Run " + str(scheduler.run_length()) + " is not sized to the bandwidth-delay product (" + str(bdp_chunks) + ")"
+
+# noisy requests that make the delay look like nothing shrink the run by half at most
+for i in xrange(0, 2):
+	run = scheduler.run_length()
+	n = run / 2
+	scheduler.record( n, n * chunksize, request_time( n, bandwidth, 0.0005 ) )
+	assert scheduler.run_length() >= run / 2, "Run collapsed from " + str(run) + " to " + str(scheduler.run_length())
+
+assert scheduler.delay < delay / 2, "Noisy requests did not throw off the fit"
+
+# get back to the bandwidth-delay product
+for i in xrange(0, 40):
+	n = scheduler.run_length()
+	scheduler.record( n, n * chunksize, request_time( n, bandwidth, delay ) )
+
+# reservations last long enough for the whole run
+assert scheduler.reservation_time( 1.0 ) > scheduler.run_length() * chunksize / scheduler.rate, "Reservation is too short for the run"
+
+# throughput falling off shrinks the run
+run = scheduler.run_length()
+n = scheduler.run_length()
+scheduler.record( n, n * chunksize, 10 * request_time( n, bandwidth, delay ) )
+assert scheduler.run_length() <= run / 2, "Run did not shrink when throughput fell off"
+
+# failures shrink the run
+run = scheduler.run_length()
+scheduler.failed()
+assert scheduler.run_length() == max( run / 2, 1 ), "Run did not shrink on failure"
+
+# never more than the maximum
+scheduler = chunk_scheduler( chunksize, 4 * chunksize )
+for i in xrange(0, 20):
+	n = scheduler.run_length()
+	scheduler.record( n, n * chunksize, request_time( n, bandwidth, 1.0 ) )
+
+assert scheduler.run_length() == 4, "Run grew past the maximum"
+
+print "test_chunk_scheduler passed"
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import threading
+import xmlrpclib
+import httplib
+import socket
+import SimpleXMLRPCServer
+
+sys.path.append( "../" )
+
+import iftutil
+
+clients_seen = []
+
+class recording_handler( iftutil.remote_request_handler ):
+	# remember where each call came from, and drop idle connections quickly
+	timeout = 0.5
+
+	def do_POST( self ):
+		clients_seen.append( self.client_address )
+		iftutil.remote_request_handler.do_POST( self )
+
+def negotiate( xmit_id, job_attrs, protos, connect_dict ):
+	return (xmit_id, "/tmp/chunks/" + xmit_id, protos[0], protos, job_attrs)
+
+def fail( msg ):
+	raise Exception( msg )
+
+def start( handler ):
+	server = iftutil.create_server( 0, [negotiate, fail], request_handler = handler )
+	server.logRequests = False
+	t = threading.Thread( target=server.serve_forever )
+	t.setDaemon( True )
+	t.start()
+	return server
+
+job_attrs = {"JOB_ATTR_SRC_NAME":"/tmp/file", "JOB_ATTR_FILE_SIZE":12345678901, "JOB_ATTR_CHUNK_TIMEOUT":1.5, "JOB_ATTR_PROTOS":["http", "iftsocket"], "empty":None}
+
+# pickled calls, over one kept connection
+server = start( recording_handler )
+port = server.server_address[1]
+client = iftutil.control_client( "127.0.0.1", port, "/RPC2", 5 )
+for i in xrange(0, 3):
+	dat = client.negotiate( str(i), job_attrs, ["iftsocket_receiver"], {} )
+	assert dat[0] == str(i) and dat[2] == "iftsocket_receiver" and dat[4] == job_attrs, "Wrong result " + str(dat)
+assert len(clients_seen) == 3 and len(set(clients_seen)) == 1, "Calls did not share a connection: " + str(clients_seen)
+
+# faults come back as faults
+try:
+	client.fail( "oops" )
+	assert False, "No fault"
+except xmlrpclib.Fault, fault:
+	assert "oops" in fault.faultString, "Wrong fault " + str(fault)
+
+# XML-RPC calls are still served, on kept connections too
+xml_client = iftutil.control_client( "127.0.0.1", port, "/RPC2", 5, binary=False )
+del clients_seen[:]
+for i in xrange(0, 2):
+	dat = xml_client.negotiate( "x", {"a":"b"}, ["p"], {} )
+	assert dat[1] == "/tmp/chunks/x" and dat[4] == {"a":"b"}, "Wrong XML-RPC result " + str(dat)
+assert len(set(clients_seen)) == 1, "XML-RPC calls did not share a connection"
+
+# a plain xmlrpclib client can still call us
+plain = xmlrpclib.Server( "http://127.0.0.1:" + str(port) + "/RPC2", allow_none=True )
+assert plain.negotiate( "y", {}, ["p"], {} )[1] == "/tmp/chunks/y", "Plain XML-RPC client was not served"
+
+# a kept connection the server has since dropped is replaced
+del clients_seen[:]
+time.sleep( 1 )
+dat = client.negotiate( "z", job_attrs, ["p"], {} )
+assert dat[0] == "z", "Call after the server dropped the connection failed"
+
+# a server that only speaks XML-RPC (over HTTP/1.0) gets XML-RPC
+old_server = SimpleXMLRPCServer.SimpleXMLRPCServer( ("127.0.0.1", 0), logRequests=False, allow_none=True )
+old_server.register_function( negotiate )
+old_server.register_function( fail )
+t = threading.Thread( target=old_server.serve_forever )
+t.setDaemon( True )
+t.start()
+old_client = iftutil.control_client( "127.0.0.1", old_server.server_address[1], "/RPC2", 5 )
+for i in xrange(0, 2):
+	dat = old_client.negotiate( "old", {"a":"b"}, ["p"], {} )
+	assert dat[1] == "/tmp/chunks/old", "Fallback to XML-RPC failed"
+assert old_client.peer in iftutil.CONTROL_POOL.xml_only, "Peer was not remembered as XML-RPC only"
+try:
+	old_client.fail( "old oops" )
+	assert False, "No fault from the old server"
+except xmlrpclib.Fault, fault:
+	assert "old oops" in fault.faultString, "Wrong fault " + str(fault)
+
+# calls still go through where httplib can't be asked to buffer responses
+buffered_getresponse = httplib.HTTPConnection.getresponse
+httplib.HTTPConnection.getresponse = lambda self: buffered_getresponse( self )
+iftutil.CONTROL_POOL.close_all()
+for i in xrange(0, 2):
+	dat = client.negotiate( "unbuffered", job_attrs, ["p"], {} )
+	assert dat[0] == "unbuffered", "Call without buffering failed"
+httplib.HTTPConnection.getresponse = buffered_getresponse
+
+# connecting gives up after the client's timeout
+started = time.time()
+try:
+	iftutil.control_client( "10.255.255.1", 9, "/RPC2", 0.5 ).negotiate( "t", {}, ["p"], {} )
+	assert False, "Connected to nowhere"
+except socket.error:
+	pass
+assert time.time() - started < 5, "Connecting took " + str(time.time() - started) + " seconds"
+
+# clients can be made from URLs
+url_client = iftutil.make_control_client( "http://127.0.0.1:" + str(port) + "/RPC2", 5 )
+assert url_client.negotiate( "u", {}, ["p"], {} )[0] == "u", "Client from a URL failed"
+
+iftutil.CONTROL_POOL.close_all()
+server.server_close()
+old_server.server_close()
+
+print "test_control_channel passed"
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import random
+import hashlib
+
+sys.path.append( "../" )
+
+import iftfile
+import iftdelta
+import iftapi
+from iftdata import *
+
+chunksize = 1024
+num_chunks = 64
+random.seed( 22 )
+data = "".join( [chr( random.randint(0, 255) ) for i in xrange(0, num_chunks * chunksize - 300)] )
+
+def chunks_of( s ):
+	return [s[i : i + chunksize] for i in xrange(0, len(s), chunksize)]
+
+def hashes_of( s ):
+	return [hashlib.sha1( c ).hexdigest() for c in chunks_of( s )]
+
+def matches( new, old ):
+	# find the chunks of new in old, and check every match
+	found = iftdelta.find_matches( old, chunksize, len(new), hashes_of( new ), iftdelta.weak_sums( chunks_of( new ) ) )
+	for (chunk_id, offset) in found.items():
+		chunk = new[chunk_id * chunksize : (chunk_id + 1) * chunksize]
+		assert old[offset : offset + len(chunk)] == chunk, "Bad match for chunk " + str(chunk_id)
+	return found
+
+# the rolled checksum is the same as one computed from scratch
+window = data[0 : chunksize]
+weak = iftdelta.weak_sum( window ) & 0xFFFFFFFF
+a, b = weak & 0xFFFF, weak >> 16
+for o in xrange(1, 200):
+	a = (a - ord(data[o - 1]) + ord(data[o - 1 + chunksize])) % iftdelta.ADLER_MOD
+	b = (b - chunksize * ord(data[o - 1]) + a - 1) % iftdelta.ADLER_MOD
+	assert (b << 16) | a == iftdelta.weak_sum( data[o : o + chunksize] ) & 0xFFFFFFFF, "Rolled checksum is wrong at " + str(o)
+
+# the same file:  every chunk, where it was
+found = matches( data, data )
+assert found == dict( [(i, i * chunksize) for i in xrange(0, num_chunks)] ), "Did not find an unchanged file"
+
+# some bytes changed in place:  all but the changed chunks
+new = data[0:5000] + "xyz" + data[5003:40000] + "q" + data[40001:]
+found = matches( new, data )
+assert sorted( found.keys() ) == [i for i in xrange(0, num_chunks) if i not in (5000 / chunksize, 40000 / chunksize)], "Wrong chunks found after an edit"
+
+# bytes inserted near the start:  everything after them is found, shifted
+new = data[0:1500] + "inserted" * 10 + data[1500:]
+found = matches( new, data )
+assert found.has_key( 0 ) and not found.has_key( 1 ), "Wrong chunks found before an insertion"
+assert len(found) >= num_chunks - 3, "Only found " + str(len(found)) + " chunks after an insertion"
+
+# bytes deleted:  likewise
+new = data[0:3000] + data[3777:]
+found = matches( new, data )
+assert len(found) >= len(chunks_of( new )) - 3, "Only found " + str(len(found)) + " chunks after a deletion"
+
+# appended to:  the old chunks, but not the new ones
+new = data + "appended" * 500
+found = matches( new, data )
+assert sorted( found.keys() ) == range(0, num_chunks - 1), "Wrong chunks found after an append"
+
+# chunks that are the same as each other are all found
+new = data[0:chunksize] * 3 + data[3 * chunksize:]
+found = matches( new, data )
+assert found[0] == 0 and found[1] == 0 and found[2] == 0, "Did not find repeated chunks"
+
+# nothing in common
+assert matches( data, "".join( [chr( random.randint(0, 255) ) for i in xrange(0, 20000)] ) ) == {}, "Found chunks in unrelated data"
+
+# copy chunks out of an old copy into the new file, then receive only the rest
+path = "/tmp/test_delta"
+old = data[0:10000] + "inserted" + data[10000:]
+fd = open( path, "wb" )
+fd.write( old )
+fd.close()
+
+new = data[0:30000] + "changed" + data[30007:]
+file_attrs = {
+	iftfile.JOB_ATTR_DELTA:True,
+	iftfile.JOB_ATTR_DEST_NAME:path,
+	iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+	iftfile.JOB_ATTR_FILE_SIZE:len(new),
+	iftfile.JOB_ATTR_FILE_HASH:hashlib.sha1( new ).hexdigest(),
+	iftfile.JOB_ATTR_CHUNK_HASHES:hashes_of( new ),
+	iftfile.JOB_ATTR_WEAK_SUMS:iftdelta.weak_sums( chunks_of( new ) )
+}
+
+old_copy = iftapi.open_delta_basis( file_attrs )
+assert old_copy != None, "Could not open the old copy"
+ift_file = iftfile.acquire_iftfile_recv( "test", path, file_attrs )
+assert ift_file != None, "Could not open file"
+iftapi.apply_delta_basis( file_attrs, old_copy, ift_file )
+
+have = sum( [range(first, last + 1) for (first, last) in ift_file.written_chunk_runs()], [] )
+assert sorted( have ) == [i for i in xrange(0, num_chunks) if i not in (10000 / chunksize, 30000 / chunksize)], "Copied the wrong chunks: " + str(ift_file.written_chunk_runs())
+
+for i in ift_file.get_unwritten_chunks():
+	assert ift_file.set_chunk( chunks_of( new )[i], i ) == 0, "Could not write chunk " + str(i)
+
+assert ift_file.is_complete(), "File is not complete"
+assert ift_file.calc_hash() == file_attrs[ iftfile.JOB_ATTR_FILE_HASH ], "File hash is wrong"
+assert iftfile.release_iftfile_recv( "test", path ) == 0, "Could not close file"
+
+fd = open( path, "rb" )
+assert fd.read() == new, "File contents are wrong"
+fd.close()
+
+# no delta unless asked for, or with nothing to compare against
+file_attrs[ iftfile.JOB_ATTR_DELTA ] = False
+assert iftapi.open_delta_basis( file_attrs ) == None, "Opened an old copy without delta mode"
+file_attrs[ iftfile.JOB_ATTR_DELTA ] = True
+os.remove( path )
+assert iftapi.open_delta_basis( file_attrs ) == None, "Opened an old copy that isn't there"
+
+print "test_delta passed"
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import socket
+import threading
+
+sys.path.append( "../" )
+
+import iftfile
+import iftcore
+from iftcore import *
+import protocols.http
+from iftdata import *
+
+class range_server:
+	# serves byte ranges of data over HTTP/1.1; can hang up after every response, or ignore ranges
+	def __init__( self, data, keep_alive=True, ignore_ranges=False ):
+		self.data = data
+		self.keep_alive = keep_alive
+		self.ignore_ranges = ignore_ranges
+		self.connections = 0
+		self.ranges = []
+		self.paths = []
+		self.soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+		self.soc.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+		self.soc.bind( ("127.0.0.1", 0) )
+		self.soc.listen( 16 )
+		self.port = self.soc.getsockname()[1]
+		t = threading.Thread( target=self.accept_loop )
+		t.setDaemon( True )
+		t.start()
+
+	def accept_loop( self ):
+		while True:
+			soc, addr = self.soc.accept()
+			self.connections += 1
+			t = threading.Thread( target=self.serve, args=(soc,) )
+			t.setDaemon( True )
+			t.start()
+
+	def serve( self, soc ):
+		try:
+			self.answer( soc )
+		except socket.error:
+			pass    # the receiver hung up with requests outstanding
+		soc.close()
+
+	def answer( self, soc ):
+		f = soc.makefile( "rb" )
+		while True:
+			line = f.readline()
+			if len(line) == 0:
+				break
+
+			self.paths.append( line.split()[1] )
+			byte_range = None
+			while True:
+				line = f.readline().strip()
+				if len(line) == 0:
+					break
+				if line.lower().startswith( "range:" ):
+					first, last = line.split( "=" )[1].split( "-" )
+					byte_range = (int(first), int(last))
+
+			self.ranges.append( byte_range )
+			connection = ""
+			if not self.keep_alive:
+				connection = "Connection: close\r\n"
+
+			if self.ignore_ranges or byte_range == None:
+				soc.sendall( "HTTP/1.1 200 OK\r\nContent-Length: %d\r\n%s\r\n" % (len(self.data), connection) + self.data )
+			else:
+				first, last = byte_range
+				soc.sendall( "HTTP/1.1 206 Partial Content\r\nContent-Range: bytes %d-%d/%d\r\nContent-Length: %d\r\n%s\r\n" % (first, last, len(self.data), last - first + 1, connection) + self.data[first : last + 1] )
+
+			if connection != "":
+				break
+
+		f.close()
+
+class collecting_receiver( protocols.http.http_receiver ):
+	# keeps what it receives
+	def add_chunk( self, chunk_id, chunk_str ):
+		self.got[ chunk_id ] = chunk_str
+
+	def whole_file( self, file_path ):
+		self.got[ "whole_file" ] = file_path
+		self.has_whole_file = True
+
+def make_receiver( server, chunksize, connections, depth ):
+	r = collecting_receiver()
+	r.job_attrs = {
+		iftfile.JOB_ATTR_SRC_HOST:"127.0.0.1",
+		iftfile.JOB_ATTR_SRC_NAME:"/test_http_ranges",
+		iftfile.JOB_ATTR_DEST_NAME:"/tmp/test_http_ranges",
+		iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+		iftfile.JOB_ATTR_FILE_SIZE:len(server.data)
+	}
+	r.remote_host = "127.0.0.1"
+	r.portnum = server.port
+	r.file_size = len(server.data)
+	r.connect_args = {protocols.http.HTTP_CONNECTIONS:connections, protocols.http.HTTP_PIPELINE_DEPTH:depth}
+	r.got = {}
+	return r
+
+chunksize = 1000
+data = os.urandom( 100 * chunksize + 123 )
+num_chunks = 101
+
+def check( r, chunk_ids ):
+	assert sorted( r.got.keys() ) == sorted( chunk_ids ), "Got chunks " + str(sorted( r.got.keys() ))
+	for chunk_id in chunk_ids:
+		assert r.got[chunk_id] == data[chunk_id * chunksize : (chunk_id + 1) * chunksize], "Chunk " + str(chunk_id) + " is wrong"
+
+# adjacent chunks are asked for as one range, and the last chunk is short
+server = range_server( data )
+r = make_receiver( server, chunksize, 1, 4 )
+assert r.recv_chunks( "", [97, 98, 99, 100] ) == 0, "Could not receive chunks"
+check( r, [97, 98, 99, 100] )
+assert server.ranges == [(97 * chunksize, len(data) - 1)], "Asked for " + str(server.ranges)
+
+# separate runs are separate ranges, reusing the same connection
+server.ranges = []
+r.got = {}
+assert r.recv_chunks( "", [5, 3, 2, 40] ) == 0, "Could not receive chunks"
+check( r, [2, 3, 5, 40] )
+assert sorted( server.ranges ) == [(2000, 3999), (5000, 5999), (40000, 40999)], "Asked for " + str(server.ranges)
+assert server.connections == 1, "Opened " + str(server.connections) + " connections instead of reusing one"
+
+# a big run is spread over every connection
+r.proto_clean()
+server = range_server( data )
+r = make_receiver( server, chunksize, 4, 4 )
+assert r.recv_chunks( "", range(0, num_chunks) ) == 0, "Could not receive the whole file"
+check( r, range(0, num_chunks) )
+assert server.connections == 4, "Used " + str(server.connections) + " connections"
+assert len(server.ranges) == 4, "Asked for " + str(len(server.ranges)) + " ranges"
+r.proto_clean()
+assert r.connections == [], "Connections left open"
+
+# a server that hangs up after each response is asked again on new connections
+server = range_server( data, keep_alive=False )
+r = make_receiver( server, chunksize, 2, 4 )
+assert r.recv_chunks( "", range(0, 50, 2) ) == 0, "Could not receive from a server that hangs up"
+check( r, range(0, 50, 2) )
+assert server.connections > 2, "Server hung up, but only " + str(server.connections) + " connections were made"
+r.proto_clean()
+
+# a server that ignores ranges sends the whole file, which is saved once
+server = range_server( data, ignore_ranges=True )
+r = make_receiver( server, chunksize, 2, 2 )
+chunks_dir = iftfile.get_chunks_dir( r.job_attrs[ iftfile.JOB_ATTR_DEST_NAME ], None )
+if not os.path.exists( chunks_dir ):
+	os.makedirs( chunks_dir )
+assert r.recv_chunks( "", range(0, num_chunks) ) == 0, "Could not receive from a server that ignores ranges"
+path = r.got[ "whole_file" ]
+fd = open( path, "rb" )
+assert fd.read() == data, "Whole file is wrong"
+fd.close()
+os.remove( path )
+r.proto_clean()
+
+# the path is quoted in the request line
+server = range_server( data )
+r = make_receiver( server, chunksize, 1, 1 )
+r.job_attrs[ iftfile.JOB_ATTR_SRC_NAME ] = "/test http ranges"
+assert r.recv_chunks( "", [0] ) == 0, "Could not receive a file with a space in its name"
+check( r, [0] )
+assert server.paths == ["/test%20http%20ranges"], "Asked for " + str(server.paths)
+r.proto_clean()
+
+# nobody home
+r = make_receiver( server, chunksize, 2, 2 )
+r.portnum = 1
+assert r.recv_chunks( "", [0, 1] ) == E_NO_CONNECT, "Received from nowhere"
+
+print "test_http_ranges passed"
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import socket
+import httplib
+import threading
+
+sys.path.append( "../" )
+
+import iftfile
+import iftcore
+from iftcore import *
+import protocols.http
+from iftdata import *
+
+path = "/tmp/test_http_server"
+data = os.urandom( 300000 )
+fd = open( path, "wb" )
+fd.write( data )
+fd.close()
+
+server = protocols.http.ift_http_server( ("127.0.0.1", 0), protocols.http.ift_http_request_handler )
+port = server.server_address[1]
+t = threading.Thread( target=server.serve_forever )
+t.setDaemon( True )
+t.start()
+
+def get( conn, path, range_header=None ):
+	headers = {}
+	if range_header != None:
+		headers["Range"] = range_header
+	conn.request( "GET", path, headers=headers )
+	resp = conn.getresponse()
+	return (resp.status, resp.getheader( "content-type" ), resp.getheader( "content-range" ), resp.read())
+
+conn = httplib.HTTPConnection( "127.0.0.1", port )
+
+# nothing is served until it is published
+status, ctype, crange, body = get( conn, path )
+assert status == 404, "Served an unpublished file (status " + str(status) + ")"
+
+server.published.publish( path )
+
+# the whole file, then a range and a suffix range, all on one connection
+status, ctype, crange, body = get( conn, path )
+assert status == 200 and body == data, "Did not serve the whole file"
+sock = conn.sock
+status, ctype, crange, body = get( conn, path, "bytes=1000-1999" )
+assert status == 206 and body == data[1000:2000], "Did not serve a range"
+assert crange == "bytes 1000-1999/" + str(len(data)), "Wrong Content-Range " + str(crange)
+status, ctype, crange, body = get( conn, path, "bytes=-100" )
+assert status == 206 and body == data[-100:], "Did not serve a suffix range"
+assert conn.sock is sock, "Connection was not kept alive"
+
+# several ranges come back as multipart/byteranges
+status, ctype, crange, body = get( conn, path, "bytes=0-9,5000-5099,299990-400000" )
+assert status == 206 and ctype.startswith( "multipart/byteranges" ), "Not a multipart response"
+boundary = ctype[ ctype.find("boundary=") + 9 : ]
+parts = body.split( "--" + boundary )
+assert parts[-1].strip() == "--", "Multipart response not terminated"
+got = []
+for part in parts[1:-1]:
+	part_headers, part_body = part.split( "\r\n\r\n", 1 )
+	got.append( part_body[:-2] )      # less the CRLF before the next boundary
+assert got == [data[0:10], data[5000:5100], data[299990:]], "Multipart response has the wrong data"
+
+# overlapping and adjacent ranges are merged, so nothing is sent twice
+status, ctype, crange, body = get( conn, path, "bytes=0-,0-,0-,0-" )
+assert status == 206 and body == data and crange == "bytes 0-%d/%d" % (len(data) - 1, len(data)), "Overlapping ranges were not merged"
+status, ctype, crange, body = get( conn, path, "bytes=100-199,0-99,150-250" )
+assert status == 206 and body == data[0:251], "Adjacent ranges were not merged"
+
+# too many ranges get the whole file
+spec = ",".join( ["%d-%d" % (i * 10, i * 10 + 4) for i in xrange(0, protocols.http.HTTP_MAX_RANGES + 1)] )
+status, ctype, crange, body = get( conn, path, "bytes=" + spec )
+assert status == 200 and body == data, "Too many ranges got " + str(status)
+
+# unsatisfiable ranges
+status, ctype, crange, body = get( conn, path, "bytes=400000-500000" )
+assert status == 416 and crange == "bytes */" + str(len(data)), "Unsatisfiable range got " + str(status)
+
+# another client is served while the first connection is idle
+conn2 = httplib.HTTPConnection( "127.0.0.1", port, timeout=5 )
+status, ctype, crange, body = get( conn2, path, "bytes=10-19" )
+assert status == 206 and body == data[10:20], "Second connection was not served"
+conn2.close()
+
+# the http receiver can get the file from it
+receiver = protocols.http.http_receiver()
+receiver.job_attrs = {
+	iftfile.JOB_ATTR_SRC_HOST:"127.0.0.1",
+	iftfile.JOB_ATTR_SRC_NAME:path,
+	iftfile.JOB_ATTR_CHUNKSIZE:4096,
+	iftfile.JOB_ATTR_FILE_SIZE:len(data)
+}
+receiver.remote_host = "127.0.0.1"
+receiver.portnum = port
+receiver.file_size = len(data)
+got = {}
+receiver.add_chunk = lambda chunk_id, chunk: got.__setitem__( chunk_id, chunk )
+num_chunks = (len(data) + 4095) / 4096
+assert receiver.recv_chunks( "", range(0, num_chunks, 2) + range(1, num_chunks, 2) ) == 0, "Receiver could not get the file"
+assert "".join( [got[i] for i in xrange(0, num_chunks)] ) == data, "Receiver got the wrong data"
+
+# ...and keeps one fetcher per connection for the whole transfer, instead of new threads per request
+fetchers = receiver.fetchers
+threads_before = threading.activeCount()
+for i in xrange(0, 10):
+	got.clear()
+	assert receiver.recv_chunks( "", range(0, num_chunks) ) == 0, "Receiver could not get the file again"
+	assert len(got) == num_chunks, "Receiver got the wrong chunks again"
+assert receiver.fetchers is fetchers, "Fetchers were not kept"
+assert fetchers.stats()["workers"] <= protocols.http.HTTP_DEFAULT_CONNECTIONS, "More fetchers than connections " + str(fetchers.stats())
+assert threading.activeCount() == threads_before, "Requests started threads"
+receiver.proto_clean()
+assert receiver.fetchers == None, "Fetchers were kept after the transfer"
+
+# a "done" request withdraws the directory
+server.published.publish( "/tmp/test_http_server_dir" )
+assert server.published.is_published( "/tmp/test_http_server_dir/chunk" ), "Directory not published"
+status, ctype, crange, body = get( conn, "/tmp/test_http_server_dir/done" )
+assert status == 200, "done request failed"
+assert not server.published.is_published( "/tmp/test_http_server_dir/chunk" ), "done did not withdraw the directory"
+
+# publications expire unless they are requested
+registry = protocols.http.publication_registry( 0.2 )
+registry.publish( "/a" )
+registry.publish( "/b" )
+for i in xrange(0, 4):
+	time.sleep( 0.1 )
+	assert registry.is_published( "/a" ), "Requested publication expired"
+assert not registry.is_published( "/b" ), "Unrequested publication did not expire"
+assert len(registry) == 1, "Expired publication still counted"
+
+conn.close()
+server.server_close()
+os.remove( path )
+
+print "test_http_server passed"
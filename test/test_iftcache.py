@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import hashlib
+
+sys.path.append( "../" )
+
+import iftfile
+import iftcore
+from iftcore import *
+from iftcore.consts import *
+from iftdata import *
+import protocols.iftcache
+from protocols.iftcache import *
+from stand_ins import stand_in_job
+
+cache_dir = "/tmp/test_iftcache/"
+work_dir = "/tmp/test_iftcache_files/"
+filesize = 4096
+
+def sha1( s ):
+	return hashlib.sha1( s ).hexdigest()
+
+def make_file( path, data ):
+	fd = open( path, "wb" )
+	fd.write( data )
+	fd.close()
+
+def read_file( path ):
+	fd = open( path, "rb" )
+	data = fd.read()
+	fd.close()
+	return data
+
+os.system( "rm -rf " + cache_dir + " " + work_dir + "; mkdir -p " + work_dir + "a " + work_dir + "b" )
+assert cache_startup( cache_dir, 8 * filesize ) == 0, "Could not start the cache"
+cache = protocols.iftcache.cache
+
+# files with the same name in different directories don't collide
+first = os.urandom( filesize )
+second = os.urandom( filesize )
+make_file( work_dir + "a/file", first )
+make_file( work_dir + "b/file", second )
+assert cache_put_file( work_dir + "a/file", cache_key( "host", work_dir + "a/file" ) ) == 0, "Could not cache a file"
+assert cache_put_file( work_dir + "b/file", cache_key( "host", work_dir + "b/file" ) ) == 0, "Could not cache a file"
+
+# look up by name and by hash
+assert cache_get_file( work_dir + "out", None, cache_key( "host", work_dir + "a/file" ), -1 ) == 0, "Miss by name"
+assert read_file( work_dir + "out" ) == first, "Got the wrong file by name"
+assert cache_get_file( work_dir + "out", sha1( second ), None, -1 ) == 0, "Miss by hash"
+assert read_file( work_dir + "out" ) == second, "Got the wrong file by hash"
+assert cache_get_file( work_dir + "out", None, cache_key( "otherhost", work_dir + "a/file" ), -1 ) < 0, "Hit on another host's file"
+assert cache_get_file( work_dir + "out", sha1( "nothing" ), None, -1 ) < 0, "Hit on a file that isn't there"
+
+# hits are links to the cached file, not copies
+assert os.stat( work_dir + "out" ).st_ino == os.stat( cache.path( sha1( second ) ) ).st_ino, "Hit was copied"
+
+# a file cached under a name that is then changed at its source is found under its new contents
+changed = os.urandom( filesize )
+make_file( work_dir + "a/file", changed )
+assert cache_put_file( work_dir + "a/file", cache_key( "host", work_dir + "a/file" ) ) == 0, "Could not cache a changed file"
+assert cache_get_file( work_dir + "out2", None, cache_key( "host", work_dir + "a/file" ), -1 ) == 0, "Miss on a changed file"
+assert read_file( work_dir + "out2" ) == changed, "Got the old contents of a changed file"
+
+# a file that isn't what its hash says isn't cached
+assert cache_put_file( work_dir + "b/file", "bad", sha1( "something else" ) ) == E_CORRUPT, "Cached a file with the wrong hash"
+assert os.listdir( cache_dir + "tmp" ) == [], "Left a rejected file behind"
+
+# a linked-out file that is changed in place is no longer served
+fd = open( work_dir + "out", "r+b" )
+fd.seek( 0, 2 )
+fd.write( "more" )
+fd.close()
+assert cache_get_file( work_dir + "out3", sha1( second ), None, -1 ) < 0, "Served a file that was changed in place"
+assert not os.path.exists( cache.path( sha1( second ) ) ), "File changed in place is still cached"
+assert cache_get_file( work_dir + "out3", None, cache_key( "host", work_dir + "b/file" ), -1 ) < 0, "Name still finds a dropped file"
+
+# stale files are not served
+assert cache_get_file( work_dir + "out3", sha1( changed ), None, 60 ) == 0, "Miss on a fresh file"
+os.utime( cache.path( sha1( changed ) ), (time.time() - 120, time.time() - 120) )
+assert cache_startup( cache_dir, 8 * filesize ) == 0 and cache_shutdown() == 0, "Could not share the cache"
+cache_shutdown()
+assert cache_startup( cache_dir, 8 * filesize ) == 0, "Could not restart the cache"
+cache = protocols.iftcache.cache
+assert cache_get_file( work_dir + "out3", sha1( changed ), None, 60 ) < 0, "Served a stale file"
+assert cache_get_file( work_dir + "out3", sha1( changed ), None, 600 ) == 0, "Miss on a file young enough"
+assert cache_get_file( work_dir + "out3", sha1( changed ), None, -1 ) == 0, "Miss with no age limit"
+
+# the least recently used files are evicted to stay under the byte budget
+files = [os.urandom( filesize ) for i in xrange(0, 12)]
+for i in xrange(0, 12):
+	make_file( work_dir + "f" + str(i), files[i] )
+	assert cache_put_file( work_dir + "f" + str(i), cache_key( None, work_dir + "f" + str(i) ) ) == 0, "Could not cache file " + str(i)
+	time.sleep( 0.01 )
+	cache_get_file( work_dir + "out", sha1( files[0] ), None, -1 )      # keep file 0 in use
+
+stats = cache.stats()
+assert stats["bytes"] <= 8 * filesize, "Cache is over its budget: " + str(stats)
+assert stats["evictions"] > 0, "Nothing was evicted"
+assert cache.lookup( sha1( files[0] ), None ) != None, "Evicted a file in use"
+assert cache.lookup( sha1( files[1] ), None ) == None, "Did not evict the least recently used file"
+assert cache.lookup( sha1( files[11] ), None ) != None, "Evicted the newest file"
+assert stats["names"] == stats["files"], "Names of evicted files are still there: " + str(stats)
+
+# it's all still there after a restart, and whatever a crash left half-written is cleared out
+make_file( cache_dir + "tmp/leftover", "half a file" )
+stats = cache.stats()
+cache_shutdown()
+assert protocols.iftcache.cache == None, "Cache is still running"
+assert cache_startup( cache_dir, 8 * filesize ) == 0, "Could not restart the cache"
+cache = protocols.iftcache.cache
+assert cache.stats()["files"] == stats["files"] and cache.stats()["bytes"] == stats["bytes"], "Lost files over a restart"
+assert os.listdir( cache_dir + "tmp" ) == [], "Crash leftovers are still there"
+assert cache_get_file( work_dir + "out", None, cache_key( None, work_dir + "f11" ), -1 ) == 0, "Miss by name after a restart"
+assert read_file( work_dir + "out" ) == files[11], "Got the wrong file after a restart"
+
+# the receiver serves a hit...
+filename = work_dir + "received"
+file_attrs = {iftfile.JOB_ATTR_CHUNKSIZE:filesize, iftfile.JOB_ATTR_FILE_SIZE:filesize}
+ift_file = iftfile.iftfile( filename )
+assert ift_file.fopen( file_attrs, iftfile.MODE_WRITE ) == 0, "Could not open file"
+job = stand_in_job( {iftfile.JOB_ATTR_IFTFILE:ift_file,
+                     iftfile.JOB_ATTR_CHUNKSIZE:filesize,
+                     iftfile.JOB_ATTR_FILE_SIZE:filesize,
+                     iftfile.JOB_ATTR_REMOTE_IFTD:False,
+                     iftfile.JOB_ATTR_SRC_NAME:work_dir + "f11",
+                     iftfile.JOB_ATTR_DEST_NAME:filename,
+                     iftfile.JOB_ATTR_DEST_CHUNK_DIR:work_dir + "a",
+                     IFTCACHE_MAX_AGE:600} )
+
+receiver = iftcache_receiver()
+assert receiver.do_setup( {IFTCACHE_BASEDIR:cache_dir, IFTCACHE_MAX_BYTES:8 * filesize} ) == 0, "Could not set up the receiver"
+assert receiver.on_start( job, {} ) == 0, "Could not start receiving"
+assert receiver.run( 0 ) == PROTO_MSG_END, "Receiving did not end"
+assert ift_file.is_complete(), "File is not complete"
+assert ift_file.fclose() == 0, "Could not close file"
+assert read_file( filename ) == files[11], "File contents are wrong"
+assert os.stat( filename ).st_ino == os.stat( cache.path( sha1( files[11] ) ) ).st_ino, "Hit was copied"
+
+# ...and fails a miss it has no remote iftd to fill from, so another protocol can be tried
+os.remove( filename )
+ift_file = iftfile.iftfile( filename )
+assert ift_file.fopen( file_attrs, iftfile.MODE_WRITE ) == 0, "Could not open file"
+job.attrs[ iftfile.JOB_ATTR_IFTFILE ] = ift_file
+job.attrs[ iftfile.JOB_ATTR_SRC_NAME ] = work_dir + "not-cached"
+assert receiver.on_start( job, {} ) == 0, "Could not start receiving"
+assert receiver.run( 0 ) != PROTO_MSG_END, "Received a file that isn't cached"
+assert not ift_file.is_complete(), "File is complete"
+ift_file.fclose()
+
+receiver.kill( None )
+cache_shutdown()
+assert protocols.iftcache.cache == None, "Cache is still running"
+os.system( "rm -rf " + cache_dir + " " + work_dir )
+print "test_iftcache passed"
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import sys
+import threading
+
+sys.path.append( "../" )
+
+import iftchunks
+
+owner1 = "owner1"
+owner2 = "owner2"
+
+table = iftchunks.chunk_table( 20, 4 )
+assert table.size() == 20, "Wrong size"
+assert not table.is_complete(), "Empty table is complete"
+assert table.next_free( 0, 3 ) == [0, 1, 2], "Wrong free chunks"
+
+# reserved chunks are skipped until their reservation runs out
+assert table.reserve( 0, owner1, 10, 0 ), "Could not reserve chunk 0"
+assert table.reserve( 1, owner1, 10, 0 ), "Could not reserve chunk 1"
+assert not table.reserve( 1, owner2, 10, 0 ), "Reserved a reserved chunk"
+assert table.reservation( 1 ) == (10, owner1), "Wrong reservation"
+assert table.next_free( 0, 2 ) == [2, 3], "Did not skip reserved chunks"
+assert table.next_free( 11, 2 ) == [0, 1], "Expired reservations were not freed"
+assert table.reserve( 1, owner2, 20, 11 ), "Could not take over an expired reservation"
+
+# written chunks are never handed out again
+for i in xrange(0, 12):
+	if i != 1:
+		assert table.mark_written( i ), "Could not mark chunk " + str(i)
+
+assert not table.mark_written( 3 ), "Marked a chunk twice"
+assert table.num_written() == 11, "Wrong number of written chunks"
+assert table.next_free( 11, 2 ) == [12, 13], "Wrong free chunks after writing"
+
+# dropping a reservation behind the cursor frees the chunk
+table.unreserve_all( owner2 )
+assert table.reservation( 1 ) == (0, None), "Reservation was not dropped"
+assert table.next_free( 11, 2 ) == [1, 12], "Unreserved chunk was not freed"
+
+# locking
+table.lock( 12, owner1 )
+assert not table.reserve( 12, owner2, 30, 11 ), "Reserved a locked chunk"
+assert not table.unlock( 12, owner2 ), "Unlocked someone else's chunk"
+assert table.unlock( 12, owner1 ), "Could not unlock chunk"
+
+# chunks in the same stripe share a lock
+table.lock( 13, owner1 )
+got_lock = []
+def lock_17():
+	table.lock( 17, owner2 )
+	got_lock.append( True )
+	table.unlock( 17, owner2 )
+
+t = threading.Thread( target=lock_17 )
+t.start()
+t.join( 0.2 )
+assert len(got_lock) == 0, "Locks are not striped"
+table.unlock( 13, owner1 )
+t.join()
+assert len(got_lock) == 1, "Striped lock was not released"
+
+# growing
+for i in [1] + range(12, 20):
+	table.mark_written( i )
+
+assert table.is_complete(), "Table is not complete"
+assert table.next_free( 11, 5 ) == [], "Complete table has free chunks"
+table.grow( 30 )
+assert not table.is_complete(), "Grown table is complete"
+assert table.next_free( 11, 2 ) == [20, 21], "Wrong free chunks after growing"
+assert table.unwritten( 11 ) == range(20, 30), "Wrong unwritten chunks"
+
+# written chunks come back as runs
+assert table.written_runs() == [[0, 19]], "Wrong runs " + str(table.written_runs())
+for i in [20, 21, 22, 25] + range(27, 30):
+	table.mark_written( i )
+assert table.written_runs() == [[0, 22], [25, 25], [27, 29]], "Wrong runs " + str(table.written_runs())
+assert iftchunks.chunk_table( 5 ).written_runs() == [], "Empty table has runs"
+
+# an empty table is complete
+assert iftchunks.chunk_table().is_complete(), "Empty table is not complete"
+
+print "test_iftchunks passed"
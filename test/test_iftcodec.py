@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import random
+import hashlib
+
+sys.path.append( "../" )
+
+import iftfile
+import iftcodec
+import iftcore
+from iftcore import *
+import iftcore.iftsender
+import iftcore.iftreceiver
+from iftcore.consts import *
+from iftdata import *
+from stand_ins import stand_in_job
+
+class memory_sender( iftcore.iftsender.sender ):
+	# a sender whose network is a dictionary in memory
+	def __init__( self, chunk_codec ):
+		iftcore.iftsender.sender.__init__( self )
+		self.name = "memory_sender"
+		self.chunk_codec = chunk_codec
+		self.sent = {}
+
+	def send_chunk( self, chunk, chunk_id, chunk_path, remote_chunk_path ):
+		self.sent[ chunk_id ] = chunk
+		return len(chunk)
+
+class memory_receiver( iftcore.iftreceiver.receiver ):
+	# a receiver whose network is a dictionary in memory
+	def __init__( self, chunks, damaged ):
+		iftcore.iftreceiver.receiver.__init__( self )
+		self.name = "memory_receiver"
+		self.chunks = chunks
+		self.damaged = damaged
+		self.received = []
+		self.chunk_codec = True
+		self.set_chunking_mode( PROTO_DETERMINISTIC_CHUNKING )
+
+	def recv_chunks( self, remote_chunk_dir, desired_chunks ):
+		self.received += desired_chunks
+		for i in desired_chunks:
+			if self.damaged.has_key( i ):
+				self.add_chunk( i, self.damaged.pop( i ) )
+			else:
+				self.add_chunk( i, self.chunks[i] )
+		return 0
+
+chunksize = 4096
+random.seed( 24 )
+words = ["chunk", "file", "iftd", "stork", "package", "transfer", "the", "a", "of"]
+text = " ".join( [random.choice( words ) for i in xrange(0, 5000)] )
+noise = os.urandom( 3 * chunksize )
+
+# each codec gives back what it was given
+for codec in [iftcodec.CODEC_NONE, iftcodec.CODEC_ZLIB, iftcodec.CODEC_BZ2]:
+	for level in [None, 1, 9]:
+		data = iftcodec.encode( text, codec, level )
+		assert iftcodec.decode( data ) == text, "Round trip failed with " + codec + " at level " + str(level)
+		if codec != iftcodec.CODEC_NONE:
+			assert len(data) < len(text) / 2, codec + " did not compress text"
+
+# data the codec would only make bigger is sent as it is
+data = iftcodec.encode( noise, iftcodec.CODEC_ZLIB, 9 )
+assert data == iftcodec.CODEC_TAGS[ iftcodec.CODEC_NONE ] + noise, "Random data was not sent as it is"
+assert iftcodec.decode( data ) == noise, "Round trip failed for random data"
+assert iftcodec.decode( iftcodec.encode( "", iftcodec.CODEC_ZLIB ) ) == "", "Round trip failed for an empty chunk"
+
+# garbage is not decoded
+for data in ["", "\x09abc", iftcodec.CODEC_TAGS[ iftcodec.CODEC_ZLIB ] + "not zlib"]:
+	try:
+		iftcodec.decode( data )
+		assert False, "Decoded " + repr(data)
+	except AssertionError:
+		raise
+	except Exception:
+		pass
+
+# a chunk that decodes to more than it should is rejected without decoding all of it
+bomb = "\0" * (64 * 1048576)
+for codec in [iftcodec.CODEC_ZLIB, iftcodec.CODEC_BZ2]:
+	data = iftcodec.encode( bomb, codec, 9 )
+	try:
+		iftcodec.decode( data, chunksize )
+		assert False, "Decoded a " + codec + " chunk bigger than a chunk"
+	except ValueError:
+		pass
+
+	data = iftcodec.encode( text[0:chunksize], codec )
+	assert iftcodec.decode( data ) == text[0:chunksize], "Could not decode a " + codec + " chunk"
+
+for codec in [iftcodec.CODEC_ZLIB, iftcodec.CODEC_BZ2]:
+	assert iftcodec.decode( iftcodec.encode( text[0:chunksize], codec ), chunksize ) == text[0:chunksize], "Could not decode a " + codec + " chunk as big as a chunk"
+
+# a bz2 bomb is given up on once it has decoded to more than a chunk, not once it has all been decoded
+# (bz2 decodes a whole block at a time, so the bomb spans many blocks)
+bomb = text * (4 * 1048576 / len(text))
+bomb_data = iftcodec.encode( bomb, iftcodec.CODEC_BZ2, 9 )
+decoded = []
+real_decompressor = iftcodec.bz2.BZ2Decompressor
+class counting_decompressor:
+	def __init__( self ):
+		self.d = real_decompressor()
+	def decompress( self, data ):
+		part = self.d.decompress( data )
+		decoded.append( len(part) )
+		return part
+iftcodec.bz2.BZ2Decompressor = counting_decompressor
+try:
+	iftcodec.decode( bomb_data, chunksize )
+	assert False, "Decoded a bz2 bomb"
+except ValueError:
+	pass
+iftcodec.bz2.BZ2Decompressor = real_decompressor
+assert sum( decoded ) < len(bomb) / 2, "Decoded " + str(sum( decoded )) + " bytes of a bz2 bomb"
+
+assert iftcodec.decode( iftcodec.encode( noise[0:chunksize], iftcodec.CODEC_ZLIB ), chunksize ) == noise[0:chunksize], "Could not decode a chunk sent as it is"
+bz2_data = iftcodec.encode( text[0:chunksize], iftcodec.CODEC_BZ2 )
+for data in [iftcodec.encode( text[0:chunksize], iftcodec.CODEC_ZLIB ) + "junk", iftcodec.CODEC_TAGS[ iftcodec.CODEC_NONE ] + noise[0:chunksize + 1], bz2_data + "junk", bz2_data[:-4]]:
+	try:
+		iftcodec.decode( data, chunksize )
+		assert False, "Decoded a bad chunk"
+	except ValueError:
+		pass
+
+# the sender picks a codec from the MIME type and the first chunks...
+assert iftcodec.choose( None, None, "text/plain", [text] ) == [iftcodec.DEFAULT_CODEC, iftcodec.DEFAULT_LEVELS[ iftcodec.DEFAULT_CODEC ]], "Did not compress text"
+assert iftcodec.choose( None, None, "application/octet-stream", [noise] ) == None, "Compressed random data"
+assert iftcodec.choose( None, None, "application/x-gzip", [text] ) == None, "Compressed a gzip file"
+assert iftcodec.choose( None, None, "video/mpeg", [text] ) == None, "Compressed a video"
+assert iftcodec.choose( None, None, None, [] ) == None, "Compressed nothing"
+
+# ...unless told which one to use
+assert iftcodec.choose( iftcodec.CODEC_BZ2, 3, "application/x-gzip", [noise] ) == [iftcodec.CODEC_BZ2, 3], "Did not use the codec asked for"
+assert iftcodec.choose( iftcodec.CODEC_NONE, None, "text/plain", [text] ) == None, "Compressed when asked not to"
+assert iftcodec.choose( "lzma", None, "text/plain", [text] ) == None, "Used a codec we don't have"
+
+# the receiver agrees to the codecs it has
+assert iftcodec.accept( iftcodec.CODEC_ZLIB, None ) == [iftcodec.CODEC_ZLIB, iftcodec.DEFAULT_LEVELS[ iftcodec.CODEC_ZLIB ]], "Did not accept zlib"
+assert iftcodec.accept( iftcodec.CODEC_ZLIB, 5 ) == [iftcodec.CODEC_ZLIB, 5], "Did not accept zlib at level 5"
+assert iftcodec.accept( iftcodec.CODEC_BZ2, 5 ) == [iftcodec.CODEC_BZ2, 5], "Did not accept bz2 at level 5"
+assert iftcodec.accept( "lzma", 5 ) == None, "Accepted a codec we don't have"
+assert iftcodec.accept( None, None ) == None and iftcodec.accept( iftcodec.CODEC_NONE, None ) == None, "Accepted no codec"
+
+# a protocol that carries chunks as they are sends them compressed, but others don't
+contents = text + noise
+chunks = [contents[i : i + chunksize] for i in xrange(0, len(contents), chunksize)]
+chunk_hashes = [hashlib.sha1( c ).hexdigest() for c in chunks]
+send_job = stand_in_job( {iftfile.JOB_ATTR_CHUNK_CODEC:[iftcodec.CODEC_ZLIB, 6], iftfile.JOB_ATTR_SRC_NAME:"source"} )
+
+plain = memory_sender( False )
+packed = memory_sender( True )
+for i in xrange(0, len(chunks)):
+	assert plain.send_one_chunk( chunks[i], i, None, None, send_job ) >= 0, "Could not send chunk " + str(i)
+	assert packed.send_one_chunk( chunks[i], i, None, None, send_job ) >= 0, "Could not send chunk " + str(i)
+
+assert plain.sent == dict( enumerate( chunks ) ), "Protocol without a codec did not send chunks as they are"
+assert sum( [len(c) for c in packed.sent.values()] ) < len(contents) * 3 / 4, "Chunks were not compressed"
+
+# the receiver decodes them before checking their hashes, and writes them as they were
+filename = "/tmp/test_iftcodec"
+file_attrs = {iftfile.JOB_ATTR_CHUNKSIZE:chunksize, iftfile.JOB_ATTR_FILE_SIZE:len(contents)}
+ift_file = iftfile.iftfile( filename )
+assert ift_file.fopen( file_attrs, iftfile.MODE_WRITE ) == 0, "Could not open file"
+recv_attrs = {iftfile.JOB_ATTR_IFTFILE:ift_file,
+              iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+              iftfile.JOB_ATTR_CHUNK_HASHES:chunk_hashes,
+              iftfile.JOB_ATTR_CHUNK_CODEC:[iftcodec.CODEC_ZLIB, 6],
+              iftfile.JOB_ATTR_CHUNK_TIMEOUT:0.5,
+              iftfile.JOB_ATTR_REMOTE_IFTD:True,
+              iftfile.JOB_ATTR_SRC_CHUNK_DIR:"/tmp",
+              iftfile.JOB_ATTR_SRC_NAME:"source",
+              iftfile.JOB_ATTR_DEST_NAME:filename}
+
+# the first time, chunk 0 is damaged on the way and chunk 1 doesn't decode, so they are received again
+damaged = {0: iftcodec.encode( "x" + chunks[0][1:], iftcodec.CODEC_ZLIB ), 1: iftcodec.CODEC_TAGS[ iftcodec.CODEC_ZLIB ] + "garbage"}
+receiver = memory_receiver( packed.sent, damaged )
+assert receiver.on_start( stand_in_job( recv_attrs ), {} ) == 0, "Could not start receiving"
+assert receiver.run( 0 ) == PROTO_MSG_END, "Receiving did not end"
+assert damaged == {} and receiver.received.count( 0 ) == 2 and receiver.received.count( 1 ) == 2, "Bad chunks were not received again: " + str(receiver.received)
+assert ift_file.is_complete(), "File is not complete"
+assert ift_file.fclose() == 0, "Could not close file"
+
+fd = open( filename, "rb" )
+assert fd.read() == contents, "File contents are wrong"
+fd.close()
+os.remove( filename )
+
+print "test_iftcodec passed"
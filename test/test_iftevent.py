@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import copy
+import thread
+
+sys.path.append( "../" )
+
+import iftevent
+import iftfile
+import iftcore
+from iftcore import *
+from iftcore.consts import *
+import iftcore.ifttransmit
+from iftdata import *
+
+# a waiter times out if nobody wakes it
+w = iftevent.waiter()
+stime = time.time()
+assert w.wait( 0.1 ) == False, "Woke up without being woken"
+assert time.time() - stime >= 0.09, "Did not wait for the timeout"
+
+# a wakeup before the wait is not lost
+w.wake()
+w.wake()
+stime = time.time()
+assert w.wait( 5.0 ) == True, "Lost a wakeup"
+assert time.time() - stime < 0.1, "Wakeup was slow"
+assert w.wait( 0.0 ) == False, "One wakeup woke two waits"
+
+# a wakeup from another thread ends the wait
+def wake_later( w, delay ):
+	time.sleep( delay )
+	w.wake()
+
+thread.start_new_thread( wake_later, (w, 0.05) )
+stime = time.time()
+assert w.wait( 5.0 ) == True, "Was not woken"
+assert time.time() - stime < 1.0, "Wakeup was slow"
+
+# a waiter can be selected on along with sockets
+import select
+assert select.select( [w], [], [], 0 )[0] == [], "Unwoken waiter was readable"
+w.wake()
+assert select.select( [w], [], [], 0 )[0] == [w], "Woken waiter was not readable"
+assert w.wait( 0.0 ) == True and select.select( [w], [], [], 0 )[0] == [], "Wakeup was not taken"
+
+# events wake every subscriber
+e = iftevent.event()
+w2 = iftevent.waiter()
+e.subscribe( w )
+e.subscribe( w2 )
+e.fire()
+assert w.wait( 0.0 ) and w2.wait( 0.0 ), "Event did not wake its subscribers"
+e.unsubscribe( w2 )
+e.fire()
+assert w.wait( 0.0 ) and not w2.wait( 0.0 ), "Event woke an unsubscribed waiter"
+
+# copies are independent
+e2 = copy.deepcopy( e )
+e2.fire()
+assert not w.wait( 0.0 ), "Copied event woke the original's subscriber"
+
+w.close()
+w2.close()
+
+# stored chunks fire the file's event
+filename = "/tmp/test_iftevent"
+chunksize = 1000
+file_attrs = {
+		iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+		iftfile.JOB_ATTR_FILE_SIZE:2 * chunksize
+		}
+
+ift_file = iftfile.iftfile( filename )
+assert ift_file.fopen( file_attrs, iftfile.MODE_WRITE ) == 0, "Could not open file"
+w = iftevent.waiter()
+ift_file.chunks_changed.subscribe( w )
+assert not w.wait( 0.0 ), "Woken before anything was stored"
+ift_file.lock_chunk( "test_iftevent", 0, True )
+assert ift_file.set_chunk( "x" * chunksize, 0 ) == 0, "Could not set chunk"
+assert w.wait( 0.0 ), "Storing a chunk did not fire chunks_changed"
+ift_file.unlock_chunk( "test_iftevent", 0 )
+ift_file.fclose()
+os.remove( filename )
+w.close()
+
+# an idle transmitter blocks instead of spinning, and wakes when a message is posted
+class idle_transmitter( iftcore.ifttransmit.transmitter ):
+	def __init__( self ):
+		iftcore.ifttransmit.transmitter.__init__( self )
+		self.name = "idle_transmitter"
+		self.calls = 0
+		self.handled = 0
+		self.set_handler( PROTO_MSG_USER, self.handle )
+		self.set_default_behavior( self.nothing_to_do )
+
+	def nothing_to_do( self ):
+		self.calls += 1
+		return (PROTO_MSG_NONE, E_TRY_AGAIN)
+
+	def handle( self, args ):
+		self.handled += 1
+
+def run_transmitter( t, done ):
+	t.run( 0 )
+	done.append( time.time() )
+
+t = idle_transmitter()
+t.set_state( PROTO_STATE_RUNNING )
+done = []
+thread.start_new_thread( run_transmitter, (t, done) )
+
+time.sleep( 1.0 )
+assert t.calls <= 1.0 / PROTO_IDLE_TIMEOUT + 2, "Idle transmitter spun (" + str(t.calls) + " iterations in 1 second)"
+
+stime = time.time()
+t.post_msg( PROTO_MSG_USER, None )
+while t.handled == 0 and time.time() - stime < 5.0:
+	time.sleep( 0.001 )
+assert t.handled == 1, "Posted message was not handled"
+assert time.time() - stime < 0.1, "Posted message took " + str(time.time() - stime) + " seconds to handle"
+
+stime = time.time()
+t.post_msg( PROTO_MSG_TERM, None )
+while len(done) == 0 and time.time() - stime < 5.0:
+	time.sleep( 0.001 )
+assert len(done) == 1, "Transmitter did not stop"
+assert done[0] - stime < 0.1, "Transmitter took " + str(done[0] - stime) + " seconds to stop"
+
+# copies of a transmitter have their own wakeups
+t2 = copy.deepcopy( idle_transmitter() )
+assert t2.wakeup is not t.wakeup, "Copied transmitter shares a wakeup"
+
+print "test_iftevent passed"
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import random
+import hashlib
+
+sys.path.append( "../" )
+
+import iftfile
+
+import test_setup
+import test_cleanup
+
+test_setup.setup()
+
+filename = "/tmp/test_iftfile_hash"
+dest_filename = "/tmp/test_iftfile_hash.dest"
+
+chunksize = 1000
+data = "".join( [chr(random.randint(0, 255)) for i in xrange(0, 50 * chunksize + 123)] )
+
+file_d = open( filename, "wb" )
+file_d.write( data )
+file_d.close()
+
+# sender: one pass gives the same hashes as hashing the file and then each chunk
+rc, file_hash, chunk_hashes = iftfile.hash_file_chunks( filename, chunksize )
+assert rc == 0, "hash_file_chunks failed (rc = " + str(rc) + ")"
+assert file_hash == iftfile.get_hash( filename ), "File hash mismatch"
+assert len(chunk_hashes) == 51, "Wrong number of chunk hashes (" + str(len(chunk_hashes)) + ")"
+for i in xrange(0, len(chunk_hashes)):
+	assert chunk_hashes[i] == hashlib.sha1( data[i * chunksize : (i+1) * chunksize] ).hexdigest(), "Chunk " + str(i) + " hash mismatch"
+
+rc, made_hash, made_chunk_hashes, chunk_paths = iftfile.make_chunks( filename, chunksize )
+assert rc == 0, "make_chunks failed (rc = " + str(rc) + ")"
+assert made_hash == file_hash, "make_chunks file hash mismatch"
+assert made_chunk_hashes == chunk_hashes, "make_chunks chunk hash mismatch"
+for i in xrange(0, len(chunk_paths)):
+	fd = open( chunk_paths[i], "rb" )
+	assert fd.read() == data[i * chunksize : (i+1) * chunksize], "Chunk file " + str(i) + " is wrong"
+	fd.close()
+
+iftfile.cleanup_chunks_dir( filename, file_hash )
+
+# receiver: write the chunks in random order and hash as they land
+order = range(0, len(chunk_hashes))
+random.shuffle( order )
+
+open( dest_filename, "wb" ).close()
+hasher = iftfile.stream_hash( dest_filename, chunksize )
+
+fd = open( dest_filename, "r+b" )
+for i in order:
+	chunk = data[i * chunksize : (i+1) * chunksize]
+	fd.seek( i * chunksize )
+	fd.write( chunk )
+	fd.flush()
+	hasher.add_chunk( i, chunk )
+
+fd.close()
+
+assert hasher.hexdigest() == file_hash, "Streamed file hash mismatch"
+
+os.system( "rm " + filename + " " + dest_filename )
+
+test_cleanup.cleanup()
+
+print "test_iftfile_hash passed"
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+
+sys.path.append( "../" )
+
+import iftfile
+import iftstore
+
+iftfile.startup( "/tmp/test_iftfile_index/files/", "/tmp/test_iftfile_index/index/" )
+
+filename = "/tmp/test_iftfile_index.dat"
+chunksize = 100
+
+file_d = open( filename, "wb" )
+file_d.write( "abcdefghij" * 105 )
+file_d.close()
+
+# pretend the file was written a while ago, so it can be indexed
+old = time.time() - 60
+os.utime( filename, (old, old) )
+
+rc, file_hash, chunk_hashes, chunk_paths = iftfile.make_chunks( filename, chunksize )
+assert rc == 0, "make_chunks failed (rc = " + str(rc) + ")"
+assert iftfile.lookup_chunk_index( filename, chunksize ) == (file_hash, chunk_hashes), "File was not indexed"
+assert iftfile.lookup_chunk_index( filename, chunksize * 2 ) == (None, None), "Indexed the wrong chunk size"
+
+# the second time around, nothing should be read
+real_hash_file_chunks = iftfile.hash_file_chunks
+def no_hashing( filename, chunksize, chunk_func=None ):
+	assert False, "Re-hashed an unchanged file"
+
+iftfile.hash_file_chunks = no_hashing
+
+rc, file_hash2, chunk_hashes2, chunk_paths2 = iftfile.make_chunks( filename, chunksize )
+assert rc == 0, "make_chunks failed on an indexed file (rc = " + str(rc) + ")"
+assert file_hash2 == file_hash and chunk_hashes2 == chunk_hashes and chunk_paths2 == chunk_paths, "Index gave back different chunks"
+
+rc, file_hash3, chunk_hashes3, chunk_views = iftfile.make_chunk_views( filename, chunksize )
+assert rc == 0, "make_chunk_views failed on an indexed file (rc = " + str(rc) + ")"
+assert file_hash3 == file_hash and chunk_hashes3 == chunk_hashes, "Index gave back different views"
+assert len(chunk_views) == len(chunk_hashes), "Wrong number of views"
+for i in xrange(0, len(chunk_views)):
+	fd = open( chunk_paths[i], "rb" )
+	assert chunk_views[i].read() == fd.read(), "View " + str(i) + " does not match its chunk"
+	fd.close()
+
+iftfile.release_chunk_views( [[v, 0, None, None] for v in chunk_views] )
+
+iftfile.hash_file_chunks = real_hash_file_chunks
+
+# a modified file must be re-hashed
+file_d = open( filename, "ab" )
+file_d.write( "more" )
+file_d.close()
+os.utime( filename, (old + 1, old + 1) )
+
+assert iftfile.lookup_chunk_index( filename, chunksize ) == (None, None), "Index did not notice the file changed"
+
+rc, file_hash4, chunk_hashes4, chunk_paths4 = iftfile.make_chunks( filename, chunksize )
+assert rc == 0, "make_chunks failed on a modified file (rc = " + str(rc) + ")"
+assert file_hash4 == iftfile.get_hash( filename ) and file_hash4 != file_hash, "Modified file has the wrong hash"
+assert iftfile.lookup_chunk_index( filename, chunksize ) == (file_hash4, chunk_hashes4), "Modified file was not indexed"
+assert len(os.listdir( "/tmp/test_iftfile_index/index/" )) == 1, "Modified file's old entry is still in the index"
+iftfile.cleanup_chunks_dir( filename, file_hash )
+iftfile.cleanup_chunks_dir( filename, file_hash4 )
+
+# recently-modified files are not indexed
+file_d = open( filename, "ab" )
+file_d.write( "still changing" )
+file_d.close()
+
+rc, file_hash5, chunk_hashes5, chunk_paths5 = iftfile.make_chunks( filename, chunksize )
+assert rc == 0, "make_chunks failed on a fresh file (rc = " + str(rc) + ")"
+assert iftfile.lookup_chunk_index( filename, chunksize ) == (None, None), "Indexed a file that might still be changing"
+
+# with a chunk store, an indexed file's chunks are linked out of it after its chunk directory is cleaned up
+os.utime( filename, (old + 2, old + 2) )
+iftstore.startup( "/tmp/test_iftfile_index/store/" )
+rc, file_hash6, chunk_hashes6, chunk_paths6 = iftfile.make_chunks( filename, chunksize )
+assert rc == 0, "make_chunks failed (rc = " + str(rc) + ")"
+chunks6 = []
+for path in chunk_paths6:
+	fd = open( path, "rb" )
+	chunks6.append( fd.read() )
+	fd.close()
+
+iftfile.cleanup_chunks_dir( filename, file_hash6 )
+assert not os.path.exists( iftfile.get_chunks_dir( filename, file_hash6 ) ), "Chunk directory was not cleaned up"
+
+iftfile.hash_file_chunks = no_hashing
+rc, file_hash7, chunk_hashes7, chunk_paths7 = iftfile.make_chunks( filename, chunksize )
+iftfile.hash_file_chunks = real_hash_file_chunks
+assert rc == 0 and file_hash7 == file_hash6 and chunk_paths7 == chunk_paths6, "Index gave back different chunks"
+for i in xrange(0, len(chunk_paths7)):
+	fd = open( chunk_paths7[i], "rb" )
+	assert fd.read() == chunks6[i], "Linked chunk " + str(i) + " is wrong"
+	fd.close()
+	assert os.stat( chunk_paths7[i] ).st_ino == os.stat( iftstore.get_store().path( chunk_hashes7[i] ) ).st_ino, "Chunk " + str(i) + " was not linked from the store"
+
+iftfile.cleanup_chunks_dir( filename, file_hash7 )
+iftstore.startup( None )
+
+# the index doesn't grow past its cap
+iftfile.CHUNK_INDEX_MAX_ENTRIES = 4
+for i in xrange(0, 10):
+	name = "/tmp/test_iftfile_index.%d.dat" % i
+	file_d = open( name, "wb" )
+	file_d.write( "file %d" % i )
+	file_d.close()
+	os.utime( name, (old, old) )
+	rc, h, hashes, views = iftfile.make_chunk_views( name, chunksize )
+	assert rc == 0, "make_chunk_views failed (rc = " + str(rc) + ")"
+	iftfile.release_chunk_views( [[v, 0, None, None] for v in views] )
+	os.remove( name )
+	assert len(os.listdir( "/tmp/test_iftfile_index/index/" )) <= 4, "Index is over its cap"
+
+os.system( "rm -rf " + filename + " /tmp/test_iftfile_index" )
+
+print "test_iftfile_index passed"
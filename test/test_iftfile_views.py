@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import hashlib
+
+sys.path.append( "../" )
+
+import iftfile
+
+filename = "/tmp/test_iftfile_views"
+
+file_d = open( filename, "w" )
+
+for i in range(0, 500):
+	file_d.write("abcdefg\n")
+
+file_d.write("xyz")
+file_d.close()
+
+chunksize = len("abcdefg\n")
+
+rc, file_hash, chunk_hashes, chunk_views = iftfile.make_chunk_views( filename, chunksize )
+
+assert rc == 0, "make_chunk_views failed (rc = " + str(rc) + ")"
+assert file_hash == iftfile.get_hash( filename ), "File hash mismatch"
+assert len(chunk_views) == 501, "Wrong number of chunks (" + str(len(chunk_views)) + ")"
+assert len(chunk_hashes) == len(chunk_views), "Wrong number of chunk hashes"
+
+for i in range(0, 500):
+	assert chunk_views[i].offset == i * chunksize, "Chunk " + str(i) + " has the wrong offset"
+	assert iftfile.chunk_data_str( chunk_views[i] ) == "abcdefg\n", "Could not read chunk " + str(i)
+	assert chunk_hashes[i] == hashlib.sha1( "abcdefg\n" ).hexdigest(), "Chunk " + str(i) + " hash mismatch"
+
+assert len(chunk_views[500]) == 3, "Last chunk has the wrong length"
+assert chunk_views[500].read() == "xyz", "Could not read last chunk"
+
+# nothing should have been written to the chunk directory
+assert not os.path.exists( os.path.join( iftfile.get_chunks_dir( filename, file_hash ), "0" ) ), "Chunk files were created"
+
+chunk_data = [[chunk_views[i], i, None, None] for i in xrange(0, len(chunk_views))]
+iftfile.release_chunk_views( chunk_data )
+
+os.system( "rm " + filename )
+
+print "test_iftfile_views passed"
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import random
+import hashlib
+
+sys.path.append( "../" )
+
+import iftfile
+
+filename = "/tmp/test_iftfile_write"
+chunksize = 1000
+data = "".join( [chr(random.randint(0, 255)) for i in xrange(0, 40 * chunksize + 77)] )
+num_chunks = (len(data) + chunksize - 1) / chunksize
+
+file_attrs = {
+		iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+		iftfile.JOB_ATTR_FILE_SIZE:len(data),
+		iftfile.JOB_ATTR_FILE_HASH:hashlib.sha1( data ).hexdigest(),
+		iftfile.JOB_ATTR_FSYNC_CHUNKS:8
+		}
+
+ift_file = iftfile.iftfile( filename )
+rc = ift_file.fopen( file_attrs, iftfile.MODE_WRITE )
+assert rc == 0, "Could not open file for writing (rc = " + str(rc) + ")"
+
+# the file is preallocated
+assert os.stat( filename ).st_size == len(data), "File was not preallocated"
+
+# write the chunks in random order
+order = range(0, num_chunks)
+random.shuffle( order )
+
+owner = "test_iftfile_write"
+
+# reserved chunks are not handed out to anyone else
+assert ift_file.next_unwritten_chunks( 2 ) == [0, 1], "Wrong unwritten chunks"
+assert ift_file.reserve_chunk( owner, 0, 60 ) == 0, "Could not reserve chunk 0"
+assert ift_file.reserve_chunk( "someone else", 0, 60 ) != 0, "Reserved a reserved chunk"
+assert ift_file.is_chunk_reserved( owner, 0 ), "Chunk 0 is not reserved"
+assert ift_file.next_unwritten_chunks( 2 ) == [1, 2], "Handed out a reserved chunk"
+ift_file.unreserve_all( owner )
+assert ift_file.next_unwritten_chunks( 1 ) == [0], "Unreserved chunk was not handed out"
+
+for i in order:
+	rc = ift_file.lock_chunk( owner, i, True )
+	assert rc == 0, "Could not lock chunk " + str(i) + " (rc = " + str(rc) + ")"
+	rc = ift_file.set_chunk( data[i * chunksize : (i+1) * chunksize], i )
+	assert rc == 0, "Could not write chunk " + str(i) + " (rc = " + str(rc) + ")"
+	ift_file.unlock_chunk( owner, i )
+
+assert ift_file.is_complete(), "File is not complete"
+assert ift_file.next_unwritten_chunks( 4 ) == [], "Complete file has unwritten chunks"
+assert ift_file.calc_hash() == file_attrs[iftfile.JOB_ATTR_FILE_HASH], "File hash is wrong"
+
+rc = ift_file.fclose()
+assert rc == 0, "Could not close file (rc = " + str(rc) + ")"
+
+fd = open( filename, "rb" )
+assert fd.read() == data, "File contents are wrong"
+fd.close()
+
+os.system( "rm " + filename )
+
+print "test_iftfile_write passed"
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import sys
+import hashlib
+
+sys.path.append( "../" )
+
+import iftmerkle
+import iftfile
+import iftapi
+
+chunksize = 100
+
+for num_chunks in [1, 2, 3, 7, 8, 33]:
+	chunks = ["chunk %d " % i + "x" * (chunksize - 12) for i in xrange(0, num_chunks)]
+	chunk_hashes = [hashlib.sha1( c ).hexdigest() for c in chunks]
+
+	tree = iftmerkle.merkle_tree( chunk_hashes )
+	root = tree.root()
+
+	proofs_fetched = []
+	def fetch_proof( chunk_ids ):
+		proofs_fetched.append( chunk_ids )
+		return tree.proof( chunk_ids )
+
+	verifier = iftmerkle.merkle_verifier( root, num_chunks, fetch_proof )
+
+	# a bad chunk should fail, and should not poison anything
+	status = verifier.verify_chunks( {0: "garbage"} )
+	assert status[0] == False, "Bad chunk verified (" + str(num_chunks) + " chunks)"
+
+	# verify a range at once
+	table = {}
+	for i in xrange(0, num_chunks / 2):
+		table[i] = chunks[i]
+
+	status = verifier.verify_chunks( table )
+	for k in status.keys():
+		assert status[k] == True, "Chunk " + str(k) + " did not verify (" + str(num_chunks) + " chunks)"
+
+	# the rest, one at a time
+	for i in xrange(num_chunks / 2, num_chunks):
+		status = verifier.verify_chunks( {i: chunks[i]} )
+		assert status[i] == True, "Chunk " + str(i) + " did not verify (" + str(num_chunks) + " chunks)"
+
+	# everything is known now, so no more proofs are needed
+	num_fetched = len(proofs_fetched)
+	status = verifier.verify_chunks( {num_chunks - 1: chunks[num_chunks - 1]} )
+	assert status[num_chunks - 1] == True, "Chunk did not re-verify"
+	assert len(proofs_fetched) == num_fetched, "Fetched a proof we did not need"
+
+	# bad chunks still fail once the tree is known
+	status = verifier.verify_chunks( {num_chunks - 1: "garbage"} )
+	assert status[num_chunks - 1] == False, "Bad chunk verified after the tree was known"
+
+# a verifier with a different root rejects everything
+tree = iftmerkle.merkle_tree( [hashlib.sha1( "a" ).hexdigest(), hashlib.sha1( "b" ).hexdigest()] )
+verifier = iftmerkle.merkle_verifier( hashlib.sha1( "c" ).hexdigest(), 2, tree.proof )
+assert verifier.verify_chunks( {0: "a"} )[0] == False, "Verified against the wrong root"
+
+assert iftmerkle.num_leaves( 0, chunksize ) == 1, "Wrong number of leaves for an empty file"
+assert iftmerkle.num_leaves( chunksize, chunksize ) == 2, "Wrong number of leaves"
+assert iftmerkle.num_leaves( chunksize + 1, chunksize ) == 2, "Wrong number of leaves"
+
+# a receiver given every hash checks them against the root once, and needs no proofs
+hashes = [hashlib.sha1( "a" ).hexdigest(), hashlib.sha1( "b" ).hexdigest()]
+attrs = {iftfile.JOB_ATTR_MERKLE_ROOT:tree.root(), iftfile.JOB_ATTR_CHUNK_HASHES:hashes}
+assert iftapi.chunk_hashes_match_root( attrs ), "Hashes did not match their root"
+assert not iftapi.needs_merkle_verifier( attrs ), "Asked for proofs with every hash at hand"
+attrs[ iftfile.JOB_ATTR_CHUNK_HASHES ] = [hashes[0], hashlib.sha1( "c" ).hexdigest()]
+assert not iftapi.chunk_hashes_match_root( attrs ), "Wrong hashes matched the root"
+attrs[ iftfile.JOB_ATTR_CHUNK_HASHES ] = None
+assert iftapi.chunk_hashes_match_root( attrs ) and iftapi.needs_merkle_verifier( attrs ), "Did not ask for proofs with just a root"
+
+print "test_iftmerkle passed"
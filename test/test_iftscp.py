@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import shutil
+
+sys.path.append( "../" )
+
+import iftfile
+import protocols.iftscp
+
+# a stand-in ssh that runs the remote command with the shell, as the remote sshd would
+bin_dir = "/tmp/test_iftscp_bin"
+if not os.path.exists( bin_dir ):
+	os.makedirs( bin_dir )
+fd = open( bin_dir + "/ssh", "w" )
+fd.write( "#!/bin/sh\nfor last; do :; done\nexec sh -c \"$last\"\n" )
+fd.close()
+os.chmod( bin_dir + "/ssh", 0755 )
+os.environ["PATH"] = bin_dir + ":" + os.environ["PATH"]
+
+dir = "/tmp/test iftscp's dir"
+if not os.path.exists( dir ):
+	os.makedirs( dir )
+path = dir + "/source"
+data = os.urandom( 10000 )
+fd = open( path, "wb" )
+fd.write( data )
+fd.close()
+
+sender = protocols.iftscp.iftscp_sender()
+sender.remote_user = "user"
+sender.remote_host = "localhost"
+
+# a chunk's byte range is streamed to a remote path that the shell would otherwise split up or run
+source = iftfile.chunk_source( path )
+chunk = iftfile.chunk_view( source, 1000, 2345 )
+for name in ["chunk 1", "it's chunk 2", "$(touch pwned)", "`touch pwned`; x"]:
+	remote = dir + "/" + name
+	assert sender.send_chunk( chunk, 1, None, remote ) == len(chunk), "Could not send to " + remote
+	fd = open( remote, "rb" )
+	assert fd.read() == data[1000:3345], "Chunk sent to " + remote + " is wrong"
+	fd.close()
+	assert not os.path.exists( "pwned" ) and not os.path.exists( dir + "/pwned" ), "Remote path " + name + " was run"
+
+assert protocols.iftscp.shell_quote( "a'b" ) == "'a'\\''b'", "Wrong quoting"
+
+source.close()
+shutil.rmtree( dir )
+shutil.rmtree( bin_dir )
+
+print "test_iftscp passed"
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import socket
+import threading
+
+sys.path.append( "../" )
+
+import iftfile
+import iftcore
+from iftcore import *
+from iftcore.consts import *
+import protocols.iftsocket
+from iftdata import *
+from stand_ins import stand_in_job
+
+def connected_pair( chunksize=4 * 1024 * 1024 ):
+	# an iftsocket sender and receiver connected over loopback
+	listen_soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+	listen_soc.bind( ("127.0.0.1", 0) )
+	listen_soc.listen( 1 )
+
+	sender = protocols.iftsocket.iftsocket_sender()
+	soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+	soc.connect( listen_soc.getsockname() )
+	sender.add_stream( soc )
+
+	receiver = protocols.iftsocket.iftsocket_receiver()
+	receiver.port = None
+	receiver.job = stand_in_job( {iftfile.JOB_ATTR_CHUNKSIZE:chunksize} )
+	soc, addr = listen_soc.accept()
+	receiver.add_stream( soc )
+	receiver.got = {}
+	receiver.add_chunk = lambda chunk_id, chunk: receiver.got.__setitem__( chunk_id, chunk )
+	listen_soc.close()
+	return (sender, receiver)
+
+def send_all( sender, chunks ):
+	for (chunk_id, chunk) in chunks:
+		assert sender.send_chunk( chunk, chunk_id, None, None ) == len(chunk), "Could not send chunk " + str(chunk_id)
+
+def send_later( sender, chunks ):
+	t = threading.Thread( target=send_all, args=(sender, chunks) )
+	t.start()
+	return t
+
+# chunks of every size make it across, including chunk 0 and an empty chunk
+sender, receiver = connected_pair()
+chunks = [(0, os.urandom( 10 )), (7, ""), (3, os.urandom( 100000 )), (12, os.urandom( 3 * 1024 * 1024 + 17 ))]
+t = send_later( sender, chunks )
+assert receiver.recv_chunks( "", [0, 3, 7, 12] ) == 0, "Could not receive chunks"
+t.join()
+for (chunk_id, chunk) in chunks:
+	assert receiver.got[ chunk_id ] == chunk, "Chunk " + str(chunk_id) + " is wrong"
+
+# ...and on Pythons that can't receive into a buffer
+protocols.iftsocket.HAVE_RECV_INTO = False
+receiver.got = {}
+t = send_later( sender, chunks )
+assert receiver.recv_chunks( "", [0, 3, 7, 12] ) == 0, "Could not receive chunks without recv_into"
+t.join()
+for (chunk_id, chunk) in chunks:
+	assert receiver.got[ chunk_id ] == chunk, "Chunk " + str(chunk_id) + " is wrong without recv_into"
+protocols.iftsocket.HAVE_RECV_INTO = True
+
+# chunk views are sent straight out of the file
+path = "/tmp/test_iftsocket_framing"
+data = os.urandom( 50000 )
+fd = open( path, "wb" )
+fd.write( data )
+fd.close()
+source = iftfile.chunk_source( path )
+assert source.open() == 0, "Could not open chunk source"
+views = [(0, iftfile.chunk_view( source, 0, 20000 )), (1, iftfile.chunk_view( source, 20000, 30000 ))]
+receiver.got = {}
+t = send_later( sender, views )
+assert receiver.recv_chunks( "", [0, 1] ) == 0, "Could not receive chunk views"
+t.join()
+assert receiver.got[0] + receiver.got[1] == data, "Chunk views arrived wrong"
+source.close()
+os.remove( path )
+
+# a chunk that fails its checksum is dropped, and the stream carries on
+receiver.got = {}
+good = os.urandom( 1000 )
+bad = protocols.iftsocket.frame_header( 5, "x" * 1000 )
+sender.streams[0].sendall( bad + "y" * 1000 )
+send_all( sender, [(6, good)] )
+assert receiver.recv_chunks( "", [5, 6] ) == E_CORRUPT, "Corrupt chunk was not reported"
+assert receiver.got == {6:good}, "Corrupt chunk was kept, or the next one was lost"
+
+# ...but the sender won't send it again, so the receiver gives up after this batch
+assert receiver.recv_finish and receiver.recv_status == TRANSMIT_STATE_FAILURE, "Receiver did not finish after a corrupt chunk"
+receiver.recv_finish = False
+receiver.recv_status = 0
+
+# ...unless checksums are off
+receiver.got = {}
+sender.checksum = False
+send_all( sender, [(8, good)] )
+assert receiver.recv_chunks( "", [8] ) == 0, "Could not receive without a checksum"
+assert receiver.got == {8:good}, "Chunk without a checksum arrived wrong"
+
+# garbage means we've lost our place, so the connection is dropped
+sender.streams[0].sendall( "this is not a frame header at all" )
+assert receiver.recv_chunks( "", [9] ) == E_CORRUPT, "Garbage was not reported"
+assert receiver.streams == [], "Connection was kept after garbage"
+
+# a frame bigger than a chunk can be means we've lost our place, and nothing is allocated for it
+sender, receiver = connected_pair( 1000 )
+huge = protocols.iftsocket.IFTSOCKET_HEADER.pack( protocols.iftsocket.IFTSOCKET_MAGIC, protocols.iftsocket.IFTSOCKET_VERSION, 0, 0, 1 << 40, 0 )
+sender.streams[0].sendall( huge )
+assert receiver.recv_chunks( "", [0] ) == E_CORRUPT, "Oversized frame was not reported"
+assert receiver.streams == [] and (receiver.buf == None or len(receiver.buf) < 1000), "Oversized frame was read"
+
+# ...though a whole chunk (and its codec tag) fits
+sender, receiver = connected_pair( 1000 )
+t = send_later( sender, [(0, "z" * 1001)] )
+assert receiver.recv_chunks( "", [0] ) == 0, "Could not receive a full-size frame"
+t.join()
+assert receiver.got == {0:"z" * 1001}, "Full-size frame arrived wrong"
+sender.kill( None )
+receiver.proto_clean()
+
+# the sender going away is the end of the file
+sender, receiver = connected_pair()
+sender.kill( None )
+assert receiver.recv_chunks( "", [0] ) == E_EOF, "Closed connection was not EOF"
+receiver.proto_clean()
+
+print "test_iftsocket_framing passed"
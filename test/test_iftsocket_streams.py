@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import socket
+import threading
+
+sys.path.append( "../" )
+
+import iftfile
+import iftcore
+from iftcore import *
+from iftcore.consts import *
+import protocols.iftsocket
+from iftdata import *
+from stand_ins import stand_in_job
+
+def free_port():
+	soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+	soc.bind( ("127.0.0.1", 0) )
+	port = soc.getsockname()[1]
+	soc.close()
+	return port
+
+port = free_port()
+chunks = [os.urandom( 20000 ) for i in xrange(0, 200)]
+
+def start( xmit_id, num_streams ):
+	receiver = protocols.iftsocket.iftsocket_receiver()
+	receiver.setup( {PROTO_PORTNUM:port} )
+	receiver.recv_job( stand_in_job( {iftfile.JOB_ATTR_XMIT_ID:xmit_id, iftfile.JOB_ATTR_FILE_HASH:"hash", iftfile.JOB_ATTR_CHUNKSIZE:20000} ) )
+	assert receiver.await_sender( {PROTO_PORTNUM:port, protocols.iftsocket.IFTSOCKET_TIMEOUT:2}, 1 ) == 0, "Receiver could not listen"
+	receiver.got = {}
+	receiver.add_chunk = lambda chunk_id, chunk: receiver.got.__setitem__( chunk_id, chunk )
+
+	sender = protocols.iftsocket.iftsocket_sender()
+	sender.setup( {PROTO_PORTNUM:port} )
+	rc = sender.prepare_transmit( stand_in_job( {iftfile.JOB_ATTR_DEST_HOST:"127.0.0.1", PROTO_PORTNUM:port, iftfile.JOB_ATTR_XMIT_ID:xmit_id, iftfile.JOB_ATTR_FILE_HASH:"hash", protocols.iftsocket.IFTSOCKET_STREAMS:num_streams} ) )
+	assert rc == 0, "Sender could not connect"
+	return (sender, receiver)
+
+def send( sender, chunk_ids, break_after=None ):
+	for i in chunk_ids:
+		if i == break_after:
+			# one stream breaks partway through
+			sender.streams[0].shutdown( socket.SHUT_RDWR )
+		assert sender.send_chunk( chunks[i], i, None, None ) == len(chunks[i]), "Could not send chunk " + str(i)
+
+def transfer( sender, receiver, chunk_ids, break_after=None ):
+	t = threading.Thread( target=send, args=(sender, chunk_ids, break_after) )
+	t.start()
+	rc = receiver.recv_chunks( "", list(chunk_ids) )
+	t.join()
+	return rc
+
+# a transfer is spread over several streams
+sender, receiver = start( "xmit1", 3 )
+assert len(sender.streams) == 3, "Sender opened " + str(len(sender.streams)) + " streams"
+assert transfer( sender, receiver, range(0, 100) ) == 0, "Could not receive over several streams"
+assert len(receiver.streams) == 3, "Receiver got " + str(len(receiver.streams)) + " streams"
+for i in xrange(0, 100):
+	assert receiver.got[i] == chunks[i], "Chunk " + str(i) + " is wrong"
+
+first_streams = [soc.getsockname() for soc in sender.streams]
+sender.proto_clean()
+receiver.proto_clean()
+
+# the next transfer to the same receiver reuses the streams
+sender, receiver = start( "xmit2", 3 )
+assert [soc.getsockname() for soc in sender.streams] == first_streams, "Streams were not reused"
+assert transfer( sender, receiver, range(100, 200) ) == 0, "Could not receive over reused streams"
+for i in xrange(100, 200):
+	assert receiver.got[i] == chunks[i], "Chunk " + str(i) + " is wrong over reused streams"
+sender.proto_clean()
+receiver.proto_clean()
+
+# a stream breaking partway through does not lose chunks
+sender, receiver = start( "xmit3", 3 )
+assert transfer( sender, receiver, range(0, 100), 50 ) == 0, "Could not receive after a stream broke"
+assert len(sender.streams) == 2, "Broken stream was not dropped"
+for i in xrange(0, 100):
+	assert receiver.got[i] == chunks[i], "Chunk " + str(i) + " is wrong after a stream broke"
+sender.proto_clean()
+receiver.proto_clean()
+
+# streams for another transfer are handed to that transfer's receiver
+sender, receiver = start( "xmit4", 2 )
+receiver.job.attrs[ iftfile.JOB_ATTR_XMIT_ID ] = "some other transfer"
+t = threading.Thread( target=send, args=(sender, [0, 1]) )
+t.start()
+assert receiver.recv_chunks( "", [0, 1] ) == E_TIMEOUT, "Received chunks from another transfer"
+t.join()
+assert receiver.got == {}, "Kept chunks from another transfer"
+
+other = protocols.iftsocket.iftsocket_receiver()
+other.setup( {PROTO_PORTNUM:port} )
+other.recv_job( stand_in_job( {iftfile.JOB_ATTR_XMIT_ID:"xmit4", iftfile.JOB_ATTR_FILE_HASH:"hash"} ) )
+assert other.await_sender( {PROTO_PORTNUM:port, protocols.iftsocket.IFTSOCKET_TIMEOUT:2}, 1 ) == 0, "Receiver could not listen"
+other.got = {}
+other.add_chunk = lambda chunk_id, chunk: other.got.__setitem__( chunk_id, chunk )
+assert other.recv_chunks( "", [0, 1] ) == 0, "Handed-off streams were not received from"
+assert other.got == {0:chunks[0], 1:chunks[1]}, "Handed-off streams carried the wrong data"
+sender.kill( None )
+receiver.kill( None )
+other.kill( None )
+
+# two transfers of the same file at once each get their own streams, and a
+# receiver waiting for its streams is woken as soon as they are handed off
+import time
+first = protocols.iftsocket.iftsocket_receiver()
+first.setup( {PROTO_PORTNUM:port} )
+first.recv_job( stand_in_job( {iftfile.JOB_ATTR_XMIT_ID:"xmit5", iftfile.JOB_ATTR_FILE_HASH:"hash"} ) )
+assert first.await_sender( {PROTO_PORTNUM:port, protocols.iftsocket.IFTSOCKET_TIMEOUT:5}, 1 ) == 0, "Receiver could not listen"
+first.got = {}
+first.add_chunk = lambda chunk_id, chunk: first.got.__setitem__( chunk_id, chunk )
+
+waiting = protocols.iftsocket.iftsocket_receiver()
+waiting.setup( {PROTO_PORTNUM:port} )
+waiting.recv_job( stand_in_job( {iftfile.JOB_ATTR_XMIT_ID:"xmit6", iftfile.JOB_ATTR_FILE_HASH:"hash"} ) )
+assert waiting.await_sender( {PROTO_PORTNUM:port, protocols.iftsocket.IFTSOCKET_TIMEOUT:5}, 1 ) == 0, "Receiver could not listen"
+waiting.soc = None      # only the first receiver accepts
+waiting.got = {}
+waiting.add_chunk = lambda chunk_id, chunk: waiting.got.__setitem__( chunk_id, chunk )
+waited = []
+def wait_for_handoff():
+	start_time = time.time()
+	waited.append( waiting.recv_chunks( "", [2, 3] ) )
+	waited.append( time.time() - start_time )
+
+t = threading.Thread( target=wait_for_handoff )
+t.start()
+time.sleep( 0.2 )
+
+sender5 = protocols.iftsocket.iftsocket_sender()
+sender5.setup( {PROTO_PORTNUM:port} )
+assert sender5.prepare_transmit( stand_in_job( {iftfile.JOB_ATTR_DEST_HOST:"127.0.0.1", PROTO_PORTNUM:port, iftfile.JOB_ATTR_XMIT_ID:"xmit5", iftfile.JOB_ATTR_FILE_HASH:"hash", protocols.iftsocket.IFTSOCKET_STREAMS:1} ) ) == 0, "Sender could not connect"
+sender6 = protocols.iftsocket.iftsocket_sender()
+sender6.setup( {PROTO_PORTNUM:port} )
+assert sender6.prepare_transmit( stand_in_job( {iftfile.JOB_ATTR_DEST_HOST:"127.0.0.1", PROTO_PORTNUM:port, iftfile.JOB_ATTR_XMIT_ID:"xmit6", iftfile.JOB_ATTR_FILE_HASH:"hash", protocols.iftsocket.IFTSOCKET_STREAMS:1} ) ) == 0, "Sender could not connect"
+send( sender5, [0, 1] )
+send( sender6, [2, 3] )
+assert first.recv_chunks( "", [0, 1] ) == 0, "Could not receive the first transfer"
+t.join()
+assert first.got == {0:chunks[0], 1:chunks[1]}, "First transfer got the wrong chunks"
+assert waited[0] == 0 and waiting.got == {2:chunks[2], 3:chunks[3]}, "Second transfer got the wrong chunks"
+assert waited[1] < 2, "Waiting receiver took " + str(waited[1]) + " seconds to notice its streams"
+sender5.kill( None )
+sender6.kill( None )
+first.kill( None )
+waiting.kill( None )
+
+print "test_iftsocket_streams passed"
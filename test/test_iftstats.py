@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import sys
+import random
+
+sys.path.append( "../" )
+
+import iftstats
+
+class stats_job:
+	# just the stats part of an iftjob
+	def __init__( self ):
+		self.stats = {}
+
+	def get_stat( self, attr ):
+		return self.stats.get( attr )
+
+	def set_stat( self, attr, value ):
+		self.stats[ attr ] = value
+
+job = stats_job()
+iftstats.begin_transfer( job, receiver=True )
+
+assert iftstats.proto_performance( job, "http" ) == (None, None), "Performance without any chunks"
+
+# log chunks from a few protocols, keeping our own list to check against
+logged = []
+t = 1000.0
+for i in xrange(0, 5000):
+	proto = random.choice( ["http", "iftsocket", "scp"] )
+	status = random.random() < 0.9
+	elapsed = random.uniform( 0.001, 0.01 )
+	size = random.randint( 1, 65536 )
+	iftstats.log_chunk( job, proto, status, t, t + elapsed, size )
+	logged.append( (proto, status, t, t + elapsed, size) )
+	t += elapsed
+
+log = job.get_stat( iftstats.IFTSTATS_PROTO_LIST )
+assert len(log) == len(logged), "Wrong number of chunks logged"
+assert log[17] == logged[17], "Chunk logged wrong: " + str(log[17]) + " != " + str(logged[17])
+assert list(log) == logged, "Log does not match what was logged"
+
+for proto in ["http", "iftsocket", "scp"]:
+	data_cnt = sum( [c[4] for c in logged if c[0] == proto and c[1]] )
+	time_cnt = sum( [c[3] - c[2] for c in logged if c[0] == proto] )
+	got_data, got_time = iftstats.proto_performance( job, proto )
+	assert got_data == data_cnt, proto + ": wrong data count"
+	assert abs( got_time - time_cnt ) < 1e-6, proto + ": wrong time count"
+
+	ewma, recent = iftstats.proto_bandwidth( job, proto )
+	assert ewma > 0, proto + ": no moving average bandwidth"
+	assert recent == None, proto + ": recent bandwidth long after the last chunk"
+
+# a protocol sending steadily has a recent bandwidth that matches its rate
+job = stats_job()
+iftstats.begin_transfer( job )
+t = 2000.0
+for i in xrange(0, 100):
+	iftstats.log_chunk( job, "http", True, t, t + 0.5, 1000 )
+	t += 0.5
+
+ewma, recent = job.get_stat( iftstats.IFTSTATS_PROTO_LIST ).bandwidth( "http", t )
+assert abs( ewma - 2000.0 ) < 1e-6, "Wrong moving average bandwidth " + str(ewma)
+assert abs( recent - 2000.0 ) < 1e-6, "Wrong recent bandwidth " + str(recent)
+
+# a chunk of unknown size (e.g. from a file that has gone away) is logged as empty
+job = stats_job()
+iftstats.begin_transfer( job )
+iftstats.log_chunk( job, "scp", False, t, t + 0.5, -1 )
+iftstats.log_chunk( job, "scp", True, t + 0.5, t + 1.0, None )
+log = job.get_stat( iftstats.IFTSTATS_PROTO_LIST )
+assert [c[4] for c in log] == [0, 0], "Unknown sizes logged as " + str([c[4] for c in log])
+assert iftstats.proto_performance( job, "scp" )[0] == 0, "Unknown sizes counted as data"
+
+print "test_iftstats passed"
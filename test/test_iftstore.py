@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import hashlib
+
+sys.path.append( "../" )
+
+import iftfile
+import iftstore
+import iftcore
+from iftcore import *
+import iftcore.iftreceiver
+from iftcore.consts import *
+from iftdata import *
+from stand_ins import stand_in_job
+
+class memory_receiver( iftcore.iftreceiver.receiver ):
+	# a receiver whose network is a list of chunks in memory
+	def __init__( self, chunks ):
+		iftcore.iftreceiver.receiver.__init__( self )
+		self.name = "memory_receiver"
+		self.chunks = chunks
+		self.received = []
+		self.set_chunking_mode( PROTO_DETERMINISTIC_CHUNKING )
+
+	def recv_chunks( self, remote_chunk_dir, desired_chunks ):
+		self.received += desired_chunks
+		for i in desired_chunks:
+			self.add_chunk( i, self.chunks[i] )
+		return 0
+
+store_dir = "/tmp/test_iftstore/"
+chunksize = 4096
+
+def sha1( s ):
+	return hashlib.sha1( s ).hexdigest()
+
+os.system( "rm -rf " + store_dir )
+assert iftstore.startup( store_dir, 8 * chunksize ) == 0, "Could not start the store"
+store = iftstore.get_store()
+
+# put and get
+chunks = [os.urandom( chunksize ) for i in xrange(0, 12)]
+assert iftstore.put( sha1( chunks[0] ), chunks[0] ) == 0, "Could not add a chunk"
+assert iftstore.put( sha1( chunks[0] ), chunks[0] ) == 0, "Could not add a chunk twice"
+assert iftstore.get( sha1( chunks[0] ) ) == chunks[0], "Got the wrong chunk"
+assert iftstore.get( sha1( chunks[1] ) ) == None, "Got a chunk that isn't there"
+assert iftstore.stats()["chunks"] == 1 and iftstore.stats()["bytes"] == chunksize, "Wrong size: " + str(iftstore.stats())
+
+# a damaged chunk is thrown away
+iftstore.put( sha1( chunks[1] ), chunks[1] )
+fd = open( store.path( sha1( chunks[1] ) ), "r+b" )
+fd.write( "x" )
+fd.close()
+assert iftstore.get( sha1( chunks[1] ) ) == None, "Got a damaged chunk"
+assert not store.has( sha1( chunks[1] ) ) and not os.path.exists( store.path( sha1( chunks[1] ) ) ), "Damaged chunk is still there"
+
+# the least recently used chunks that aren't referenced are evicted
+iftstore.ref( [sha1( chunks[2] )] )
+for i in xrange(2, 12):
+	iftstore.put( sha1( chunks[i] ), chunks[i] )
+	time.sleep( 0.01 )
+	iftstore.get( sha1( chunks[0] ) )        # keep chunk 0 in use
+
+assert iftstore.stats()["bytes"] <= 8 * chunksize, "Store is over its cap: " + str(iftstore.stats())
+assert store.has( sha1( chunks[0] ) ), "Evicted a chunk in use"
+assert store.has( sha1( chunks[2] ) ), "Evicted a referenced chunk"
+assert not store.has( sha1( chunks[3] ) ), "Did not evict the least recently used chunk"
+assert store.has( sha1( chunks[11] ) ), "Evicted the newest chunk"
+assert iftstore.stats()["evictions"] > 0, "Nothing was evicted"
+
+iftstore.unref( [sha1( chunks[2] )] )
+for i in xrange(3, 12):
+	iftstore.put( sha1( chunks[i] ), chunks[i] )
+assert not store.has( sha1( chunks[2] ) ), "Unreferenced chunk was never evicted"
+
+# it's all still there after a restart
+stored = iftstore.stats()
+assert iftstore.startup( store_dir, 8 * chunksize ) == 0, "Could not restart the store"
+store = iftstore.get_store()
+assert iftstore.stats()["chunks"] == stored["chunks"] and iftstore.stats()["bytes"] == stored["bytes"], "Lost chunks over a restart"
+assert iftstore.get( sha1( chunks[11] ) ) == chunks[11], "Got the wrong chunk after a restart"
+
+# senders' chunk files are shared with the store (and so with each other)
+assert iftstore.startup( store_dir, 1024 * chunksize ) == 0, "Could not restart the store"
+store = iftstore.get_store()
+send_dir = "/tmp/test_iftstore_send/"
+os.system( "rm -rf " + send_dir + "; mkdir -p " + send_dir )
+iftfile.startup( send_dir + "chunks/", None )
+common = os.urandom( 3 * chunksize )
+first = common + os.urandom( 2 * chunksize )
+second = os.urandom( chunksize ) + common
+for (name, data) in [("first", first), ("second", second)]:
+	fd = open( send_dir + name, "wb" )
+	fd.write( data )
+	fd.close()
+
+rc, first_hash, first_hashes, first_paths = iftfile.make_chunks( send_dir + "first", chunksize )
+assert rc == 0, "Could not chunk the first file"
+rc, second_hash, second_hashes, second_paths = iftfile.make_chunks( send_dir + "second", chunksize )
+assert rc == 0, "Could not chunk the second file"
+for i in xrange(0, 3):
+	assert os.stat( first_paths[i] ).st_ino == os.stat( second_paths[i + 1] ).st_ino, "Common chunk " + str(i) + " is stored twice"
+	assert os.stat( first_paths[i] ).st_ino == os.stat( store.path( first_hashes[i] ) ).st_ino, "Chunk " + str(i) + " is not in the store"
+	fd = open( second_paths[i + 1], "rb" )
+	assert fd.read() == common[i * chunksize : (i + 1) * chunksize], "Shared chunk " + str(i) + " is wrong"
+	fd.close()
+
+# chunks that a sender's chunk directory links to are not evicted (that would free nothing),
+# and the store doesn't go looking for chunks to evict when there aren't enough to be worth it
+class counting_os:
+	def __init__( self ):
+		self.stats = 0
+
+	def __getattr__( self, name ):
+		return getattr( os, name )
+
+	def stat( self, path ):
+		self.stats += 1
+		return os.stat( path )
+
+assert iftstore.stats()["pinned_bytes"] >= 6 * chunksize, "Linked chunks are not pinned: " + str(iftstore.stats())
+store.max_bytes = chunksize
+iftstore.put( sha1( "evict" ), "evict" )      # evicts the chunks that aren't pinned
+iftstore.os = counting_os()
+for i in xrange(0, 10):
+	iftstore.put( sha1( "evict" + str(i) ), "evict" + str(i) )
+assert iftstore.os.stats == 0, "Looked for chunks to evict " + str(iftstore.os.stats) + " times with nearly all of them pinned"
+iftstore.os = os
+assert store.has( first_hashes[0] ), "Evicted a chunk a sender links to"
+
+# a receiver takes what it can from the store, receives the rest, and stores those too
+store.max_bytes = 1024 * chunksize
+filename = "/tmp/test_iftstore_recv"
+new = first[0 : 4 * chunksize] + os.urandom( 3 * chunksize ) + "tail"
+new_chunks = [new[i : i + chunksize] for i in xrange(0, len(new), chunksize)]
+new_hashes = [sha1( c ) for c in new_chunks]
+file_attrs = {iftfile.JOB_ATTR_CHUNKSIZE:chunksize, iftfile.JOB_ATTR_FILE_SIZE:len(new), iftfile.JOB_ATTR_CHUNK_HASHES:new_hashes}
+
+ift_file = iftfile.iftfile( filename )
+assert ift_file.fopen( file_attrs, iftfile.MODE_WRITE ) == 0, "Could not open file"
+assert iftstore.stats()["referenced"] == len(set( new_hashes )), "File does not reference its chunks"
+job = stand_in_job( {iftfile.JOB_ATTR_IFTFILE:ift_file,
+                     iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+                     iftfile.JOB_ATTR_CHUNK_HASHES:new_hashes,
+                     iftfile.JOB_ATTR_CHUNK_TIMEOUT:0.5,
+                     iftfile.JOB_ATTR_REMOTE_IFTD:True,
+                     iftfile.JOB_ATTR_SRC_CHUNK_DIR:"/tmp",
+                     iftfile.JOB_ATTR_SRC_NAME:"source",
+                     iftfile.JOB_ATTR_DEST_NAME:filename} )
+
+receiver = memory_receiver( new_chunks )
+assert receiver.on_start( job, {} ) == 0, "Could not start receiving"
+assert receiver.run( 0 ) == PROTO_MSG_END, "Receiving did not end"
+assert sorted( receiver.received ) == range(4, len(new_chunks)), "Received " + str(sorted( receiver.received ))
+assert ift_file.is_complete(), "File is not complete"
+assert ift_file.fclose() == 0, "Could not close file"
+assert iftstore.stats()["referenced"] == 0, "Closed file still references its chunks"
+
+fd = open( filename, "rb" )
+assert fd.read() == new, "File contents are wrong"
+fd.close()
+
+for h in new_hashes:
+	assert store.has( h ), "Received chunk was not stored"
+
+# the same file again comes entirely from the store
+ift_file = iftfile.iftfile( filename )
+assert ift_file.fopen( file_attrs, iftfile.MODE_WRITE ) == 0, "Could not open file"
+job.attrs[ iftfile.JOB_ATTR_IFTFILE ] = ift_file
+receiver = memory_receiver( new_chunks )
+assert receiver.on_start( job, {} ) == 0, "Could not start receiving"
+assert receiver.run( 0 ) == PROTO_MSG_END, "Receiving did not end"
+assert receiver.received == [], "Received " + str(receiver.received)
+assert ift_file.is_complete(), "File is not complete"
+assert ift_file.fclose() == 0, "Could not close file"
+
+fd = open( filename, "rb" )
+assert fd.read() == new, "File contents are wrong"
+fd.close()
+
+# once the senders' chunk directories are gone, their chunks can be evicted
+store.max_bytes = 2 * chunksize
+iftfile.cleanup_chunks_dir( send_dir + "first", first_hash )
+iftfile.cleanup_chunks_dir( send_dir + "second", second_hash )
+assert iftstore.stats()["pinned_bytes"] == 0, "Chunks are still pinned: " + str(iftstore.stats())
+assert iftstore.stats()["bytes"] <= 2 * chunksize, "Store is over its cap: " + str(iftstore.stats())
+
+iftstore.startup( None )
+os.remove( filename )
+os.system( "rm -rf " + store_dir + " " + send_dir )
+print "test_iftstore passed"
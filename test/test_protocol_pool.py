@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import sys
+import copy
+import time
+
+sys.path.append( "../" )
+
+import iftapi
+import iftevent
+import iftcore
+from iftcore.consts import *
+from iftdata import *
+import ifttransfer
+
+# set up vanilla instances, as iftd_setup does
+for (package, name) in [("protocols.iftsocket", "iftsocket_sender"), ("protocols.iftsocket", "iftsocket_receiver"), ("protocols.http", "http_sender")]:
+	rc, proto = iftapi.config_protocol( package, name, {PROTO_PORTNUM:0} )
+	assert rc == 0, "Could not set up " + name
+	iftapi.PROTOCOLS[ proto.name ] = proto
+
+pool = iftapi.protocol_pool( 2 )
+iftapi.PROTOCOL_POOL = pool
+
+# with nothing idle, the vanilla instance is cloned
+sender = iftapi.clone_protocol( "iftsocket_sender" )
+assert sender is not iftapi.PROTOCOLS["iftsocket_sender"] and sender.name == "iftsocket_sender", "Vanilla instance was not cloned"
+assert pool.stats()["misses"] == 1, "Miss not counted"
+
+# a cleaned instance is reset, kept, and checked out again
+watcher = iftevent.waiter()
+sender.state_changed.subscribe( watcher )
+sender.post_msg( PROTO_MSG_USER, PROTO_STATE_RUNNING )
+sender.last_error = E_NO_CONNECT
+sender.clean()
+assert pool.checkin( sender ), "Cleaned instance was not kept"
+assert len(sender.msg_queue) == 0 and sender.last_error == 0 and sender.get_transmit_state() == TRANSMIT_STATE_DEAD, "Instance was not reset"
+watcher.wait( 0 )
+sender.state_changed.fire()
+assert not watcher.wait( 0 ), "Last transfer's watchers were kept"
+assert iftapi.clone_protocol( "iftsocket_sender" ) is sender, "Idle instance was not reused"
+assert pool.stats()["hits"] == 1, "Hit not counted"
+
+# running instances, vanilla instances, unknown protocols and protocols that can't be reset are not kept
+running = iftapi.clone_protocol( "iftsocket_sender" )
+running.set_state( PROTO_STATE_RUNNING )
+assert not pool.checkin( running ), "Running instance was kept"
+assert not pool.checkin( iftapi.PROTOCOLS["iftsocket_sender"] ), "Vanilla instance was kept"
+
+class unresettable( iftcore.iftsender.sender ):
+	def __init__( self ):
+		iftcore.iftsender.sender.__init__( self )
+		self.name = "unresettable_sender"
+
+iftapi.PROTOCOLS["unresettable_sender"] = unresettable()
+assert not pool.checkin( unresettable() ), "Instance that can't be reset was kept"
+del iftapi.PROTOCOLS["unresettable_sender"]
+
+# no more than max_idle of each protocol are kept
+spares = [iftapi.clone_protocol( "iftsocket_sender" ) for i in xrange(0, 3)]
+kept = [pool.checkin( spare ) for spare in spares]
+assert kept == [True, True, False], "Pool was not bounded: " + str(kept)
+assert pool.stats()["idle"]["iftsocket_sender"] == 2, "Wrong idle count " + str(pool.stats())
+pool.clear()
+assert pool.stats()["idle"] == {}, "Pool was not cleared"
+
+# http senders can be cloned, and share the vanilla instance's server
+http = iftapi.clone_protocol( "http_sender" )
+assert http.http_server is iftapi.PROTOCOLS["http_sender"].http_server, "HTTP server was not shared"
+
+# a receiver that ran until told to end goes back to the pool
+receiver = iftapi.clone_protocol( "iftsocket_receiver" )
+receiver.post_msg( PROTO_MSG_END, None )
+ifttransfer.run_protocol( receiver, -1, pool.checkin )
+assert pool.stats()["idle"].get( "iftsocket_receiver" ) == 1, "Ended receiver was not given back " + str(pool.stats())
+assert iftapi.clone_protocol( "iftsocket_receiver" ) is receiver, "Ended receiver was not reused"
+
+# one that was terminated does not
+receiver.post_msg( PROTO_MSG_TERM, None )
+ifttransfer.run_protocol( receiver, -1, pool.checkin )
+assert pool.stats()["idle"].get( "iftsocket_receiver" ) == 0, "Terminated receiver was given back"
+
+iftapi.PROTOCOLS["http_sender"].http_server.server_close()
+
+print "test_protocol_pool passed"
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import hashlib
+import threading
+
+sys.path.append( "../" )
+
+import iftfile
+import iftutil
+import iftcore
+from iftcore import *
+import iftcore.iftreceiver
+from iftcore.iftreceiver import receive_pipeline
+from iftcore.consts import *
+from iftdata import *
+from stand_ins import stand_in_job
+
+class memory_receiver( iftcore.iftreceiver.receiver ):
+	# a receiver whose network is a list of chunks in memory
+	def __init__( self, chunks, corrupt ):
+		iftcore.iftreceiver.receiver.__init__( self )
+		self.name = "memory_receiver"
+		self.chunks = chunks
+		self.corrupt = set( corrupt )
+		self.requests = []
+		self.set_chunking_mode( PROTO_DETERMINISTIC_CHUNKING )
+
+	def recv_chunks( self, remote_chunk_dir, desired_chunks ):
+		self.requests.append( list(desired_chunks) )
+		for i in desired_chunks:
+			if i in self.corrupt:
+				# arrives damaged the first time
+				self.corrupt.remove( i )
+				self.add_chunk( i, "x" * len(self.chunks[i]) )
+			else:
+				self.add_chunk( i, self.chunks[i] )
+		return 0
+
+class bulk_receiver( memory_receiver ):
+	# answers the first request with every chunk, and notes how much was on disk before it returned
+	def recv_chunks( self, remote_chunk_dir, desired_chunks ):
+		self.requests.append( list(desired_chunks) )
+		if len(self.requests) > 1:
+			return 0
+		for i in xrange(0, len(self.chunks)):
+			self.add_chunk( i, self.chunks[i] )
+		self.written_early = self.ift_job.get_attr( iftfile.JOB_ATTR_IFTFILE ).progress()[0]
+		return 0
+
+filename = "/tmp/test_receive_pipeline"
+chunksize = 10000
+chunks = [os.urandom( chunksize ) for i in xrange(0, 200)]
+data = "".join( chunks )
+
+def receive( corrupt, receiver_class=memory_receiver ):
+	ift_file = iftfile.iftfile( filename )
+	assert ift_file.fopen( {iftfile.JOB_ATTR_CHUNKSIZE:chunksize, iftfile.JOB_ATTR_FILE_SIZE:len(data)}, iftfile.MODE_WRITE ) == 0, "Could not open file"
+	job = stand_in_job( {iftfile.JOB_ATTR_IFTFILE:ift_file,
+	                     iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+	                     iftfile.JOB_ATTR_CHUNK_HASHES:[hashlib.sha1( c ).hexdigest() for c in chunks],
+	                     iftfile.JOB_ATTR_CHUNK_TIMEOUT:0.5,
+	                     iftfile.JOB_ATTR_REMOTE_IFTD:True,
+	                     iftfile.JOB_ATTR_SRC_CHUNK_DIR:"/tmp",
+	                     iftfile.JOB_ATTR_SRC_NAME:"source",
+	                     iftfile.JOB_ATTR_DEST_NAME:filename} )
+
+	receiver = receiver_class( chunks, corrupt )
+	assert receiver.on_start( job, {} ) == 0, "Could not start receiving"
+	assert (receiver.pipeline != None) == iftcore.iftreceiver.RECEIVE_PIPELINE, "Wrong pipeline"
+	rc = receiver.run( 0 )
+	assert rc == PROTO_MSG_END, "Receiving did not end (" + str(rc) + ")"
+	assert receiver.pipeline == None, "Pipeline was not cleaned up"
+	assert ift_file.is_complete(), "File is not complete"
+	assert ift_file.fclose() == 0, "Could not close file"
+
+	fd = open( filename, "rb" )
+	assert fd.read() == data, "File contents are wrong"
+	fd.close()
+	os.remove( filename )
+	return receiver
+
+# received chunks are verified and written on the worker pools, and damaged ones are asked for again
+verified = iftutil.VerifyThreadPool.stats()["completed"]
+written = iftutil.WriteThreadPool.stats()["completed"]
+receiver = receive( [3, 150] )
+assert iftutil.VerifyThreadPool.stats()["completed"] > verified, "Nothing was verified on the verify pool"
+assert iftutil.WriteThreadPool.stats()["completed"] > written, "Nothing was written on the write pool"
+asked = sum( receiver.requests, [] )
+assert asked.count( 3 ) == 2 and asked.count( 150 ) == 2, "Damaged chunks were not asked for again"
+
+# without the pipeline, the same transfer is done on the protocol's thread
+iftcore.iftreceiver.RECEIVE_PIPELINE = False
+verified = iftutil.VerifyThreadPool.stats()["submitted"]
+receive( [7] )
+assert iftutil.VerifyThreadPool.stats()["submitted"] == verified, "Verified on the pool without the pipeline"
+
+# a big request goes to disk while it is still arriving, instead of piling up in memory
+iftcore.iftreceiver.RECEIVE_BATCH_MAX_BYTES = 10 * chunksize
+receiver = receive( [], bulk_receiver )
+assert receiver.written_early >= len(chunks) - 10, "Only " + str(receiver.written_early) + " chunks were written while the request arrived"
+iftcore.iftreceiver.RECEIVE_PIPELINE = True
+receive( [], bulk_receiver )
+iftcore.iftreceiver.RECEIVE_BATCH_MAX_BYTES = 4 * 1024 * 1024
+
+# the pipeline pushes back on the network stage once it holds too much data
+gate = threading.Event()
+woken = []
+written = []
+
+def slow_write( table ):
+	gate.wait()
+	written.extend( table.keys() )
+	return (0, 0)
+
+pipeline = receive_pipeline( lambda table: table, slow_write, lambda: woken.append( 1 ), 2 * chunksize )
+pipeline.put( {0:chunks[0]} )
+pipeline.put( {1:chunks[1]} )
+t = threading.Thread( target=pipeline.put, args=({2:chunks[2]},) )
+t.start()
+time.sleep( 0.2 )
+assert t.isAlive(), "Network stage was not held back"
+assert pipeline.pending() == (2, 2 * chunksize), "Wrong pending data " + str(pipeline.pending())
+gate.set()
+t.join( 5 )
+pipeline.drain()
+assert sorted(written) == [0, 1, 2] and len(woken) == 3, "Batches did not all finish"
+assert pipeline.pending() == (0, 0) and pipeline.take_error() == (0, 0), "Pipeline is not empty"
+
+# a batch bigger than the limit still goes through
+pipeline.put( {3:chunks[3], 4:chunks[4], 5:chunks[5]} )
+pipeline.drain()
+assert sorted(written) == range(0, 6), "Big batch did not go through"
+
+# recoverable errors are reported once; fatal ones stick
+errors = [(PROTO_MSG_ERROR, E_TRY_AGAIN)]
+pipeline = receive_pipeline( lambda table: table, lambda table: errors.pop( 0 ), lambda: None )
+pipeline.put( {0:chunks[0]} )
+pipeline.drain()
+assert pipeline.take_error() == (PROTO_MSG_ERROR, E_TRY_AGAIN), "Recoverable error was not reported"
+assert pipeline.take_error() == (0, 0), "Recoverable error was reported twice"
+errors.append( (PROTO_MSG_ERROR_FATAL, E_IOERROR) )
+pipeline.put( {0:chunks[0]} )
+pipeline.drain()
+assert pipeline.take_error() == (PROTO_MSG_ERROR_FATAL, E_IOERROR) and pipeline.take_error() == (PROTO_MSG_ERROR_FATAL, E_IOERROR), "Fatal error did not stick"
+
+# chunks that fail verification are not written
+written = []
+pipeline = receive_pipeline( lambda table: {}, lambda table: written.append( table ), lambda: None )
+pipeline.put( {0:chunks[0]} )
+pipeline.drain()
+assert written == [], "Unverified chunks were written"
+
+# aborting drops what hasn't been written yet
+gate.clear()
+written = []
+pipeline = receive_pipeline( lambda table: gate.wait() or table, lambda table: written.append( table ), lambda: None )
+pipeline.put( {0:chunks[0]} )
+t = threading.Thread( target=pipeline.drain, args=(True,) )
+t.start()
+time.sleep( 0.1 )
+gate.set()
+t.join( 5 )
+assert not t.isAlive() and pipeline.pending() == (0, 0), "Abort did not drain"
+assert written == [], "Aborted batch was written"
+
+print "test_receive_pipeline passed"
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import signal
+import socket
+import hashlib
+import threading
+import subprocess
+
+sys.path.append( "../" )
+
+import iftfile
+import iftjournal
+import iftcore
+from iftcore import *
+from iftcore.consts import *
+import protocols.http
+from iftdata import *
+from stand_ins import stand_in_job
+
+class slow_server:
+	# serves byte ranges of data over HTTP/1.1, a piece at a time
+	def __init__( self, data, piece, delay ):
+		self.data = data
+		self.piece = piece
+		self.delay = delay
+		self.ranges = []
+		self.soc = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+		self.soc.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+		self.soc.bind( ("127.0.0.1", 0) )
+		self.soc.listen( 16 )
+		self.port = self.soc.getsockname()[1]
+		t = threading.Thread( target=self.accept_loop )
+		t.setDaemon( True )
+		t.start()
+
+	def accept_loop( self ):
+		while True:
+			soc, addr = self.soc.accept()
+			t = threading.Thread( target=self.serve, args=(soc,) )
+			t.setDaemon( True )
+			t.start()
+
+	def serve( self, soc ):
+		try:
+			f = soc.makefile( "rb" )
+			while len(f.readline()) > 0:
+				byte_range = None
+				while True:
+					line = f.readline().strip()
+					if len(line) == 0:
+						break
+					if line.lower().startswith( "range:" ):
+						first, last = line.split( "=" )[1].split( "-" )
+						byte_range = (int(first), int(last))
+
+				self.ranges.append( byte_range )
+				if byte_range == None:
+					first, last = (0, len(self.data) - 1)
+					soc.sendall( "HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(self.data) )
+				else:
+					first, last = byte_range
+					soc.sendall( "HTTP/1.1 206 Partial Content\r\nContent-Range: bytes %d-%d/%d\r\nContent-Length: %d\r\n\r\n" % (first, last, len(self.data), last - first + 1) )
+				for offset in xrange(first, last + 1, self.piece):
+					soc.sendall( self.data[offset : min(offset + self.piece, last + 1)] )
+					time.sleep( self.delay )
+		except socket.error:
+			pass    # the receiver went away
+		soc.close()
+
+filename = "/tmp/test_resume_transfer"
+journal_dir = "/tmp/test_resume_transfer_journal/"
+chunksize = 2048
+num_chunks = 400
+data = "".join( [hashlib.sha1( str(i) ).digest() for i in xrange(0, num_chunks * chunksize / 20)] )[0 : (num_chunks - 1) * chunksize + 100]     # the same in both processes
+chunk_hashes = [hashlib.sha1( data[i * chunksize : (i + 1) * chunksize] ).hexdigest() for i in xrange(0, num_chunks)]
+
+file_attrs = {
+	iftfile.JOB_ATTR_CHUNKSIZE:chunksize,
+	iftfile.JOB_ATTR_FILE_SIZE:len(data),
+	iftfile.JOB_ATTR_FILE_HASH:hashlib.sha1( data ).hexdigest(),
+	iftfile.JOB_ATTR_CHUNK_HASHES:chunk_hashes
+}
+
+def receive( port ):
+	# receive the file over HTTP, picking up whatever an earlier attempt left behind.
+	# return what we had at the start, as [first, last] runs of chunks
+	ift_file = iftfile.acquire_iftfile_recv( "test", filename, dict(file_attrs) )
+	assert ift_file != None, "Could not open file"
+	had = ift_file.written_chunk_runs()
+
+	attrs = dict(file_attrs)
+	attrs.update( {iftfile.JOB_ATTR_IFTFILE:ift_file,
+	               iftfile.JOB_ATTR_CHUNK_TIMEOUT:5,
+	               iftfile.JOB_ATTR_REMOTE_IFTD:True,
+	               iftfile.JOB_ATTR_SRC_HOST:"127.0.0.1",
+	               iftfile.JOB_ATTR_SRC_CHUNK_DIR:"/tmp",
+	               iftfile.JOB_ATTR_SRC_NAME:"/test_resume_transfer",
+	               iftfile.JOB_ATTR_DEST_NAME:filename,
+	               PROTO_PORTNUM:port} )
+
+	receiver = protocols.http.http_receiver()
+	assert receiver.on_start( stand_in_job( attrs ), {PROTO_PORTNUM:port, protocols.http.HTTP_CONNECTIONS:1} ) == 0, "Could not start receiving"
+	rc = receiver.run( 0 )
+	assert rc == PROTO_MSG_END, "Receiving did not end (" + str(rc) + ")"
+	assert ift_file.is_complete(), "File is not complete"
+	assert ift_file.calc_hash() == file_attrs[ iftfile.JOB_ATTR_FILE_HASH ], "File hash is wrong"
+	assert iftfile.release_iftfile_recv( "test", filename ) == 0, "Could not close file"
+	return had
+
+iftjournal.startup( journal_dir )
+
+if len(sys.argv) > 2 and sys.argv[1] == "receive":
+	# the receiver that gets killed
+	receive( int(sys.argv[2]) )
+	sys.exit(0)
+
+os.system( "rm -rf " + journal_dir + "*" )
+if os.path.exists( filename ):
+	os.remove( filename )
+
+log_path = iftjournal.journal_path( filename ) + ".log"
+
+# kill a receiver partway through
+server = slow_server( data, chunksize, 0.002 )
+child = subprocess.Popen( [sys.executable, sys.argv[0], "receive", str(server.port)], stdout=open( os.devnull, "w" ) )
+deadline = time.time() + 60
+while time.time() < deadline and child.poll() == None:
+	if os.path.exists( log_path ) and os.path.getsize( log_path ) >= 100 * iftjournal.RECORD_SIZE:
+		break
+	time.sleep( 0.01 )
+
+assert child.poll() == None, "Receiver finished before it could be killed (rc = " + str(child.returncode) + ")"
+os.kill( child.pid, signal.SIGKILL )
+child.wait()
+
+j = iftjournal.journal( iftjournal.journal_path( filename ), iftjournal.read_header( iftjournal.journal_path( filename ) ) )
+logged = [chunk_id for (chunk_id, digest) in j.chunks()]
+assert len(logged) >= 100 and len(logged) < num_chunks, "Journal has " + str(len(logged)) + " chunks"
+
+# one logged chunk's data didn't make it to disk, and the last record was cut short
+damaged = logged[ len(logged) / 2 ]
+fd = open( filename, "r+b" )
+fd.seek( damaged * chunksize )
+fd.write( "x" * chunksize )
+fd.close()
+
+fd = open( log_path, "ab" )
+fd.write( "\0" * (iftjournal.RECORD_SIZE / 2) )
+fd.close()
+
+# start again:  only the good chunks are kept, and only the rest are asked for
+server.ranges = []
+server.delay = 0
+had = receive( server.port )
+kept = sum( [range(first, last + 1) for (first, last) in had], [] )
+assert sorted( kept ) == sorted( [i for i in logged if i != damaged] ), "Kept the wrong chunks"
+
+asked = set()
+for byte_range in server.ranges:
+	if byte_range == None:
+		continue
+	(first, last) = byte_range
+	asked.update( xrange(first / chunksize, last / chunksize + 1) )
+assert asked.isdisjoint( kept ), "Asked again for chunks we had"
+assert damaged in asked, "Did not ask again for the damaged chunk"
+assert len(asked) + len(kept) == num_chunks, "Asked for " + str(len(asked)) + " chunks, but had " + str(len(kept))
+
+fd = open( filename, "rb" )
+assert fd.read() == data, "File contents are wrong"
+fd.close()
+
+# a finished file leaves no journal behind
+assert not os.path.exists( log_path ) and iftjournal.list_journals() == [], "Journal was not removed"
+
+# a journal for some other version of the file is not picked up
+ift_file = iftfile.acquire_iftfile_recv( "test", filename, dict(file_attrs) )
+ift_file.set_chunk( data[0:chunksize], 0 )
+assert iftfile.release_iftfile_recv( "test", filename ) == 0, "Could not close file"
+assert len(iftjournal.list_journals()) == 1, "Incomplete file has no journal"
+
+other_attrs = dict(file_attrs)
+other_attrs[ iftfile.JOB_ATTR_FILE_HASH ] = "0" * 40
+ift_file = iftfile.acquire_iftfile_recv( "test", filename, other_attrs )
+assert ift_file.progress()[0] == 0, "Picked up a different file"
+ift_file.discard_journal()
+assert iftfile.release_iftfile_recv( "test", filename ) == 0, "Could not close file"
+assert iftjournal.list_journals() == [], "Discarded journal is still there"
+
+os.remove( filename )
+os.system( "rm -rf " + journal_dir )
+print "test_resume_transfer passed"
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import threading
+
+sys.path.append( "../" )
+
+import ifttransfer
+from iftcore.consts import *
+from iftdata import *
+
+class scripted_sender:
+	# stands in for a connected active sender; takes delay seconds per chunk
+	def __init__( self, name, delay, fail=False, die_after=None ):
+		self.name = name
+		self.delay = delay
+		self.fail = fail
+		self.die_after = die_after
+		self.sent = []
+		self.lock = threading.Lock()
+
+	def send_one_chunk( self, chunk, chunk_id, chunk_path, remote_chunk_path ):
+		time.sleep( self.delay )
+		if self.fail:
+			return E_NO_CONNECT
+		if self.die_after != None and len(self.sent) >= self.die_after:
+			raise Exception("connection lost")
+		self.sent.append( chunk_id )
+		return len(chunk)
+
+def chunks( n ):
+	return [["x" * 100, i, None, None] for i in xrange(0, n)]
+
+core = ifttransfer.TransferCore
+
+# a faster sender sends more of the file, and every chunk is sent once
+fast = scripted_sender( "fast", 0.001 )
+slow = scripted_sender( "slow", 0.004 )
+rc = core.stripe_send( [fast, slow], chunks( 600 ), 3 )
+assert rc == TRANSMIT_STATE_SUCCESS, "Striping failed"
+assert sorted( fast.sent + slow.sent ) == range(0, 600), "Chunks were not each sent once"
+assert len(fast.sent) > 2 * len(slow.sent), "Fast sender sent " + str(len(fast.sent)) + " chunks, slow sender sent " + str(len(slow.sent))
+
+# chunks a sender fails to send are sent by another
+good = scripted_sender( "good", 0.0 )
+bad = scripted_sender( "bad", 0.0, fail=True )
+rc = core.stripe_send( [bad, good], chunks( 100 ), 3 )
+assert rc == TRANSMIT_STATE_SUCCESS, "Did not recover from a failing sender"
+assert sorted( good.sent ) == range(0, 100), "Good sender did not send everything"
+
+# so are chunks a sender took before it died
+good = scripted_sender( "good", 0.001 )
+dying = scripted_sender( "dying", 0.0, die_after=10 )
+rc = core.stripe_send( [dying, good], chunks( 200 ), 3 )
+assert rc == TRANSMIT_STATE_SUCCESS, "Did not recover from a dying sender"
+assert sorted( dying.sent + good.sent ) == range(0, 200), "Chunks were lost when a sender died"
+
+# nobody can send
+rc = core.stripe_send( [scripted_sender( "bad1", 0.0, fail=True ), scripted_sender( "bad2", 0.0, fail=True )], chunks( 10 ), 3 )
+assert rc == TRANSMIT_STATE_FAILURE, "Succeeded without sending anything"
+
+print "test_stripe_send passed"
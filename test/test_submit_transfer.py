@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import threading
+
+sys.path.append( "../" )
+
+import iftfile
+import iftevent
+import iftstats
+import iftapi
+from ifttransfer import TransferCore
+from iftcore.consts import *
+from iftdata import *
+from stand_ins import stand_in_job
+
+iftstats.RETRAIN_FREQ = 0
+
+class stand_in_receiver:
+	# stands in for a running receiver protocol
+	def __init__( self, name ):
+		self.name = name
+		self.messages = []
+		self.transmit_state = TRANSMIT_STATE_CHUNKS
+		self.state_changed = iftevent.event()
+
+	def post_msg( self, msg_type, msg_params ):
+		self.messages.append( msg_type )
+		if msg_type == PROTO_MSG_END:
+			self.transmit_state = TRANSMIT_STATE_DEAD
+			self.state_changed.fire()
+
+	def run( self, niceness ):
+		pass
+
+	def get_transmit_state( self ):
+		return self.transmit_state
+
+	def get_connection_attrs( self ):
+		return None
+
+class slow_sender:
+	# stands in for a connected active sender
+	name = "slow_sender"
+
+	def __init__( self ):
+		self.sent = 0
+
+	def send_one_chunk( self, chunk, chunk_id, chunk_path, remote_chunk_path ):
+		time.sleep( 0.02 )
+		self.sent += 1
+		return len(chunk)
+
+	def clean( self ):
+		pass
+
+class stand_in_peer:
+	# stands in for the control_client to the other iftd
+	def __init__( self ):
+		self.cancelled = []
+
+	def cancel_iftd_transfer( self, xmit_id ):
+		self.cancelled.append( xmit_id )
+
+scripts = {}
+
+def run_ift( job_attrs, connect_dict, sender, receiver, iftd_remote_port, iftd_xmlrpc_path, user_timeout, transfer=None ):
+	# stands in for run_ift:  each job attribute dictionary names a scripted transfer
+	return scripts[ job_attrs["script"] ]( transfer )
+
+iftapi.run_ift = run_ift
+
+# a receive in progress reports its progress, and cancelling it ends its protocols and removes what it received
+recv_path = "/tmp/test_submit_transfer_recv"
+recv_file = iftfile.iftfile( recv_path )
+assert recv_file.fopen( {iftfile.JOB_ATTR_CHUNKSIZE:100, iftfile.JOB_ATTR_FILE_SIZE:1000}, iftfile.MODE_WRITE ) == 0, "Could not open file"
+for chunk_id in xrange(0, 3):
+	assert recv_file.set_chunk( "x" * 100, chunk_id ) == 0, "Could not write chunk " + str(chunk_id)
+recv_job = stand_in_job( {iftfile.JOB_ATTR_FILE_SIZE:1000, iftfile.JOB_ATTR_DEST_NAME:recv_path, iftfile.JOB_ATTR_IFTFILE:recv_file} )
+receiver = stand_in_receiver( "stand_in_receiver" )
+
+def receive( transfer ):
+	transfer.job = recv_job
+	assert TransferCore.begin_ift_recv( "recv1", recv_job, [receiver], False, -1, 0.5, 60 ) == 0, "Could not begin receiving"
+	if not transfer.started( "recv1", stand_in_peer() ):
+		return E_CANCELLED
+	return TransferCore.run_ift_recv( "recv1", None )
+
+scripts["receive"] = receive
+
+handle = iftapi.submit_ift( {"script":"receive"}, None, False, True )
+time.sleep( 0.3 )
+status = iftapi.ift_status( handle )
+assert status["state"] == iftapi.TRANSFER_RUNNING, "Wrong state " + str(status)
+assert status["chunks_done"] == 3 and status["chunks_total"] == 10, "Wrong chunk counts " + str(status)
+assert status["bytes_done"] == 300 and status["bytes_total"] == 1000, "Wrong byte counts " + str(status)
+assert status["protocols"] == ["stand_in_receiver"], "Wrong protocols " + str(status)
+assert status["eta"] != None and status["eta"] > 0, "No ETA " + str(status)
+assert status["file"] == recv_path, "Wrong file " + str(status)
+
+start = time.time()
+assert iftapi.cancel_ift( handle ) == 0, "Could not cancel"
+status = iftapi.wait_ift( handle, 5 )
+assert time.time() - start < 1, "Cancelling took " + str(time.time() - start) + " seconds"
+assert status["state"] == iftapi.TRANSFER_CANCELLED and status["rc"] == E_CANCELLED, "Wrong status after cancelling " + str(status)
+assert PROTO_MSG_END in receiver.messages, "Receiver was not ended"
+assert status["protocols"] == [], "Protocols still running " + str(status)
+assert not os.path.exists( recv_path ), "Partially received file was left behind"
+assert recv_file.fclose() == 0, "Could not close file"
+assert iftapi.cancel_ift( handle ) == E_BAD_STATE, "Cancelled a finished transfer"
+
+# a send in progress stops sending once cancelled, and tells the receiving iftd
+sender = slow_sender()
+peer = stand_in_peer()
+send_job = stand_in_job( {iftfile.JOB_ATTR_FILE_SIZE:200 * 100, iftfile.JOB_ATTR_SRC_NAME:"/tmp/send_file"} )
+
+def send( transfer ):
+	transfer.job = send_job
+	TransferCore.begin_ift_send( "send1", send_job, [["x" * 100, i, None, None] for i in xrange(0, 200)], 1.0, {} )
+	TransferCore.add_receiver_ack( "send1" )
+	if not transfer.started( "send1", peer ):
+		return E_CANCELLED
+	rc, receiver_rc = TransferCore.run_ift_send_active( "send1", send_job, [sender], 60 )
+	return rc
+
+scripts["send"] = send
+
+handle = iftapi.submit_ift( {"script":"send"}, None, True, False )
+time.sleep( 0.5 )
+status = iftapi.ift_status( handle )
+assert status["state"] == iftapi.TRANSFER_RUNNING, "Wrong state " + str(status)
+assert status["chunks_done"] > 0 and status["chunks_total"] == 200, "Wrong chunk counts " + str(status)
+assert status["bytes_done"] == status["chunks_done"] * 100, "Wrong byte count " + str(status)
+assert status["protocols"] == ["slow_sender"], "Wrong protocols " + str(status)
+
+start = time.time()
+assert iftapi.cancel_ift( handle ) == 0, "Could not cancel"
+status = iftapi.wait_ift( handle, 5 )
+assert time.time() - start < 1, "Cancelling took " + str(time.time() - start) + " seconds"
+assert status["state"] == iftapi.TRANSFER_CANCELLED, "Wrong status after cancelling " + str(status)
+assert sender.sent < 200, "Sender kept sending"
+assert peer.cancelled == ["send1"], "Receiving iftd was not told"
+
+# a transfer cancelled while negotiating never starts
+def negotiate( transfer ):
+	time.sleep( 0.3 )
+	if not transfer.started( "late1", peer ):
+		return E_CANCELLED
+	return 0
+
+scripts["negotiate"] = negotiate
+handle = iftapi.submit_ift( {"script":"negotiate"}, None, True, False )
+assert iftapi.ift_status( handle )["state"] == iftapi.TRANSFER_NEGOTIATING, "Not negotiating"
+assert iftapi.cancel_ift( handle ) == 0, "Could not cancel while negotiating"
+status = iftapi.wait_ift( handle, 5 )
+assert status["state"] == iftapi.TRANSFER_CANCELLED, "Cancelled negotiation went on " + str(status)
+
+# finished transfers report everything done, and waiting times out on running ones
+scripts["quick"] = lambda transfer: 0
+scripts["slow"] = lambda transfer: time.sleep( 0.5 ) or 0
+handle = iftapi.submit_ift( {"script":"slow"}, None, True, False )
+assert iftapi.wait_ift( handle, 0.1 )["state"] == iftapi.TRANSFER_NEGOTIATING, "Wait did not time out"
+assert iftapi.wait_ift( handle )["state"] == iftapi.TRANSFER_SUCCEEDED, "Wait did not wait"
+
+# only so many submitted transfers run at once; the rest wait their turn
+import iftutil
+iftutil.init_threadpools( 10, 10, num_submit_threads=2 )
+gate = threading.Event()
+running = []
+def held( transfer ):
+	running.append( transfer.handle )
+	gate.wait()
+	return 0
+
+scripts["held"] = held
+handles = [iftapi.submit_ift( {"script":"held"}, None, True, False ) for i in xrange(0, 5)]
+time.sleep( 0.3 )
+assert len(running) == 2, str(len(running)) + " submitted transfers ran at once"
+assert iftutil.SubmitThreadPool.stats()["queued"] == 3, "Extra transfers were not queued"
+gate.set()
+for handle in handles:
+	assert iftapi.wait_ift( handle, 5 )["state"] == iftapi.TRANSFER_SUCCEEDED, "Queued transfer did not run"
+
+# a protocol that starts a transfer of its own (e.g. iftcache on a miss) holds its
+# protocol worker, so that transfer's protocols run on the nested pool instead of waiting for it
+iftutil.init_threadpools( 10, 10, num_protocol_threads=1 )
+inner_ran = threading.Event()
+nested = []
+class inner_receiver( stand_in_receiver ):
+	def run( self, niceness ):
+		inner_ran.set()
+
+class outer_receiver( stand_in_receiver ):
+	def run( self, niceness ):
+		nested_job = stand_in_job( {iftfile.JOB_ATTR_FILE_SIZE:1000} )
+		nested.append( TransferCore.begin_ift_recv( "nested1", nested_job, [inner_receiver( "inner_receiver" )], False, -1, 0.5, 60 ) )
+		nested.append( inner_ran.wait( 5 ) )
+
+outer_job = stand_in_job( {iftfile.JOB_ATTR_FILE_SIZE:1000} )
+assert TransferCore.begin_ift_recv( "outer1", outer_job, [outer_receiver( "outer_receiver" )], False, -1, 0.5, 60 ) == 0, "Could not begin receiving"
+start = time.time()
+while len(nested) < 2 and time.time() - start < 10:
+	time.sleep( 0.05 )
+assert nested == [0, True], "Nested transfer's protocols did not run " + str(nested)
+assert iftutil.NestedThreadPool.stats()["completed"] == 1, "Nested transfer's protocols did not use the nested pool"
+TransferCore.cleanup_recv( "nested1" )
+TransferCore.cleanup_recv( "outer1" )
+
+assert iftapi.ift_status( "no such handle" ) == None, "Status for an unknown handle"
+assert iftapi.cancel_ift( "no such handle" ) == E_INVAL, "Cancelled an unknown handle"
+
+print "test_submit_transfer passed"
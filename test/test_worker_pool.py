@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import threading
+
+sys.path.append( "../" )
+
+import iftutil
+
+lock = threading.Lock()
+done = []
+running = [0, 0]
+thread_names = set()
+
+def short_transfer( i ):
+	lock.acquire()
+	running[0] += 1
+	running[1] = max( running[0], running[1] )
+	thread_names.add( threading.currentThread().getName() )
+	lock.release()
+	time.sleep( 0.0005 )
+	lock.acquire()
+	running[0] -= 1
+	done.append( i )
+	lock.release()
+
+# thousands of short tasks all run, on a few reused workers, with the queue pushing back on the submitter
+pool = iftutil.iftworkers( "load", 8, 16 )
+threads_before = threading.activeCount()
+count = 5000
+for i in xrange(0, count):
+	assert pool.start_new_thread( short_transfer, (i,) ), "Task " + str(i) + " was rejected"
+
+deadline = time.time() + 30
+while pool.stats()["completed"] < count and time.time() < deadline:
+	time.sleep( 0.01 )
+
+stats = pool.stats()
+assert sorted(done) == range(0, count), "Only " + str(len(done)) + " tasks ran"
+assert stats["submitted"] == count and stats["completed"] == count and stats["rejected"] == 0, "Wrong counts " + str(stats)
+assert running[1] <= 8, "Ran " + str(running[1]) + " tasks at once"
+assert len(thread_names) <= 8 and stats["workers"] <= 8, "Workers were not reused: " + str(len(thread_names)) + " threads"
+assert threading.activeCount() - threads_before <= 8, "Too many threads"
+assert stats["peak_queued"] <= 16, "Queue grew past its limit " + str(stats)
+assert stats["blocked"] > 0, "Submitter never waited for room " + str(stats)
+assert stats["busy"] == 0 and stats["queued"] == 0 and stats["idle"] == stats["workers"], "Pool not idle " + str(stats)
+assert stats["mean_wait"] > 0 and stats["max_wait"] >= stats["mean_wait"], "No queue wait recorded " + str(stats)
+
+# a full queue rejects non-blocking submissions, and blocking ones time out
+gate = threading.Event()
+small = iftutil.iftworkers( "small", 1, 2 )
+assert small.start_new_thread( gate.wait, () ), "Could not start the first task"
+time.sleep( 0.1 )
+assert small.start_new_thread( gate.wait, () ) and small.start_new_thread( gate.wait, () ), "Could not queue"
+stats = small.stats()
+assert stats["busy"] == 1 and stats["queued"] == 2 and stats["saturation"] == 1.0, "Wrong saturation " + str(stats)
+assert not small.start_new_thread( gate.wait, (), False ), "Queued past the limit"
+start = time.time()
+assert not small.start_new_thread( gate.wait, (), True, 0.2 ), "Queued past the limit after waiting"
+assert time.time() - start >= 0.2, "Did not wait for room"
+assert small.stats()["rejected"] == 2, "Rejections not counted"
+
+# a blocked submitter goes through once room is made
+queued = []
+t = threading.Thread( target=lambda: queued.append( small.start_new_thread( gate.wait, () ) ) )
+t.start()
+time.sleep( 0.1 )
+assert queued == [], "Submitter did not wait"
+gate.set()
+t.join( 5 )
+assert queued == [True], "Waiting submitter was not let in"
+
+# a pool knows its own workers
+inside = []
+assert small.start_new_thread( lambda: inside.append( (small.is_worker(), pool.is_worker()) ), () ), "Could not queue a task"
+time.sleep( 0.2 )
+assert inside == [(True, False)] and not small.is_worker(), "Pool did not know its workers " + str(inside)
+
+# failing tasks are counted and don't kill their worker
+def fail():
+	raise Exception( "task failed" )
+
+assert small.start_new_thread( fail, () ), "Could not queue a failing task"
+time.sleep( 0.2 )
+stats = small.stats()
+assert stats["failed"] == 1 and stats["workers"] == 1, "Failure was not contained " + str(stats)
+
+# shut down pools take no more work
+small.shutdown()
+pool.shutdown()
+assert not small.start_new_thread( gate.wait, () ), "Shut down pool took work"
+
+# the global pools report their metrics
+assert [s["name"] for s in iftutil.threadpool_stats()] == ["sender", "receiver", "protocol", "verify", "write", "submit", "nested"], "Wrong global pools"
+
+print "test_worker_pool passed"